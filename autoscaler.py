@@ -0,0 +1,398 @@
+"""
+
+Capacity autoscaler for the proxy pool.
+
+The pool is otherwise as large as the last `-P -N` made it. Autoscaler
+reads the smoothed HAProxy statistics of every active proxy - sessions
+(scur), queued requests (qcur) and response time (rtime) - and sizes
+the pool from them:
+
+    up   - when the sessions per server, the backend queue or the
+           response time stay above their upper bound for `sustain`
+           seconds, nodes are added in parallel by the provisioning
+           workers, in regions picked as for rotations
+    down - when the sessions per server stay below the lower bound with
+           nothing queued for `sustain_down` seconds, nodes are drained
+           and deleted, from the regions with the most proxies
+
+Each action sizes the pool for `target_sessions` per server from the
+sessions and queued requests seen, at most `max_step` nodes at a time,
+so a crawl window is met in one step rather than one node per cooldown.
+
+The pool is kept within min_nodes and max_nodes, and a scale action is
+only taken `cooldown_up` / `cooldown_down` seconds after the previous
+one, so that a new node's share of the load shows in the statistics
+before the next decision. Proxies being rotated or drained are never
+picked for removal.
+
+Settings come from the "autoscale" section of proxy.conf. Run with
+--simulate to replay days of synthetic crawl load through the decisions
+and compare with fixed pool sizes.
+
+"""
+
+import math
+import time
+import random
+import argparse
+import threading
+import collections
+
+import timing
+
+# Mean sessions per server, total queued requests, mean response time (ms)
+Load = collections.namedtuple('Load', ('nodes', 'sessions', 'queue', 'rtime'))
+
+class Autoscaler(object):
+    """ Grow and shrink the proxy pool from the LB load """
+
+    def __init__(self, records, stats, grow, shrink, ignore=None, min_nodes=2, max_nodes=16,
+                 high_sessions=20.0, low_sessions=5.0, target_sessions=15.0, max_queue=1.0,
+                 high_rtime=2000.0, sustain=300.0, sustain_down=900.0, cooldown_up=600.0,
+                 cooldown_down=1800.0, max_step=8, interval=30.0, clock=None, notify=None, verbose=True):
+        # Return the active proxy records
+        self.records = records
+        # Return the smoothed LB statistics of a proxy
+        self.stats_of = stats
+        # Called with a number of nodes to add, returning how many it did,
+        # and with a proxy IP to drain and delete, returning whether it did
+        self.grow = grow
+        self.shrink = shrink
+        # Return IPs not to remove, e.g. those being rotated out
+        self.ignore = ignore or (lambda: set())
+        self.min_nodes = min_nodes
+        self.max_nodes = max_nodes
+        self.high_sessions = high_sessions
+        self.low_sessions = low_sessions
+        self.target_sessions = target_sessions
+        self.max_queue = max_queue
+        self.high_rtime = high_rtime
+        self.sustain = sustain
+        self.sustain_down = sustain_down
+        self.cooldown_up = cooldown_up
+        self.cooldown_down = cooldown_down
+        self.max_step = max_step
+        self.interval = interval
+        self.clock = clock or time
+        self.notify = notify
+        self.verbose = verbose
+        # Since when the load has been above / below the bounds
+        self.high_since = None
+        self.low_since = None
+        # Times of the last scale actions
+        self.last_up = None
+        self.last_down = None
+        self.last = None
+        self.history = collections.deque(maxlen=100)
+        self.counters = collections.defaultdict(int)
+        self.wakeup = threading.Event()
+        self.running = False
+
+    @classmethod
+    def from_config(cls, config, grow, shrink, ignore=None, notify=None):
+        """ Create an autoscaler from the "autoscale" section of proxy.conf,
+        None if it is disabled """
+
+        settings = config.autoscale or {}
+        if not settings.get('enabled', False):
+            return None
+        return cls(config.get_active_proxies, config.get_proxy_stats, grow, shrink, ignore=ignore,
+                   min_nodes=int(settings.get('min_nodes', 2)),
+                   max_nodes=int(settings.get('max_nodes', 16)),
+                   high_sessions=float(settings.get('high_sessions', 20)),
+                   low_sessions=float(settings.get('low_sessions', 5)),
+                   target_sessions=float(settings.get('target_sessions', 15)),
+                   max_queue=float(settings.get('max_queue', 1)),
+                   high_rtime=float(settings.get('high_rtime', 2000)),
+                   sustain=float(settings.get('sustain', 300)),
+                   sustain_down=float(settings.get('sustain_down', 900)),
+                   cooldown_up=float(settings.get('cooldown_up', 600)),
+                   cooldown_down=float(settings.get('cooldown_down', 1800)),
+                   max_step=int(settings.get('max_step', 8)),
+                   interval=float(settings.get('interval', 30)),
+                   clock=config.clock, notify=notify)
+
+    def observe(self):
+        """ Return the Load of the pool, None if the LB has no statistics
+        for any of it yet """
+
+        records = self.records()
+        stats = [self.stats_of(record.ip) for record in records]
+        stats = [s for s in stats if s]
+        if not stats:
+            return None
+        return Load(len(records),
+                    sum(s.get('scur', 0) for s in stats) / len(stats),
+                    sum(s.get('qcur', 0) for s in stats),
+                    sum(s.get('rtime', 0) for s in stats) / len(stats))
+
+    def decide(self, load, now):
+        """ Return (nodes to add, negative to remove, reason) for a Load """
+
+        hot = [name for name, over in (('sessions', load.sessions > self.high_sessions),
+                                       ('queue', load.queue >= self.max_queue),
+                                       ('rtime', load.rtime > self.high_rtime)) if over]
+        cold = load.sessions < self.low_sessions and load.queue < self.max_queue
+        if hot:
+            self.high_since = self.high_since if self.high_since != None else now
+            self.low_since = None
+        elif cold:
+            self.low_since = self.low_since if self.low_since != None else now
+            self.high_since = None
+        else:
+            self.high_since = self.low_since = None
+
+        # The bounds apply at once
+        if load.nodes < self.min_nodes:
+            return self.min_nodes - load.nodes, 'below min_nodes'
+        if load.nodes > self.max_nodes:
+            return self.max_nodes - load.nodes, 'above max_nodes'
+
+        # Nodes needed for the target sessions per server, queue included
+        wanted = int(math.ceil((load.sessions * load.nodes + load.queue) / self.target_sessions))
+        wanted = min(max(wanted, self.min_nodes), self.max_nodes)
+        last = max(self.last_up, self.last_down)
+        if (hot and now - self.high_since >= self.sustain and load.nodes < self.max_nodes and
+            (self.last_up == None or now - self.last_up >= self.cooldown_up)):
+            delta = min(max(wanted - load.nodes, 1), self.max_step, self.max_nodes - load.nodes)
+            return delta, 'high ' + ', '.join(hot)
+        if (cold and now - self.low_since >= self.sustain_down and load.nodes > self.min_nodes and
+            (last == None or now - last >= self.cooldown_down)):
+            delta = min(max(load.nodes - wanted, 1), self.max_step, load.nodes - self.min_nodes)
+            return -delta, 'low sessions'
+        return 0, None
+
+    def victims(self, records, count):
+        """ Pick count proxies to remove, each from the region with the most
+        proxies left, the longest serving one there """
+
+        ignore = self.ignore()
+        by_region = collections.defaultdict(list)
+        for record in records:
+            by_region[record.region].append(record)
+        picked = []
+        for i in range(count):
+            candidates = [(len(rs), region) for region, rs in by_region.items()
+                          if [r for r in rs if r.ip not in ignore]]
+            if not candidates:
+                break
+            region = max(candidates)[1]
+            record = min((r for r in by_region[region] if r.ip not in ignore), key=lambda r: r.switch_in)
+            by_region[region].remove(record)
+            picked.append(record.ip)
+        return picked
+
+    def apply(self, delta, now):
+        """ Add or remove nodes. Returns how many were. """
+
+        done = 0
+        if delta > 0:
+            try:
+                done = self.grow(delta)
+            except Exception, e:
+                print 'Error adding nodes',e
+                self.counters['errors'] += 1
+            self.last_up = self.clock.time()
+        else:
+            for ip in self.victims(self.records(), -delta):
+                try:
+                    if self.shrink(ip):
+                        done += 1
+                except Exception, e:
+                    print 'Error removing node',ip,e
+                    self.counters['errors'] += 1
+            self.last_down = self.clock.time()
+        self.high_since = self.low_since = None
+        return done
+
+    def check(self, now=None):
+        """ Observe the load once and scale if needed. Returns the number of
+        nodes added or removed, negative if removed. """
+
+        now = now or self.clock.time()
+        load = self.observe()
+        if load == None:
+            return 0
+        self.last = load
+        delta, reason = self.decide(load, now)
+        self.counters['checks'] += 1
+        if not delta:
+            return 0
+
+        if self.verbose:
+            print 'Autoscaler: %s (%d nodes, %.1f sessions/server, queue %d, rtime %dms) => %+d nodes' % (
+                reason, load.nodes, load.sessions, load.queue, load.rtime, delta)
+        with timing.span('autoscale.' + ('up' if delta > 0 else 'down')):
+            done = self.apply(delta, now)
+        done = done if delta > 0 else -done
+        self.counters['up' if delta > 0 else 'down'] += abs(done)
+        self.history.append((now, load, delta, done, reason))
+        if self.notify and done:
+            self.notify('autoscale', 'Pool %s by %d node(s) to %d: %s\nLoad: %.1f sessions/server, queue %d, '
+                        'response time %dms' % ('grown' if done > 0 else 'shrunk', abs(done), load.nodes + done,
+                                                reason, load.sessions, load.queue, load.rtime))
+        return done
+
+    def loop(self):
+        while self.running:
+            try:
+                self.check()
+            except Exception, e:
+                print 'Error in autoscaler',e
+            self.wakeup.wait(self.interval)
+
+    def start(self):
+        """ Scale in a background thread """
+
+        self.running = True
+        t = threading.Thread(target=self.loop, name='autoscaler')
+        t.daemon = True
+        t.start()
+
+    def stop(self):
+        self.running = False
+        self.wakeup.set()
+
+    def stats(self):
+        stats = dict(self.counters)
+        if self.last != None:
+            stats['load'] = dict((k, round(v, 1)) for k, v in self.last._asdict().items())
+        return stats
+
+class SimRecord(object):
+    """ A proxy of the simulated pool """
+
+    def __init__(self, ip, region, switch_in):
+        self.ip = ip
+        self.region = region
+        self.switch_in = switch_in
+
+class SimPool(object):
+    """ A pool of proxies under synthetic crawl load, stepped one minute at
+    a time. Nodes come up provision_delay seconds after being added. """
+
+    def __init__(self, size, regions, capacity=25.0, rtime=300.0, provision_delay=120.0):
+        self.regions = regions
+        # Sessions a node serves before requests queue
+        self.capacity = capacity
+        self.base_rtime = rtime
+        self.provision_delay = provision_delay
+        self.now = 0.0
+        self.seq = 0
+        self.nodes = []
+        # (ready time, region) of nodes being created
+        self.coming = []
+        for i in range(size):
+            self.nodes.append(self.make(regions[i % len(regions)]))
+        self.load = None
+
+    def make(self, region):
+        self.seq += 1
+        return SimRecord('10.1.%d.%d' % (self.seq // 250, self.seq % 250 + 1), region, self.now)
+
+    def add(self, count):
+        for i in range(count):
+            # As pick_region does, prefer a region not in use
+            used = set(r.region for r in self.nodes) | set(region for t, region in self.coming)
+            free = [region for region in self.regions if region not in used]
+            self.coming.append((self.now + self.provision_delay, random.choice(free or self.regions)))
+        return count
+
+    def remove(self, ip):
+        self.nodes = [r for r in self.nodes if r.ip != ip]
+        return True
+
+    def records(self):
+        return list(self.nodes)
+
+    def time(self):
+        return self.now
+
+    def stats(self, ip):
+        if self.load == None:
+            return {}
+        return {'scur': self.load.sessions, 'qcur': self.load.queue / max(len(self.nodes), 1),
+                'rtime': self.load.rtime}
+
+    def tick(self, demand, secs=60.0):
+        """ Advance by secs under demand concurrent requests """
+
+        self.now += secs
+        for ready, region in [c for c in self.coming if c[0] <= self.now]:
+            self.coming.remove((ready, region))
+            self.nodes.append(self.make(region))
+        n = max(len(self.nodes), 1)
+        util = demand / (n * self.capacity)
+        queue = max(demand - n * self.capacity, 0)
+        # Response time climbs steeply as the pool saturates
+        rtime = self.base_rtime * (1 + min(util, 4.0) ** 4)
+        self.load = Load(len(self.nodes), min(demand / n, self.capacity), queue, rtime)
+        return self.load
+
+def demand_at(t, base, peak, jitter):
+    """ Concurrent crawl requests at t seconds: a daily cycle with two crawl
+    windows at peak, and noise """
+
+    hour = (t / 3600.0) % 24
+    level = base * (0.6 + 0.4 * math.sin((hour - 6) / 24.0 * 2 * math.pi))
+    if 9 <= hour < 12 or 20 <= hour < 22:
+        level = peak
+    return max(level * random.gauss(1.0, jitter), 0)
+
+def simulate(days, base, peak, fixed_sizes, seed, **settings):
+    """ Replay days of synthetic load through the autoscaler, and through
+    pools of fixed sizes for comparison """
+
+    regions = [2, 3, 4, 6, 7, 9, 10]
+    minutes = int(days * 24 * 60)
+    rows = []
+    for size in [None] + list(fixed_sizes):
+        random.seed(seed)
+        pool = SimPool(size or settings.get('min_nodes', 2), regions)
+        scaler = None
+        if size == None:
+            scaler = Autoscaler(pool.records, pool.stats, pool.add, pool.remove, clock=pool, verbose=False,
+                                **settings)
+        node_secs = queued_mins = requests = queued = 0.0
+        rtimes = []
+        for minute in range(minutes):
+            load = pool.tick(demand_at(pool.now, base, peak, 0.1))
+            node_secs += 60 * load.nodes
+            requests += load.sessions * load.nodes + load.queue
+            queued += load.queue
+            if load.queue > 0:
+                queued_mins += 1
+            rtimes.append(load.rtime)
+            if scaler != None and minute % max(int(scaler.interval // 60), 1) == 0:
+                scaler.check(pool.now)
+        rtimes.sort()
+        name = 'autoscale' if size == None else 'fixed %d' % size
+        rows.append((name, node_secs / 3600.0, queued_mins / 60.0, 100.0 * queued / max(requests, 1),
+                     rtimes[len(rtimes) // 2], rtimes[int(len(rtimes) * 0.99)],
+                     len(scaler.history) if scaler else 0))
+        if scaler != None:
+            sizes = [seen.nodes + done for t, seen, delta, done, reason in scaler.history]
+            print 'Autoscaler: %d actions, pool between %d and %d nodes, stats %s' % (
+                len(scaler.history), min(sizes or [0]), max(sizes or [0]), scaler.stats())
+
+    print '%d days, demand %d sessions off peak, %d at peak' % (days, base, peak)
+    print '%-12s %10s %12s %9s %10s %10s %8s' % ('pool', 'node-hours', 'queued-hours', 'queued%', 'p50 rtime',
+                                                  'p99 rtime', 'actions')
+    for row in rows:
+        print '%-12s %10.0f %12.1f %8.2f%% %9.0fms %9.0fms %8d' % row
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog='autoscaler')
+    parser.add_argument('--simulate',help='Replay synthetic load through the autoscaler', action='store_true')
+    parser.add_argument('-d','--days',help='Days of load to simulate', type=float, default=7)
+    parser.add_argument('-b','--base',help='Concurrent requests off peak', type=float, default=120)
+    parser.add_argument('-p','--peak',help='Concurrent requests in the crawl windows', type=float, default=450)
+    parser.add_argument('-f','--fixed',help='Fixed pool sizes to compare with', type=int, nargs='*',
+                        default=[8, 16])
+    parser.add_argument('--min',help='Minimum pool size', type=int, default=4)
+    parser.add_argument('--max',help='Maximum pool size', type=int, default=24)
+    parser.add_argument('-s','--seed',help='Random seed', type=int, default=1)
+    args = parser.parse_args()
+
+    if args.simulate:
+        simulate(args.days, args.base, args.peak, args.fixed, args.seed, min_nodes=args.min, max_nodes=args.max)
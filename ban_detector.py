@@ -0,0 +1,380 @@
+"""
+
+Emergency rotation of throttled or banned proxies.
+
+BanDetector checks the error signals of every active proxy at a short
+interval, using the metric sources of rotation_score - HAProxy server
+counters, squid log status codes or active probes. A signal trips a node
+after `trip_after` checks in a row above its trip level, and a tripped
+node only clears after `clear_after` checks below its lower clear level,
+so a node hovering around a threshold does not flap.
+
+A trip at once puts the node's LB slot into maintenance and asks the
+scheduler for an urgent replacement of that node. Trips are limited by
+a global token bucket, and held altogether while more than
+`max_drained` of the pool is failing. An error spike across the whole
+fleet is most likely the target site, and rotating every node into it
+would only burn money.
+
+The time from the first bad check and from the trip decision to the
+completed drain is measured per trip and reported by stats().
+
+Settings come from the "ban" section of proxy.conf. Run with --simulate
+to replay bans and a site-wide outage on a virtual clock.
+
+"""
+
+import sys
+import time
+import random
+import argparse
+import threading
+import collections
+
+import timing
+from clock import VirtualClock
+from utils import RateLimiter
+from rotation_score import make_sources
+
+# Signal => (trip level, clear level)
+default_thresholds = {'errors': (0.5, 0.2)}
+
+class NodeState(object):
+    """ Hysteresis state of one proxy """
+
+    __slots__ = ('ip', 'tripped', 'bad', 'good', 'first_bad', 'tripped_at', 'signal', 'value')
+
+    def __init__(self, ip):
+        self.ip = ip
+        self.tripped = False
+        # Consecutive checks above the trip, or below the clear, level
+        self.bad = 0
+        self.good = 0
+        self.first_bad = None
+        self.tripped_at = None
+        # Signal and value which caused the trip
+        self.signal = None
+        self.value = None
+
+class BanDetector(object):
+    """ Trip, drain and replace proxies whose error signals cross thresholds """
+
+    def __init__(self, sources, records, drain, replace, thresholds=None, trip_after=2, clear_after=3,
+                 min_rate=0.0, max_trips=3, per=3600.0, max_drained=0.25, interval=30.0, clock=None,
+                 notify=None):
+        self.sources = list(sources)
+        # Returns the active proxy records
+        self.records = records
+        # Called with a proxy IP to take it out of the LB, returns success
+        self.drain = drain
+        # Called with a proxy IP to queue its replacement
+        self.replace = replace
+        self.thresholds = dict(thresholds or default_thresholds)
+        self.trip_after = trip_after
+        self.clear_after = clear_after
+        # Error rates of nodes serving fewer requests per second are noise
+        self.min_rate = min_rate
+        self.clock = clock or time
+        self.limiter = RateLimiter(max_trips, per=per, clock=self.clock)
+        self.max_drained = max_drained
+        self.interval = interval
+        self.notify = notify
+        # IP => NodeState
+        self.nodes = {}
+        self.counters = collections.defaultdict(int)
+        # (first bad check to drain, trip to drain) of every drain
+        self.latencies = []
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.running = False
+        # Whether trips are held for a fleet-wide problem
+        self.holding = False
+
+    @classmethod
+    def from_config(cls, config, drain, replace, notify=None):
+        """ Create a detector from the "ban" section of proxy.conf, None if
+        it is disabled """
+
+        settings = config.ban or {}
+        if not settings.get('enabled', False):
+            return None
+        thresholds = dict((name, tuple(levels)) for name, levels in
+                          settings.get('thresholds', {'errors': [0.5, 0.2]}).items())
+        return cls(make_sources(config, settings.get('sources', ['lb_stats'])), config.get_active_proxies,
+                   drain, replace, thresholds=thresholds,
+                   trip_after=int(settings.get('trip_after', 2)),
+                   clear_after=int(settings.get('clear_after', 3)),
+                   min_rate=float(settings.get('min_rate', 0.0)),
+                   max_trips=float(settings.get('max_trips', 3)),
+                   per=float(settings.get('per', 3600)),
+                   max_drained=float(settings.get('max_drained', 0.25)),
+                   interval=float(settings.get('interval', 30)),
+                   notify=notify)
+
+    def breach(self, metrics):
+        """ Return (signal, value, level) of the first signal above its trip
+        level, and whether every signal is below its clear level """
+
+        if 'errors' in metrics and metrics.get('throughput', self.min_rate) < self.min_rate:
+            metrics = dict(metrics)
+            del metrics['errors']
+
+        tripped, clear = None, True
+        for name, (trip, lower) in sorted(self.thresholds.items()):
+            value = metrics.get(name)
+            if value == None:
+                continue
+            if value >= trip and tripped == None:
+                tripped = (name, value, trip)
+            if value > lower:
+                clear = False
+        return tripped, clear
+
+    def check(self, now=None):
+        """ Check every active proxy once. Returns the IPs drained. """
+
+        now = self.clock.time() if now == None else now
+        records = self.records()
+        for source in self.sources:
+            source.prepare(records)
+
+        drained = []
+        with self.lock:
+            active = set(r.ip for r in records)
+            for ip in self.nodes.keys():
+                if ip not in active:
+                    # Rotated out
+                    del self.nodes[ip]
+
+            candidates = []
+            for record in records:
+                metrics = {}
+                for source in self.sources:
+                    metrics.update(source.metrics(record.ip))
+                node = self.nodes.setdefault(record.ip, NodeState(record.ip))
+                if self.update(node, metrics, now):
+                    candidates.append(node)
+
+            # Nodes tripped or on the way to it
+            failing = len([n for n in self.nodes.values() if n.tripped or n.bad])
+            if candidates and float(failing) / len(records) > self.max_drained:
+                if not self.holding:
+                    print 'Ban detector: %d of %d proxies failing, likely a site-wide problem -' % (
+                        failing, len(records)),'holding trips'
+                self.holding = True
+                self.counters['held'] += len(candidates)
+            else:
+                self.holding = False
+                for node in candidates:
+                    if self.trip(node, now):
+                        drained.append(node.ip)
+        self.counters['checks'] += 1
+        return drained
+
+    def update(self, node, metrics, now):
+        """ Advance the hysteresis of node. Returns True when it should trip. """
+
+        tripped, clear = self.breach(metrics)
+        if node.tripped:
+            node.good = node.good + 1 if clear else 0
+            if node.good >= self.clear_after:
+                print 'Ban detector: proxy',node.ip,'cleared'
+                node.tripped, node.bad, node.first_bad = False, 0, None
+                self.counters['cleared'] += 1
+            return False
+
+        if tripped == None:
+            node.bad, node.first_bad = 0, None
+            return False
+        if node.bad == 0:
+            node.first_bad = now
+        node.bad += 1
+        node.signal, node.value = tripped[0], tripped[1]
+        return node.bad >= self.trip_after
+
+    def trip(self, node, now):
+        """ Drain node and queue its replacement, within the rate limit.
+        Caller holds lock. Returns whether it was drained. """
+
+        if not self.limiter.try_acquire():
+            self.counters['rate_limited'] += 1
+            if node.bad == self.trip_after:
+                print 'Ban detector: trip of',node.ip,'rate limited'
+            return False
+
+        node.tripped, node.tripped_at, node.good = True, now, 0
+        print 'Ban detector: tripping proxy %s - %s %.3f for %d checks' % (node.ip, node.signal, node.value, node.bad)
+        try:
+            ok = self.drain(node.ip)
+        except Exception, e:
+            print 'Error draining',node.ip,e
+            ok = False
+        done = self.clock.time()
+        if ok:
+            latency = (done - node.first_bad, done - now)
+            self.latencies.append(latency)
+            timing.observe('ban.detect_to_drain', latency[0])
+            timing.observe('ban.trip_to_drain', latency[1])
+            self.counters['drained'] += 1
+        self.counters['tripped'] += 1
+        self.replace(node.ip)
+        if self.notify:
+            self.notify('ban', 'Proxy %s tripped on %s %.3f, drained: %s, replacement queued.\n' % (
+                node.ip, node.signal, node.value, ok))
+        return ok
+
+    def loop(self):
+        while self.running:
+            try:
+                self.check()
+            except Exception, e:
+                print 'Error in ban detector',e
+            self.wakeup.wait(self.interval)
+
+    def start(self):
+        """ Check in a background thread """
+
+        self.running = True
+        t = threading.Thread(target=self.loop, name='ban-detector')
+        t.daemon = True
+        t.start()
+
+    def stop(self):
+        self.running = False
+        self.wakeup.set()
+
+    def stats(self):
+        """ Return the counters and the detection-to-drain latencies """
+
+        stats = dict(self.counters)
+        stats['tripped_now'] = len([n for n in self.nodes.values() if n.tripped])
+        for idx, name in enumerate(('detect_to_drain', 'trip_to_drain')):
+            values = sorted(latency[idx] for latency in self.latencies)
+            if values:
+                stats[name] = {'p50': round(values[len(values) // 2], 4),
+                               'p95': round(values[int(len(values) * 0.95)], 4),
+                               'max': round(values[-1], 4)}
+        return stats
+
+class SimSource(object):
+    """ Error rates of a simulated pool, smoothed like the LB stats poller """
+
+    def __init__(self, alpha=0.3):
+        self.alpha = alpha
+        # IP => raw error rate right now
+        self.raw = {}
+        self.smoothed = {}
+
+    def prepare(self, records):
+        for record in records:
+            raw = self.raw.get(record.ip, 0.0) + random.uniform(0.0, 0.05)
+            last = self.smoothed.get(record.ip, raw)
+            self.smoothed[record.ip] = last + self.alpha * (raw - last)
+
+    def metrics(self, ip):
+        return {'errors': self.smoothed.get(ip, 0.0), 'throughput': 10.0}
+
+def simulate(days=7, nodes=20, bans_per_day=2.0, outage_hours=1.0, interval=30.0, seed=1, **kwargs):
+    """ Simulate bans of single nodes and one site-wide outage. A replaced
+    node comes back clean after a rotation delay. """
+
+    random.seed(seed)
+    clock = VirtualClock()
+    source = SimSource()
+    pool = dict(('10.1.0.%d' % (i + 1), None) for i in range(nodes))
+    serial = [nodes]
+    onset = {}
+    replacements = []
+
+    class Record(object):
+        def __init__(self, ip):
+            self.ip = ip
+
+    def replace(ip):
+        # The scheduler swaps the node in a few minutes
+        replacements.append((clock.time() + random.uniform(120, 600), ip))
+
+    detector = BanDetector([source], lambda: [Record(ip) for ip in pool], lambda ip: True, replace,
+                           interval=interval, clock=clock, **kwargs)
+
+    end = days * 86400.0
+    outage = (end / 2, end / 2 + outage_hours * 3600.0)
+    ban_delays = []
+    next_ban = random.expovariate(bans_per_day / 86400.0)
+
+    stdout, sys.stdout = sys.stdout, open('/dev/null', 'w')
+    start = time.time()
+    try:
+        while clock.time() < end:
+            now = clock.time()
+            if now >= next_ban:
+                ip = random.choice(pool.keys())
+                if ip not in onset:
+                    source.raw[ip] = random.uniform(0.6, 0.95)
+                    onset[ip] = now
+                next_ban = now + random.expovariate(bans_per_day / 86400.0)
+            in_outage = outage[0] <= now < outage[1]
+            for ip in pool:
+                if ip not in onset:
+                    source.raw[ip] = 0.9 if in_outage else 0.0
+
+            for ip in detector.check(now):
+                if ip in onset:
+                    ban_delays.append(now - onset[ip])
+
+            for item in [r for r in replacements if r[0] <= now]:
+                replacements.remove(item)
+                ip = item[1]
+                if ip in pool:
+                    del pool[ip]
+                    onset.pop(ip, None)
+                    source.raw.pop(ip, None)
+                    source.smoothed.pop(ip, None)
+                    serial[0] += 1
+                    pool['10.1.%d.%d' % divmod(serial[0], 250)] = None
+            clock.advance(interval)
+    finally:
+        sys.stdout = stdout
+
+    stats = detector.stats()
+    ban_delays.sort()
+    print 'Simulated %d days of %d nodes, %.1f bans per day, a %.1fh outage, checks every %ds in %.2fs' % (
+        days, nodes, bans_per_day, outage_hours, interval, time.time() - start)
+    print 'Tripped %d, drained %d, held %d, rate limited %d, cleared %d' % (
+        stats.get('tripped', 0), stats.get('drained', 0), stats.get('held', 0), stats.get('rate_limited', 0),
+        stats.get('cleared', 0))
+    if ban_delays:
+        print 'Ban onset to drain: median %.0fs, max %.0fs over %d bans' % (ban_delays[len(ban_delays) // 2],
+                                                                            ban_delays[-1], len(ban_delays))
+    print 'Still banned at the end:',len(onset)
+    return detector
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog='ban_detector')
+    parser.add_argument('--simulate',help='Simulate N days on a virtual clock', type=int, default=0)
+    parser.add_argument('-n','--nodes',help='Pool size in the simulation', type=int, default=20)
+    parser.add_argument('-b','--bans',help='Bans per day in the simulation', type=float, default=2.0)
+    parser.add_argument('-i','--interval',help='Seconds between checks', type=float, default=30.0)
+    parser.add_argument('-C','--conf',help='Use the given configuration file', default='proxy.conf')
+    parser.add_argument('--check',help='Check the proxies once and print their signals', action='store_true')
+    args = parser.parse_args()
+
+    if args.simulate:
+        simulate(args.simulate, args.nodes, args.bans, interval=args.interval)
+        sys.exit(0)
+
+    if args.check:
+        from rotate_proxies import ProxyConfig
+        config = ProxyConfig(args.conf, read_only=True)
+        config.lb_poller.poll()
+        # Dry run - print the signals and what is above its trip level
+        detector = BanDetector.from_config(config, None, None) or \
+                   BanDetector(make_sources(config, ['lb_stats']), config.get_active_proxies, None, None)
+        records = config.get_active_proxies()
+        for source in detector.sources:
+            source.prepare(records)
+        for record in records:
+            metrics = {}
+            for source in detector.sources:
+                metrics.update(source.metrics(record.ip))
+            print '%-16s %s %s' % (record.ip, metrics, detector.breach(metrics)[0] or '')
@@ -0,0 +1,366 @@
+"""
+
+Blue/green replacement of the whole proxy fleet.
+
+A plain `provision` drops every proxy linode before creating the new
+ones, leaving the crawlers without egress until it is done. BlueGreen
+keeps the current (blue) fleet serving while it
+
+    build     - creates the new (green) fleet in parallel, unlabelled,
+                each node gated by the readiness checks
+    validate  - requires `min_ready` of it to have become ready, else
+                deletes it and leaves the blue fleet as it was
+    baseline  - measures the requests per second the blue fleet serves
+    cutover   - switches the HAProxy backend to the green fleet in one
+                runtime update, the blue slots draining
+    watch     - polls the green slots for `watch` seconds: the share of
+                healthy nodes (LB status and a proxied request) must stay
+                above `min_healthy`, and the requests per second must
+                reach `min_throughput` of the baseline. Polls which
+                cannot read the LB count as unhealthy.
+    rollback  - if it does not, switches the LB back to the blue fleet,
+                which is still up, and deletes the green one
+    teardown  - otherwise waits for the blue slots to drain, deletes the
+                blue nodes and gives their labels to the green ones
+
+Settings come from the "bluegreen" section of proxy.conf, the drain
+deadline from the "drain" one. Used by `rotate_proxies.py -P -B`. Run
+with --demo to replace a fleet against the fake Linode API and admin
+socket, with --fail to see a rollback.
+
+"""
+
+import os
+import sys
+import json
+import math
+import time
+import shutil
+import argparse
+import tempfile
+import threading
+
+from multiprocessing.pool import ThreadPool
+
+import timing
+from haproxy_stats import StatsPoller
+from health_probe import HealthProber
+
+class BlueGreen(object):
+    """ Build a new fleet next to the current one and switch over to it """
+
+    def __init__(self, rotator, count, parallel=None, min_ready=1.0, baseline=60.0, watch=300.0,
+                 interval=10.0, min_healthy=0.8, min_throughput=0.5, fall=2, poller=None, prober=None):
+        self.rotator = rotator
+        self.config = rotator.config
+        self.clock = rotator.clock
+        self.count = count
+        self.parallel = parallel
+        # Share of the new fleet which must be ready to switch over
+        self.min_ready = min_ready
+        # Seconds the old fleet's throughput is measured for
+        self.baseline = baseline
+        # Seconds the new fleet is watched for after the switch, polled every interval
+        self.watch = watch
+        self.interval = interval
+        # Rollback thresholds, and how many polls in a row health may be below
+        self.min_healthy = min_healthy
+        self.min_throughput = min_throughput
+        self.fall = fall
+        # A poller of our own, so the shared one keeps its interval
+        self.poller = poller or StatsPoller(self.config.lb_admin)
+        # Probes the green fleet concurrently, with the readiness settings
+        readiness = rotator.readiness.prober
+        self.prober = prober or HealthProber(concurrency=int((self.config.probe or {}).get('concurrency', 32)),
+                                             timeout=readiness.timeout, url=readiness.url, auth=readiness.auth)
+        # Steps done and their outcome, for the report
+        self.log = []
+
+    @classmethod
+    def from_config(cls, rotator, count, parallel=None):
+        """ Create a replacement run from the "bluegreen" section of proxy.conf """
+
+        settings = rotator.config.bluegreen or {}
+        return cls(rotator, count, parallel,
+                   min_ready=float(settings.get('min_ready', 1.0)),
+                   baseline=float(settings.get('baseline', 60)),
+                   watch=float(settings.get('watch', 300)),
+                   interval=float(settings.get('interval', 10)),
+                   min_healthy=float(settings.get('min_healthy', 0.8)),
+                   min_throughput=float(settings.get('min_throughput', 0.5)),
+                   fall=int(settings.get('fall', 2)))
+
+    def step(self, name, detail):
+        print 'Blue/green %s: %s' % (name, detail)
+        self.log.append((name, detail))
+
+    def blue(self):
+        """ Return (ip, linode id, region) of the current fleet """
+
+        with self.config.lock:
+            records = self.config.index.active_records()
+        fleet = []
+        for record in records:
+            linode_id = record.linode_id or self.rotator.linode_cmd.get_proxy_id(record.ip) or 0
+            fleet.append((record.ip, int(linode_id), record.region))
+        return fleet
+
+    def build(self):
+        """ Create the green fleet, unlabelled, in parallel. Returns the
+        provision results. """
+
+        parallel = self.rotator.provision_settings(self.parallel)
+        regions = self.config.region_ids
+        jobs = [(None, regions[idx % len(regions)]) for idx in range(self.count)]
+        pool = ThreadPool(max(1, min(parallel, self.count)))
+        try:
+            with timing.span('bluegreen.build'):
+                return pool.map(self.rotator.provision_node, jobs, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+    def servers(self, proxies):
+        with self.config.lock:
+            return dict((self.config.slot_name(proxy), proxy) for proxy in proxies if proxy in self.config.slot_of)
+
+    def health(self, servers, samples):
+        """ Return the share of servers the LB has up and which answer a
+        proxied request """
+
+        if not servers:
+            return 0.0
+        probes = {}
+        if self.prober.url:
+            for result in self.prober.sweep([(name, ip, self.rotator.readiness.port)
+                                             for name, ip in servers.items()]):
+                probes[result.name] = result.ok
+        healthy = 0
+        for name in servers:
+            sample = samples.get(name)
+            if sample != None and sample.status.startswith('UP') and probes.get(name, True):
+                healthy += 1
+        return float(healthy) / len(servers)
+
+    def throughput(self, servers, first, last):
+        """ Requests per second the servers served between two polls """
+
+        if not first or not last:
+            return 0.0
+        total, elapsed = 0, 0.0
+        for name in servers:
+            a, b = first.get(name), last.get(name)
+            if a != None and b != None:
+                total += max(b.stot - a.stot, 0)
+                elapsed = max(elapsed, b.ts - a.ts)
+        return total / elapsed if elapsed > 0 else 0.0
+
+    def measure(self, servers, secs):
+        """ Requests per second served by servers over secs """
+
+        first = self.poller.poll(self.clock.time())
+        self.clock.sleep(secs)
+        last = self.poller.poll(self.clock.time())
+        return self.throughput(servers, first, last)
+
+    def watch_green(self, servers, baseline):
+        """ Watch the green fleet after the switch. Returns None if it is
+        healthy, else why it is not. """
+
+        start = self.clock.time()
+        first = last = self.poller.poll(start)
+        below = 0
+        while True:
+            self.clock.sleep(self.interval)
+            samples = self.poller.poll(self.clock.time())
+            if samples == None:
+                # Nothing says the new fleet is healthy
+                below += 1
+                print 'Blue/green watch: LB stats unreadable'
+                if below >= self.fall:
+                    return 'LB stats unreadable'
+            else:
+                last = samples
+                healthy = self.health(servers, samples)
+                below = below + 1 if healthy < self.min_healthy else 0
+                print 'Blue/green watch: %.0f%% healthy' % (healthy * 100)
+                if below >= self.fall:
+                    return 'only %.0f%% of the new fleet healthy' % (healthy * 100)
+            if self.clock.time() - start >= self.watch:
+                break
+
+        rate = self.throughput(servers, first, last)
+        self.step('throughput', '%.1f req/s, baseline %.1f req/s' % (rate, baseline))
+        # An idle fleet gives nothing to compare with
+        if baseline > 0 and rate < self.min_throughput * baseline:
+            return 'throughput %.1f req/s below %.0f%% of %.1f req/s' % (rate, self.min_throughput * 100,
+                                                                        baseline)
+        return None
+
+    def remove(self, nodes):
+        """ Delete nodes, a list of (ip, linode id, region) """
+
+        for ip, linode_id, region in nodes:
+            try:
+                self.rotator.retire(ip, linode_id, None, None)
+            except Exception, e:
+                print 'Error removing linode',linode_id,e
+
+    def teardown(self, blue, green):
+        """ Delete the drained blue fleet and give its labels to the green one """
+
+        drainer = self.rotator.drainer
+        if drainer:
+            with self.config.lock:
+                draining = dict(self.config.draining)
+            for ip, linode_id, region in blue:
+                if ip in draining:
+                    self.rotator.drain(ip, linode_id)
+            while drainer.pending():
+                self.clock.sleep(drainer.interval)
+            drainer.stop()
+            self.step('drained', drainer.stats())
+            drained = set(draining)
+            blue = [node for node in blue if node[0] not in drained]
+        self.remove(blue)
+
+        for idx, (ip, linode_id, region) in enumerate(green):
+            label = self.config.proxy_prefix + str(idx + 1)
+            try:
+                self.rotator.relabel(linode_id, label)
+            except Exception, e:
+                print 'Error assigning label',label,'to linode',linode_id,e
+
+    def run(self):
+        """ Replace the fleet. Returns a report dictionary with the outcome -
+        'switched', 'aborted' or 'rolled back' - and the steps taken. """
+
+        begin = time.time()
+        blue = self.blue()
+        self.step('start', '%d current proxies, building %d new ones' % (len(blue), self.count))
+        results = self.build()
+        green = [(r['ip'], r['id'], r['region']) for r in results if r['error'] == None]
+        needed = int(math.ceil(self.min_ready * self.count))
+        self.step('validate', '%d of %d new proxies ready, %d needed' % (len(green), self.count, needed))
+
+        outcome = 'switched'
+        if len(green) < needed or not green:
+            outcome = 'aborted'
+            self.remove(green)
+        else:
+            rate = self.measure(self.servers([ip for ip, i, r in blue]), self.baseline)
+            self.step('baseline', '%.1f req/s' % rate)
+            drain = self.rotator.drainer != None
+            with timing.span('bluegreen.cutover'):
+                switched = self.config.switch_fleet(green, [ip for ip, i, r in blue], drain=drain)
+            self.step('cutover', 'LB updated' if switched else 'LB update failed')
+            reason = 'LB update failed'
+            if switched:
+                reason = self.watch_green(self.servers([ip for ip, i, r in green]), rate)
+            if reason != None:
+                outcome = 'rolled back'
+                self.step('rollback', reason)
+                with timing.span('bluegreen.rollback'):
+                    self.config.switch_fleet(blue, [ip for ip, i, r in green])
+                self.remove(green)
+            else:
+                self.teardown(blue, green)
+        self.prober.close()
+        self.config.write()
+
+        elapsed = time.time() - begin
+        timing.observe('bluegreen.total', elapsed)
+        lines = ['Blue/green replacement %s in %.1f seconds.' % (outcome, elapsed)]
+        lines += ['%-10s %s' % step for step in self.log]
+        print '\n'.join(lines)
+        self.rotator.notifier.notify('provision', '\n'.join(lines))
+        return {'outcome': outcome, 'elapsed': elapsed, 'steps': self.log, 'results': results}
+
+def demo(count, fail, watch):
+    """ Replace a fleet of count proxies against the fake Linode API and
+    admin socket, the new fleet failing its health checks if fail is set """
+
+    from fake_linode_api import FakeLinodeServer
+    from fake_haproxy import FakeHAProxy
+
+    tmp = tempfile.mkdtemp(prefix='bluegreen')
+    server = FakeLinodeServer().start()
+    lines = []
+    for i in range(count):
+        ip = '192.168.0.%d' % (i + 1)
+        linode_id = server.state.add('ynode%d' % (i + 1), 3, 'ynodes', ip=ip)
+        lines.append('%s,3,%d,0,0' % (ip, linode_id))
+    open(os.path.join(tmp, 'proxies.list'), 'w').write('\n'.join(lines) + '\n')
+
+    conf = json.load(open('proxy.conf'))
+    conf.update({'linode_backend': 'api', 'linode_api': {'url': server.url, 'api_key': 'demo'},
+                 'proxylist': os.path.join(tmp, 'proxies.list'), 'group': 'ynodes', 'proxy_prefix': 'ynode',
+                 'lb_config': os.path.join(tmp, 'haproxy.cfg'), 'lb_restart': 'true',
+                 'lb_socket': os.path.join(tmp, 'admin.sock'),
+                 'state': {'journal': os.path.join(tmp, 'journal'), 'snapshot': os.path.join(tmp, 'snapshot'),
+                           'export_csv': False},
+                 'inventory': {'state_file': ''}, 'standby': {'enabled': False},
+                 'notify': {'spool': os.path.join(tmp, 'spool'), 'window': 1},
+                 'email': dict(conf.get('email', {}), send_email=False),
+                 'ssh': {'command': '%s fake_ssh.py' % sys.executable},
+                 # The fake nodes run no squid to send a request through
+                 'probe': dict(conf.get('probe', {}), url=''),
+                 'readiness': {'stages': ['boot', 'ssh'], 'initial_backoff': 0.2, 'deadline': 20},
+                 'provision': {'retries': 1, 'region_rate': 60},
+                 'drain': {'deadline': 2, 'interval': 0.2},
+                 'bluegreen': {'baseline': 1, 'watch': watch, 'interval': 0.5}})
+    cfg = os.path.join(tmp, 'proxy.conf')
+    json.dump(conf, open(cfg, 'w'), indent=4)
+    os.environ['FAKE_SSH_HANDSHAKE'] = '0.05'
+    os.environ['FAKE_SSH_DRYRUN'] = '1'
+
+    from rotate_proxies import ProxyRotator
+    from loadgen import LocalProxyConfig
+    rotator = ProxyRotator(cfg=cfg, config=LocalProxyConfig(cfg))
+    rotator.config.write_lb_config(reload=False)
+    lb = FakeHAProxy(conf['lb_socket'])
+    lb.state.load_config(conf['lb_config'])
+    lb.start()
+    blue = set(ip for ip, i, r in BlueGreen(rotator, 0).blue())
+
+    # Clients keep sending requests to whatever the LB serves
+    running = [True]
+    def traffic():
+        while running[0]:
+            for slot in lb.state.servers.values():
+                if slot.admin == 'ready':
+                    if fail and slot.addr not in blue:
+                        slot.check = 'DOWN'
+                    else:
+                        slot.stot += 5
+                        slot.scur = 2
+                elif slot.admin == 'drain':
+                    slot.scur = max(slot.scur - 1, 0)
+            time.sleep(0.1)
+    thread = threading.Thread(target=traffic)
+    thread.daemon = True
+    thread.start()
+
+    try:
+        report = rotator.provision(count, bluegreen=True)
+    finally:
+        running[0] = False
+        rotator.notifier.close()
+        lb.stop()
+        server.shutdown()
+
+    live = sorted(record.ip for record in rotator.config.index.active_records())
+    print 'Outcome =>',report['outcome']
+    print 'Active proxies =>',live,'(old fleet)' if set(live) == blue else '(new fleet)'
+    print 'Linodes =>',sorted((node['LABEL'], server.state.ips[id]) for id, node in server.state.linodes.items())
+    shutil.rmtree(tmp, ignore_errors=True)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog='bluegreen')
+    parser.add_argument('--demo',help='Replace a fleet of N proxies against the fakes', type=int, default=0)
+    parser.add_argument('--fail',help='Make the new fleet fail its health checks', action='store_true')
+    parser.add_argument('-w','--watch',help='Seconds to watch the new fleet in the demo', type=float, default=3.0)
+    args = parser.parse_args()
+
+    if args.demo:
+        demo(args.demo, args.fail, args.watch)
@@ -0,0 +1,57 @@
+"""
+
+Clocks for code which waits on time.
+
+RealClock is the wall clock. VirtualClock only moves when advanced, and
+its sleep() and wait() advance it instead of blocking, so schedules
+spanning weeks can be simulated in a fraction of a second.
+
+"""
+
+import time
+import threading
+
+class RealClock(object):
+    """ The wall clock """
+
+    def time(self):
+        return time.time()
+
+    def sleep(self, seconds):
+        if seconds > 0:
+            time.sleep(seconds)
+
+    def wait(self, event, timeout=None):
+        """ Wait for event up to timeout seconds, return whether it is set """
+
+        return event.wait(timeout)
+
+class VirtualClock(object):
+    """ Simulated time, moved forward by advance(), sleep() and wait() """
+
+    def __init__(self, start=0.0):
+        self.now = float(start)
+        self.lock = threading.Lock()
+
+    def time(self):
+        return self.now
+
+    def advance(self, seconds):
+        with self.lock:
+            self.now += max(0.0, seconds)
+            return self.now
+
+    def advance_to(self, when):
+        with self.lock:
+            self.now = max(self.now, when)
+            return self.now
+
+    def sleep(self, seconds):
+        self.advance(seconds)
+
+    def wait(self, event, timeout=None):
+        """ Return at once if event is set, else skip ahead by timeout """
+
+        if not event.is_set() and timeout != None:
+            self.advance(timeout)
+        return event.is_set()
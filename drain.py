@@ -0,0 +1,292 @@
+"""
+
+Graceful draining of switched out proxies.
+
+Instead of going into maintenance at once, the LB slot of a switched out
+proxy is put into the HAProxy `drain` state by ProxyConfig.update_lb.
+HAProxy then sends it no new clients, so it hands out no new sticky
+cookies, while requests already pinned to it by the proxycookie can
+finish. Drainer watches the current sessions (scur) of every draining
+slot and, once a slot is idle or its deadline passes, shuts down what
+is left of its sessions, puts it into maintenance and hands the node
+back to be deleted and its slot freed.
+
+All drains are watched by one thread polling `show stat` once per
+interval, so any number can run at once and a rotation never waits for
+one. The duration of every drain and the number of sessions it had to
+cut are logged, kept in the history and recorded as timings. Time is
+read from a clock, so that on a VirtualClock the drains can be checked
+inline by the simulated daemon loop instead of a thread.
+
+Settings come from the "drain" section of proxy.conf. Run with --demo
+to drain a few busy servers of the fake admin socket.
+
+"""
+
+import os
+import time
+import random
+import argparse
+import tempfile
+import threading
+import collections
+
+import timing
+from clock import RealClock
+from haproxy_admin import HAProxyAdminError
+from haproxy_stats import StatsPoller
+
+class Drain(object):
+    """ One switched out proxy being drained """
+
+    __slots__ = ('proxy', 'server', 'linode_id', 'context', 'started', 'deadline', 'sessions', 'finished',
+                 'forced', 'outcome', 'clock')
+
+    def __init__(self, proxy, server, linode_id, started, deadline, context=None, clock=None):
+        self.proxy = proxy
+        self.server = server
+        self.linode_id = linode_id
+        # Whatever the caller needs to release the node
+        self.context = context
+        self.started = started
+        self.deadline = deadline
+        # Sessions when the drain started, None until the first poll
+        self.sessions = None
+        self.finished = None
+        # Sessions still open at the deadline, which were cut
+        self.forced = 0
+        # 'drained', 'deadline' or 'stopped'
+        self.outcome = None
+        self.clock = clock or RealClock()
+
+    def duration(self):
+        return (self.finished or self.clock.time()) - self.started
+
+    def to_dict(self):
+        return {'proxy': self.proxy, 'server': self.server, 'linode_id': self.linode_id,
+                'sessions': self.sessions, 'forced': self.forced, 'outcome': self.outcome,
+                'duration': round(self.duration(), 3)}
+
+    def __repr__(self):
+        return '<Drain %s %s %s %.1fs sessions=%s forced=%d>' % (self.proxy, self.server, self.outcome or 'draining',
+                                                                 self.duration(), self.sessions, self.forced)
+
+class Drainer(object):
+    """ Watch draining LB slots and release their nodes when done """
+
+    def __init__(self, lb_admin, done, deadline=300.0, interval=5.0, history=100, poller=None, clock=None):
+        self.lb_admin = lb_admin
+        # Called with each finished Drain, to delete the node and free the slot
+        self.done = done
+        self.deadline = deadline
+        self.interval = interval
+        # A poller of our own, so the shared one keeps its interval
+        self.poller = poller or StatsPoller(lb_admin)
+        self.drains = []
+        self.history = collections.deque(maxlen=history)
+        self.counters = collections.defaultdict(int)
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.clock = clock or RealClock()
+        self.running = False
+        self.thread = None
+        # Check the drains in the thread calling check(), as needed when
+        # they wait on a virtual clock
+        self.inline = False
+
+    @classmethod
+    def from_config(cls, config, lb_admin, done, clock=None):
+        """ Create a drainer from the "drain" section of proxy.conf, None if
+        draining is disabled """
+
+        settings = config.drain or {}
+        if not settings.get('enabled', True):
+            return None
+        return cls(lb_admin, done, deadline=float(settings.get('deadline', 300)),
+                   interval=float(settings.get('interval', 5)),
+                   history=int(settings.get('history', 100)),
+                   clock=clock)
+
+    def add(self, proxy, server, linode_id, context=None, deadline=None):
+        """ Start watching a slot already put into drain, until the given
+        deadline or for the configured one. Returns at once. """
+
+        now = self.clock.time()
+        if deadline == None:
+            deadline = now + self.deadline
+        drain = Drain(proxy, server, linode_id, now, deadline, context, self.clock)
+        with self.lock:
+            self.drains.append(drain)
+            self.counters['started'] += 1
+        print 'Draining',proxy,'in slot',server,'for up to',round(deadline - now, 1),'seconds'
+        if not self.running and not self.inline:
+            self.start()
+        self.wakeup.set()
+        return drain
+
+    def pending(self):
+        with self.lock:
+            return list(self.drains)
+
+    def next_check(self):
+        """ Return the time of the next inline check, None if nothing drains """
+
+        with self.lock:
+            if not self.drains:
+                return None
+        return self.clock.time() + self.interval
+
+    def check(self, now=None):
+        """ Poll the sessions of the draining slots once and finish those
+        which are idle or past their deadline """
+
+        drains = self.pending()
+        if not drains:
+            return []
+
+        now = now or self.clock.time()
+        samples = self.poller.poll(now)
+        if samples == None:
+            self.counters['poll_errors'] += 1
+
+        finished = []
+        for drain in drains:
+            # A slot missing from the stats has no sessions, but if the LB
+            # cannot be read only the deadline ends the drain
+            sample = samples and samples.get(drain.server)
+            sessions = sample.scur if sample else 0
+            if drain.sessions == None and samples != None:
+                drain.sessions = sessions
+            if sessions == 0 and (samples != None or now >= drain.deadline):
+                self.finish(drain, 'drained', 0)
+            elif now >= drain.deadline:
+                self.finish(drain, 'deadline', sessions)
+            else:
+                continue
+            finished.append(drain)
+        return finished
+
+    def finish(self, drain, outcome, sessions):
+        """ Cut the remaining sessions of a slot, put it into maintenance and
+        hand the node back """
+
+        cmds = []
+        if sessions:
+            cmds.append('shutdown sessions server %s/%s' % (self.lb_admin.backend, drain.server))
+        cmds.append(self.lb_admin.server_state_cmd(drain.server, 'maint'))
+        try:
+            self.lb_admin.execute(*cmds)
+        except HAProxyAdminError, e:
+            print 'Error finishing drain of',drain.proxy,e
+            self.counters['lb_errors'] += 1
+
+        drain.finished, drain.outcome, drain.forced = self.clock.time(), outcome, sessions
+        with self.lock:
+            self.drains.remove(drain)
+            self.history.append(drain)
+            self.counters[outcome] += 1
+            self.counters['sessions_forced'] += sessions
+        timing.observe('drain.duration', drain.duration())
+        print 'Finished',drain
+        try:
+            self.done(drain)
+        except Exception, e:
+            print 'Error releasing drained proxy',drain.proxy,e
+            self.counters['release_errors'] += 1
+
+    def loop(self):
+        while self.running:
+            try:
+                self.check()
+            except Exception, e:
+                print 'Error in drainer',e
+            self.clock.wait(self.wakeup, self.interval)
+            self.wakeup.clear()
+
+    def start(self):
+        """ Watch the drains in a background thread """
+
+        with self.lock:
+            if self.running:
+                return
+            self.running = True
+        self.thread = threading.Thread(target=self.loop, name='drainer')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """ Stop watching. Drains in progress are cut short so that no node
+        is left behind. """
+
+        self.running = False
+        self.wakeup.set()
+        if self.thread != None:
+            self.thread.join()
+        samples = self.poller.poll() or {}
+        for drain in self.pending():
+            sample = samples.get(drain.server)
+            self.finish(drain, 'stopped', sample.scur if sample != None else 0)
+
+    def stats(self):
+        """ Return the counters and the distribution of drain durations """
+
+        stats = dict(self.counters)
+        with self.lock:
+            stats['draining'] = len(self.drains)
+            durations = sorted(drain.duration() for drain in self.history)
+        if durations:
+            stats['duration'] = {'p50': round(durations[len(durations) // 2], 3),
+                                 'max': round(durations[-1], 3)}
+        return stats
+
+    def report(self):
+        lines = ['%-16s %-8s %-9s %9s %8s %6s' % ('proxy', 'server', 'outcome', 'duration', 'sessions', 'forced')]
+        with self.lock:
+            drains = list(self.history) + list(self.drains)
+        for drain in drains:
+            lines.append('%-16s %-8s %-9s %8.1fs %8s %6d' % (drain.proxy, drain.server, drain.outcome or 'draining',
+                                                             drain.duration(), drain.sessions, drain.forced))
+        return '\n'.join(lines)
+
+def demo(servers, deadline):
+    """ Drain busy servers of the fake admin socket, whose sessions finish
+    at random, a few of them never """
+
+    from fake_haproxy import FakeHAProxy
+    from haproxy_admin import HAProxyAdmin
+
+    path = os.path.join(tempfile.mkdtemp(prefix='drain'), 'admin.sock')
+    lb = FakeHAProxy(path).start()
+    for i in range(servers):
+        server = lb.state.add_server('squid%d' % (i + 1), '10.0.0.%d' % (i + 1))
+        server.scur = random.randint(0, 20)
+        server.admin = 'drain'
+
+    released = []
+    drainer = Drainer(HAProxyAdmin(path), released.append, deadline=deadline, interval=0.2)
+    for i in range(servers):
+        drainer.add('10.0.0.%d' % (i + 1), 'squid%d' % (i + 1), 1000 + i)
+
+    # Sessions end over time, but the last server has one which never does
+    stuck = lb.state.servers['squid%d' % servers]
+    stuck.scur += 1
+    while drainer.pending():
+        time.sleep(0.1)
+        for server in lb.state.servers.values():
+            if server.scur:
+                server.scur = max(1 if server is stuck else 0, server.scur - random.randint(0, 3))
+
+    drainer.stop()
+    print drainer.report()
+    print 'stats =>',drainer.stats()
+    print 'Released',len(released),'nodes, slots now',dict((name, s.admin) for name, s in lb.state.servers.items())
+    lb.stop()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog='drain')
+    parser.add_argument('--demo',help='Drain N busy servers of the fake admin socket', type=int, default=0)
+    parser.add_argument('-d','--deadline',help='Drain deadline in seconds', type=float, default=3.0)
+    args = parser.parse_args()
+
+    if args.demo:
+        demo(args.demo, args.deadline)
@@ -1,9 +1,11 @@
 from fabric.api import run
 from fabric.api import hosts, local, settings, abort
-from fabric.state import env
 
 import os
 
+from fleet import FleetExecutor, hosts_from_list
+from ssh_session import SessionManager
+
 def process_proxy_host():
     """ Post-process a proxy host """
 
@@ -23,12 +25,12 @@ def proxy_iptables():
     # get proxy list from proxylb
     local('scp alpha@proxylb:proxyrotate/proxies.list .')
     if os.path.isfile('proxies.list'):
-        for line in open('proxies.list'):
-            ip = line.strip().split(',')[0].strip()
-            env.host_string = ip
-            env.user = 'alpha'
-            print 'Restoring iptables rules on',ip,'...'
-            run('sudo iptables-restore < /etc/iptables.rules')
+        proxy_hosts = hosts_from_list('proxies.list')
+        print 'Restoring iptables rules on',len(proxy_hosts),'hosts ...'
+        fleet = FleetExecutor(SessionManager(user='alpha'))
+        fleet.run(proxy_hosts, 'sudo iptables-restore < /etc/iptables.rules').report()
+        fleet.close()
+        fleet.sessions.close_all()
 
 
 def install_keys():
@@ -37,11 +39,10 @@ def install_keys():
     # get proxy list from proxylb
     local('scp alpha@proxylb:proxyrotate/proxies.list .')
     if os.path.isfile('proxies.list'):
-        for line in open('proxies.list'):
-            ip = line.strip().split(',')[0].strip()
-            env.host_string = ip
-            env.user = 'alpha'
-            local('scp id_rsa.pub alpha@%s:' % ip)
-            run('cat id_rsa.pub >> .ssh/authorized_keys')
-
-
+        # The key is not there yet, so ssh may have to ask for a password -
+        # one host at a time, at the terminal
+        fleet = FleetExecutor(SessionManager(user='alpha', batch_mode=False), concurrency=1)
+        fleet.push(hosts_from_list('proxies.list'), 'id_rsa.pub', 'id_rsa.pub',
+                   commands=['cat id_rsa.pub >> .ssh/authorized_keys']).report()
+        fleet.close()
+        fleet.sessions.close_all()
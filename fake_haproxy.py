@@ -0,0 +1,216 @@
+"""
+
+Local stand-in for the HAProxy admin socket, for testing the runtime
+server updates offline.
+
+Serves a unix socket understanding the subset of admin commands the
+rotator uses, with server slots loaded from a rendered haproxy.cfg.
+`show stat` is synthesized from the fake servers' counters, or replayed
+from snapshots recorded with `haproxy_stats.py --record`.
+
+"""
+
+import re
+import os
+import sys
+import argparse
+import threading
+import SocketServer
+
+from haproxy_stats import stat_columns
+
+server_line_re = re.compile(r'server\s+(\S+)\s+([0-9.]+):(\d+)(.*)')
+set_addr_re = re.compile(r'set server (\S+)/(\S+) addr (\S+)(?: port (\d+))?$')
+set_state_re = re.compile(r'set server (\S+)/(\S+) state (ready|drain|maint)$')
+shutdown_re = re.compile(r'shutdown sessions server (\S+)/(\S+)$')
+
+# srv_admin_state flags as reported by `show servers state`
+admin_flags = {'ready': 0, 'maint': 0x01, 'drain': 0x08}
+
+class FakeServer(object):
+    """ One server slot in the fake backend """
+
+    def __init__(self, sid, name, addr, port, admin='ready'):
+        self.sid = sid
+        self.name = name
+        self.addr = addr
+        self.port = port
+        self.admin = admin
+        # Statistics reported by `show stat`, set by tests as needed
+        self.scur = 0
+        self.qcur = 0
+        self.rtime = 0
+        self.stot = 0
+        self.econ = 0
+        self.eresp = 0
+        self.hrsp_4xx = 0
+        self.hrsp_5xx = 0
+        self.bout = 0
+        self.check = 'UP'
+
+    def status(self):
+        return {'ready': self.check, 'drain': 'DRAIN', 'maint': 'MAINT'}[self.admin]
+
+    def stat_line(self, backend):
+        values = dict(pxname=backend, svname=self.name, qcur=self.qcur, scur=self.scur, stot=self.stot,
+                      bout=self.bout, econ=self.econ, eresp=self.eresp, status=self.status(),
+                      weight=1, act=1, bck=0, pid=1, iid=3, sid=self.sid, type=2,
+                      hrsp_4xx=self.hrsp_4xx, hrsp_5xx=self.hrsp_5xx, rtime=self.rtime)
+        return ','.join(str(values.get(col, '')) for col in stat_columns) + ','
+
+class FakeHAProxyState(object):
+    """ Backend servers and the admin commands acting on them """
+
+    def __init__(self, backend='rotateproxy'):
+        self.backend = backend
+        self.servers = {}
+        self.order = []
+        self.lock = threading.Lock()
+        # Every command received, for inspection by tests
+        self.history = []
+        # Recorded `show stat` snapshots to replay in turn
+        self.recording = []
+        self.replayed = 0
+
+    def load_recording(self, filename):
+        """ Load `show stat` snapshots separated by blank lines """
+
+        self.recording = [snap.strip() + '\n' for snap in open(filename).read().split('\n\n') if snap.strip()]
+
+    def show_stat(self):
+        if self.recording:
+            snap = self.recording[self.replayed % len(self.recording)]
+            self.replayed += 1
+            return snap + '\n'
+
+        lines = ['# ' + ','.join(stat_columns) + ',']
+        with self.lock:
+            for name in self.order:
+                lines.append(self.servers[name].stat_line(self.backend))
+        return '\n'.join(lines) + '\n\n'
+
+    def add_server(self, name, addr, port=8321, admin='ready'):
+        with self.lock:
+            server = FakeServer(len(self.order) + 1, name, addr, int(port), admin)
+            self.servers[name] = server
+            self.order.append(name)
+            return server
+
+    def load_config(self, filename):
+        """ Load server slots from a rendered haproxy.cfg """
+
+        for line in open(filename):
+            match = server_line_re.match(line.strip())
+            if match:
+                name, addr, port, rest = match.groups()
+                self.add_server(name, addr, port, 'maint' if ' disabled' in rest else 'ready')
+
+    def lookup(self, backend, name):
+        if backend != self.backend or name not in self.servers:
+            raise KeyError('No such server.')
+        return self.servers[name]
+
+    def run(self, command):
+        """ Execute a single admin command and return its output """
+
+        self.history.append(command)
+        try:
+            match = set_addr_re.match(command)
+            if match:
+                backend, name, addr, port = match.groups()
+                with self.lock:
+                    server = self.lookup(backend, name)
+                    old = server.addr
+                    server.addr = addr
+                    if port:
+                        server.port = int(port)
+                if old == addr:
+                    return 'no need to change the addr by \'stats socket command\'\n'
+                return 'IP changed from \'%s\' to \'%s\' by \'stats socket command\'\n' % (old, addr)
+
+            match = set_state_re.match(command)
+            if match:
+                backend, name, state = match.groups()
+                with self.lock:
+                    self.lookup(backend, name).admin = state
+                return ''
+
+            match = shutdown_re.match(command)
+            if match:
+                backend, name = match.groups()
+                with self.lock:
+                    self.lookup(backend, name).scur = 0
+                return ''
+
+            if command.startswith('show servers state'):
+                return self.show_servers_state()
+
+            if command.startswith('show stat'):
+                return self.show_stat()
+        except KeyError, e:
+            return e.args[0] + '\n'
+
+        return 'Unknown command.\n'
+
+    def show_servers_state(self):
+        lines = ['1', '# be_id be_name srv_id srv_name srv_addr srv_op_state srv_admin_state '
+                 'srv_uweight srv_iweight srv_time_since_last_change srv_check_status '
+                 'srv_check_result srv_check_health srv_check_state srv_agent_state '
+                 'bk_f_forced_id srv_f_forced_id srv_port']
+        with self.lock:
+            for name in self.order:
+                s = self.servers[name]
+                lines.append('3 %s %d %s %s 2 %d 1 1 0 6 3 4 6 0 0 0 %d' % (self.backend, s.sid, s.name,
+                                                                         s.addr, admin_flags[s.admin], s.port))
+        return '\n'.join(lines) + '\n\n'
+
+class FakeAdminHandler(SocketServer.StreamRequestHandler):
+    """ Handle one non-interactive admin socket connection """
+
+    def handle(self):
+        line = self.rfile.readline().strip()
+        output = [self.server.state.run(cmd.strip()) for cmd in line.split(';') if cmd.strip()]
+        self.wfile.write(''.join(output))
+
+class FakeHAProxy(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    """ Threaded fake admin socket server """
+
+    daemon_threads = True
+
+    def __init__(self, socket_path, state=None):
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        SocketServer.UnixStreamServer.__init__(self, socket_path, FakeAdminHandler)
+        self.socket_path = socket_path
+        self.state = state or FakeHAProxyState()
+
+    def start(self):
+        """ Serve in a background thread """
+
+        t = threading.Thread(target=self.serve_forever)
+        t.daemon = True
+        t.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        os.unlink(self.socket_path)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog='fake_haproxy')
+    parser.add_argument('config', help='Rendered haproxy.cfg to load server slots from')
+    parser.add_argument('-s','--socket',help='Socket path', default='/tmp/haproxy-admin.sock')
+    parser.add_argument('-r','--replay',help='Replay show stat snapshots recorded in this file', default=None)
+    args = parser.parse_args()
+
+    server = FakeHAProxy(args.socket)
+    server.state.load_config(args.config)
+    if args.replay:
+        server.state.load_recording(args.replay)
+    print 'Fake HAProxy admin socket at',args.socket,'with',len(server.state.order),'servers'
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.stop()
+        sys.exit(0)
@@ -0,0 +1,199 @@
+"""
+
+Local stand-in for the Linode HTTP API, for testing the API backend
+and the rotator offline.
+
+Implements the subset of API actions used by linode_api.LinodeAPI,
+including batch requests, over keep-alive HTTP/1.1. State lives in
+memory only.
+
+"""
+
+import sys
+import json
+import time
+import random
+import urlparse
+import threading
+import argparse
+import SocketServer
+import BaseHTTPServer
+
+class FakeLinodeState(object):
+    """ In-memory linode inventory """
+
+    def __init__(self, boot_delay=0.0, failure_rate=0.0, ip_factory=None, on_delete=None):
+        self.boot_delay = boot_delay
+        self.failure_rate = failure_rate
+        # Optional hooks giving new linodes their IP, e.g. of a local
+        # stand-in squid, and told the IP of every deleted linode
+        self.ip_factory = ip_factory
+        self.on_delete = on_delete
+        self.linodes = {}
+        self.ips = {}
+        self.next_id = 1000
+        self.lock = threading.Lock()
+        # Action => number of calls, for inspection by tests/benchmarks
+        self.calls = {}
+
+    def add(self, label, region, group='', ip=None, status=1):
+        """ Add a linode directly, returns its id """
+
+        if ip == None and self.ip_factory != None:
+            ip = self.ip_factory()
+        with self.lock:
+            self.next_id += 1
+            linode_id = self.next_id
+            self.linodes[linode_id] = {'LINODEID': linode_id, 'LABEL': label,
+                                       'DATACENTERID': int(region), 'STATUS': status,
+                                       'LPM_DISPLAYGROUP': group, 'BOOTED_AT': None}
+            self.ips[linode_id] = ip or '10.%d.%d.%d' % (linode_id // 65536 % 256,
+                                                         linode_id // 256 % 256, linode_id % 256)
+            return linode_id
+
+    def status(self, linode):
+        """ Return the current status, a booting linode runs after boot_delay """
+
+        if linode['BOOTED_AT'] != None and time.time() - linode['BOOTED_AT'] >= self.boot_delay:
+            linode['STATUS'], linode['BOOTED_AT'] = 1, None
+        return linode['STATUS']
+
+    def get(self, params):
+        linode = self.linodes.get(int(params.get('LinodeID', 0)))
+        if linode == None:
+            raise KeyError('LinodeID')
+        return linode
+
+    def listing(self, linode):
+        item = dict(linode)
+        item['STATUS'] = self.status(linode)
+        del item['BOOTED_AT']
+        return item
+
+    def dispatch(self, action, params):
+        """ Execute one API action and return its DATA """
+
+        self.calls[action] = self.calls.get(action, 0) + 1
+        if self.failure_rate and action == 'linode.create' and random.random() < self.failure_rate:
+            raise ValueError('Simulated create failure')
+
+        if action == 'test.echo':
+            return params
+
+        if action == 'linode.create':
+            linode_id = self.add('linode%d' % (self.next_id + 1), params['DatacenterID'], status=0)
+            return {'LinodeID': linode_id}
+
+        with self.lock:
+            if action == 'linode.list':
+                if 'LinodeID' in params:
+                    return [self.listing(self.get(params))]
+                return [self.listing(l) for l in self.linodes.values()]
+
+            if action == 'linode.ip.list':
+                ids = [int(params['LinodeID'])] if 'LinodeID' in params else self.ips.keys()
+                return [{'LINODEID': i, 'IPADDRESS': self.ips[i], 'ISPUBLIC': 1,
+                         'IPADDRESSID': i} for i in ids if i in self.ips]
+
+            linode = self.get(params)
+            if action in ('linode.disk.createfromimage', 'linode.disk.createfromdistribution'):
+                return {'DiskID': linode['LINODEID'] * 10, 'JobID': 1}
+            if action == 'linode.config.create':
+                return {'ConfigID': linode['LINODEID'] * 10 + 1}
+            if action == 'linode.boot':
+                linode['BOOTED_AT'] = time.time()
+                return {'JobID': 2}
+            if action == 'linode.update':
+                if 'Label' in params:
+                    linode['LABEL'] = params['Label']
+                if 'lpm_displayGroup' in params:
+                    linode['LPM_DISPLAYGROUP'] = params['lpm_displayGroup']
+                return {'LinodeID': linode['LINODEID']}
+            if action == 'linode.delete':
+                del self.linodes[linode['LINODEID']]
+                ip = self.ips.pop(linode['LINODEID'])
+                if self.on_delete != None:
+                    self.on_delete(ip)
+                return {'LinodeID': linode['LINODEID']}
+
+        raise ValueError('Unknown action %s' % action)
+
+    def respond(self, action, params):
+        """ Return the response envelope for an action """
+
+        try:
+            data, errors = self.dispatch(action, params), []
+        except KeyError, e:
+            data, errors = {}, [{'ERRORCODE': 5, 'ERRORMESSAGE': 'Object not found'}]
+        except ValueError, e:
+            data, errors = {}, [{'ERRORCODE': 4, 'ERRORMESSAGE': str(e)}]
+
+        return {'ACTION': action, 'DATA': data, 'ERRORARRAY': errors}
+
+class FakeAPIHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """ Handle API requests, keeping connections alive """
+
+    protocol_version = 'HTTP/1.1'
+    # Headers and body go out in separate writes
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        params = dict(urlparse.parse_qsl(self.rfile.read(length)))
+        self.reply(params)
+
+    def do_GET(self):
+        self.reply(dict(urlparse.parse_qsl(urlparse.urlsplit(self.path).query)))
+
+    def reply(self, params):
+        state = self.server.state
+        action = params.pop('api_action', '')
+        params.pop('api_key', None)
+
+        if action == 'batch':
+            requests = json.loads(params.get('api_requestArray', '[]'))
+            result = [state.respond(r.pop('api_action', ''), r) for r in requests]
+        else:
+            result = state.respond(action, params)
+
+        body = json.dumps(result)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class FakeLinodeServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """ Threaded fake API server. Use port 0 to pick a free port """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host='127.0.0.1', port=0, state=None):
+        BaseHTTPServer.HTTPServer.__init__(self, (host, port), FakeAPIHandler)
+        self.state = state or FakeLinodeState()
+        self.url = 'http://%s:%d/' % self.server_address
+
+    def start(self):
+        """ Serve in a background thread """
+
+        t = threading.Thread(target=self.serve_forever)
+        t.daemon = True
+        t.start()
+        return self
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog='fake_linode_api')
+    parser.add_argument('-p','--port',help='Port to listen on', type=int, default=8765)
+    parser.add_argument('-b','--boot-delay',help='Seconds a linode takes to boot', type=float, default=0)
+    args = parser.parse_args()
+
+    server = FakeLinodeServer(port=args.port, state=FakeLinodeState(boot_delay=args.boot_delay))
+    print 'Fake Linode API listening on',server.url
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        sys.exit(0)
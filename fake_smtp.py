@@ -0,0 +1,76 @@
+"""
+
+Local SMTP stand-in for testing notifications offline.
+
+Accepts mail on a local port, optionally taking `delay` seconds per
+message to play a slow server, and keeps every message and the number
+of connections made for inspection.
+
+"""
+
+import sys
+import time
+import smtpd
+import asyncore
+import argparse
+import threading
+
+class FakeSMTPServer(smtpd.SMTPServer):
+    """ Record messages instead of delivering them """
+
+    def __init__(self, host='127.0.0.1', port=0, delay=0.0):
+        smtpd.SMTPServer.__init__(self, (host, port), None)
+        self.port = self.socket.getsockname()[1]
+        self.delay = delay
+        # (from, recipients, data) of every message
+        self.messages = []
+        self.connections = 0
+        self.thread = None
+        self.serving = False
+
+    def handle_accept(self):
+        self.connections += 1
+        smtpd.SMTPServer.handle_accept(self)
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        if self.delay:
+            time.sleep(self.delay)
+        self.messages.append((mailfrom, rcpttos, data))
+
+    def serve(self):
+        while self.serving:
+            asyncore.loop(timeout=0.1, count=1)
+
+    def start(self):
+        """ Serve in a background thread """
+
+        self.serving = True
+        self.thread = threading.Thread(target=self.serve)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.serving = False
+        if self.thread != None:
+            self.thread.join()
+        asyncore.close_all()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog='fake_smtp')
+    parser.add_argument('-p','--port',help='Port to listen on', type=int, default=2525)
+    parser.add_argument('-d','--delay',help='Seconds to take per message', type=float, default=0.0)
+    args = parser.parse_args()
+
+    server = FakeSMTPServer(port=args.port, delay=args.delay)
+    print 'Fake SMTP server on port',server.port
+    try:
+        while True:
+            asyncore.loop(timeout=1.0, count=1)
+            for mailfrom, rcpttos, data in server.messages:
+                print 'From',mailfrom,'to',','.join(rcpttos)
+                print data
+                print
+            del server.messages[:]
+    except KeyboardInterrupt:
+        sys.exit(0)
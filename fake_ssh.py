@@ -0,0 +1,182 @@
+"""
+
+Local stand-in for the ssh client and the proxy nodes' sshd, for testing
+ssh_session offline.
+
+Understands the subset of ssh options ssh_session uses. A plain
+invocation pays a simulated handshake and runs the command locally.
+`-M -f -N -S path` pays the handshake once and forks a master serving
+commands over a unix socket at path until `-O exit` or until it has been
+idle for ControlPersist seconds. A client given `-S path` with a live
+master runs its command through it without a handshake.
+
+Environment:
+
+FAKE_SSH_HANDSHAKE - simulated handshake time in seconds (default 0.3)
+FAKE_SSH_DRYRUN    - if set, print commands instead of running them
+FAKE_SSH_FAIL      - comma separated hosts which refuse connections
+
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import threading
+import subprocess
+
+# Options taking a value
+value_options = set('bcDEeFIiJLlmOoSpQRWw')
+
+def parse_args(argv):
+    """ Return ({option: value}, target, command) from ssh style arguments """
+
+    opts, rest = {'o': {}}, list(argv)
+    while rest and rest[0].startswith('-'):
+        arg = rest.pop(0)
+        for idx, flag in enumerate(arg[1:]):
+            if flag in value_options:
+                value = arg[idx + 2:] or rest.pop(0)
+                if flag == 'o':
+                    key, val = value.split('=', 1)
+                    opts['o'][key] = val
+                else:
+                    opts[flag] = value
+                break
+            opts[flag] = True
+
+    target = rest.pop(0) if rest else None
+    return opts, target, ' '.join(rest)
+
+def host_of(target):
+    return target.split('@')[-1]
+
+def execute(command, data=''):
+    """ Run a command as the remote shell would. Returns (status, stdout, stderr) """
+
+    if os.environ.get('FAKE_SSH_DRYRUN'):
+        return 0, 'fake: %s\n' % command, ''
+    proc = subprocess.Popen(['/bin/sh', '-c', command], stdin=subprocess.PIPE,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    stdout, stderr = proc.communicate(data)
+    return proc.returncode, stdout, stderr
+
+def handshake(target):
+    time.sleep(float(os.environ.get('FAKE_SSH_HANDSHAKE', 0.3)))
+    if host_of(target) in os.environ.get('FAKE_SSH_FAIL', '').split(','):
+        sys.stderr.write('ssh: connect to host %s port 22: Connection refused\n' % host_of(target))
+        sys.exit(255)
+
+def request(path, message):
+    """ Send a message to the master at path, None if there is none """
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except socket.error:
+        return None
+    sock.sendall(json.dumps(message) + '\n')
+    data = ''
+    while not data.endswith('\n'):
+        chunk = sock.recv(65536)
+        if not chunk:
+            break
+        data += chunk
+    sock.close()
+    return json.loads(data) if data else None
+
+def handle(conn, done):
+    """ Serve one client connection - a channel of the master """
+
+    data = ''
+    while not data.endswith('\n'):
+        chunk = conn.recv(65536)
+        if not chunk:
+            break
+        data += chunk
+    message = json.loads(data)
+    if message['op'] == 'exit':
+        done.set()
+        reply = {'status': 0}
+    elif message['op'] == 'check':
+        reply = {'status': 0}
+    else:
+        status, stdout, stderr = execute(message['command'], message.get('stdin', '').decode('base64'))
+        reply = {'status': status, 'stdout': stdout, 'stderr': stderr}
+    try:
+        conn.sendall(json.dumps(reply) + '\n')
+    except socket.error:
+        # The client went away, e.g. killed on timeout
+        pass
+    conn.close()
+
+def serve_master(path, persist):
+    """ Serve commands on the control socket until told to exit or idle """
+
+    if os.path.exists(path):
+        os.unlink(path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen(16)
+    # Wake up regularly to notice an exit request
+    server.settimeout(0.1)
+    done = threading.Event()
+    last = time.time()
+
+    while not done.is_set():
+        try:
+            conn, addr = server.accept()
+        except socket.timeout:
+            if persist and time.time() - last > persist:
+                break
+            continue
+        last = time.time()
+        conn.settimeout(None)
+        t = threading.Thread(target=handle, args=(conn, done))
+        t.daemon = True
+        t.start()
+
+    server.close()
+    os.unlink(path)
+
+def main(argv):
+    opts, target, command = parse_args(argv)
+    path = opts.get('S')
+
+    if opts.get('O'):
+        reply = path and request(path, {'op': opts['O']})
+        if reply == None:
+            sys.stderr.write('Control socket connect(%s): No such file or directory\n' % path)
+            return 255
+        return reply['status']
+
+    if opts.get('M'):
+        handshake(target)
+        persist = opts['o'].get('ControlPersist', '0')
+        persist = 0 if persist in ('yes', 'no') else float(persist)
+        if opts.get('f') and os.fork():
+            # Like ssh -f, return once the master is ready
+            while not os.path.exists(path):
+                time.sleep(0.005)
+            return 0
+        if opts.get('f'):
+            os.setsid()
+            devnull = os.open(os.devnull, os.O_RDWR)
+            for fd in (0, 1, 2):
+                os.dup2(devnull, fd)
+        serve_master(path, persist)
+        return 0
+
+    data = '' if sys.stdin.isatty() else sys.stdin.read()
+    reply = path and request(path, {'op': 'run', 'command': command, 'stdin': data.encode('base64')})
+    if reply == None:
+        handshake(target)
+        status, stdout, stderr = execute(command, data)
+        reply = {'status': status, 'stdout': stdout, 'stderr': stderr}
+    sys.stdout.write(reply['stdout'])
+    sys.stderr.write(reply['stderr'])
+    return reply['status']
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,277 @@
+"""
+
+Parallel command execution across the proxy fleet.
+
+FleetExecutor runs a batch of commands, or pushes a file, on many nodes
+at once over the multiplexed ssh sessions of ssh_session. Nodes are
+taken in rolling batches of a percentage of the selection, so only that
+share of the LB pool is touched at a time, optionally drained in HAProxy
+while it is worked on. Within a batch up to `concurrency` hosts run in
+parallel, each command bounded by the per-host timeout. Results are
+collected into a FleetReport.
+
+Hosts come from the proxy state (ProxyConfig.proxy_dict), filtered by
+region or address, or from a proxies.list file.
+
+Usage: fleet.py [options] run COMMAND... | push LOCAL REMOTE
+
+"""
+
+import sys
+import math
+import time
+import argparse
+import threading
+
+from multiprocessing.pool import ThreadPool
+
+from ssh_session import SessionManager, CommandResult, timeout_status
+
+class HostResult(object):
+    """ Outcome of the commands run on one host """
+
+    __slots__ = ('host', 'results', 'elapsed', 'batch')
+
+    def __init__(self, host, results, elapsed, batch=0):
+        self.host = host
+        self.results = results
+        self.elapsed = elapsed
+        self.batch = batch
+
+    @property
+    def ok(self):
+        return all(r.ok for r in self.results)
+
+    @property
+    def timed_out(self):
+        return any(r.timed_out for r in self.results)
+
+    def failed_command(self):
+        for r in self.results:
+            if not r.ok:
+                return r
+        return None
+
+class FleetReport(object):
+    """ Aggregated results of a fleet run """
+
+    def __init__(self, commands):
+        self.commands = commands
+        # Host => HostResult
+        self.results = {}
+        self.batches = 0
+        self.elapsed = 0.0
+        # Hosts not run on as the run was aborted
+        self.skipped = []
+        self.lock = threading.Lock()
+
+    def add(self, result):
+        with self.lock:
+            self.results[result.host] = result
+
+    def ok(self):
+        return sorted(h for h, r in self.results.items() if r.ok)
+
+    def failed(self):
+        return sorted(h for h, r in self.results.items() if not r.ok)
+
+    def summary(self):
+        times = sorted(r.elapsed for r in self.results.values())
+        return {'hosts': len(self.results), 'ok': len(self.ok()), 'failed': len(self.failed()),
+                'timed_out': len([r for r in self.results.values() if r.timed_out]),
+                'skipped': len(self.skipped), 'batches': self.batches, 'elapsed': round(self.elapsed, 3),
+                'max_host_time': round(times[-1], 3) if times else 0.0}
+
+    def report(self, verbose=False):
+        """ Print the failures (or every host if verbose) and the summary """
+
+        for host in sorted(self.results):
+            result = self.results[host]
+            failed = result.failed_command()
+            if failed == None and not verbose:
+                continue
+            state = 'ok' if failed == None else ('timed out' if failed.timed_out else 'exit %d' % failed.status)
+            print '%-16s batch %-3d %-10s %7.2fs %s' % (host, result.batch, state, result.elapsed,
+                                                       (failed and failed.command) or '')
+            if failed != None and failed.stderr.strip():
+                print '  stderr:',failed.stderr.strip().splitlines()[-1]
+        if self.skipped:
+            print 'Skipped after abort:',' '.join(self.skipped)
+        print 'Fleet summary =>',self.summary()
+        return self
+
+class FleetExecutor(object):
+    """ Run commands across many hosts with bounded concurrency in
+    rolling batches """
+
+    def __init__(self, sessions, concurrency=16, timeout=120, batch_percent=100, batch_pause=0,
+                 max_failures=None):
+        self.sessions = sessions
+        self.concurrency = concurrency
+        # Per host, per command timeout
+        self.timeout = timeout
+        # Share of the selected hosts worked on at a time
+        self.batch_percent = batch_percent
+        self.batch_pause = batch_pause
+        # Abort the run after more than this many failed hosts
+        self.max_failures = max_failures
+        self.pool = ThreadPool(concurrency)
+
+    @classmethod
+    def from_config(cls, config, sessions=None, **overrides):
+        """ Create an executor from the "fleet" section of proxy.conf, with
+        any non-None overrides applied """
+
+        settings = dict(config.fleet or {})
+        settings.update((key, value) for key, value in overrides.items() if value != None)
+        max_failures = settings.get('max_failures')
+        return cls(sessions or SessionManager.from_config(config),
+                   concurrency=int(settings.get('concurrency', 16)),
+                   timeout=float(settings.get('timeout', 120)),
+                   batch_percent=float(settings.get('batch_percent', 100)),
+                   batch_pause=float(settings.get('batch_pause', 0)),
+                   max_failures=int(max_failures) if max_failures != None else None)
+
+    def batches(self, hosts):
+        """ Split hosts into rolling batches of batch_percent """
+
+        size = max(1, int(math.ceil(len(hosts) * self.batch_percent / 100.0)))
+        return [hosts[i:i + size] for i in range(0, len(hosts), size)]
+
+    def run_host(self, host, commands, batch=0, push=None):
+        """ Run commands on one host, stopping at the first failure. push is
+        an optional (local, remote, mode) file to copy first. """
+
+        start = time.time()
+        session = self.sessions.session(host)
+        results = []
+        try:
+            if push:
+                results.append(session.push(push[0], push[1], self.timeout, push[2]))
+            if not results or results[-1].ok:
+                results.extend(session.run_batch(commands, self.timeout, stop_on_error=True))
+        except Exception, e:
+            # An unexpected local failure must not take the whole run down
+            results.append(CommandResult(host, ' && '.join(commands), timeout_status, stderr=str(e)))
+        return HostResult(host, results, time.time() - start, batch)
+
+    def submit(self, host, commands):
+        """ Queue commands for one host, returning an AsyncResult of its HostResult """
+
+        return self.pool.apply_async(self.run_host, (host, commands))
+
+    def run(self, hosts, commands, push=None, before_batch=None, after_batch=None):
+        """ Run commands on hosts in rolling batches and return a FleetReport.
+        before_batch and after_batch are called with the hosts of each batch,
+        e.g. to drain them from the load balancer and bring them back. """
+
+        if isinstance(commands, basestring):
+            commands = [commands]
+        report = FleetReport(commands)
+        start = time.time()
+        batches = self.batches(list(hosts))
+
+        for idx, batch in enumerate(batches):
+            if self.max_failures != None and len(report.failed()) > self.max_failures:
+                print 'Too many failures, aborting fleet run'
+                report.skipped = [h for b in batches[idx:] for h in b]
+                break
+            if idx and self.batch_pause:
+                time.sleep(self.batch_pause)
+
+            print 'Batch %d/%d: %d hosts' % (idx + 1, len(batches), len(batch))
+            if before_batch:
+                before_batch(batch)
+            try:
+                for result in self.pool.imap_unordered(lambda h: self.run_host(h, commands, idx + 1, push), batch):
+                    report.add(result)
+            finally:
+                if after_batch:
+                    # Bring back only the hosts which came through fine
+                    after_batch([h for h in batch if h in report.results and report.results[h].ok])
+            report.batches += 1
+
+        report.elapsed = time.time() - start
+        return report
+
+    def push(self, hosts, local_path, remote_path, mode=None, commands=(), **kwargs):
+        """ Copy a file to hosts, then run commands on those which got it """
+
+        return self.run(hosts, list(commands), push=(local_path, remote_path, mode), **kwargs)
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+def select_hosts(config, regions=None, hosts=None, inactive=False):
+    """ Return proxy IPs from the proxy state, optionally only of the given
+    regions or addresses and including switched out proxies """
+
+    selected = []
+    for ip, record in config.proxy_dict.items():
+        if not inactive and not record.active:
+            continue
+        if regions and record.region not in regions:
+            continue
+        if hosts and ip not in hosts:
+            continue
+        selected.append(ip)
+    return sorted(selected)
+
+def hosts_from_list(filename='proxies.list'):
+    """ Return the proxy IPs of a proxies.list file """
+
+    return [line.split(',')[0].strip() for line in open(filename) if line.strip()]
+
+def lb_drain_hooks(config):
+    """ Return (before, after) batch hooks putting the LB slots of a batch
+    into maintenance and back to ready through the admin socket """
+
+    def set_state(hosts, state):
+        cmds = [config.lb_admin.server_state_cmd(config.slot_name(h), state)
+                for h in hosts if h in config.slot_of]
+        if cmds:
+            config.lb_admin.execute(*cmds)
+
+    return (lambda hosts: set_state(hosts, 'maint')), (lambda hosts: set_state(hosts, 'ready'))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog='fleet')
+    parser.add_argument('-C','--conf',help='Use the given configuration file', default='proxy.conf')
+    parser.add_argument('-l','--list',help='Take hosts from a proxies.list file instead of the state', default=None)
+    parser.add_argument('-r','--region',help='Only hosts in this region (repeatable)', type=int, action='append')
+    parser.add_argument('-H','--host',help='Only this host (repeatable)', action='append')
+    parser.add_argument('-j','--concurrency',help='Hosts worked on in parallel', type=int, default=None)
+    parser.add_argument('-t','--timeout',help='Per host command timeout', type=float, default=None)
+    parser.add_argument('-b','--batch-percent',help='Rolling batch size in percent of hosts', type=float, default=None)
+    parser.add_argument('--drain',help='Put each batch into maintenance on the LB while it runs', action='store_true')
+    parser.add_argument('-v','--verbose',help='Report every host', action='store_true')
+    parser.add_argument('action', choices=('run', 'push'))
+    parser.add_argument('args', nargs='+', help='Commands to run, or LOCAL REMOTE [COMMAND...] to push')
+    args = parser.parse_args()
+
+    from rotate_proxies import ProxyConfig
+
+    config = ProxyConfig(args.conf, read_only=True)
+    fleet = FleetExecutor.from_config(config, concurrency=args.concurrency, timeout=args.timeout,
+                                      batch_percent=args.batch_percent)
+
+    if args.list:
+        hosts = [h for h in hosts_from_list(args.list) if not args.host or h in args.host]
+    else:
+        hosts = select_hosts(config, args.region, args.host)
+    print 'Running on',len(hosts),'hosts ...'
+
+    before, after = lb_drain_hooks(config) if args.drain else (None, None)
+    if args.action == 'run':
+        report = fleet.run(hosts, args.args, before_batch=before, after_batch=after)
+    else:
+        if len(args.args) < 2:
+            parser.error('push needs LOCAL and REMOTE paths')
+        report = fleet.push(hosts, args.args[0], args.args[1], commands=args.args[2:],
+                            before_batch=before, after_batch=after)
+
+    report.report(args.verbose)
+    fleet.close()
+    fleet.sessions.close_all()
+    sys.exit(1 if report.failed() or report.skipped else 0)
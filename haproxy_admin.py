@@ -0,0 +1,88 @@
+"""
+
+Client for the HAProxy runtime admin socket.
+
+Lets the rotator repoint and enable/disable pre-declared server slots
+(`set server addr`, `set server state`) without restarting HAProxy.
+
+"""
+
+import socket
+
+# Informational replies to `set server addr`
+success_prefixes = ('IP changed', 'no need to change', 'port changed')
+
+class HAProxyAdminError(Exception):
+    """ Error talking to, or returned by, the HAProxy admin socket """
+    pass
+
+class HAProxyAdmin(object):
+    """ Send commands to the HAProxy stats socket at admin level """
+
+    def __init__(self, socket_path='/run/haproxy/admin.sock', backend='rotateproxy', timeout=5):
+        self.socket_path = socket_path
+        self.backend = backend
+        self.timeout = timeout
+
+    def command(self, *commands):
+        """ Send one or more commands over a single connection and return
+        the raw output """
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.socket_path)
+            sock.sendall('; '.join(commands) + '\n')
+            chunks = []
+            while True:
+                chunk = sock.recv(65536)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+        except socket.error, e:
+            raise HAProxyAdminError('%s: %s' % (self.socket_path, e))
+        finally:
+            sock.close()
+
+        return ''.join(chunks)
+
+    def execute(self, *commands):
+        """ Run state changing commands, raising HAProxyAdminError if HAProxy
+        reports an error. `set server state` is silent on success while
+        `set server addr` reports the address change. """
+
+        for line in self.command(*commands).split('\n'):
+            line = line.strip()
+            if line and not line.startswith(success_prefixes):
+                raise HAProxyAdminError(line)
+
+    def server_addr_cmd(self, server, ip, port=8321):
+        return 'set server %s/%s addr %s port %d' % (self.backend, server, ip, port)
+
+    def server_state_cmd(self, server, state):
+        # state is one of ready, drain or maint
+        return 'set server %s/%s state %s' % (self.backend, server, state)
+
+    def set_server_addr(self, server, ip, port=8321):
+        """ Point the given server slot at ip:port """
+
+        self.execute(self.server_addr_cmd(server, ip, port))
+
+    def set_server_state(self, server, state):
+        """ Set the administrative state of a server slot """
+
+        self.execute(self.server_state_cmd(server, state))
+
+    def show_servers_state(self):
+        """ Return {server name: (addr, admin state)} for our backend """
+
+        servers = {}
+        for line in self.command('show servers state %s' % self.backend).split('\n'):
+            fields = line.split()
+            # Skip the version line, header comment and other backends
+            if len(fields) < 7 or line.startswith('#') or fields[1] != self.backend:
+                continue
+            # be_id be_name srv_id srv_name srv_addr srv_op_state srv_admin_state ...
+            servers[fields[3]] = (fields[4], int(fields[6]))
+
+        return servers
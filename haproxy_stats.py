@@ -0,0 +1,293 @@
+"""
+
+HAProxy stats scraper.
+
+Polls `show stat` on the admin socket at a fixed interval, parses only
+the columns the rotator needs and keeps a ring buffer of samples plus
+exponentially smoothed values for every squidN server of the backend.
+
+Run with --bench to measure the per-poll parsing overhead against the
+fake admin socket, or --record to capture `show stat` snapshots for
+replaying through fake_haproxy.
+
+"""
+
+import sys
+import time
+import random
+import operator
+import argparse
+import threading
+import collections
+
+from haproxy_admin import HAProxyAdmin, HAProxyAdminError
+
+# Columns of `show stat` as of HAProxy 1.7
+stat_columns = ('pxname,svname,qcur,qmax,scur,smax,slim,stot,bin,bout,dreq,dresp,ereq,econ,eresp,'
+                'wretr,wredis,status,weight,act,bck,chkfail,chkdown,lastchg,downtime,qlimit,pid,iid,'
+                'sid,throttle,lbtot,tracked,type,rate,rate_lim,rate_max,check_status,check_code,'
+                'check_duration,hrsp_1xx,hrsp_2xx,hrsp_3xx,hrsp_4xx,hrsp_5xx,hrsp_other,hanafail,'
+                'req_rate,req_rate_max,req_tot,cli_abrt,srv_abrt,comp_in,comp_out,comp_byp,comp_rsp,'
+                'lastsess,last_chk,last_agt,qtime,ctime,rtime,ttime').split(',')
+
+# The columns we keep, in Sample order
+sample_columns = ('scur', 'qcur', 'rtime', 'stot', 'econ', 'eresp', 'hrsp_4xx', 'hrsp_5xx', 'bout')
+
+Sample = collections.namedtuple('Sample', ('ts', 'status') + sample_columns)
+
+# Gauges are smoothed directly, counters are turned into per second rates
+gauges = ('scur', 'qcur', 'rtime')
+counters = ('stot', 'econ', 'eresp', 'hrsp_4xx', 'hrsp_5xx', 'bout')
+
+class ServerStats(object):
+    """ Sample history and smoothed values of one server """
+
+    __slots__ = ('samples', 'smoothed')
+
+    def __init__(self, history):
+        self.samples = collections.deque(maxlen=history)
+        self.smoothed = {}
+
+    def update(self, sample, alpha):
+        """ Add a sample and fold it into the smoothed values """
+
+        values = dict((name, getattr(sample, name)) for name in gauges)
+        if self.samples:
+            prev = self.samples[-1]
+            elapsed = sample.ts - prev.ts
+            if elapsed > 0:
+                for name in counters:
+                    # A counter going backwards means HAProxy was reloaded
+                    delta = getattr(sample, name) - getattr(prev, name)
+                    values[name + '_rate'] = max(delta, 0) / elapsed
+
+        for name, value in values.items():
+            old = self.smoothed.get(name)
+            self.smoothed[name] = value if old == None else old + alpha * (value - old)
+        self.samples.append(sample)
+
+class StatsPoller(object):
+    """ Poll HAProxy server statistics from the admin socket """
+
+    def __init__(self, admin, interval=10.0, history=60, alpha=0.3):
+        self.admin = admin
+        self.backend = admin.backend
+        self.interval = interval
+        self.alpha = alpha
+        self.history = history
+        # Server name => ServerStats
+        self.servers = {}
+        self.header = None
+        self.getter = None
+        # Raw `show stat` line => (name, status, values) of the last poll
+        self.parsed = {}
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.running = False
+        self.polls = 0
+        self.errors = 0
+        self.poll_time = 0.0
+
+    @classmethod
+    def from_config(cls, admin, config):
+        """ Create a poller from the "lb_stats" section of proxy.conf """
+
+        settings = config.lb_stats or {}
+        return cls(admin, interval=float(settings.get('interval', 10)),
+                   history=int(settings.get('history', 60)),
+                   alpha=float(settings.get('alpha', 0.3)))
+
+    def parse(self, data, now=None):
+        """ Parse `show stat` output into {server name: Sample} for our backend """
+
+        now = now or time.time()
+        lines = data.split('\n')
+        header = lines[0]
+        if header != self.header:
+            names = header.lstrip('# ').split(',')
+            self.getter = operator.itemgetter(*[names.index(name) for name in sample_columns])
+            self.status_idx = names.index('status')
+            self.header = header
+            self.parsed = {}
+
+        backend = self.backend + ','
+        getter, status_idx = self.getter, self.status_idx
+        # Lines identical to the previous poll (idle servers) are not split again
+        previous, parsed = self.parsed, {}
+        samples = {}
+        for line in lines[1:]:
+            if not line.startswith(backend):
+                continue
+            row = previous.get(line)
+            if row == None:
+                fields = line.split(',')
+                if fields[1] == 'BACKEND':
+                    continue
+                values = getter(fields)
+                try:
+                    values = map(int, values)
+                except ValueError:
+                    # Empty columns, e.g. rtime before any response
+                    values = [int(v or 0) for v in values]
+                row = (fields[1], fields[status_idx], values)
+            parsed[line] = row
+            name, status, values = row
+            samples[name] = Sample(now, status, *values)
+
+        self.parsed = parsed
+        return samples
+
+    def poll(self, now=None):
+        """ Fetch and record one round of samples """
+
+        start = time.time()
+        try:
+            # Servers only (type mask 4) of every proxy
+            data = self.admin.command('show stat -1 4 -1')
+        except HAProxyAdminError, e:
+            self.errors += 1
+            print 'Error polling LB stats',e
+            return None
+
+        samples = self.parse(data, now)
+        with self.lock:
+            for name, sample in samples.items():
+                stats = self.servers.get(name)
+                if stats == None:
+                    stats = self.servers[name] = ServerStats(self.history)
+                stats.update(sample, self.alpha)
+        self.polls += 1
+        self.poll_time += time.time() - start
+        return samples
+
+    def current(self, server):
+        """ Return the latest Sample of a server, None if never seen """
+
+        with self.lock:
+            stats = self.servers.get(server)
+            return stats.samples[-1] if stats and stats.samples else None
+
+    def smoothed(self, server):
+        """ Return the smoothed gauges and counter rates of a server """
+
+        with self.lock:
+            stats = self.servers.get(server)
+            return dict(stats.smoothed) if stats else {}
+
+    def samples(self, server):
+        """ Return the sample history of a server, oldest first """
+
+        with self.lock:
+            stats = self.servers.get(server)
+            return list(stats.samples) if stats else []
+
+    def forget(self, server):
+        """ Drop the history of a server, e.g. when its slot is reused """
+
+        with self.lock:
+            self.servers.pop(server, None)
+
+    def loop(self):
+        while self.running:
+            try:
+                self.poll()
+            except Exception, e:
+                # E.g. an empty or garbled `show stat` - keep polling
+                self.errors += 1
+                print 'Error parsing LB stats',e
+            self.wakeup.wait(self.interval)
+
+    def start(self):
+        """ Start polling in a background thread """
+
+        self.running = True
+        t = threading.Thread(target=self.loop, name='lb-stats')
+        t.daemon = True
+        t.start()
+
+    def stop(self):
+        self.running = False
+        self.wakeup.set()
+
+def benchmark(servers, rounds, busy=0.2):
+    """ Measure poll overhead for a number of servers on the fake socket,
+    with a fraction of busy servers whose counters move between polls """
+
+    import os
+    import tempfile
+    from fake_haproxy import FakeHAProxy
+
+    path = os.path.join(tempfile.mkdtemp(), 'admin.sock')
+    fake = FakeHAProxy(path).start()
+    for i in range(servers):
+        server = fake.state.add_server('squid%d' % (i + 1), '10.0.%d.%d' % (i // 256, i % 256))
+        server.scur, server.stot, server.rtime = random.randrange(50), random.randrange(10**6), random.randrange(900)
+
+    poller = StatsPoller(HAProxyAdmin(path))
+    data = poller.admin.command('show stat -1 4 -1')
+
+    start = time.time()
+    for i in range(rounds):
+        poller.parsed = {}
+        poller.parse(data)
+    cold = (time.time() - start) / rounds
+
+    busy_servers = random.sample(fake.state.servers.values(), int(servers * busy))
+    snapshots = []
+    for i in range(rounds):
+        for server in busy_servers:
+            server.stot += random.randrange(1, 20)
+            server.scur = random.randrange(50)
+        snapshots.append(fake.state.show_stat())
+
+    start = time.time()
+    for data in snapshots:
+        poller.parse(data)
+    parse = (time.time() - start) / rounds
+
+    start = time.time()
+    for i in range(rounds):
+        poller.poll()
+    poll = (time.time() - start) / rounds
+    fake.stop()
+    os.rmdir(os.path.dirname(path))
+
+    print 'Servers: %d, rounds: %d' % (servers, rounds)
+    print 'Parse, every line new:   %7.3f ms per poll' % (cold * 1000)
+    print 'Parse, %3d%% busy:         %7.3f ms per poll' % (busy * 100, parse * 1000)
+    print 'Socket + parse + record: %7.3f ms per poll' % (poll * 1000)
+    print 'Smoothed squid1 =>',poller.smoothed('squid1')
+
+def record(admin, path, count, interval):
+    """ Append `show stat` snapshots to path, separated by blank lines """
+
+    f = open(path, 'a')
+    for i in range(count):
+        f.write(admin.command('show stat -1 4 -1').strip() + '\n\n')
+        f.flush()
+        if i < count - 1:
+            time.sleep(interval)
+    f.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog='haproxy_stats')
+    parser.add_argument('-s','--socket',help='Admin socket path', default='/run/haproxy/admin.sock')
+    parser.add_argument('--bench',help='Benchmark polling N servers', type=int, default=0)
+    parser.add_argument('--record',help='Record show stat snapshots to the given file', default=None)
+    parser.add_argument('--busy',help='Fraction of servers changing between benchmark polls', type=float, default=0.2)
+    parser.add_argument('-n','--count',help='Rounds to benchmark or snapshots to record', type=int, default=1000)
+    parser.add_argument('-i','--interval',help='Seconds between recorded snapshots', type=float, default=10)
+    args = parser.parse_args()
+
+    if args.bench:
+        benchmark(args.bench, args.count, args.busy)
+        sys.exit(0)
+
+    admin = HAProxyAdmin(args.socket)
+    if args.record:
+        record(admin, args.record, args.count, args.interval)
+        sys.exit(0)
+
+    poller = StatsPoller(admin)
+    for name, sample in sorted(poller.poll().items()):
+        print name, sample
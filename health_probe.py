@@ -0,0 +1,382 @@
+"""
+
+Concurrent health prober for the squid backends behind HAProxy.
+
+Every backend is checked at the same time (bounded by a concurrency cap)
+with an in-process TCP connect followed by a real proxied HTTP request
+through squid. Restarts of dead squid instances run on a separate bounded
+worker pool so that slow ssh restarts never hold up a sweep.
+
+Run with --bench to compare the legacy serial sweep against the concurrent
+one on local stand-in listeners.
+
+"""
+
+import re
+import os
+import sys
+import json
+import time
+import socket
+import base64
+import random
+import argparse
+import threading
+import urlparse
+
+from multiprocessing.pool import ThreadPool
+
+server_re = re.compile(r'server\s+([a-zA-Z0-9]+)\s+(\d+\.\d+\.\d+\.\d+)\:(\d+)*')
+squid_restart_cmd = 'ssh -o StrictHostKeyChecking=no -o UserKnownHostsFile=/dev/null ubuntu@%s "sudo squid3 -f /etc/squid3/squid.conf"'
+# The same, run through a fleet.FleetExecutor
+squid_start_cmd = 'sudo squid3 -f /etc/squid3/squid.conf'
+
+# Default probe settings, overridden by the "probe" section of proxy.conf
+probe_defaults = {'concurrency': 32,
+                  'timeout': 5,
+                  'url': 'http://www.google.com/',
+                  'auth': '',
+                  'restart_workers': 4}
+
+def load_probe_config(cfg='proxy.conf'):
+    """ Load probe settings from the given config file, falling back to defaults """
+
+    settings = dict(probe_defaults)
+    try:
+        settings.update(json.load(open(cfg)).get('probe', {}))
+    except (OSError, IOError, ValueError):
+        pass
+
+    return settings
+
+def parse_lb_servers(filename='/etc/haproxy/haproxy.cfg', disabled=False):
+    """ Return a list of (server name, ip, port) tuples from the HAProxy config.
+    Spare server slots declared `disabled` are skipped unless asked for. """
+
+    servers = []
+    for line in open(filename).readlines():
+        line = line.strip()
+        if not line.startswith('server'): continue
+        if not disabled and ' disabled' in line: continue
+
+        match = server_re.match(line)
+        if match == None: continue
+        name, ip_address, port = match.groups()
+        servers.append((name, ip_address, int(port or 8321)))
+
+    return servers
+
+class ProbeResult(object):
+    """ Outcome of probing a single backend """
+
+    def __init__(self, name, ip, port):
+        self.name = name
+        self.ip = ip
+        self.port = port
+        self.ok = False
+        # Stage at which the probe failed - 'tcp' or 'http'
+        self.stage = None
+        self.status = None
+        self.error = None
+        self.elapsed = 0.0
+
+    def __repr__(self):
+        if self.ok:
+            return '<ProbeResult %s %s:%d ok %d %.3fs>' % (self.name, self.ip, self.port,
+                                                          self.status, self.elapsed)
+        return '<ProbeResult %s %s:%d failed at %s (%s) %.3fs>' % (self.name, self.ip, self.port,
+                                                                   self.stage, self.error, self.elapsed)
+
+def tcp_probe(ip, port, timeout=5):
+    """ Return a connected socket to ip:port, raising socket.error on failure """
+
+    sock = socket.create_connection((ip, port), timeout)
+    sock.settimeout(timeout)
+    return sock
+
+def build_proxy_request(url, auth=None):
+    """ Build a proxied request for url. HTTPS urls are probed with CONNECT,
+    everything else with an absolute-URI GET """
+
+    parts = urlparse.urlsplit(url)
+    headers = []
+    if parts.scheme == 'https':
+        target = '%s:%d' % (parts.hostname, parts.port or 443)
+        headers.append('CONNECT %s HTTP/1.1' % target)
+        headers.append('Host: %s' % target)
+    else:
+        headers.append('GET %s HTTP/1.1' % url)
+        headers.append('Host: %s' % parts.netloc)
+        headers.append('Connection: close')
+
+    if auth:
+        headers.append('Proxy-Authorization: Basic %s' % base64.b64encode(auth))
+
+    return '\r\n'.join(headers) + '\r\n\r\n'
+
+def read_status(sock):
+    """ Read the response status line from sock and return the status code """
+
+    data = ''
+    while '\r\n' not in data:
+        chunk = sock.recv(1024)
+        if not chunk:
+            break
+        data += chunk
+        if len(data) > 8192:
+            break
+
+    line = data.split('\r\n', 1)[0]
+    fields = line.split(None, 2)
+    if len(fields) < 2 or not fields[0].startswith('HTTP/'):
+        raise ValueError('bad status line %r' % line[:80])
+
+    return int(fields[1])
+
+def http_probe(sock, url, auth=None):
+    """ Send a proxied request for url over sock and return the status code """
+
+    sock.sendall(build_proxy_request(url, auth))
+    return read_status(sock)
+
+class HealthProber(object):
+    """ Probe all squid backends concurrently with a per-probe timeout """
+
+    def __init__(self, concurrency=32, timeout=5, url=None, auth=None):
+        self.concurrency = concurrency
+        self.timeout = timeout
+        # If url is None only the TCP connect is performed
+        self.url = url
+        self.auth = auth
+        self.pool = None
+
+    def probe(self, server):
+        """ Probe a single (name, ip, port) backend and return a ProbeResult """
+
+        name, ip, port = server
+        result = ProbeResult(name, ip, port)
+        start = time.time()
+        sock = None
+        try:
+            result.stage = 'tcp'
+            sock = tcp_probe(ip, port, self.timeout)
+            if self.url:
+                result.stage = 'http'
+                # Whatever is left of the timeout applies to the request
+                sock.settimeout(max(0.01, self.timeout - (time.time() - start)))
+                result.status = http_probe(sock, self.url, self.auth)
+                # 407 means squid is rejecting our credentials and 5xx
+                # means it could not fetch anything - neither is serving.
+                if result.status == 407 or result.status >= 500:
+                    raise ValueError('proxy returned status %d' % result.status)
+            else:
+                result.status = 0
+            result.ok, result.stage = True, None
+        except (socket.error, socket.timeout, ValueError), e:
+            result.error = str(e) or e.__class__.__name__
+        finally:
+            if sock != None:
+                sock.close()
+
+        result.elapsed = time.time() - start
+        return result
+
+    def sweep(self, servers):
+        """ Probe all servers concurrently and return a list of ProbeResults
+        in the same order """
+
+        if len(servers) == 0:
+            return []
+
+        if self.pool == None:
+            self.pool = ThreadPool(self.concurrency)
+
+        return self.pool.map(self.probe, servers, chunksize=1)
+
+    def close(self):
+        """ Shut down the probe workers """
+
+        if self.pool != None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+class RestartPool(object):
+    """ Bounded pool of workers restarting squid on dead nodes. A node which
+    already has a restart in flight is not queued again. """
+
+    def __init__(self, workers=4, command=squid_restart_cmd, restart_func=None, fleet=None):
+        self.command = command
+        # Optional fleet.FleetExecutor to restart through, on its workers
+        self.fleet = fleet
+        self.restart_func = restart_func or self.restart
+        self.pool = fleet.pool if fleet else ThreadPool(workers)
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    def restart(self, ip):
+        """ Restart squid on the given IP, return True on success """
+
+        print 'Restarting squid on',ip,'...'
+        if self.fleet:
+            result = self.fleet.run_host(ip, [squid_start_cmd])
+            if not result.ok:
+                print 'Restart failed on',ip,result.failed_command()
+            return result.ok
+        return os.system(self.command % ip) == 0
+
+    def submit(self, ip):
+        """ Queue a restart for ip. Returns False if one is already in flight """
+
+        with self.lock:
+            pending = self.pending.get(ip)
+            if pending != None and not pending.ready():
+                return False
+            self.pending[ip] = self.pool.apply_async(self.restart_func, (ip,))
+            return True
+
+    def in_flight(self):
+        """ Return number of restarts not yet completed """
+
+        with self.lock:
+            return len([r for r in self.pending.values() if not r.ready()])
+
+    def collect(self):
+        """ Return {ip: success} for completed restarts and forget them """
+
+        done = {}
+        with self.lock:
+            for ip, res in self.pending.items():
+                if res.ready():
+                    done[ip] = res.successful() and res.get()
+                    del self.pending[ip]
+
+        return done
+
+    def wait(self):
+        """ Wait for all queued restarts and return {ip: success} """
+
+        with self.lock:
+            results = self.pending.values()
+        for res in results:
+            res.wait()
+
+        return self.collect()
+
+    def close(self):
+        """ Wait for in-flight restarts and shut down the workers. Those of
+        a fleet are left to fleet.close(). """
+
+        if self.fleet:
+            self.wait()
+            return
+        self.pool.close()
+        self.pool.join()
+
+# Benchmark helpers - local stand-in squid listeners
+
+class StandInSquid(object):
+    """ A local listener standing in for a squid instance. A healthy one
+    answers any request with 200, a hung one accepts connections at the TCP
+    level but never replies. """
+
+    def __init__(self, healthy=True):
+        self.healthy = healthy
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(128)
+        self.port = self.sock.getsockname()[1]
+        if healthy:
+            t = threading.Thread(target=self.serve)
+            t.daemon = True
+            t.start()
+
+    def serve(self):
+        while True:
+            try:
+                conn, addr = self.sock.accept()
+            except socket.error:
+                return
+            try:
+                data = ''
+                while '\r\n\r\n' not in data:
+                    chunk = conn.recv(4096)
+                    if not chunk: break
+                    data += chunk
+                conn.sendall('HTTP/1.1 200 OK\r\nContent-Length: 0\r\nConnection: close\r\n\r\n')
+            except socket.error:
+                pass
+            conn.close()
+
+    def close(self):
+        self.sock.close()
+
+def serial_sweep(prober, servers, restart):
+    """ The legacy sweep - probe one server at a time, restarting inline """
+
+    for server in servers:
+        result = prober.probe(server)
+        if not result.ok:
+            restart(result.ip)
+
+def benchmark(nodes, dead, timeout, restart_delay):
+    """ Time the serial sweep against the concurrent one on local listeners """
+
+    listeners = [StandInSquid(healthy=(i >= dead)) for i in range(nodes)]
+    random.shuffle(listeners)
+    servers = [('squid%d' % (i + 1), '127.0.0.1', l.port) for i, l in enumerate(listeners)]
+
+    def fake_restart(ip):
+        time.sleep(restart_delay)
+        return True
+
+    prober = HealthProber(timeout=timeout, url='http://example.com/')
+    start = time.time()
+    serial_sweep(prober, servers, fake_restart)
+    serial = time.time() - start
+
+    prober = HealthProber(concurrency=32, timeout=timeout, url='http://example.com/')
+    restarter = RestartPool(workers=4, restart_func=fake_restart)
+    start = time.time()
+    results = prober.sweep(servers)
+    for result in results:
+        if not result.ok:
+            restarter.submit(result.ip)
+    probe_time = time.time() - start
+    restarter.wait()
+    total = time.time() - start
+    prober.close()
+    restarter.close()
+
+    for l in listeners:
+        l.close()
+
+    print 'Nodes: %d (%d hung), probe timeout %.1fs, restart time %.1fs' % (nodes, dead, timeout, restart_delay)
+    print 'Serial sweep (before):         %8.3fs' % serial
+    print 'Concurrent sweep (after):      %8.3fs' % probe_time
+    print 'Concurrent sweep + restarts:   %8.3fs' % total
+    print 'Unhealthy detected:',len([r for r in results if not r.ok])
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog='health_probe')
+    parser.add_argument('config', nargs='?', help='HAProxy config to probe', default='/etc/haproxy/haproxy.cfg')
+    parser.add_argument('-C','--conf',help='Use the given configuration file', default='proxy.conf')
+    parser.add_argument('--bench',help='Benchmark sweep time for N local stand-in nodes', type=int, default=0)
+    parser.add_argument('--dead',help='Number of hung nodes in the benchmark', type=int, default=8)
+    parser.add_argument('--timeout',help='Per-probe timeout in seconds', type=float, default=None)
+    parser.add_argument('--restart-delay',help='Simulated restart time in the benchmark', type=float, default=2.0)
+    args = parser.parse_args()
+
+    settings = load_probe_config(args.conf)
+    timeout = args.timeout or float(settings['timeout'])
+
+    if args.bench:
+        benchmark(args.bench, min(args.dead, args.bench), timeout, args.restart_delay)
+        sys.exit(0)
+
+    prober = HealthProber(concurrency=int(settings['concurrency']), timeout=timeout,
+                          url=settings['url'], auth=settings['auth'])
+    for result in prober.sweep(parse_lb_servers(args.config)):
+        print result
+    prober.close()
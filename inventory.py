@@ -0,0 +1,331 @@
+"""
+
+Cached inventory of the proxy linodes.
+
+Inventory sits in front of a linode backend (LinodeAPI, LinodeCommand or
+a fake) and keeps the ids, labels, IPs, regions, statuses and groups of
+the fleet in memory and in a state file. The nodes of our group are
+refreshed with a single list call once the inventory is older than `ttl`
+seconds, or on demand. Nodes we created but never put in the group are
+not listed, so they are looked up one by one and dropped once gone. Our
+own creates, updates and deletes are applied to the cache as they are
+made, so label and id lookups during rotations are answered locally
+instead of running `linode info` every time.
+
+Everything else, e.g. node_status() for the readiness checks, goes
+straight to the backend.
+
+Settings come from the "inventory" section of proxy.conf. Run with
+--bench to count API calls with and without the cache against the fake
+API server, or with --list to print the inventory.
+
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+import collections
+
+import timing
+from utils import LinodeNode
+from state_journal import atomic_write
+
+class Inventory(object):
+    """ Linode backend with a TTL cache of the fleet """
+
+    def __init__(self, backend, group=None, ttl=3600.0, state_file=None, clock=None):
+        self.backend = backend
+        self.group = group
+        self.ttl = ttl
+        self.state_file = state_file
+        self.clock = clock or time
+        # Linode id => LinodeNode, and IP => linode id
+        self.nodes = {}
+        self.by_ip = {}
+        # Time of the last full refresh, None if never
+        self.refreshed = None
+        self.lock = threading.RLock()
+        self.counters = collections.defaultdict(int)
+        self.load()
+
+    @classmethod
+    def from_config(cls, config, backend, clock=None):
+        """ Create an inventory from the "inventory" section of proxy.conf """
+
+        settings = config.inventory or {}
+        return cls(backend, group=config.group,
+                   ttl=float(settings.get('ttl', 3600)),
+                   state_file=settings.get('state_file', 'inventory.json') or None,
+                   clock=clock)
+
+    def __getattr__(self, name):
+        """ Anything not cached is the backend's """
+
+        if name == 'backend':
+            raise AttributeError(name)
+        return getattr(self.backend, name)
+
+    def put(self, node):
+        with self.lock:
+            old = self.nodes.get(node.id)
+            if old != None and self.by_ip.get(old.ip) == node.id:
+                del self.by_ip[old.ip]
+            self.nodes[node.id] = node
+            if node.ip:
+                self.by_ip[node.ip] = node.id
+
+    def forget(self, linode_id):
+        with self.lock:
+            node = self.nodes.pop(linode_id, None)
+            if node != None and self.by_ip.get(node.ip) == linode_id:
+                del self.by_ip[node.ip]
+
+    def age(self):
+        """ Seconds since the last refresh, None if never refreshed """
+
+        if self.refreshed == None:
+            return None
+        return self.clock.time() - self.refreshed
+
+    def stale(self):
+        age = self.age()
+        return age == None or age >= self.ttl
+
+    def refresh(self):
+        """ Reload the nodes of our group with one list call, and check
+        that the unassigned nodes still exist. On error the cached
+        inventory is kept. Returns whether it was reloaded. """
+
+        start = time.time()
+        try:
+            nodes = self.backend.list_nodes()
+        except Exception, e:
+            print 'Error refreshing linode inventory',e
+            self.counters['refresh_errors'] += 1
+            return False
+
+        # Unassigned nodes are not listed - look them up, e.g. in case
+        # they were deleted by hand
+        listed = set(node.id for node in nodes)
+        with self.lock:
+            unlisted = [node.id for node in self.nodes.values() if node.group == None and node.id not in listed]
+        gone = set(linode_id for linode_id in unlisted if not self.exists(linode_id))
+
+        with self.lock:
+            old = self.nodes
+            self.nodes, self.by_ip = {}, {}
+            for node in nodes:
+                # The CLI does not list labels - keep the ones we know
+                if node.label == None and node.id in old:
+                    node = node._replace(label=old[node.id].label)
+                self.put(node)
+            # Nodes we created but never put in our group, unless gone
+            for node in old.values():
+                if node.group == None and node.id not in self.nodes and node.id not in gone:
+                    self.put(node)
+            self.counters['gone'] += len(gone)
+            self.refreshed = self.clock.time()
+            self.counters['refreshes'] += 1
+            self.save()
+        timing.observe('inventory.refresh', time.time() - start)
+        return True
+
+    def exists(self, linode_id):
+        """ Return whether the backend still has a linode. Nodes are taken
+        to exist if the backend cannot tell. """
+
+        linode_exists = getattr(self.backend, 'linode_exists', None)
+        if linode_exists == None:
+            return True
+        try:
+            return linode_exists(linode_id)
+        except Exception, e:
+            print 'Error looking up linode',linode_id,e
+            return True
+
+    def ensure(self):
+        """ Refresh if the inventory is older than the TTL """
+
+        with self.lock:
+            if self.stale():
+                self.counters['stale'] += 1
+                self.refresh()
+
+    def list_nodes(self, refresh=False):
+        """ Return the proxy linodes of our group as a list of LinodeNode """
+
+        if refresh:
+            self.refresh()
+        else:
+            self.ensure()
+        with self.lock:
+            return [node for id, node in sorted(self.nodes.items()) if node.group == self.group]
+
+    def unassigned(self):
+        """ Return the nodes we created which are not in our group, e.g.
+        standby nodes or those of a failed rotation """
+
+        with self.lock:
+            return [node for id, node in sorted(self.nodes.items()) if node.group == None]
+
+    def get_node(self, linode_id):
+        """ Return the cached LinodeNode of a linode id, or None """
+
+        self.ensure()
+        with self.lock:
+            return self.nodes.get(int(linode_id))
+
+    def get_label(self, linode_id, fresh=False):
+        """ Return the label of a linode, from the cache unless fresh is set
+        or the label is unknown """
+
+        linode_id = int(linode_id)
+        if not fresh:
+            node = self.get_node(linode_id)
+            if node != None and node.label != None:
+                self.counters['hits'] += 1
+                return node.label
+
+        self.counters['misses'] += 1
+        label = self.backend.get_label(linode_id)
+        with self.lock:
+            node = self.nodes.get(linode_id)
+            if node != None and node.label != label:
+                self.put(node._replace(label=label))
+                self.save()
+        return label
+
+    def get_proxy_id(self, ip):
+        """ Return the linode id of a proxy IP, None if it is not in the
+        inventory """
+
+        self.ensure()
+        with self.lock:
+            linode_id = self.by_ip.get(ip)
+        self.counters['hits' if linode_id != None else 'misses'] += 1
+        return linode_id
+
+    def create_node(self, *args):
+        node = self.backend.create_node(*args)
+        self.put(node)
+        self.counters['writes'] += 1
+        self.save()
+        return node
+
+    def linode_update(self, linode_id, label, group):
+        result = self.backend.linode_update(linode_id, label, group)
+        with self.lock:
+            node = self.nodes.get(int(linode_id))
+            if node != None:
+                self.put(node._replace(label=label, group=group))
+            self.counters['writes'] += 1
+            self.save()
+        return result
+
+    def linode_delete(self, linode_id):
+        result = self.backend.linode_delete(linode_id)
+        self.forget(int(linode_id))
+        self.counters['writes'] += 1
+        self.save()
+        return result
+
+    def load(self):
+        """ Load the inventory saved by a previous run. Its refresh time is
+        kept, so a recent inventory is used as is. """
+
+        if not self.state_file or not os.path.isfile(self.state_file):
+            return
+        try:
+            data = json.load(open(self.state_file))
+            nodes = [LinodeNode(**item) for item in data['nodes']]
+        except (IOError, OSError, ValueError, KeyError, TypeError), e:
+            print 'Could not load linode inventory',self.state_file,e
+            return
+
+        for node in nodes:
+            self.put(node)
+        self.refreshed = data.get('refreshed')
+
+    def save(self):
+        if not self.state_file:
+            return
+        with self.lock:
+            data = {'refreshed': self.refreshed,
+                    'nodes': [node._asdict() for id, node in sorted(self.nodes.items())]}
+        try:
+            atomic_write(self.state_file, [json.dumps(data, indent=1)])
+        except (IOError, OSError), e:
+            print 'Could not save linode inventory',self.state_file,e
+
+    def stats(self):
+        age = self.age()
+        stats = dict(self.counters)
+        stats.update({'nodes': len(self.nodes), 'age': round(age, 1) if age != None else None})
+        return stats
+
+def benchmark(nodes, rotations, ttl):
+    """ Count API calls of the lookups made by a run of rotations, straight
+    to the fake API server and through the inventory """
+
+    from fake_linode_api import FakeLinodeServer
+    from linode_api import LinodeAPI
+
+    print 'Fleet of %d nodes, %d rotations, TTL %ds' % (nodes, rotations, ttl)
+    for cached in (False, True):
+        server = FakeLinodeServer().start()
+        for i in range(nodes):
+            server.state.add('ynode%d' % (i + 1), random.choice((2, 3, 4)), 'ynodes')
+        backend = LinodeAPI(url=server.url)
+        backend.group = 'ynodes'
+        inventory = Inventory(backend, group='ynodes', ttl=ttl)
+        client = inventory if cached else backend
+
+        start = time.time()
+        for i in range(rotations):
+            # What a rotation does: create, label lookup of the outgoing
+            # node, delete and relabel
+            out = random.choice(client.list_nodes())
+            node = client.create_node(3, 1, 140, 1121781, 'proxy_disk', 'secret')
+            label = client.get_label(out.id)
+            client.linode_delete(out.id)
+            client.linode_update(node.id, label, 'ynodes')
+            # Rotations are hours apart
+            if cached:
+                inventory.refreshed -= 3600
+        elapsed = time.time() - start
+
+        lookups = sum(server.state.calls.get(action, 0) for action in ('linode.list', 'linode.ip.list'))
+        print '%-10s lookup calls %5d, all calls %5d, %7.2f ms per rotation' % (
+            'inventory' if cached else 'direct', lookups, sum(server.state.calls.values()),
+            elapsed * 1000 / rotations)
+        if cached:
+            print '  stats =>',inventory.stats()
+        backend.close()
+        server.shutdown()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog='inventory')
+    parser.add_argument('--bench',help='Count API calls with and without the cache', action='store_true')
+    parser.add_argument('-n','--nodes',help='Fleet size in the benchmark', type=int, default=50)
+    parser.add_argument('-r','--rotations',help='Rotations in the benchmark', type=int, default=200)
+    parser.add_argument('--ttl',help='TTL in seconds in the benchmark', type=float, default=4 * 3600)
+    parser.add_argument('-C','--conf',help='Use the given configuration file', default='proxy.conf')
+    parser.add_argument('-l','--list',help='Refresh and print the inventory', action='store_true')
+    args = parser.parse_args()
+
+    if args.bench:
+        benchmark(args.nodes, args.rotations, args.ttl)
+        sys.exit(0)
+
+    if args.list:
+        from rotate_proxies import ProxyConfig
+        from linode_api import make_linode_backend
+        config = ProxyConfig(args.conf, read_only=True)
+        inventory = Inventory.from_config(config, make_linode_backend(config))
+        for node in inventory.list_nodes(refresh=True):
+            print '%10d %-12s %-16s %3d %s' % (node.id, node.label, node.ip, node.region, node.status)
+        print inventory.stats()
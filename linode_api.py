@@ -0,0 +1,308 @@
+"""
+
+Native Linode HTTP API backend.
+
+LinodeAPI is a drop-in replacement for utils.LinodeCommand which talks
+to the API directly over a pool of persistent keep-alive connections
+instead of forking the linode CLI for every operation. Reads which need
+several API actions are sent as a single batch request.
+
+Run with --bench to time the client against the local fake API server.
+
+"""
+
+import sys
+import json
+import time
+import Queue
+import socket
+import urllib
+import httplib
+import urlparse
+import argparse
+
+from utils import LinodeNode, LinodeCommand
+
+# ERRORCODE of the API for an id which does not exist
+not_found_code = 5
+
+class LinodeAPIError(Exception):
+    """ Error returned by the Linode API """
+
+    def __init__(self, message, codes=()):
+        Exception.__init__(self, message)
+        # ERRORCODEs of the errors reported by the API, if any
+        self.codes = list(codes)
+
+class LinodeAPI(object):
+    """ Linode API client with connection pooling """
+
+    def __init__(self, api_key='', url='https://api.linode.com/', pool_size=4, timeout=30,
+                 kernel_id=138, disk_size=24576, verbose=False, config=None):
+        self.api_key = api_key
+        self.verbose = verbose
+        self.timeout = timeout
+        self.kernel_id = kernel_id
+        self.disk_size = disk_size
+        self.group = config.group if config else ''
+        self.proxylb = config.proxylb if config else None
+
+        parts = urlparse.urlsplit(url)
+        self.secure = (parts.scheme == 'https')
+        self.host = parts.hostname
+        self.port = parts.port or (443 if self.secure else 80)
+        self.path = parts.path or '/'
+        # Idle connections, most recently used first. With a pool size
+        # of 0 every request uses a fresh connection.
+        self.pool_size = pool_size
+        self.pool = Queue.LifoQueue()
+
+    def _connect(self):
+        if self.secure:
+            return httplib.HTTPSConnection(self.host, self.port, timeout=self.timeout)
+        return httplib.HTTPConnection(self.host, self.port, timeout=self.timeout)
+
+    def _acquire(self):
+        """ Return a connection and whether it was reused from the pool """
+
+        try:
+            return self.pool.get_nowait(), True
+        except Queue.Empty:
+            return self._connect(), False
+
+    def _release(self, conn):
+        if self.pool.qsize() < self.pool_size:
+            self.pool.put(conn)
+        else:
+            conn.close()
+
+    def _post(self, params):
+        """ POST params and return the decoded JSON response. A pooled
+        connection the server closed while idle is retried once on a fresh
+        one. Nothing else is retried, least of all a timeout: the API may
+        have acted on the request, and a second linode.create would leak a
+        billed linode. """
+
+        params['api_key'] = self.api_key
+        body = urllib.urlencode(params)
+        headers = {'Content-Type': 'application/x-www-form-urlencoded',
+                   'Connection': 'keep-alive' if self.pool_size else 'close'}
+
+        conn, reused = self._acquire()
+        while True:
+            sent = False
+            try:
+                conn.request('POST', self.path, body, headers)
+                sent = True
+                response = conn.getresponse()
+                data = response.read()
+            except socket.timeout, e:
+                conn.close()
+                raise LinodeAPIError('Request timed out: %s' % e)
+            except (httplib.HTTPException, socket.error), e:
+                conn.close()
+                # A stale connection fails on send, or is closed before any
+                # response comes back
+                if reused and (not sent or isinstance(e, httplib.BadStatusLine)):
+                    conn, reused = self._connect(), False
+                    continue
+                raise LinodeAPIError('Request failed: %s' % e)
+
+            if response.status != 200:
+                conn.close()
+                raise LinodeAPIError('HTTP %d from API' % response.status)
+            self._release(conn)
+            return json.loads(data)
+
+    def _check(self, response):
+        """ Return DATA from a response envelope, raising on errors """
+
+        errors = response.get('ERRORARRAY')
+        if errors:
+            raise LinodeAPIError('%s: %s' % (response.get('ACTION'),
+                                             ', '.join(e.get('ERRORMESSAGE', '') for e in errors)),
+                                 [e.get('ERRORCODE') for e in errors])
+        return response.get('DATA')
+
+    def call(self, action, **params):
+        """ Run a single API action and return its data """
+
+        if self.verbose: print 'API call',action,params
+        params['api_action'] = action
+        return self._check(self._post(params))
+
+    def batch(self, *requests):
+        """ Run (action, params) requests in one round trip, returning a
+        list of their data """
+
+        if self.verbose: print 'API batch',[action for action, params in requests]
+        array = []
+        for action, params in requests:
+            item = dict(params)
+            item['api_action'] = action
+            array.append(item)
+
+        responses = self._post({'api_action': 'batch', 'api_requestArray': json.dumps(array)})
+        return map(self._check, responses)
+
+    def make_node(self, item, ips):
+        return LinodeNode(int(item['LINODEID']), item['LABEL'], ips.get(int(item['LINODEID'])),
+                          int(item['DATACENTERID']), int(item['STATUS']), item['LPM_DISPLAYGROUP'])
+
+    def public_ips(self, ip_list):
+        """ Return linode id => public IP from linode.ip.list data """
+
+        return dict((int(ip['LINODEID']), ip['IPADDRESS']) for ip in ip_list if ip.get('ISPUBLIC', 1))
+
+    def linode_create(self, region, plan_id, os_id, image_id, label, passwd):
+        """ Create, configure and boot a linode. Returns a LinodeNode """
+
+        linode_id = self.call('linode.create', DatacenterID=region, PlanID=plan_id)['LinodeID']
+        try:
+            if image_id:
+                disk = self.call('linode.disk.createfromimage', LinodeID=linode_id, ImageID=image_id,
+                                 Label=label, rootPass=passwd)
+            else:
+                disk = self.call('linode.disk.createfromdistribution', LinodeID=linode_id,
+                                 DistributionID=os_id, Label=label, Size=self.disk_size, rootPass=passwd)
+
+            self.call('linode.config.create', LinodeID=linode_id, KernelID=self.kernel_id,
+                      Label=label, DiskList=disk['DiskID'])
+            # Boot and fetch the IP address in one round trip
+            boot, ips = self.batch(('linode.boot', {'LinodeID': linode_id}),
+                                   ('linode.ip.list', {'LinodeID': linode_id}))
+        except LinodeAPIError, e:
+            # Do not leave a half built linode behind
+            print 'Error setting up linode',linode_id,e,'- deleting it'
+            try:
+                self.linode_delete(linode_id)
+            except LinodeAPIError, e2:
+                print 'Could not delete linode',linode_id,e2
+            raise
+
+        return LinodeNode(int(linode_id), label, self.public_ips(ips).get(int(linode_id)),
+                          int(region), None, None)
+
+    def linode_delete(self, linode_id):
+        """ Delete a linode """
+
+        return self.call('linode.delete', LinodeID=linode_id, skipChecks=1)
+
+    def linode_info(self, linode_id):
+        """ Return a LinodeNode for the given linode id """
+
+        items, ips = self.batch(('linode.list', {'LinodeID': linode_id}),
+                                ('linode.ip.list', {'LinodeID': linode_id}))
+        return self.make_node(items[0], self.public_ips(ips))
+
+    def node_status(self, linode_id):
+        """ Return the status of a linode, 1 once it is running """
+
+        return self.linode_info(linode_id).status
+
+    def linode_exists(self, linode_id):
+        """ Return whether a linode of the given id exists """
+
+        try:
+            return bool(self.call('linode.list', LinodeID=linode_id))
+        except LinodeAPIError, e:
+            if not_found_code in e.codes:
+                return False
+            raise
+
+    def linode_update(self, linode_id, label, group):
+        """ Update label and display group of a linode """
+
+        return self.call('linode.update', LinodeID=linode_id, Label=label, lpm_displayGroup=group)
+
+    def linode_list_proxies(self):
+        """ Return all proxy linodes (those in our group, except the LB)
+        with a single batched request """
+
+        items, ips = self.batch(('linode.list', {}), ('linode.ip.list', {}))
+        ips = self.public_ips(ips)
+        return [self.make_node(item, ips) for item in items
+                if item['LPM_DISPLAYGROUP'] == self.group and item['LABEL'] != self.proxylb]
+
+    def get_label(self, linode_id):
+        """ Return the label, given the linode id """
+
+        return self.linode_info(linode_id).label
+
+    # Structured interface shared with LinodeCommand
+    create_node = linode_create
+    list_nodes = linode_list_proxies
+
+    def close(self):
+        """ Close all pooled connections """
+
+        while True:
+            try:
+                self.pool.get_nowait().close()
+            except Queue.Empty:
+                break
+
+def make_linode_backend(config, verbose=False):
+    """ Return the linode backend selected by the "linode_backend" setting -
+    "api" for the native client, else the CLI """
+
+    if config.linode_backend == 'api':
+        settings = config.linode_api or {}
+        return LinodeAPI(api_key=settings.get('api_key', ''),
+                         url=settings.get('url', 'https://api.linode.com/'),
+                         pool_size=int(settings.get('pool_size', 4)),
+                         kernel_id=int(settings.get('kernel_id', 138)),
+                         verbose=verbose, config=config)
+
+    return LinodeCommand(verbose=verbose, config=config)
+
+def benchmark(rounds):
+    """ Time create/info/update/delete against the local fake API server,
+    with and without connection reuse """
+
+    import os
+    from fake_linode_api import FakeLinodeServer
+
+    server = FakeLinodeServer().start()
+
+    start = time.time()
+    for i in range(5):
+        os.popen('%s -c pass' % sys.executable).read()
+    spawn = (time.time() - start) / 5
+
+    print 'Process spawn alone (CLI lower bound): %7.2f ms' % (spawn * 1000)
+    for pool_size in (0, 4):
+        client = LinodeAPI(url=server.url, pool_size=pool_size)
+        timings = {'create': 0.0, 'info': 0.0, 'update': 0.0, 'delete': 0.0, 'list': 0.0}
+        for i in range(rounds):
+            t = time.time()
+            node = client.linode_create(3, 1, 140, 1121781, 'proxy_disk', 'secret')
+            timings['create'] += time.time() - t
+            t = time.time()
+            client.linode_info(node.id)
+            timings['info'] += time.time() - t
+            t = time.time()
+            client.linode_update(node.id, 'ynode%d' % i, 'ynodes')
+            timings['update'] += time.time() - t
+            t = time.time()
+            client.linode_list_proxies()
+            timings['list'] += time.time() - t
+            t = time.time()
+            client.linode_delete(node.id)
+            timings['delete'] += time.time() - t
+
+        print '%s:' % ('keep-alive pool' if pool_size else 'new connection per call')
+        for op in ('create', 'info', 'update', 'list', 'delete'):
+            print '  %-8s %7.2f ms' % (op, timings[op] * 1000 / rounds)
+        client.close()
+
+    server.shutdown()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog='linode_api')
+    parser.add_argument('--bench',help='Benchmark the client against the fake API server', action='store_true')
+    parser.add_argument('-n','--rounds',help='Rounds of operations in the benchmark', type=int, default=200)
+    args = parser.parse_args()
+
+    if args.bench:
+        benchmark(args.rounds)
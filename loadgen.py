@@ -0,0 +1,815 @@
+"""
+
+Replay load generator and end-to-end proxy throughput benchmark.
+
+Replays a recorded request corpus - a JSONL file with one request per
+line, {"method": ..., "url": ..., "headers": {...}, "body": ...} -
+through the proxy frontend (HAProxy on 5729, balancing over squid on
+8321) from `concurrency` client threads, at up to `rate` requests per
+second. Every request is sent as a proxy request with no cookie, so
+HAProxy inserts a fresh proxycookie naming the slot that served it.
+
+Latency, status and backend of every request are recorded and reported
+by the second they completed in - requests per second, p50/p95/p99
+latency, error rate and the spread over backends - and per backend for
+the whole run. With --rotate-at, a rotation is triggered at the given
+seconds into the run and the report compares the requests completed
+before, during (until the old slot has drained) and after it, to
+quantify the disruption.
+
+By default everything runs locally: a stand-in HTTP origin, stand-in
+squids forwarding to it on loopback addresses (127.0.1.x:8321), and a
+stand-in HAProxy frontend routing round robin over the `ready` slots of
+the fake admin socket, which the rotator drives at runtime as it would
+a real HAProxy. New linodes of the fake Linode API get a stand-in squid
+of their own, deleted ones lose it. Corpus URLs are pointed at the local
+origin, so a corpus recorded from real crawls replays as is. Use
+--frontend host:port to load a real HAProxy instead, rotating with the
+configuration given by --conf.
+
+"""
+
+import os
+import sys
+import json
+import time
+import errno
+import fcntl
+import random
+import socket
+import shutil
+import httplib
+import argparse
+import tempfile
+import threading
+import urlparse
+import collections
+import SocketServer
+import BaseHTTPServer
+
+from rotate_proxies import ProxyConfig, ProxyRotator
+from state_journal import atomic_write
+
+# Request headers a proxy does not pass on
+hop_headers = ('connection', 'keep-alive', 'proxy-connection', 'proxy-authorization', 'te', 'trailers',
+               'transfer-encoding', 'upgrade')
+
+user_agents = ('Mozilla/5.0 (X11; Linux x86_64; rv:45.0) Gecko/20100101 Firefox/45.0',
+               'Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/49.0 Safari/537.36')
+
+class Sample(collections.namedtuple('Sample', 'started latency status backend error')):
+    """ One replayed request, started seconds into the run """
+
+    __slots__ = ()
+
+    @property
+    def finished(self):
+        return self.started + self.latency
+
+def load_corpus(filename):
+    """ Return the requests of a JSONL corpus as dicts with method, url,
+    headers and body. Lines without a url are skipped. """
+
+    requests = []
+    for count, line in enumerate(open(filename)):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            item = json.loads(line)
+        except ValueError, e:
+            print 'Skipping line',count + 1,'of',filename,e
+            continue
+        if not item.get('url'):
+            continue
+        requests.append({'method': item.get('method', 'GET').upper(), 'url': item['url'],
+                         'headers': dict(item.get('headers') or {}), 'body': item.get('body')})
+    return requests
+
+def make_corpus(count, seed=1):
+    """ Return a synthetic corpus of count crawl-like requests: mostly
+    pages, some heavier listings and a few POSTed searches """
+
+    rand = random.Random(seed)
+    requests = []
+    for i in range(count):
+        headers = {'User-Agent': rand.choice(user_agents), 'Accept': 'text/html,application/xhtml+xml'}
+        kind = rand.random()
+        if kind < 0.8:
+            url = 'http://www.example.com/item/%d?size=%d' % (rand.randint(1, 100000), rand.randint(2048, 32768))
+            requests.append({'method': 'GET', 'url': url, 'headers': headers, 'body': None})
+        elif kind < 0.95:
+            url = 'http://www.example.com/list?page=%d&size=%d' % (rand.randint(1, 500), rand.randint(65536, 196608))
+            requests.append({'method': 'GET', 'url': url, 'headers': headers, 'body': None})
+        else:
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+            requests.append({'method': 'POST', 'url': 'http://www.example.com/search?size=8192', 'headers': headers,
+                             'body': 'q=item+%d' % rand.randint(1, 1000)})
+    return requests
+
+def retarget(requests, netloc):
+    """ Point the requests at the origin at netloc, keeping path and query """
+
+    retargeted = []
+    for request in requests:
+        parts = urlparse.urlsplit(request['url'])
+        request = dict(request, url=urlparse.urlunsplit(('http', netloc, parts.path or '/', parts.query, '')))
+        request['headers'] = dict((k, v) for k, v in request['headers'].items() if k.lower() != 'host')
+        retargeted.append(request)
+    return retargeted
+
+def percentile(values, fraction):
+    """ Return the value at fraction of the sorted values, None if empty """
+
+    if not values:
+        return None
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+def summarize(samples, seconds=None):
+    """ Return count, throughput, error rate and latency percentiles (ms) of
+    samples """
+
+    latencies = sorted(s.latency for s in samples if not s.error)
+    errors = sum(1 for s in samples if s.error)
+    summary = {'requests': len(samples), 'errors': errors,
+               'error_rate': round(float(errors) / len(samples), 4) if samples else 0.0}
+    if seconds:
+        summary['rps'] = round(len(samples) / seconds, 1)
+    for name, fraction in (('p50', 0.5), ('p95', 0.95), ('p99', 0.99)):
+        value = percentile(latencies, fraction)
+        summary[name] = round(value * 1000, 1) if value != None else None
+    summary['max'] = round(latencies[-1] * 1000, 1) if latencies else None
+    return summary
+
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """ Threaded HTTP server for the stand-ins. Use port 0 to pick a free
+    port """
+
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 128
+
+    def server_bind(self):
+        # Keep the listener out of the ssh masters the rotator spawns
+        flags = fcntl.fcntl(self.socket.fileno(), fcntl.F_GETFD)
+        fcntl.fcntl(self.socket.fileno(), fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+        BaseHTTPServer.HTTPServer.server_bind(self)
+
+    def start(self):
+        """ Serve in a background thread """
+
+        t = threading.Thread(target=self.serve_forever)
+        t.daemon = True
+        t.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+class QuietHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """ Keep-alive handler which does not log every request """
+
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def read_body(self):
+        length = int(self.headers.getheader('content-length') or 0)
+        return self.rfile.read(length) if length else None
+
+    def reply(self, status, headers, body):
+        self.send_response(status)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+class OriginHandler(QuietHandler):
+    """ Answer any request with `size` bytes (from the query, else the
+    server default) after the server's delay """
+
+    def handle_any(self):
+        self.read_body()
+        query = urlparse.parse_qs(urlparse.urlsplit(self.path).query)
+        size = int(query.get('size', [self.server.size])[0])
+        if self.server.delay:
+            time.sleep(random.expovariate(1.0 / self.server.delay))
+        self.reply(200, [('Content-Type', 'text/html')], 'x' * size)
+
+    do_GET = do_POST = do_HEAD = handle_any
+
+class Origin(ThreadingHTTPServer):
+    """ Stand-in HTTP origin """
+
+    def __init__(self, host='127.0.0.1', port=0, size=4096, delay=0.0):
+        ThreadingHTTPServer.__init__(self, (host, port), OriginHandler)
+        self.size = size
+        # Mean response time in seconds
+        self.delay = delay
+        self.netloc = '%s:%d' % self.server_address
+
+def forward(host, port, method, url, headers, body, timeout, connected=None):
+    """ Send one request upstream and return status, headers and body.
+    connected is called once the connection is up. """
+
+    conn = httplib.HTTPConnection(host, port, timeout=timeout)
+    try:
+        conn.connect()
+        if connected != None:
+            connected()
+        conn.request(method, url, body, headers)
+        response = conn.getresponse()
+        return response.status, response.getheaders(), response.read()
+    finally:
+        conn.close()
+
+def upstream_headers(headers):
+    return dict((name, value) for name, value in headers.items() if name.lower() not in hop_headers)
+
+def downstream_headers(headers):
+    return [(name, value) for name, value in headers
+            if name.lower() not in hop_headers and name.lower() != 'content-length']
+
+class SquidHandler(QuietHandler):
+    """ Forward an absolute-URI proxy request to its origin """
+
+    def setup(self):
+        QuietHandler.setup(self)
+        with self.server.lock:
+            self.server.active.add(self.connection)
+
+    def finish(self):
+        with self.server.lock:
+            self.server.active.discard(self.connection)
+        QuietHandler.finish(self)
+
+    def handle_any(self):
+        body = self.read_body()
+        parts = urlparse.urlsplit(self.path)
+        if not parts.hostname:
+            self.reply(400, [], 'Invalid URL\n')
+            return
+        if self.server.delay:
+            time.sleep(self.server.delay)
+        path = urlparse.urlunsplit(('', '', parts.path or '/', parts.query, ''))
+        try:
+            status, headers, data = forward(parts.hostname, parts.port or 80, self.command, path,
+                                            upstream_headers(self.headers), body, self.server.timeout)
+        except (socket.error, httplib.HTTPException), e:
+            self.reply(503, [('X-Squid-Error', 'ERR_CONNECT_FAIL 0')], 'Upstream error %s\n' % e)
+            return
+        headers = downstream_headers(headers)
+        headers.append(('X-Cache', 'MISS from %s' % self.server.server_address[0]))
+        self.reply(status, headers, data)
+
+    do_GET = do_POST = do_HEAD = handle_any
+
+class StandInProxy(ThreadingHTTPServer):
+    """ Stand-in squid on ip:port, adding delay seconds to every request
+    like a node far from us would """
+
+    def __init__(self, ip, port=8321, delay=0.0, timeout=30.0):
+        ThreadingHTTPServer.__init__(self, (ip, port), SquidHandler)
+        self.delay = delay
+        self.timeout = timeout
+        # Open client connections, cut when the node goes away
+        self.active = set()
+        self.lock = threading.Lock()
+
+    def stop(self):
+        with self.lock:
+            active, self.active = list(self.active), set()
+        for conn in active:
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+        ThreadingHTTPServer.stop(self)
+
+class SquidFarm(object):
+    """ Stand-in squids on loopback addresses, one per node """
+
+    def __init__(self, port=8321, delay=0.05, jitter=0.5, network='127.0.1'):
+        self.port = port
+        # Every squid gets its own delay, delay * (1 +- jitter)
+        self.delay = delay
+        self.jitter = jitter
+        self.network = network
+        self.squids = {}
+        self.next_host = 0
+        self.lock = threading.Lock()
+
+    def spawn(self):
+        """ Start a stand-in squid on the next free loopback address and
+        return the address """
+
+        while True:
+            with self.lock:
+                self.next_host += 1
+                if self.next_host > 254:
+                    raise RuntimeError('No loopback addresses left in %s.0/24' % self.network)
+                ip = '%s.%d' % (self.network, self.next_host)
+            delay = self.delay * random.uniform(1 - self.jitter, 1 + self.jitter)
+            try:
+                squid = StandInProxy(ip, self.port, delay)
+            except socket.error, e:
+                if e.errno == errno.EADDRINUSE:
+                    continue
+                raise
+            with self.lock:
+                self.squids[ip] = squid.start()
+            return ip
+
+    def release(self, ip):
+        """ Stop the squid at ip, as deleting its node would. Returns at once. """
+
+        with self.lock:
+            squid = self.squids.pop(ip, None)
+        if squid != None:
+            t = threading.Thread(target=squid.stop)
+            t.daemon = True
+            t.start()
+
+    def stop(self):
+        with self.lock:
+            squids, self.squids = self.squids.values(), {}
+        for squid in squids:
+            squid.stop()
+
+class FrontendHandler(QuietHandler):
+    """ Route a proxy request to the next ready slot, as HAProxy would """
+
+    def handle_any(self):
+        body = self.read_body()
+        headers = upstream_headers(self.headers)
+        tried = set()
+        # option redispatch: a failed connection is retried on another slot,
+        # a failure once the request went out is a 502
+        for attempt in range(self.server.retries + 1):
+            slot = self.server.choose(tried)
+            if slot == None:
+                break
+            tried.add(slot.name)
+            started, connected = time.time(), []
+            self.server.begin(slot)
+            try:
+                status, rheaders, data = forward(slot.addr, slot.port, self.command, self.path, headers, body,
+                                                 self.server.timeout, lambda: connected.append(True))
+            except (socket.error, httplib.HTTPException):
+                self.server.end(slot, started, error='eresp' if connected else 'econ')
+                if connected:
+                    self.reply(502, [], '<html><body><h1>502 Bad Gateway</h1></body></html>\n')
+                    return
+                continue
+            self.server.end(slot, started, status)
+            rheaders = downstream_headers(rheaders)
+            rheaders.append(('Set-Cookie', 'proxycookie=%s; path=/' % slot.name))
+            self.reply(status, rheaders, data)
+            return
+        self.reply(503, [], '<html><body><h1>503 Service Unavailable</h1></body></html>\n')
+
+    do_GET = do_POST = do_HEAD = handle_any
+
+class StandInFrontend(ThreadingHTTPServer):
+    """ Stand-in HAProxy frontend balancing round robin over the ready
+    slots of a FakeHAProxyState, keeping their session counters """
+
+    def __init__(self, state, host='127.0.0.1', port=5729, retries=1, timeout=30.0):
+        ThreadingHTTPServer.__init__(self, (host, port), FrontendHandler)
+        self.state = state
+        self.retries = retries
+        self.timeout = timeout
+        self.turn = 0
+
+    def choose(self, exclude=()):
+        with self.state.lock:
+            ready = [self.state.servers[name] for name in self.state.order
+                     if self.state.servers[name].admin == 'ready' and name not in exclude]
+            if not ready:
+                return None
+            self.turn += 1
+            return ready[self.turn % len(ready)]
+
+    def begin(self, slot):
+        with self.state.lock:
+            slot.scur += 1
+            slot.stot += 1
+
+    def end(self, slot, started, status=None, error=None):
+        """ Count a finished request, error being 'econ' or 'eresp' if it
+        failed """
+
+        elapsed = int((time.time() - started) * 1000)
+        with self.state.lock:
+            slot.scur = max(slot.scur - 1, 0)
+            # A moving average, as HAProxy reports it
+            slot.rtime += (elapsed - slot.rtime) // 16
+            if error:
+                setattr(slot, error, getattr(slot, error) + 1)
+            elif status >= 500:
+                slot.hrsp_5xx += 1
+            elif status >= 400:
+                slot.hrsp_4xx += 1
+
+def backend_of(response):
+    """ Return the LB slot, and the squid address where known, that served a
+    response """
+
+    slot = None
+    for name, value in response.getheaders():
+        if name == 'set-cookie':
+            for part in value.split(','):
+                part = part.strip()
+                if part.startswith('proxycookie='):
+                    slot = part.split(';')[0].split('=', 1)[1]
+    squid = (response.getheader('x-cache') or '').rpartition(' from ')[2]
+    if squid and squid != 'localhost':
+        return '%s/%s' % (slot, squid) if slot else squid
+    return slot or '-'
+
+class LoadGen(object):
+    """ Replay a corpus through a proxy frontend from concurrent clients """
+
+    def __init__(self, frontend, corpus, concurrency=16, rate=0.0, duration=30.0, timeout=30.0):
+        self.host, self.port = frontend
+        self.corpus = corpus
+        self.concurrency = concurrency
+        # Requests per second over all clients, 0 for as fast as they go
+        self.rate = rate
+        self.duration = duration
+        self.timeout = timeout
+        self.samples = []
+        # (seconds into the run, event) to mark in the report
+        self.events = []
+        self.sent = 0
+        self.lock = threading.Lock()
+        self.started = None
+        self.running = False
+
+    def next_request(self):
+        with self.lock:
+            index = self.sent
+            self.sent += 1
+        return index, self.corpus[index % len(self.corpus)]
+
+    def send(self, conn, request):
+        """ Send one request over conn and return its Sample, and whether
+        conn can be used again """
+
+        headers = dict(request['headers'])
+        if not any(name.lower() == 'host' for name in headers):
+            headers['Host'] = urlparse.urlsplit(request['url']).netloc
+        started = time.time()
+        try:
+            conn.request(request['method'], request['url'], request.get('body'), headers)
+            response = conn.getresponse()
+            response.read()
+        except (socket.error, httplib.HTTPException), e:
+            error = e.__class__.__name__
+            return Sample(started - self.started, time.time() - started, 0, '-', error), False
+        error = 'http %d' % response.status if response.status >= 500 else None
+        sample = Sample(started - self.started, time.time() - started, response.status, backend_of(response), error)
+        return sample, not response.will_close
+
+    def client(self):
+        conn = None
+        end = self.started + self.duration
+        while self.running:
+            index, request = self.next_request()
+            if self.rate:
+                due = self.started + index / self.rate
+                if due >= end:
+                    break
+                if due > time.time():
+                    time.sleep(due - time.time())
+            elif time.time() >= end:
+                break
+            if conn == None:
+                conn = httplib.HTTPConnection(self.host, self.port, timeout=self.timeout)
+            sample, reuse = self.send(conn, request)
+            self.samples.append(sample)
+            if not reuse:
+                conn.close()
+                conn = None
+        if conn != None:
+            conn.close()
+
+    def mark(self, event):
+        self.events.append((time.time() - self.started, event))
+        print '%6.1fs %s' % (self.events[-1][0], event)
+
+    def run(self):
+        """ Replay for duration seconds and return the samples """
+
+        print 'Replaying %d requests through %s:%d, %d clients, %s for %.0fs ...' % (
+            len(self.corpus), self.host, self.port, self.concurrency,
+            '%.0f req/s' % self.rate if self.rate else 'unthrottled', self.duration)
+        self.samples, self.events, self.sent = [], [], 0
+        self.started, self.running = time.time(), True
+        threads = [threading.Thread(target=self.client, name='client%d' % i) for i in range(self.concurrency)]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        try:
+            for t in threads:
+                while t.is_alive():
+                    t.join(0.5)
+        except KeyboardInterrupt:
+            print 'Interrupted'
+        self.running = False
+        self.elapsed = time.time() - self.started
+        return self.samples
+
+    def rotate_at(self, seconds, rotate, settle=None):
+        """ Call rotate() at each of seconds into the run, then settle() until
+        it returns, marking the start, switch and settling of every rotation """
+
+        def rotations():
+            for at in sorted(seconds):
+                while self.started == None or time.time() < self.started + at:
+                    time.sleep(0.05)
+                if not self.running:
+                    return
+                self.mark('rotate start')
+                try:
+                    ok = rotate()
+                except Exception, e:
+                    print 'Error rotating',e
+                    ok = False
+                self.mark('rotate %s' % ('switched' if ok else 'failed'))
+                if settle != None:
+                    settle()
+                self.mark('rotate settled')
+        t = threading.Thread(target=rotations, name='rotations')
+        t.daemon = True
+        t.start()
+
+    def phases(self):
+        """ Return [(name, start, end)] of the run around its rotations:
+        before the first one, from its start until the last one settled,
+        and after """
+
+        starts = [at for at, event in self.events if event == 'rotate start']
+        settled = [at for at, event in self.events if event == 'rotate settled']
+        if not starts:
+            return [('run', 0.0, self.elapsed)]
+        end = settled[-1] if settled else self.elapsed
+        return [('before', 0.0, starts[0]), ('during', starts[0], end), ('after', end, self.elapsed)]
+
+    def results(self, bucket=1.0):
+        """ Return the summary, per-phase summaries, per-backend totals and
+        the timeline as a dict """
+
+        samples = sorted(self.samples)
+        results = {'summary': summarize(samples, self.elapsed), 'events': self.events,
+                   'concurrency': self.concurrency, 'rate': self.rate, 'duration': round(self.elapsed, 1)}
+
+        results['phases'] = {}
+        for name, start, end in self.phases():
+            window = [s for s in samples if start <= s.finished < end]
+            results['phases'][name] = dict(summarize(window, end - start), start=round(start, 1),
+                                           end=round(end, 1))
+
+        backends = collections.defaultdict(list)
+        for sample in samples:
+            backends[sample.backend].append(sample)
+        results['backends'] = dict((name, dict(summarize(group), share=round(float(len(group)) / len(samples), 4),
+                                               first=round(group[0].started, 1), last=round(group[-1].started, 1)))
+                                   for name, group in backends.items())
+
+        buckets = collections.defaultdict(list)
+        for sample in samples:
+            buckets[int(sample.finished // bucket)].append(sample)
+        results['timeline'] = []
+        for index in range(max(buckets) + 1 if buckets else 0):
+            group = buckets.get(index, [])
+            row = summarize(group, bucket)
+            row['t'] = index * bucket
+            row['backends'] = dict(collections.Counter(s.backend for s in group))
+            results['timeline'].append(row)
+        return results
+
+def format_ms(value):
+    return '%7.1f' % value if value != None else '%7s' % '-'
+
+def report(results, bucket=1.0):
+    """ Print the timeline, backends and phase comparison of results """
+
+    print
+    print '%6s %7s %7s %7s %7s %6s  %s' % ('t', 'req/s', 'p50', 'p95', 'p99', 'err%', 'backends')
+    events = list(results['events'])
+    for row in results['timeline']:
+        marks = [event for at, event in events if row['t'] <= at < row['t'] + bucket]
+        spread = ' '.join('%s:%d' % item for item in sorted(row['backends'].items()))
+        print '%5.0fs %7.1f %s %s %s %6.2f  %s%s' % (row['t'], row['rps'], format_ms(row['p50']), format_ms(row['p95']),
+                                                  format_ms(row['p99']), row['error_rate'] * 100, spread,
+                                                  '  <- ' + ', '.join(marks) if marks else '')
+
+    print
+    print '%-24s %8s %7s %7s %7s %7s %8s %8s' % ('backend', 'requests', 'share', 'p50', 'p99', 'errors', 'first',
+                                                  'last')
+    for name, row in sorted(results['backends'].items()):
+        print '%-24s %8d %6.1f%% %s %s %7d %7.1fs %7.1fs' % (name, row['requests'], row['share'] * 100,
+                                                          format_ms(row['p50']), format_ms(row['p99']), row['errors'],
+                                                          row['first'], row['last'])
+
+    print
+    print '%-8s %13s %8s %8s %7s %7s %7s %7s %7s' % ('phase', 'window', 'requests', 'req/s', 'p50', 'p95', 'p99',
+                                                       'max', 'err%')
+    for name in ('before', 'during', 'after', 'run'):
+        row = results['phases'].get(name)
+        if row == None:
+            continue
+        print '%-8s %5.1f-%6.1fs %8d %8.1f %s %s %s %s %7.2f' % (name, row['start'], row['end'], row['requests'],
+                                                             row.get('rps', 0), format_ms(row['p50']),
+                                                             format_ms(row['p95']), format_ms(row['p99']),
+                                                             format_ms(row['max']), row['error_rate'] * 100)
+
+    summary = results['summary']
+    print
+    print 'Total: %d requests in %.1fs, %.1f req/s, p50 %sms p95 %sms p99 %sms, %d errors (%.2f%%)' % (
+        summary['requests'], results['duration'], summary.get('rps', 0), summary['p50'], summary['p95'],
+        summary['p99'], summary['errors'], summary['error_rate'] * 100)
+
+    before, during = results['phases'].get('before'), results['phases'].get('during')
+    if before and during and before['requests'] and during['requests']:
+        dip = min([tl['rps'] for tl in results['timeline'] if during['start'] <= tl['t'] < during['end']]
+                  or [during['rps']])
+        print 'Rotation: %d errors while rotating, p99 %sms against %sms before, lowest %.1f req/s against %.1f' % (
+            during['errors'], during['p99'], before['p99'], dip, before['rps'])
+
+class LocalProxyConfig(ProxyConfig):
+    """ Proxy config which writes the LB config to its own path, for the
+    fake admin socket to load, instead of installing it with sudo """
+
+    def write_lb_config(self, disabled=False, test=False, reload=True):
+        if not test:
+            atomic_write(self.lb_config, [self.render_lb_config()])
+            self.deployed_slots = len(self.slots)
+        if reload:
+            return self.reload_lb()
+        return True
+
+class LocalBench(object):
+    """ The fake Linode API, fake admin socket, stand-in frontend, squids
+    and origin, and a rotator driving them """
+
+    def __init__(self, nodes=4, port=5729, squid_delay=0.05, origin_delay=0.02, drain=True, drain_deadline=10.0):
+        self.nodes = nodes
+        self.port = port
+        self.squid_delay = squid_delay
+        self.origin_delay = origin_delay
+        self.drain = drain
+        self.drain_deadline = drain_deadline
+        self.tmp = None
+
+    def start(self):
+        from fake_linode_api import FakeLinodeServer, FakeLinodeState
+        from fake_haproxy import FakeHAProxy
+
+        self.tmp = tempfile.mkdtemp(prefix='loadgen')
+        self.origin = Origin(delay=self.origin_delay).start()
+        self.farm = SquidFarm(delay=self.squid_delay)
+        self.api = FakeLinodeServer(state=FakeLinodeState(ip_factory=self.farm.spawn,
+                                                          on_delete=self.farm.release)).start()
+
+        lines = []
+        regions = [2, 3, 4, 6, 7, 8, 9, 10]
+        for i in range(self.nodes):
+            region = regions[i % len(regions)]
+            linode_id = self.api.state.add('lnode%d' % (i + 1), region, 'lnodes')
+            lines.append('%s,%d,%d,0,0' % (self.api.state.ips[linode_id], region, linode_id))
+        open(os.path.join(self.tmp, 'proxies.list'), 'w').write('\n'.join(lines) + '\n')
+
+        path = lambda name: os.path.join(self.tmp, name)
+        conf = json.load(open('proxy.conf'))
+        conf.update({'linode_backend': 'api', 'linode_api': {'url': self.api.url, 'api_key': 'loadgen'},
+                     'proxylist': path('proxies.list'), 'group': 'lnodes', 'proxy_prefix': 'lnode',
+                     'lb_config': path('haproxy.cfg'), 'lb_restart': 'true', 'lb_socket': path('admin.sock'),
+                     'state': {'journal': path('journal'), 'snapshot': path('snapshot'), 'export_csv': False},
+                     'inventory': {'state_file': ''}, 'standby': {'enabled': False},
+                     'region_score': {'state_file': path('region_stats.json')},
+                     'notify': {'spool': path('spool'), 'window': 1},
+                     'email': dict(conf.get('email', {}), send_email=False),
+                     'ssh': {'command': '%s fake_ssh.py' % sys.executable},
+                     'readiness': {'stages': ['boot', 'ssh', 'port'], 'initial_backoff': 0.2, 'deadline': 20},
+                     'provision': {'retries': 1, 'region_rate': 60},
+                     'drain': {'enabled': self.drain, 'deadline': self.drain_deadline, 'interval': 0.2}})
+        cfg = path('proxy.conf')
+        json.dump(conf, open(cfg, 'w'), indent=4)
+        os.environ['FAKE_SSH_HANDSHAKE'] = '0.05'
+        os.environ['FAKE_SSH_DRYRUN'] = '1'
+
+        self.rotator = ProxyRotator(cfg=cfg, config=LocalProxyConfig(cfg))
+        self.rotator.config.write_lb_config(reload=False)
+        self.lb = FakeHAProxy(conf['lb_socket'])
+        self.lb.state.load_config(conf['lb_config'])
+        self.lb.start()
+        self.frontend = StandInFrontend(self.lb.state, port=self.port).start()
+        print 'Local bench: origin %s, %d squids on %s.x:%d, frontend on %s:%d' % (
+            self.origin.netloc, self.nodes, self.farm.network, self.farm.port, self.frontend.server_address[0],
+            self.frontend.server_address[1])
+        return self
+
+    def rotate(self):
+        return self.rotator.rotate()
+
+    def settle(self):
+        settle(self.rotator)
+
+    def stop(self):
+        if self.rotator.drainer != None:
+            self.rotator.drainer.stop()
+        self.rotator.notifier.close()
+        self.rotator.ssh.close_all()
+        self.frontend.stop()
+        self.lb.stop()
+        self.api.shutdown()
+        self.farm.stop()
+        self.origin.stop()
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+def settle(rotator):
+    """ Wait until the switched out proxies of rotator have drained and been
+    deleted """
+
+    while rotator.drainer != None and rotator.drainer.pending():
+        time.sleep(0.1)
+
+def parse_frontend(value):
+    host, sep, port = value.rpartition(':')
+    return (host or '127.0.0.1'), int(port)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog='loadgen')
+    parser.add_argument('corpus',help='JSONL corpus of method/url/headers to replay', nargs='?', default=None)
+    parser.add_argument('-c','--concurrency',help='Concurrent clients', type=int, default=16)
+    parser.add_argument('-r','--rate',help='Requests per second over all clients, 0 for unthrottled',
+                        type=float, default=0)
+    parser.add_argument('-d','--duration',help='Seconds to run', type=float, default=30)
+    parser.add_argument('-b','--bucket',help='Seconds per row of the timeline', type=float, default=1.0)
+    parser.add_argument('-n','--requests',help='Size of the synthetic corpus used without one', type=int,
+                        default=5000)
+    parser.add_argument('--rotate-at',help='Rotate a proxy at this many seconds into the run (repeatable)',
+                        type=float, action='append', default=[])
+    parser.add_argument('--frontend',help='Load a real frontend at host:port instead of the local bench',
+                        default=None)
+    parser.add_argument('-C','--conf',help='Configuration to rotate with when using --frontend',
+                        default='proxy.conf')
+    parser.add_argument('--nodes',help='Proxies of the local bench', type=int, default=4)
+    parser.add_argument('--port',help='Port of the local stand-in frontend', type=int, default=5729)
+    parser.add_argument('--squid-delay',help='Mean seconds the local squids add to a request', type=float,
+                        default=0.05)
+    parser.add_argument('--origin-delay',help='Mean response time of the local origin in seconds', type=float,
+                        default=0.02)
+    parser.add_argument('--no-drain',help='Switch proxies out without draining them', action='store_true')
+    parser.add_argument('--write-corpus',help='Write the synthetic corpus to this file and exit', default=None)
+    parser.add_argument('-o','--output',help='Write the results as JSON to this file', default=None)
+    args = parser.parse_args()
+
+    corpus = load_corpus(args.corpus) if args.corpus else make_corpus(args.requests)
+    if args.write_corpus:
+        with open(args.write_corpus, 'w') as f:
+            for request in corpus:
+                f.write(json.dumps(request) + '\n')
+        print 'Wrote',len(corpus),'requests to',args.write_corpus
+        sys.exit(0)
+    if not corpus:
+        print 'No requests in',args.corpus
+        sys.exit(1)
+
+    bench = rotator = None
+    if args.frontend:
+        frontend = parse_frontend(args.frontend)
+        if args.rotate_at:
+            rotator = ProxyRotator(cfg=args.conf)
+    else:
+        bench = LocalBench(args.nodes, args.port, args.squid_delay, args.origin_delay, not args.no_drain).start()
+        frontend = bench.frontend.server_address
+        corpus = retarget(corpus, bench.origin.netloc)
+
+    loadgen = LoadGen(frontend, corpus, args.concurrency, args.rate, args.duration)
+    if args.rotate_at:
+        if bench != None:
+            loadgen.rotate_at(args.rotate_at, bench.rotate, bench.settle)
+        else:
+            loadgen.rotate_at(args.rotate_at, rotator.rotate, lambda: settle(rotator))
+
+    try:
+        loadgen.run()
+    finally:
+        if bench != None:
+            bench.stop()
+        elif rotator != None and rotator.drainer != None:
+            rotator.drainer.stop()
+
+    results = loadgen.results(args.bucket)
+    report(results, args.bucket)
+    if args.output:
+        json.dump(results, open(args.output, 'w'), indent=1, sort_keys=True)
+        print 'Wrote results to',args.output
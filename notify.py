@@ -0,0 +1,357 @@
+"""
+
+Background notification queue.
+
+Notifier.notify() only appends the event to an on-disk spool and wakes
+a worker thread, so a slow or unreachable mail server never holds up a
+rotation. The worker coalesces the events of a configurable window into
+one digest and hands it to a transport - gmail SMTP over a connection
+kept open across messages, Amazon SES or stdout. Events leave the spool
+only once delivered, so whatever is queued when the daemon stops or
+dies is sent after the next start.
+
+Settings come from the "notify" and "email" sections of proxy.conf.
+
+Run with --bench to compare enqueueing against synchronous sends on the
+local SMTP stand-in in fake_smtp.
+
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import smtplib
+import argparse
+import datetime
+import threading
+
+from send_gmail import create_message
+from state_journal import atomic_write
+
+class StdoutTransport(object):
+    """ Print messages instead of sending them """
+
+    def send(self, from_email, recipients, subject, body):
+        print 'Subject:',subject
+        print body
+
+    def close(self):
+        pass
+
+class SMTPTransport(object):
+    """ Send over one SMTP connection, kept open between messages """
+
+    def __init__(self, host='smtp.gmail.com', port=587, user=None, password=None, timeout=30, idle_timeout=240):
+        self.host = host
+        self.port = port
+        self.user = user
+        self.password = password
+        self.timeout = timeout
+        # Servers drop idle clients - reconnect rather than trip over it
+        self.idle_timeout = idle_timeout
+        self.server = None
+        self.last_used = 0
+        self.connects = 0
+
+    def connect(self):
+        self.close()
+        server = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        server.ehlo()
+        if server.has_extn('starttls'):
+            server.starttls()
+            server.ehlo()
+        if self.password and server.has_extn('auth'):
+            server.login(self.user, self.password)
+        self.server = server
+        self.connects += 1
+
+    def send(self, from_email, recipients, subject, body):
+        msg = create_message(from_email, recipients, subject, body).as_string()
+        if self.server == None or time.time() - self.last_used > self.idle_timeout:
+            self.connect()
+        try:
+            self.server.sendmail(from_email, recipients, msg)
+        except (smtplib.SMTPServerDisconnected, socket.error), e:
+            # Connection went stale - one fresh attempt
+            print 'SMTP connection lost',e,'- reconnecting'
+            self.connect()
+            self.server.sendmail(from_email, recipients, msg)
+        self.last_used = time.time()
+
+    def close(self):
+        if self.server != None:
+            try:
+                self.server.quit()
+            except (smtplib.SMTPException, socket.error):
+                pass
+            self.server = None
+
+class SESTransport(object):
+    """ Send through Amazon SES, reusing the boto connection """
+
+    def __init__(self):
+        self.conn = None
+
+    def send(self, from_email, recipients, subject, body):
+        import boto
+        import ses_email
+
+        if self.conn == None:
+            self.conn = boto.connect_ses()
+        error = ses_email.send_ses(from_email, subject, body, ', '.join(recipients), conn=self.conn)
+        if error:
+            raise IOError(error)
+
+    def close(self):
+        self.conn = None
+
+def make_transport(name, settings, email_config):
+    """ Create a transport by name: smtp, ses or stdout """
+
+    if name == 'smtp':
+        return SMTPTransport(host=settings.get('smtp_host', 'smtp.gmail.com'),
+                             port=int(settings.get('smtp_port', 587)),
+                             user=email_config.get('from_email'),
+                             password=email_config.get('from_pass'),
+                             timeout=float(settings.get('smtp_timeout', 30)),
+                             idle_timeout=float(settings.get('smtp_idle_timeout', 240)))
+    if name == 'ses':
+        return SESTransport()
+    return StdoutTransport()
+
+class Notifier(object):
+    """ Persistent queue of notification events, delivered as digests by a
+    background thread """
+
+    def __init__(self, transport, from_email=None, recipients=(), subject='Linode proxy report: %s from %s',
+                 window=300.0, spool='notify.spool', max_events=100, retry_backoff=60.0):
+        self.transport = transport
+        self.from_email = from_email
+        self.recipients = list(recipients)
+        # Takes the timestamp and the host name
+        self.subject = subject
+        # Events within this many seconds of the first go into one digest
+        self.window = window
+        self.spool = spool
+        self.max_events = max_events
+        self.retry_backoff = retry_backoff
+        self.pending = []
+        self.cond = threading.Condition()
+        # Serializes deliveries of the worker and flush()
+        self.sending = threading.Lock()
+        self.thread = None
+        self.running = False
+        self.retry_at = 0
+        self.sent = 0
+        self.digests = 0
+        self.failures = 0
+        self.load()
+
+    @classmethod
+    def from_config(cls, config):
+        """ Create a notifier from the "notify" and "email" sections of proxy.conf """
+
+        settings = config.notify or {}
+        email_config = config.email or {}
+        transport = settings.get('transport', 'smtp')
+        if not email_config.get('send_email', True):
+            transport = 'stdout'
+        return cls(make_transport(transport, settings, email_config),
+                   from_email=email_config.get('from_email'),
+                   recipients=email_config.get('to_email', []),
+                   subject=email_config.get('email_subject', 'Linode proxy report: %s from %s'),
+                   window=float(settings.get('window', 300)),
+                   spool=settings.get('spool', 'notify.spool'),
+                   max_events=int(settings.get('max_events', 100)),
+                   retry_backoff=float(settings.get('retry_backoff', 60)))
+
+    def load(self):
+        """ Load events left in the spool by a previous run """
+
+        if not self.spool or not os.path.isfile(self.spool):
+            return
+        for line in open(self.spool):
+            try:
+                self.pending.append(json.loads(line))
+            except ValueError:
+                # Cut short by a crash
+                print 'Skipping bad spool line',repr(line)
+        if self.pending:
+            print 'Loaded',len(self.pending),'queued notifications from',self.spool
+
+    def save(self):
+        """ Rewrite the spool with the pending events. Caller holds cond. """
+
+        if self.spool:
+            atomic_write(self.spool, [json.dumps(event) + '\n' for event in self.pending])
+
+    def notify(self, kind, body):
+        """ Queue an event. Returns at once; delivery happens in the background """
+
+        event = {'ts': time.time(), 'kind': kind, 'body': body}
+        with self.cond:
+            if self.spool:
+                f = open(self.spool, 'a')
+                f.write(json.dumps(event) + '\n')
+                f.close()
+            self.pending.append(event)
+            self.cond.notify()
+        self.start()
+
+    def format(self, events):
+        """ Return (subject, body) of the digest of events """
+
+        stamp = datetime.datetime.strftime(datetime.datetime.now(), "%d-%b-%Y %I:%M:%S %p")
+        subject = self.subject % (stamp, socket.gethostname())
+        if len(events) == 1:
+            return subject, events[0]['body']
+
+        kinds = {}
+        for event in events:
+            kinds[event['kind']] = kinds.get(event['kind'], 0) + 1
+        subject += ' (%d events)' % len(events)
+        parts = ['Digest of %d events: %s' % (len(events), ', '.join('%d %s' % (n, k) for k, n in sorted(kinds.items())))]
+        for event in events:
+            when = time.strftime('%d-%b-%Y %H:%M:%S', time.localtime(event['ts']))
+            parts.append('---- %s at %s ----\n%s' % (event['kind'], when, event['body'].strip()))
+        return subject, '\n\n'.join(parts) + '\n'
+
+    def deliver(self, events):
+        """ Send a digest of events. Returns True on success """
+
+        subject, body = self.format(events)
+        try:
+            self.transport.send(self.from_email, self.recipients, subject, body)
+        except Exception, e:
+            self.failures += 1
+            print 'Error sending notification',e
+            self.transport.close()
+            return False
+        self.digests += 1
+        self.sent += len(events)
+        return True
+
+    def send_pending(self, limit=None):
+        """ Deliver up to limit pending events as one digest and drop them
+        from the queue. Returns True on success. """
+
+        with self.sending:
+            with self.cond:
+                events = list(self.pending[:limit or self.max_events])
+            if not events or not self.deliver(events):
+                return not events
+            with self.cond:
+                # New events may have been queued meanwhile, behind these
+                del self.pending[:len(events)]
+                self.save()
+            return True
+
+    def loop(self):
+        while True:
+            with self.cond:
+                while self.running and (not self.pending or time.time() < self.retry_at):
+                    if self.pending:
+                        # Back off from a failed delivery
+                        self.cond.wait(self.retry_at - time.time())
+                    else:
+                        # Idle until notify() or close() signals
+                        self.cond.wait()
+                if not self.running:
+                    break
+                # Give further events the rest of the window to coalesce
+                deadline = self.pending[0]['ts'] + self.window
+                while self.running and time.time() < deadline and len(self.pending) < self.max_events:
+                    self.cond.wait(deadline - time.time())
+                if not self.running:
+                    break
+
+            if not self.send_pending():
+                self.retry_at = time.time() + self.retry_backoff
+
+    def start(self):
+        """ Start the worker, unless it is running in this process """
+
+        with self.cond:
+            if self.thread != None and self.thread.is_alive():
+                return
+            self.running = True
+            self.thread = threading.Thread(target=self.loop, name='notify')
+            self.thread.daemon = True
+            self.thread.start()
+
+    def close(self, timeout=30.0):
+        """ Stop the worker and try to send what is pending now. Undelivered
+        events stay in the spool for the next run. """
+
+        with self.cond:
+            self.running = False
+            self.cond.notify_all()
+        if self.thread != None:
+            self.thread.join(timeout)
+        deadline = time.time() + timeout
+        while self.pending and time.time() < deadline:
+            if not self.send_pending():
+                break
+        self.transport.close()
+
+    def stats(self):
+        return {'pending': len(self.pending), 'sent': self.sent, 'digests': self.digests,
+                'failures': self.failures}
+
+def benchmark(events, delay):
+    """ Compare synchronous sends with queued digests on the fake SMTP server """
+
+    import tempfile
+    from fake_smtp import FakeSMTPServer
+
+    server = FakeSMTPServer(delay=delay).start()
+    recipients = ['ops@example.com']
+
+    transport = SMTPTransport('127.0.0.1', server.port)
+    start = time.time()
+    for i in range(events):
+        # The old way - a fresh connection and a blocking send per event
+        transport.send('proxy@example.com', recipients, 'switch %d' % i, 'Switched proxy %d' % i)
+        transport.close()
+    sync = (time.time() - start) / events
+    sync_connects = transport.connects
+
+    spool = tempfile.mktemp(prefix='notify-bench')
+    transport = SMTPTransport('127.0.0.1', server.port)
+    notifier = Notifier(transport, 'proxy@example.com', recipients, window=0.5, spool=spool)
+    start = time.time()
+    for i in range(events):
+        notifier.notify('rotate', 'Switched proxy %d' % i)
+    queued = (time.time() - start) / events
+    while notifier.pending:
+        time.sleep(0.05)
+    drained = time.time() - start
+    notifier.close()
+    os.remove(spool)
+    server.stop()
+
+    print 'Events: %d, SMTP server delay %.2fs per message' % (events, delay)
+    print 'Synchronous send:  %8.2f ms per event, %d connections' % (sync * 1000, sync_connects)
+    print 'Queued notify:     %8.3f ms per event, %d digest(s) over %d connection(s) in %.2fs' % (
+        queued * 1000, notifier.digests, transport.connects, drained)
+    print 'Messages received by the fake server:',len(server.messages)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog='notify')
+    parser.add_argument('--bench',help='Benchmark N events against the fake SMTP server', type=int, default=0)
+    parser.add_argument('--delay',help='Fake SMTP server delay per message', type=float, default=0.2)
+    parser.add_argument('-C','--conf',help='Use the given configuration file', default='proxy.conf')
+    parser.add_argument('--flush',help='Send whatever is queued in the spool and exit', action='store_true')
+    args = parser.parse_args()
+
+    if args.bench:
+        benchmark(args.bench, args.delay)
+        sys.exit(0)
+
+    if args.flush:
+        from rotate_proxies import ProxyConfig
+        notifier = Notifier.from_config(ProxyConfig(args.conf, read_only=True))
+        notifier.close()
+        print 'Notifier stats =>',notifier.stats()
@@ -0,0 +1,281 @@
+"""
+
+Indexed proxy state for rotation selection.
+
+ProxyIndex keeps compact ProxyRecords together with secondary indexes -
+a lazily cleaned min-heap on switch_out time (global and per region) and
+per-region buckets of active proxies - so that LRU, LRU + new region,
+random and new region selection run in logarithmic or constant time
+however large the fleet grows.
+
+Run this module to benchmark selection at 10k and 100k proxies.
+
+"""
+
+import time
+import heapq
+import random
+import operator
+import argparse
+import itertools
+
+class ProxyRecord(object):
+    """ State of one proxy node """
+
+    __slots__ = ('ip', 'region', 'linode_id', 'switch_in', 'switch_out', 'active',
+                 # Index bookkeeping
+                 'seq', 'pos', 'rpos')
+
+    def __init__(self, ip, region, linode_id, switch_in, switch_out, active=True):
+        self.ip = ip
+        self.region = region
+        self.linode_id = linode_id
+        self.switch_in = switch_in
+        self.switch_out = switch_out
+        self.active = active
+        self.seq = 0
+        self.pos = -1
+        self.rpos = -1
+
+    def __iter__(self):
+        """ Unpack as the legacy (ip, region, id, switch_in, switch_out) list """
+
+        return iter((self.ip, self.region, self.linode_id, self.switch_in, self.switch_out))
+
+    def __repr__(self):
+        return '[%s, %d, %d, %d, %d%s]' % (self.ip, self.region, self.linode_id, self.switch_in,
+                                           self.switch_out, '' if self.active else ', inactive')
+
+class ProxyIndex(object):
+    """ Proxy records with indexes for fast rotation selection """
+
+    def __init__(self):
+        # Proxy IP => ProxyRecord, active or not
+        self.records = {}
+        # Min-heaps of (switch_out, seq, record) over active records. Entries
+        # of records switched out since are skipped lazily.
+        self.heap = []
+        self.region_heaps = {}
+        # Active records, overall and per region, for O(1) random choice
+        self.active = []
+        self.region_active = {}
+        self.counter = itertools.count(1)
+
+    def __len__(self):
+        return len(self.records)
+
+    def __contains__(self, ip):
+        return ip in self.records
+
+    def get(self, ip):
+        return self.records.get(ip)
+
+    def count_active(self, region=None):
+        """ Return number of active proxies, overall or in a region """
+
+        if region != None:
+            return len(self.region_active.get(region, ()))
+        return len(self.active)
+
+    def add(self, ip, region, linode_id, switch_in, switch_out, active=True):
+        """ Add or replace the record for ip and return it """
+
+        old = self.records.get(ip)
+        if old != None:
+            self.deactivate(old)
+
+        record = ProxyRecord(ip, region, linode_id, switch_in, switch_out, False)
+        self.records[ip] = record
+        if active:
+            self.activate(record)
+        return record
+
+    def activate(self, record):
+        """ Mark a record active and index it """
+
+        if record.active:
+            return
+        record.active = True
+        record.seq = self.counter.next()
+
+        record.pos = len(self.active)
+        self.active.append(record)
+        bucket = self.region_active.setdefault(record.region, [])
+        record.rpos = len(bucket)
+        bucket.append(record)
+
+        entry = (record.switch_out, record.seq, record)
+        heapq.heappush(self.heap, entry)
+        heapq.heappush(self.region_heaps.setdefault(record.region, []), entry)
+
+    def _remove(self, items, record, attr):
+        """ Swap-remove record from items using its stored position """
+
+        idx = getattr(record, attr)
+        last = items.pop()
+        if last is not record:
+            items[idx] = last
+            setattr(last, attr, idx)
+        setattr(record, attr, -1)
+
+    def deactivate(self, record):
+        """ Mark a record inactive and drop it from the indexes """
+
+        if not record.active:
+            return
+        record.active = False
+        # Invalidates its heap entries
+        record.seq = 0
+        self._remove(self.active, record, 'pos')
+        self._remove(self.region_active[record.region], record, 'rpos')
+
+        # Rebuild the heaps once they are mostly stale entries
+        if len(self.heap) > 2*len(self.active) + 64:
+            self.rebuild()
+
+    def prune(self, keep):
+        """ Drop all but the keep most recently switched out inactive
+        records. Returns the number dropped. """
+
+        inactive = sorted((r for r in self.records.values() if not r.active), key=lambda r: r.switch_out)
+        dropped = inactive[:max(len(inactive) - keep, 0)]
+        for record in dropped:
+            del self.records[record.ip]
+        return len(dropped)
+
+    def rebuild(self):
+        """ Rebuild the heaps from the active records only """
+
+        self.heap = [(r.switch_out, r.seq, r) for r in self.active]
+        heapq.heapify(self.heap)
+        self.region_heaps = {}
+        for region, bucket in self.region_active.items():
+            heap = [(r.switch_out, r.seq, r) for r in bucket]
+            heapq.heapify(heap)
+            self.region_heaps[region] = heap
+
+    def _top(self, heap):
+        """ Return the live record at the top of heap, dropping stale entries """
+
+        while heap:
+            switch_out, seq, record = heap[0]
+            if record.active and record.seq == seq:
+                return record
+            heapq.heappop(heap)
+        return None
+
+    def lru(self, exclude_region=None):
+        """ Return the active record switched out longest ago, optionally
+        not from exclude_region. Returns None if there is none. """
+
+        if exclude_region == None:
+            return self._top(self.heap)
+
+        best = None
+        for region, heap in self.region_heaps.items():
+            if region == exclude_region:
+                continue
+            record = self._top(heap)
+            if record != None and (best == None or (record.switch_out, record.seq) < (best.switch_out, best.seq)):
+                best = record
+        return best
+
+    def random(self, exclude_region=None):
+        """ Return a random active record, optionally not from exclude_region.
+        Returns None if there is none. """
+
+        if exclude_region == None:
+            return random.choice(self.active) if self.active else None
+
+        total = len(self.active) - self.count_active(exclude_region)
+        if total <= 0:
+            return None
+
+        # Pick a region weighted by its active count, then a record in it
+        pick = random.randrange(total)
+        for region, bucket in self.region_active.items():
+            if region == exclude_region:
+                continue
+            if pick < len(bucket):
+                return bucket[pick]
+            pick -= len(bucket)
+
+    def active_regions(self):
+        """ Return regions which have active proxies """
+
+        return [region for region, bucket in self.region_active.items() if bucket]
+
+    def active_records(self):
+        """ Return a list of the active records """
+
+        return list(self.active)
+
+def legacy_select(proxies, input_region, policy):
+    """ The original list based selection, for comparison """
+
+    active_proxies = [p for p in proxies if p[-1]]
+    if policy == 'random':
+        return random.choice(active_proxies)
+
+    if policy in ('lru', 'lru_new_region'):
+        proxies_used = sorted(active_proxies, key=operator.itemgetter(4))
+        if policy == 'lru_new_region':
+            for item in proxies_used:
+                if item[1] != input_region:
+                    return item
+        return proxies_used[0]
+
+    random.shuffle(active_proxies)
+    for item in active_proxies:
+        if item[1] != input_region:
+            return item
+
+def benchmark(size, rounds, regions=range(8)):
+    """ Time rotations (select one, switch in a replacement) at the given size """
+
+    now = int(time.time())
+    index, legacy = ProxyIndex(), []
+    for i in range(size):
+        ip, region, so = 'ip%d' % i, random.choice(regions), now - random.randrange(10**6)
+        index.add(ip, region, i, so, so)
+        legacy.append([ip, region, i, so, so, True])
+
+    policies = (('random', None, False),
+                ('lru', None, True),
+                ('new_region', 0, False),
+                ('lru_new_region', 0, True))
+
+    print 'Proxies: %d, %d rotations per policy' % (size, rounds)
+    for name, exclude, lru in policies:
+        start = time.time()
+        for i in range(rounds):
+            region = random.choice(regions)
+            exclude = region if exclude != None else None
+            record = index.lru(exclude) if lru else index.random(exclude)
+            if record == None:
+                record = index.lru()
+            index.deactivate(record)
+            del index.records[record.ip]
+            index.add('new%d-%s' % (i, name), region, i, now + i, now + i)
+        indexed = (time.time() - start) / rounds
+
+        legacy_rounds = max(1, min(rounds, 2000000 // size))
+        start = time.time()
+        for i in range(legacy_rounds):
+            region = random.choice(regions)
+            item = legacy_select(legacy, region, name)
+            item[-1] = False
+            legacy.append(['new%d-%s' % (i, name), region, i, now + i, now + i, True])
+        old = (time.time() - start) / legacy_rounds
+
+        print '  %-16s indexed %9.2f us   legacy %10.2f us   (%.0fx)' % (name, indexed * 1e6, old * 1e6,
+                                                                       old / max(indexed, 1e-9))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog='proxy_index')
+    parser.add_argument('-n','--rounds',help='Rotations per policy', type=int, default=2000)
+    parser.add_argument('sizes', nargs='*', type=int, default=[10000, 100000])
+    args = parser.parse_args()
+
+    for size in args.sizes:
+        benchmark(size, args.rounds)
@@ -4,51 +4,105 @@ Script to parse haproxy.cfg file and restart dead squid instances
 
 """
 
-import re
-import os
+import json
 import time
 import utils
+import timing
 
-server_re = re.compile(r'server\s+([a-zA-Z0-9]+)\s+(\d+\.\d+\.\d+\.\d+)\:(\d+)*')
-network_test_cmd = 'nc %s %d -w 5 -zv 2>/dev/null'
-squid_restart_cmd = 'ssh -o StrictHostKeyChecking=no -o UserKnownHostsFile=/dev/null ubuntu@%s "sudo squid3 -f /etc/squid3/squid.conf"'
-
-def parse_config(filename='/etc/haproxy/haproxy.cfg'):
-    """ Parse HAproxy configuration file """
-
-    restarted = {}
-    
-    for line in open(filename).readlines():
-        line = line.strip()
-        if line == '': continue
-
-        if line.startswith('server'):
-            # Get the server name out
-            match = server_re.match(line)
-            server_name, ip_address, port = match.groups()
-            # Test for access via nc
-            print ip_address, port
-            cmd = network_test_cmd % (ip_address, int(port))
-            if os.system(cmd) != 0:
-                # This squid instance is down
-                cmd = squid_restart_cmd % ip_address
-                print 'Restarting squid on',ip_address,'...'
-                if os.system(cmd) == 0:
-                    restarted[ip_address] = 1
-
-    print 'Restarted',len(restarted),'squid instances.'
+from health_probe import HealthProber, RestartPool, parse_lb_servers, load_probe_config
+from ssh_session import SessionManager
+from fleet import FleetExecutor
+
+def make_prober(settings):
+    """ Return a HealthProber configured from the probe settings """
+
+    return HealthProber(concurrency=int(settings['concurrency']),
+                        timeout=float(settings['timeout']),
+                        url=settings['url'],
+                        auth=settings['auth'])
+
+def load_section(name, cfg='proxy.conf'):
+    """ Load a section of the given config file, empty if missing """
+
+    try:
+        return json.load(open(cfg)).get(name, {})
+    except (OSError, IOError, ValueError):
+        return {}
+
+def make_fleet(workers):
+    """ Return a FleetExecutor over ssh sessions configured from proxy.conf """
+
+    settings = load_section('fleet')
+    sessions = SessionManager.from_settings(load_section('ssh'), load_section('user') or 'ubuntu')
+    return FleetExecutor(sessions, concurrency=workers, timeout=float(settings.get('timeout', 120)))
+
+@timing.timed('monitor.parse_config')
+def parse_config(filename='/etc/haproxy/haproxy.cfg', prober=None, restarter=None):
+    """ Parse HAproxy configuration file, probe all squid backends concurrently
+    and queue restarts for the dead ones """
+
+    settings = load_probe_config()
+    own_prober = (prober == None)
+    own_restarter = (restarter == None)
+    if own_prober:
+        prober = make_prober(settings)
+    if own_restarter:
+        workers = int(settings['restart_workers'])
+        restarter = RestartPool(workers=workers, fleet=make_fleet(workers))
+
+    start = time.time()
+    with timing.span('monitor.sweep'):
+        results = prober.sweep(parse_lb_servers(filename))
+    queued = 0
+    for result in results:
+        print result
+        if not result.ok and restarter.submit(result.ip):
+            queued += 1
+
+    print 'Probed',len(results),'squid instances in %.2fs,' % (time.time() - start),
+    print 'queued',queued,'restarts.'
+
+    if own_prober:
+        prober.close()
+    if own_restarter:
+        # One-shot run - wait for the restarts to finish
+        with timing.span('monitor.restart_wait'):
+            restarted = restarter.wait()
+        restarter.close()
+        restarter.fleet.close()
+        restarter.fleet.sessions.close_all()
+        print 'Restarted',len(filter(None, restarted.values())),'squid instances.'
+
+    return results
 
 def main():
 
     utils.daemonize('monitor.pid', logfile='monitor.log')
-    
+
+    timing_settings = load_section('timing')
+    timing.setup(timing_settings)
+    timing.serve(timing_settings, port_key='monitor_port')
+
+    settings = load_probe_config()
+    prober = make_prober(settings)
+    # Sessions to nodes restarted recently are reused, idle ones closed
+    workers = int(settings['restart_workers'])
+    fleet = make_fleet(workers)
+    restarter = RestartPool(workers=workers, fleet=fleet)
+
     while True:
-        parse_config()
+        parse_config(prober=prober, restarter=restarter)
+        restarted = restarter.collect()
+        if restarted:
+            print 'Restarted',len(filter(None, restarted.values())),'squid instances.'
+        fleet.sessions.evict_idle()
         time.sleep(300)
-        
+
 if __name__ == "__main__":
     import sys
     if len(sys.argv)>1:
+        timing.setup(load_section('timing'))
         parse_config(sys.argv[1])
+        timing.report()
     else:
         main()
@@ -0,0 +1,196 @@
+"""
+
+Readiness gate for new proxy nodes.
+
+A freshly created linode goes through a pipeline of stages before it may
+be switched in, each polled with exponential backoff until it passes:
+
+    boot    - the Linode backend reports the node running
+    ssh     - a command runs over ssh
+    setup   - the post-process commands (iptables, squid) succeed
+    port    - the squid port accepts connections
+    proxy   - a real proxied request, with auth, gets an answer
+
+All stages share one overall deadline. The time and number of attempts
+of every stage are recorded, both on the result and as timing
+histograms (readiness.<stage>).
+
+Settings come from the "readiness" section of proxy.conf, the url and
+auth of the proxied request from the "probe" section. Run with an IP to
+check a running node by hand.
+
+"""
+
+import sys
+import argparse
+
+import timing
+from clock import RealClock
+from health_probe import HealthProber
+
+stages = ('boot', 'ssh', 'setup', 'port', 'proxy')
+
+class ReadinessError(Exception):
+    """ A node did not become ready within the deadline """
+    pass
+
+class ReadinessResult(object):
+    """ Outcome of gating one node """
+
+    def __init__(self, ip, linode_id=None):
+        self.ip = ip
+        self.linode_id = linode_id
+        self.ok = False
+        # Stage which did not pass in time, if any
+        self.failed = None
+        self.error = None
+        # (stage, seconds, attempts) in pipeline order
+        self.stages = []
+        self.elapsed = 0.0
+
+    def to_dict(self):
+        return {'ip': self.ip, 'linode_id': self.linode_id, 'ok': self.ok, 'failed': self.failed,
+                'error': self.error, 'elapsed': round(self.elapsed, 3),
+                'stages': [(stage, round(secs, 3), attempts) for stage, secs, attempts in self.stages]}
+
+    def __repr__(self):
+        parts = ' '.join('%s=%.1fs/%d' % stage for stage in self.stages)
+        if self.ok:
+            return '<Ready %s in %.1fs: %s>' % (self.ip, self.elapsed, parts)
+        return '<Not ready %s at %s after %.1fs: %s (%s)>' % (self.ip, self.failed, self.elapsed,
+                                                             self.error, parts)
+
+class ReadinessChecker(object):
+    """ Poll the stages of a new node with backoff, under a deadline """
+
+    def __init__(self, linode_cmd, ssh, prober=None, port=8321, clock=None, deadline=600.0,
+                 initial=2.0, factor=1.5, max_interval=10.0, enabled=stages):
+        self.linode_cmd = linode_cmd
+        self.ssh = ssh
+        # HealthProber doing the proxied request of the proxy stage
+        self.prober = prober or HealthProber(concurrency=1)
+        # and one which only connects, for the port stage
+        self.connector = HealthProber(concurrency=1, timeout=self.prober.timeout)
+        self.port = port
+        self.clock = clock or RealClock()
+        self.deadline = deadline
+        self.initial = initial
+        self.factor = factor
+        self.max_interval = max_interval
+        # Stages not listed here are skipped
+        self.enabled = [stage for stage in stages if stage in enabled]
+
+    @classmethod
+    def from_config(cls, config, linode_cmd, ssh, clock=None):
+        """ Create a checker from the "readiness" section of proxy.conf """
+
+        settings = config.readiness or {}
+        probe = config.probe or {}
+        prober = HealthProber(concurrency=1, timeout=float(settings.get('timeout', probe.get('timeout', 5))),
+                              url=probe.get('url') or None, auth=probe.get('auth') or None)
+        return cls(linode_cmd, ssh, prober,
+                   port=int(settings.get('port', 8321)),
+                   clock=clock,
+                   deadline=float(settings.get('deadline', 600)),
+                   initial=float(settings.get('initial_backoff', 2)),
+                   factor=float(settings.get('factor', 1.5)),
+                   max_interval=float(settings.get('max_backoff', 10)),
+                   enabled=settings.get('stages', stages))
+
+    def check_boot(self, ip, linode_id):
+        # Backends which cannot tell the status pass at once
+        node_status = getattr(self.linode_cmd, 'node_status', None)
+        if node_status == None or linode_id == None:
+            return True, 'no status'
+        status = node_status(linode_id)
+        return status in (None, 1), 'status %s' % status
+
+    def check_ssh(self, ip, linode_id):
+        result = self.ssh.run(ip, ['true'])[0]
+        return result.ok, result.stderr.strip() or 'exit %s' % result.status
+
+    def check_port(self, ip, linode_id):
+        result = self.connector.probe(('new', ip, self.port))
+        return result.ok, result.error
+
+    def check_proxy(self, ip, linode_id):
+        if not self.prober.url:
+            return True, 'no url'
+        result = self.prober.probe(('new', ip, self.port))
+        return result.ok, result.error or 'status %s' % result.status
+
+    def poll(self, check, end):
+        """ Call check() until it returns (True, detail) or end is passed.
+        Returns (passed, attempts, last detail) """
+
+        delay, attempts = self.initial, 0
+        while True:
+            attempts += 1
+            try:
+                ok, detail = check()
+            except Exception, e:
+                ok, detail = False, str(e) or e.__class__.__name__
+            if ok:
+                return True, attempts, detail
+            now = self.clock.time()
+            if now >= end:
+                return False, attempts, detail
+            self.clock.sleep(min(delay, end - now))
+            delay = min(delay * self.factor, self.max_interval)
+
+    def wait(self, ip, linode_id=None, setup=None):
+        """ Run every enabled stage on the node in order, calling setup(ip) -
+        which returns whether it succeeded - for the setup stage. setup is
+        called on every attempt, so it should only redo what failed before.
+        Returns a ReadinessResult, ok only if all stages passed. """
+
+        result = ReadinessResult(ip, linode_id)
+        start = self.clock.time()
+        end = start + self.deadline
+        for stage in self.enabled:
+            if stage == 'setup':
+                if setup == None:
+                    continue
+                check = lambda: (setup(ip), 'setup commands failed')
+            else:
+                method = getattr(self, 'check_' + stage)
+                check = lambda: method(ip, linode_id)
+
+            stage_start = self.clock.time()
+            passed, attempts, detail = self.poll(check, end)
+            secs = self.clock.time() - stage_start
+            result.stages.append((stage, secs, attempts))
+            timing.observe('readiness.' + stage, secs)
+            if not passed:
+                result.failed, result.error = stage, detail
+                break
+        else:
+            result.ok = True
+
+        result.elapsed = self.clock.time() - start
+        timing.observe('readiness.total', result.elapsed)
+        return result
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog='readiness')
+    parser.add_argument('ip',help='IP address of the node to check')
+    parser.add_argument('-l','--linode-id',help='Linode id of the node, for the boot stage', type=int, default=None)
+    parser.add_argument('-C','--conf',help='Use the given configuration file', default='proxy.conf')
+    parser.add_argument('-d','--deadline',help='Overall deadline in seconds', type=float, default=None)
+    args = parser.parse_args()
+
+    from rotate_proxies import ProxyConfig
+    from linode_api import make_linode_backend
+    from ssh_session import SessionManager
+
+    config = ProxyConfig(args.conf, read_only=True)
+    ssh = SessionManager.from_config(config)
+    checker = ReadinessChecker.from_config(config, make_linode_backend(config), ssh)
+    if args.deadline != None:
+        checker.deadline = args.deadline
+    try:
+        result = checker.wait(args.ip, args.linode_id)
+    finally:
+        ssh.close_all()
+    print result
+    sys.exit(0 if result.ok else 1)
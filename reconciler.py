@@ -0,0 +1,411 @@
+"""
+
+Reconciliation of the Linode fleet, the proxy state and the live LB.
+
+A rotation which fails halfway can leave a linode running that neither
+proxies.list nor haproxy.cfg knows about, and a node deleted or crashed
+outside the daemon stays in the state and the LB. Reconciler
+periodically diffs three sources:
+
+    linodes - the inventory, refreshed with one list call per cycle,
+              plus the nodes we created and never put in our group
+    state   - the active proxies of ProxyConfig and their LB slots
+    LB      - the live servers of the HAProxy backend (admin socket)
+
+and finds
+
+    orphan     - a linode with no active proxy, which is not a standby
+                 node; it is deleted
+    missing    - an active proxy whose linode is gone; it is replaced
+                 through the scheduler
+    lb_missing - an active proxy its LB slot does not serve; the slot is
+                 pointed at it and set ready
+    lb_stale   - an LB slot serving an IP which is not an active proxy;
+                 the slot is put into maintenance
+
+Proxies with a rotation queued or running, or drained by the ban
+detector, are skipped. A finding is only acted on once it has persisted
+for `grace` seconds, so nodes of rotations in progress are left alone.
+Without `apply` findings are only reported (dry run). Deletes are capped
+per cycle and held altogether when most of the fleet looks orphaned -
+that is a lost state file rather than leaked nodes.
+
+Settings come from the "reconcile" section of proxy.conf. Run with a
+config to reconcile once, or with --bench to time a cycle over a large
+fake fleet.
+
+"""
+
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+import threading
+import collections
+
+import timing
+from haproxy_admin import HAProxyAdminError
+
+kinds = ('orphan', 'missing', 'lb_missing', 'lb_stale')
+
+# HAProxy srv_admin_state flag of a server in maintenance
+admin_maint = 0x01
+
+class Finding(object):
+    """ One difference between the sources """
+
+    __slots__ = ('kind', 'ip', 'linode_id', 'server', 'detail', 'first_seen', 'action')
+
+    def __init__(self, kind, ip, linode_id=None, server=None, detail=None):
+        self.kind = kind
+        self.ip = ip
+        self.linode_id = linode_id
+        self.server = server
+        self.detail = detail
+        self.first_seen = None
+        # What was done about it, None if nothing (yet)
+        self.action = None
+
+    def key(self):
+        return (self.kind, self.ip, self.linode_id, self.server)
+
+    def to_dict(self):
+        return dict((name, getattr(self, name)) for name in self.__slots__)
+
+    def __repr__(self):
+        parts = [self.kind, self.ip]
+        if self.linode_id != None:
+            parts.append('id=%s' % self.linode_id)
+        if self.server != None:
+            parts.append('server=%s' % self.server)
+        if self.detail:
+            parts.append('(%s)' % self.detail)
+        if self.action:
+            parts.append('=> %s' % self.action)
+        return '<%s>' % ' '.join(map(str, parts))
+
+class Reconciler(object):
+    """ Find and optionally fix drift between linodes, state and LB """
+
+    def __init__(self, inventory, records, slots, lb_admin, lock=None, replace=None, ignore=None,
+                 standby=None, apply=False, grace=1800.0, max_deletes=3, max_lb_fixes=16,
+                 max_orphans=0.5, interval=900.0, clock=None, notify=None):
+        self.inventory = inventory
+        # Return the active proxy records
+        self.records = records
+        # Return {proxy IP: LB server name} of the active proxies
+        self.slots = slots
+        self.lb_admin = lb_admin
+        # Held while the state and the LB are read and while the LB is fixed
+        self.lock = lock or threading.RLock()
+        # Called with a proxy IP to queue its replacement
+        self.replace = replace
+        # Return IPs to leave alone, e.g. those being rotated out
+        self.ignore = ignore or (lambda: set())
+        # Return linode ids of the standby pool
+        self.standby = standby or (lambda: set())
+        self.apply = apply
+        self.grace = grace
+        self.max_deletes = max_deletes
+        self.max_lb_fixes = max_lb_fixes
+        # Hold deletes when more than this share of the linodes is orphaned
+        self.max_orphans = max_orphans
+        self.interval = interval
+        self.clock = clock or time
+        self.notify = notify
+        # Finding key => time first seen
+        self.first_seen = {}
+        # Keys of findings already notified
+        self.reported = set()
+        self.last = []
+        self.counters = collections.defaultdict(int)
+        self.wakeup = threading.Event()
+        self.running = False
+
+    @classmethod
+    def from_config(cls, config, inventory, replace=None, ignore=None, standby=None, notify=None):
+        """ Create a reconciler from the "reconcile" section of proxy.conf,
+        None if it is disabled """
+
+        settings = config.reconcile or {}
+        if not settings.get('enabled', True):
+            return None
+        return cls(inventory, config.get_active_proxies, config.get_slot_names, config.lb_admin,
+                   lock=config.lock, replace=replace, ignore=ignore, standby=standby,
+                   apply=bool(settings.get('apply', False)),
+                   grace=float(settings.get('grace', 1800)),
+                   max_deletes=int(settings.get('max_deletes', 3)),
+                   max_lb_fixes=int(settings.get('max_lb_fixes', 16)),
+                   max_orphans=float(settings.get('max_orphans', 0.5)),
+                   interval=float(settings.get('interval', 900)),
+                   clock=config.clock, notify=notify)
+
+    def collect(self):
+        """ Read the three sources. Returns (linodes, records, slots, servers)
+        where servers is None if the LB could not be read, or None if the
+        linodes could not be listed. """
+
+        # The one API call of the cycle
+        self.counters['api_calls'] += 1
+        if not self.inventory.refresh():
+            self.counters['list_errors'] += 1
+            return None
+        linodes = self.inventory.list_nodes() + self.inventory.unassigned()
+        with self.lock:
+            records = list(self.records())
+            slots = self.slots()
+            try:
+                servers = self.lb_admin.show_servers_state()
+            except HAProxyAdminError, e:
+                print 'Reconciler could not read the LB',e
+                self.counters['lb_errors'] += 1
+                servers = None
+        return linodes, records, slots, servers
+
+    def diff(self, linodes, records, slots, servers, ignore=(), standby=()):
+        """ Return the findings between the sources """
+
+        findings = []
+        active = dict((record.ip, record) for record in records)
+        by_id = dict((node.id, node) for node in linodes)
+        by_ip = dict((node.ip, node) for node in linodes)
+
+        for node in linodes:
+            if node.ip in active or node.ip in ignore or node.id in standby:
+                continue
+            findings.append(Finding('orphan', node.ip, node.id, detail=node.label))
+
+        for ip, record in active.items():
+            if ip in ignore:
+                continue
+            if record.linode_id not in by_id and ip not in by_ip:
+                findings.append(Finding('missing', ip, record.linode_id))
+                continue
+            if servers == None or ip not in slots:
+                continue
+            server = slots[ip]
+            addr, admin = servers.get(server, (None, admin_maint))
+            if addr != ip or admin & admin_maint:
+                findings.append(Finding('lb_missing', ip, record.linode_id, server,
+                                        detail='%s %s' % (addr, 'maint' if admin & admin_maint else 'ready')))
+
+        if servers != None:
+            for server, (addr, admin) in sorted(servers.items()):
+                if admin & admin_maint or addr in active or addr in ignore:
+                    continue
+                findings.append(Finding('lb_stale', addr, server=server))
+
+        return findings
+
+    def age(self, findings, now):
+        """ Stamp findings with the time they were first seen, forgetting
+        those which went away """
+
+        seen = {}
+        for finding in findings:
+            key = finding.key()
+            finding.first_seen = seen[key] = self.first_seen.get(key, now)
+        self.first_seen = seen
+        self.reported &= set(seen)
+
+    def fix(self, findings, now):
+        """ Act on the findings older than the grace period """
+
+        due = [f for f in findings if now - f.first_seen >= self.grace]
+        orphans = [f for f in due if f.kind == 'orphan']
+        linodes = max(1, len(self.inventory.nodes))
+        deletes, lb_fixes = 0, 0
+        for finding in due:
+            if finding.kind == 'orphan':
+                if len(orphans) > max(1, self.max_orphans * linodes):
+                    finding.action = 'held - %d of %d linodes orphaned' % (len(orphans), linodes)
+                    self.counters['held'] += 1
+                elif deletes >= self.max_deletes:
+                    finding.action = 'deferred'
+                else:
+                    deletes += 1
+                    self.counters['api_calls'] += 1
+                    try:
+                        self.inventory.linode_delete(finding.linode_id)
+                        finding.action = 'deleted'
+                    except Exception, e:
+                        finding.action = 'delete failed: %s' % e
+                        # Most likely gone already
+                        self.inventory.forget(finding.linode_id)
+
+            elif finding.kind == 'missing':
+                if self.replace == None:
+                    continue
+                self.replace(finding.ip)
+                finding.action = 'replacement queued'
+
+            elif lb_fixes >= self.max_lb_fixes:
+                finding.action = 'deferred'
+            else:
+                lb_fixes += 1
+                if finding.kind == 'lb_missing':
+                    cmds = [self.lb_admin.server_addr_cmd(finding.server, finding.ip),
+                            self.lb_admin.server_state_cmd(finding.server, 'ready')]
+                else:
+                    cmds = [self.lb_admin.server_state_cmd(finding.server, 'maint')]
+                try:
+                    with self.lock:
+                        # Skip it if a rotation changed the slot meanwhile
+                        if finding.kind == 'lb_missing' and self.slots().get(finding.ip) != finding.server:
+                            continue
+                        self.lb_admin.execute(*cmds)
+                    finding.action = 'LB fixed'
+                except HAProxyAdminError, e:
+                    finding.action = 'LB fix failed: %s' % e
+
+            if finding.action and not finding.action.startswith(('held', 'deferred')):
+                self.counters['fixed_' + finding.kind] += 1
+
+    def check(self, now=None):
+        """ Run one reconciliation cycle and return its findings """
+
+        start = time.time()
+        now = self.clock.time() if now == None else now
+        sources = self.collect()
+        if sources == None:
+            return []
+        linodes, records, slots, servers = sources
+        findings = self.diff(linodes, records, slots, servers, self.ignore(), self.standby())
+        self.age(findings, now)
+        if self.apply:
+            self.fix(findings, now)
+
+        self.counters['cycles'] += 1
+        for finding in findings:
+            self.counters[finding.kind] += 1
+        self.last = findings
+        timing.observe('reconcile.cycle', time.time() - start)
+
+        # Tell about each finding once, when it is due or acted upon
+        new = [f for f in findings if f.key() not in self.reported and
+               (f.action or now - f.first_seen >= self.grace)]
+        if new:
+            print 'Reconciler =>',new
+            self.reported.update(f.key() for f in new)
+            if self.notify:
+                self.notify('reconcile', self.report(new))
+        return findings
+
+    def report(self, findings=None):
+        findings = self.last if findings == None else findings
+        lines = ['%d findings%s:' % (len(findings), '' if self.apply else ' (dry run)')]
+        lines.extend('  %r' % finding for finding in findings)
+        return '\n'.join(lines)
+
+    def loop(self):
+        while self.running:
+            try:
+                self.check()
+            except Exception, e:
+                print 'Error in reconciler',e
+            self.wakeup.wait(self.interval)
+
+    def start(self):
+        """ Reconcile in a background thread """
+
+        self.running = True
+        t = threading.Thread(target=self.loop, name='reconciler')
+        t.daemon = True
+        t.start()
+
+    def stop(self):
+        self.running = False
+        self.wakeup.set()
+
+    def stats(self):
+        stats = dict(self.counters)
+        stats['pending'] = len(self.first_seen)
+        return stats
+
+def benchmark(nodes, drift):
+    """ Time reconciliation of a fleet of fake nodes with drift injected
+    in every way, counting API calls """
+
+    from fake_linode_api import FakeLinodeServer
+    from fake_haproxy import FakeHAProxy
+    from haproxy_admin import HAProxyAdmin
+    from linode_api import LinodeAPI
+    from proxy_index import ProxyRecord
+    from inventory import Inventory
+
+    server = FakeLinodeServer().start()
+    path = os.path.join(tempfile.mkdtemp(prefix='reconcile'), 'admin.sock')
+    lb = FakeHAProxy(path).start()
+    backend = LinodeAPI(url=server.url)
+    backend.group = 'ynodes'
+    inventory = Inventory(backend, group='ynodes')
+
+    records, slots = {}, {}
+    for i in range(nodes):
+        linode_id = server.state.add('ynode%d' % (i + 1), random.choice((2, 3, 4)), 'ynodes')
+        ip = server.state.ips[linode_id]
+        records[ip] = ProxyRecord(ip, 3, linode_id, 0, 0)
+        slots[ip] = 'squid%d' % (i + 1)
+        lb.state.add_server(slots[ip], ip)
+
+    # Leaked nodes, nodes deleted behind our back, and LB slots gone wrong
+    for i in range(drift):
+        server.state.add('leaked%d' % i, 3, 'ynodes')
+    ips = random.sample(sorted(records), drift * 2)
+    for ip in ips[:drift]:
+        server.state.dispatch('linode.delete', {'LinodeID': records[ip].linode_id})
+    for ip in ips[drift:]:
+        lb.state.servers[slots[ip]].admin = 'maint'
+    lb.state.add_server('squid%d' % (nodes + 1), '10.9.9.9')
+
+    replaced = []
+    reconciler = Reconciler(inventory, records.values, lambda: dict(slots), HAProxyAdmin(path),
+                            replace=replaced.append, apply=True, grace=0, max_deletes=drift)
+    for cycle in (1, 2):
+        server.state.calls.clear()
+        start = time.time()
+        findings = reconciler.check()
+        elapsed = time.time() - start
+        # Replaced proxies leave the state and the LB
+        for ip in replaced:
+            records.pop(ip, None)
+            lb.state.servers[slots.pop(ip)].admin = 'maint'
+        del replaced[:]
+        counts = collections.Counter(f.kind for f in findings)
+        print 'Cycle %d over %d nodes: %.1f ms, %d API requests, findings %s' % (
+            cycle, nodes, elapsed * 1000, sum(server.state.calls.values()), dict(counts))
+    print 'stats =>',reconciler.stats()
+    lb.stop()
+    server.shutdown()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog='reconciler')
+    parser.add_argument('-C','--conf',help='Use the given configuration file', default='proxy.conf')
+    parser.add_argument('--apply',help='Fix what is found, default is a dry run', action='store_true')
+    parser.add_argument('--now',help='Act on findings at once instead of after the grace period',
+                        action='store_true')
+    parser.add_argument('--bench',help='Time a cycle over N fake nodes', type=int, default=0)
+    parser.add_argument('-d','--drift',help='Drifted nodes of each kind in the benchmark', type=int, default=5)
+    args = parser.parse_args()
+
+    if args.bench:
+        benchmark(args.bench, args.drift)
+        sys.exit(0)
+
+    from rotate_proxies import ProxyConfig
+    from linode_api import make_linode_backend
+    from inventory import Inventory
+
+    config = ProxyConfig(args.conf, read_only=True)
+    inventory = Inventory.from_config(config, make_linode_backend(config))
+    reconciler = Reconciler.from_config(config, inventory) or Reconciler(inventory, config.get_active_proxies,
+                                                                         config.get_slot_names, config.lb_admin)
+    reconciler.apply = args.apply
+    if args.now:
+        reconciler.grace = 0
+    reconciler.check()
+    print reconciler.report()
+    if reconciler.apply:
+        print 'Missing proxies are only replaced by the running daemon.'
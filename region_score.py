@@ -0,0 +1,349 @@
+"""
+
+Latency aware region selection.
+
+RegionScorer keeps, for every region, the proxied-request latency and
+the throughput its proxies have shown, as averages with exponential
+time decay: an observation loses half its weight every `half_life`
+seconds. The metrics come from the same sources as rotation scoring
+(rotation_score.make_sources) - the HAProxy stats poller, the squid
+access logs or probes - sampled every `interval` seconds and averaged
+over the active proxies of each region.
+
+When a rotation picks the region of its new node, every candidate
+region is scored
+
+    latency     - fastest region's latency / region's latency
+    throughput  - region's throughput / best region's throughput
+    diversity   - 1 / (1 + active proxies already in the region / fair
+                  share, the fleet spread evenly over the candidates)
+
+each multiplied by its weight from the "region_score" section. The
+region with the highest score wins. Measurements lose influence as
+their weight decays, so a region not seen for a while drifts back to
+neutral (0.5) and gets tried again, and the diversity weight keeps the
+fleet from collapsing into the single fastest region.
+
+Scoring is off unless "enabled" is set in the section; without it the
+rotator falls back to the plain "region not in use" pick. The stats are
+saved to `state_file` after every sample and loaded on start. Run with --simulate to compare the regions and fleet latency of
+the scored pick with the plain "region not in use" pick, or with
+--show to print the saved stats.
+
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+import collections
+
+from state_journal import atomic_write
+
+# Score components, in display order
+components = ('latency', 'throughput', 'diversity')
+
+default_weights = {'latency': 1.0, 'throughput': 0.5, 'diversity': 2.0}
+
+class RegionStats(object):
+    """ Decaying averages of one region's metrics """
+
+    __slots__ = ('means', 'weights', 'updated', 'samples')
+
+    def __init__(self):
+        # Metric => decayed mean, and the decayed weight behind it
+        self.means = {}
+        self.weights = {}
+        self.updated = None
+        self.samples = 0
+
+    def decay(self, now, half_life):
+        if self.updated != None and now > self.updated:
+            factor = 0.5 ** ((now - self.updated) / half_life)
+            for name in self.weights:
+                self.weights[name] *= factor
+        self.updated = now
+
+    def update(self, metrics, now, half_life):
+        """ Fold one observation in, after decaying the older ones """
+
+        self.decay(now, half_life)
+        for name, value in metrics.items():
+            weight = self.weights.get(name, 0.0)
+            mean = self.means.get(name, 0.0)
+            self.means[name] = (mean * weight + value) / (weight + 1.0)
+            self.weights[name] = weight + 1.0
+        self.samples += 1
+
+    def confidence(self, name, now, half_life):
+        """ Weight of a metric as of now, mapped to 0..1 """
+
+        weight = self.weights.get(name, 0.0)
+        if self.updated != None and now > self.updated:
+            weight *= 0.5 ** ((now - self.updated) / half_life)
+        return weight / (weight + 1.0)
+
+    def to_dict(self):
+        return {'means': self.means, 'weights': self.weights, 'updated': self.updated, 'samples': self.samples}
+
+    @classmethod
+    def from_dict(cls, data):
+        stats = cls()
+        stats.means = dict(data.get('means', {}))
+        stats.weights = dict(data.get('weights', {}))
+        stats.updated = data.get('updated')
+        stats.samples = int(data.get('samples', 0))
+        return stats
+
+class RegionScorer(object):
+    """ Score regions for new nodes from decayed latency and throughput,
+    and diversity """
+
+    def __init__(self, records=None, sources=(), weights=None, half_life=172800.0, interval=300.0,
+                 state_file=None, clock=None):
+        # Return the active proxy records to sample
+        self.records = records
+        self.sources = list(sources)
+        self.weights = dict(default_weights)
+        self.weights.update(weights or {})
+        self.half_life = half_life
+        self.interval = interval
+        self.state_file = state_file
+        self.clock = clock or time
+        # Region => RegionStats
+        self.regions = {}
+        self.lock = threading.Lock()
+        self.counters = collections.defaultdict(int)
+        self.wakeup = threading.Event()
+        self.running = False
+        self.load()
+
+    @classmethod
+    def from_config(cls, config, clock=None):
+        """ Create a scorer from the "region_score" section of proxy.conf,
+        None if it is disabled """
+
+        from rotation_score import make_sources
+
+        settings = config.region_score or {}
+        if not settings.get('enabled', False):
+            return None
+        return cls(config.get_active_proxies, make_sources(config, settings.get('sources', ['lb_stats'])),
+                   weights=settings.get('weights'),
+                   half_life=float(settings.get('half_life', 172800)),
+                   interval=float(settings.get('interval', 300)),
+                   state_file=settings.get('state_file', 'region_stats.json') or None,
+                   clock=clock or config.clock)
+
+    def observe(self, region, metrics, now=None):
+        """ Record metrics of a region: any of 'latency' (ms) and
+        'throughput' (requests per second) """
+
+        metrics = dict((name, float(value)) for name, value in metrics.items()
+                       if name in ('latency', 'throughput') and value != None)
+        if not metrics:
+            return
+        now = now or self.clock.time()
+        with self.lock:
+            stats = self.regions.get(region)
+            if stats == None:
+                stats = self.regions[region] = RegionStats()
+            stats.update(metrics, now, self.half_life)
+
+    def sample(self, records=None, now=None):
+        """ Sample the metric sources over the active proxies once and fold
+        the per region averages in """
+
+        records = records if records != None else self.records()
+        if not records:
+            return
+        for source in self.sources:
+            source.prepare(records)
+
+        totals = collections.defaultdict(lambda: collections.defaultdict(list))
+        for record in records:
+            for source in self.sources:
+                for name, value in source.metrics(record.ip).items():
+                    # Idle proxies say nothing about their region's speed
+                    if value != None and (name != 'latency' or value > 0):
+                        totals[record.region][name].append(value)
+
+        now = now or self.clock.time()
+        for region, metrics in totals.items():
+            self.observe(region, dict((name, sum(values) / len(values)) for name, values in metrics.items()), now)
+        self.counters['samples'] += 1
+        self.save()
+
+    def parts(self, region, counts, fair, now):
+        """ Return the normalized score components of a region """
+
+        known = [(r, s) for r, s in self.regions.items()]
+        best_latency = min([s.means['latency'] for r, s in known if s.means.get('latency')] or [0])
+        best_throughput = max([s.means.get('throughput', 0) for r, s in known] or [0])
+
+        stats = self.regions.get(region)
+        parts = {'diversity': 1.0 / (1 + counts.get(region, 0) / fair)}
+        for name in ('latency', 'throughput'):
+            value, confidence = 0.5, 0.0
+            if stats != None and name in stats.means:
+                confidence = stats.confidence(name, now, self.half_life)
+                mean = stats.means[name]
+                if name == 'latency':
+                    value = best_latency / mean if mean > 0 else 0.5
+                else:
+                    value = mean / best_throughput if best_throughput > 0 else 0.5
+            # Fade to neutral as the measurements age
+            parts[name] = confidence * value + (1 - confidence) * 0.5
+        return parts
+
+    def score(self, candidates, counts, now=None):
+        """ Return [(score, breakdown, region)] for the candidate regions,
+        best first. counts maps a region to its active proxies. """
+
+        now = now or self.clock.time()
+        # Proxies per region if the fleet, new node included, were spread evenly
+        fair = float(sum(counts.values()) + 1) / max(len(candidates), 1)
+        scored = []
+        with self.lock:
+            for region in candidates:
+                parts = self.parts(region, counts, fair, now)
+                breakdown = dict((name, self.weights.get(name, 0.0) * parts[name]) for name in components)
+                breakdown['score'] = sum(breakdown[name] for name in components)
+                scored.append((breakdown['score'], breakdown, region))
+        # Ties are broken at random
+        random.shuffle(scored)
+        scored.sort(key=lambda item: -item[0])
+        return scored
+
+    def pick(self, candidates, counts, now=None):
+        """ Return the best region of the candidates """
+
+        score, breakdown, region = self.score(candidates, counts, now)[0]
+        self.counters['picks'] += 1
+        print 'Region %s scored %.3f (%s)' % (region, score, ', '.join('%s %.3f' % (name, breakdown[name])
+                                                                        for name in components))
+        return region
+
+    def load(self):
+        if not self.state_file or not os.path.isfile(self.state_file):
+            return
+        try:
+            data = json.load(open(self.state_file))
+            self.regions = dict((int(region), RegionStats.from_dict(stats)) for region, stats in data.items())
+        except (IOError, OSError, ValueError, TypeError, AttributeError), e:
+            print 'Could not load region stats',self.state_file,e
+
+    def save(self):
+        if not self.state_file:
+            return
+        with self.lock:
+            data = dict((str(region), stats.to_dict()) for region, stats in self.regions.items())
+        try:
+            atomic_write(self.state_file, [json.dumps(data, indent=1, sort_keys=True)])
+        except (IOError, OSError), e:
+            print 'Could not save region stats',self.state_file,e
+
+    def loop(self):
+        while self.running:
+            try:
+                self.sample()
+            except Exception, e:
+                print 'Error sampling region stats',e
+            self.wakeup.wait(self.interval)
+
+    def start(self):
+        """ Sample in a background thread """
+
+        self.running = True
+        t = threading.Thread(target=self.loop, name='region_score')
+        t.daemon = True
+        t.start()
+
+    def stop(self):
+        self.running = False
+        self.wakeup.set()
+
+    def stats(self):
+        stats = dict(self.counters)
+        stats['regions'] = len(self.regions)
+        return stats
+
+    def report(self, names=None, now=None):
+        now = now or self.clock.time()
+        lines = ['%-10s %10s %10s %8s %8s' % ('region', 'latency', 'req/s', 'samples', 'weight')]
+        with self.lock:
+            for region, stats in sorted(self.regions.items()):
+                lines.append('%-10s %8.0fms %10.2f %8d %8.2f' % (
+                    (names or {}).get(region, region), stats.means.get('latency', 0),
+                    stats.means.get('throughput', 0), stats.samples,
+                    stats.confidence('latency', now, self.half_life)))
+        return '\n'.join(lines)
+
+def plain_pick(candidates, counts):
+    """ pick_region without a scorer: a random region not in use, else any """
+
+    candidates = list(candidates)
+    random.shuffle(candidates)
+    for region in candidates:
+        if not counts.get(region):
+            return region
+    return random.choice(candidates)
+
+def simulate(nodes, rotations, seed):
+    """ Rotate a fleet through regions of different hidden latency, picking
+    regions plainly and through the scorer """
+
+    # Mean proxied-request latency of each region for our targets, ms
+    latency = {2: 420, 3: 380, 4: 450, 6: 250, 7: 520, 8: 1100, 9: 1250, 10: 560}
+    regions = sorted(latency)
+    print 'Fleet of %d nodes, %d rotations, region latencies %s' % (nodes, rotations, latency)
+    for name in ('plain', 'scored'):
+        random.seed(seed)
+        scorer = RegionScorer()
+        now = 0.0
+        fleet = [random.choice(regions) for i in range(nodes)]
+        fleet_latency = []
+        for i in range(rotations):
+            now += 3600
+            counts = collections.Counter(fleet)
+            # Noisy samples of the regions in use
+            for region in counts:
+                scorer.observe(region, {'latency': latency[region] * random.gauss(1.0, 0.15),
+                                        'throughput': 1000.0 / latency[region]}, now)
+            if name == 'plain':
+                region = plain_pick(regions, counts)
+            else:
+                region = scorer.score(regions, counts, now)[0][2]
+            # The oldest node goes
+            fleet.pop(0)
+            fleet.append(region)
+            fleet_latency.append(sum(latency[r] for r in fleet) / float(len(fleet)))
+
+        tail = fleet_latency[len(fleet_latency) // 2:]
+        counts = collections.Counter(fleet)
+        print '  %-7s mean fleet latency %5.0fms, %d regions in use, most in one region %d, final %s' % (
+            name, sum(tail) / len(tail), len(counts), max(counts.values()), dict(counts))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog='region_score')
+    parser.add_argument('--simulate',help='Compare plain and scored region picks', action='store_true')
+    parser.add_argument('-n','--nodes',help='Size of the simulated fleet', type=int, default=8)
+    parser.add_argument('-r','--rotations',help='Number of simulated rotations', type=int, default=2000)
+    parser.add_argument('-s','--seed',help='Random seed', type=int, default=1)
+    parser.add_argument('-C','--conf',help='Use the given configuration file', default='proxy.conf')
+    parser.add_argument('--show',help='Print the saved region stats', action='store_true')
+    args = parser.parse_args()
+
+    if args.simulate:
+        simulate(args.nodes, args.rotations, args.seed)
+        sys.exit(0)
+
+    if args.show:
+        settings = json.load(open(args.conf)).get('region_score', {})
+        from rotate_proxies import region_dict
+        scorer = RegionScorer(state_file=settings.get('state_file', 'region_stats.json'),
+                              half_life=float(settings.get('half_life', 172800)))
+        print scorer.report(region_dict)
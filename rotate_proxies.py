@@ -9,14 +9,35 @@ import sys
 import time
 import random
 import collections
-import operator
 import uuid
 import threading
 import signal
 import json
-import email_report
-
-from utils import daemonize, randpass, enum, LinodeCommand
+import timing
+
+from multiprocessing.pool import ThreadPool
+
+from utils import daemonize, randpass, enum, retry, synchronized, RateLimiter
+from linode_api import make_linode_backend
+from standby_pool import StandbyPool
+from health_probe import parse_lb_servers
+from proxy_index import ProxyIndex
+from state_journal import StateJournal, export_csv
+from haproxy_admin import HAProxyAdmin, HAProxyAdminError
+from haproxy_stats import StatsPoller
+from rotation_score import RotationScorer, format_breakdown
+from ssh_session import SessionManager
+from notify import Notifier
+from clock import RealClock
+from scheduler import RotationScheduler
+from ban_detector import BanDetector
+from readiness import ReadinessChecker, ReadinessError
+from inventory import Inventory
+from reconciler import Reconciler
+from drain import Drainer
+from bluegreen import BlueGreen
+from autoscaler import Autoscaler
+from region_score import RegionScorer
 
 # Rotation Policies
 Policy = enum('ROTATION_RANDOM',
@@ -25,7 +46,11 @@ Policy = enum('ROTATION_RANDOM',
               # Switch to another region
               'ROTATION_NEW_REGION',
               # LRU + New region
-              'ROTATION_LRU_NEW_REGION')
+              'ROTATION_LRU_NEW_REGION',
+              # Worst performance score first
+              'ROTATION_SCORE',
+              # Performance score + New region
+              'ROTATION_SCORE_NEW_REGION')
 
 region_dict = {2: 'Dallas',
                3: 'Fremont',
@@ -46,35 +71,52 @@ Out: %(label)s, %(proxy_out)s
 
 Region: %(region)s
 
+Score of switched out proxy: %(score)s
+
 -- Linode proxy daemon
 
 """
 
-# Post process command
-post_process_cmd_template = """ssh -o StrictHostKeyChecking=no -o UserKnownHostsFile=/dev/null %s@%s "%s" """
+# Post process commands, run over one ssh session per host
 iptables_restore_cmd = "sudo iptables-restore < /etc/iptables.rules"
-squid_restart_cmd = "sudo squid3 -f /etc/squid3/squid.conf"
+# Starting squid again fails if it is up already, e.g. started at boot
+squid_restart_cmd = "sudo squid3 -k check || sudo squid3 -f /etc/squid3/squid.conf"
 
 class ProxyConfig(object):
     """ Class representing configuration of crawler proxy infrastructure """
 
-    def __init__(self, cfg='proxy.conf'):
-        """ Initialize proxy config from the config file """
+    def __init__(self, cfg='proxy.conf', clock=None, read_only=False):
+        """ Initialize proxy config from the config file. With read_only
+        the saved state is loaded but never written. """
 
+        # Guards the proxy state against concurrent rotations
+        self.lock = threading.RLock()
+        # Source of the switch timestamps
+        self.clock = clock or RealClock()
         self.parse_config(cfg)
-        # This is a file with each line of the form
-        # IPV4 address, datacenter code, linode-id, switch_in timestamp, switch_out timestamp
-        # E.g: 45.79.91.191, 3, 1446731065, 144673390
-        try:
-            proxies = map(lambda x: x.strip().split(','), open(self.proxylist).readlines())
-            # Proxy IP to (switch_in, switch_out) timestamp mappings
-            self.proxy_dict = {}
-            # Proxy IP to enabled mapping
-            self.proxy_state = {}
-            self.process_proxies(proxies)
-        except (OSError, IOError), e:
-            print e
-            sys.exit("Fatal error, proxy list input file " + self.proxylist + " not found!")
+        # Proxy records with indexes for rotation selection
+        self.index = ProxyIndex()
+        # Proxy IP to ProxyRecord mappings, active or not
+        self.proxy_dict = self.index.records
+        # Crash-safe state store
+        self.journal = StateJournal.from_config(self, read_only=read_only)
+
+        if self.journal.exists():
+            records, events = self.journal.replay(self.index)
+            print 'Loaded',records,'proxies and replayed',events,'events from state journal.'
+        else:
+            # This is a file with each line of the form
+            # IPV4 address, datacenter code, linode-id, switch_in timestamp, switch_out timestamp
+            # E.g: 45.79.91.191, 3, 1446731065, 144673390
+            try:
+                proxies = map(lambda x: x.strip().split(','), open(self.proxylist).readlines())
+                self.process_proxies(proxies)
+            except (OSError, IOError), e:
+                print e
+                sys.exit("Fatal error, proxy list input file " + self.proxylist + " not found!")
+            # Start the journal from what we imported
+            if not read_only:
+                self.journal.compact(self.index)
 
         try:
             self.proxy_template = open(self.lb_template).read()
@@ -82,6 +124,22 @@ class ProxyConfig(object):
             print e
             sys.exit("Fatal error, template config input file " + template_file + " not found!")
 
+        # Runtime API of the load balancer
+        self.lb_admin = HAProxyAdmin(self.lb_socket or '/run/haproxy/admin.sock',
+                                     backend=self.lb_backend or 'rotateproxy')
+        # Per server statistics scraped from the admin socket
+        self.lb_poller = StatsPoller.from_config(self.lb_admin, self)
+        # Performance scoring for the score policies
+        self.scorer = RotationScorer.from_config(self)
+        # Score breakdown of the last proxy picked by score
+        self.last_score = None
+        # Proxies put into maintenance by drain_proxy
+        self.drained = set()
+        # Switched out proxies => LB server name, while their slot drains,
+        # starting with those journalled by the previous run
+        self.draining = dict((ip, drain[0]) for ip, drain in self.journal.drains.items())
+        self.init_slots()
+
     def parse_config(self, cfg):
         """ Parse the configuration file and load config """
 
@@ -97,34 +155,60 @@ class ProxyConfig(object):
     def get_proxy_ips(self):
         """ Return all proxy IP addresses as a list """
 
-        return self.proxy_state.keys()
+        return self.proxy_dict.keys()
 
     def get_active_proxies(self):
         """ Return a list of all active proxies as a list """
 
-        return map(self.proxy_dict.get, filter(self.proxy_state.get, self.proxy_state.keys()))
+        return self.index.active_records()
+
+    def count_active(self):
+        """ Return number of active proxies """
+
+        return self.index.count_active()
+
+    def is_active(self, proxy):
+        """ Return whether the given proxy IP is active """
+
+        record = self.proxy_dict.get(proxy)
+        return record != None and record.active
         
     def process_proxies(self, proxies):
         """ Process the proxy information to create internal dictionaries """
 
         # Prepare the proxy region dict
-        for proxy_ip, region, proxy_id, switch_in, switch_out in proxies:
+        for fields in proxies:
+            if len(fields) != 5:
+                print 'Skipping bad proxy list line',fields
+                continue
+            proxy_ip, region, proxy_id, switch_in, switch_out = fields
             # If switch_in ==0: put current time
             if int(float(switch_in))==0:
                 switch_in = int(time.time())
             if int(float(switch_out))==0:
                 switch_out = int(time.time())
                 
-            self.proxy_dict[proxy_ip] = [proxy_ip, int(region), int(proxy_id), int(float(switch_in)), int(float(switch_out))]
-            self.proxy_state[proxy_ip] = True
+            self.index.add(proxy_ip, int(region), int(proxy_id), int(float(switch_in)), int(float(switch_out)))
+
+        print 'Processed',len(self.proxy_dict),'proxies.'
 
-        print 'Processed',len(self.proxy_state),'proxies.'
+    def collect_metrics(self):
+        """ Return {ip: metrics} of the active proxies for the score
+        policies. The sources may pull logs over ssh or run a probe sweep,
+        so call this without holding the state lock. """
 
+        with self.lock:
+            records = self.get_active_proxies()
+        return self.scorer.collect(records)
+
+    @synchronized
     def get_proxy_for_rotation(self,
                                use_random=False,
                                least_used=False,
                                region_switch=False,
-                               input_region=3):
+                               scored=False,
+                               input_region=3,
+                               metrics=None):
         """ Return a proxy IP address for rotation using the given settings. The
         returned proxy will be replaced with a new proxy.
 
@@ -133,55 +217,51 @@ class ProxyConfig(object):
         so we keep the switching more or less democratic.
         @region_switch - Returns a proxy which belongs to a different region
         from the new proxy.
+        @scored - Returns the proxy with the worst performance score, see
+        rotation_score. Combines with region_switch.
         @input_region - The region of the new proxy node - defaults to Fremont, CA.
+        @metrics - {ip: metrics} for scored, from collect_metrics(). Collected
+        here, under the state lock, if not given.
         
         Note that if use_random is set to true, the other parameters are ignored.
         
         """
 
-        active_proxies = self.get_active_proxies()
-        print 'Active proxies =>',active_proxies
-        
-        if use_random:
+        print 'Active proxies =>',self.count_active()
+        record = None
+        self.last_score = None
+
+        if scored:
+            record, self.last_score = self.scorer.select(self.index.active_records(),
+                                                         exclude_region=input_region if region_switch else None,
+                                                         now=self.clock.time(), metrics=metrics)
+            if record != None:
+                print 'Score breakdown =>',format_breakdown(self.last_score)
+        elif use_random:
             # Pick a random proxy IP
-            proxy = random.choice(active_proxies)
-            print 'Returning proxy =>',proxy
-            proxy_ip = proxy[0]
-            
-            # Remove it from every data structure
-            self.switch_out_proxy(proxy_ip)
-            return proxy
-
-        if least_used:
+            record = self.index.random()
+        elif least_used:
             # Pick the oldest switched out proxy i.e one
             # with smallest switched out value
-            proxies_used = sorted(active_proxies,
-                                  key=operator.itemgetter(-1))
-
-            print 'Proxies used =>',proxies_used
-            
             if region_switch:
                 # Find the one with a different region from input
-                for proxy, reg, pi, si, so in proxies_used:
-                    if reg != input_region:
-                        print 'Returning proxy',proxy,'from region',reg
-                        self.switch_out_proxy(proxy)                        
-                        return proxy
+                record = self.index.lru(exclude_region=input_region)
 
             # If all regions are already in use, pick the last used
             # proxy anyway
-            return proxies_used[0][0]
-            
-        if region_switch:
+            if record == None:
+                record = self.index.lru()
+        elif region_switch:
             # Pick a random proxy not in the input region
-            proxies = active_proxies
-            random.shuffle(proxies)
+            record = self.index.random(exclude_region=input_region)
 
-            for proxy, reg, pi, si, so in proxies:
-                if reg != input_region:
-                    print 'Returning proxy',proxy,'from region',reg
-                    self.switch_out_proxy(proxy)                    
-                    return proxy
+        if record == None:
+            return None
+
+        print 'Returning proxy',record.ip,'from region',record.region
+        # Remove it from every index
+        self.switch_out_proxy(record.ip)
+        return record.ip
 
     def __getattr__(self, name):
         """ Return from local, else written from config """
@@ -194,55 +274,192 @@ class ProxyConfig(object):
     def switch_out_proxy(self, proxy):
         """ Switch out a given proxy IP """
 
+        record = self.proxy_dict[proxy]
         # Disable it
-        self.proxy_state[proxy] = False
+        self.index.deactivate(record)
         # Mark its switched out timestamp
-        self.proxy_dict[proxy][-1] = int(time.time())
+        record.switch_out = int(self.clock.time())
+        self.journal.switch_out(proxy, record.switch_out)
+        self.drained.discard(proxy)
+
+    @synchronized
+    def claim_proxy(self, proxy):
+        """ Switch out the given proxy for rotation if it is still active.
+        Returns whether it was. """
+
+        if not self.is_active(proxy):
+            return False
+        print 'Returning proxy',proxy,'from region',self.proxy_dict[proxy].region
+        self.switch_out_proxy(proxy)
+        return True
 
+    @synchronized
     def switch_in_proxy(self, proxy, proxy_id, region):
         """ Switch in a given proxy IP """
 
-        # Mark its switched out timestamp
-        self.proxy_dict[proxy] = [proxy, int(region), int(proxy_id), int(time.time()), int(time.time())]
-        # Enable it
-        self.proxy_state[proxy] = True     
+        # Mark its switched in and out timestamps, and enable it
+        now = int(self.clock.time())
+        self.index.add(proxy, int(region), int(proxy_id), now, now)
+        self.journal.switch_in(proxy, int(region), int(proxy_id), now, now)
+        self.assign_slot(proxy)
+
+    def init_slots(self):
+        """ Assign active proxies to LB server slots, keeping the slots of the
+        currently deployed HAProxy config wherever possible """
+
+        # Slot i is rendered as server squid<i+1>
+        deployed, self.deployed_slots = {}, 0
+        try:
+            servers = parse_lb_servers(self.lb_config, disabled=True)
+            self.deployed_slots = len(servers)
+            for name, ip, port in parse_lb_servers(self.lb_config):
+                deployed[ip] = int(name.replace('squid', '')) - 1
+        except (OSError, IOError, ValueError), e:
+            print 'Could not read deployed LB config',e
+
+        self.slots, self.slot_of = [None]*self.deployed_slots, {}
+        active = [record.ip for record in self.index.active_records()]
+        for proxy in active:
+            slot = deployed.get(proxy)
+            if slot != None and slot < len(self.slots) and self.slots[slot] == None:
+                self.slots[slot] = proxy
+                self.slot_of[proxy] = slot
+
+        # Drains of a previous run keep the slot they drain in, which the
+        # config on disk lists as disabled. If it is gone or taken the
+        # drain cannot be watched.
+        for proxy, server in sorted(self.draining.items()):
+            slot = int(server.replace('squid', '')) - 1
+            if slot < len(self.slots) and self.slots[slot] == None:
+                self.slots[slot] = proxy
+                self.slot_of[proxy] = slot
+            else:
+                del self.draining[proxy]
+
+        for proxy in active:
+            if proxy not in self.slot_of:
+                self.assign_slot(proxy)
+
+        # Always keep at least one step worth of slots
+        step = int(self.lb_slots or 16)
+        if len(self.slots) < step:
+            self.slots.extend([None]*(step - len(self.slots)))
+
+    def assign_slot(self, proxy):
+        """ Give a proxy a free LB server slot, adding slots if all are taken """
+
+        if proxy in self.slot_of:
+            return self.slot_of[proxy]
+
+        free = [idx for idx, p in enumerate(self.slots) if p == None]
+        if not free:
+            # Grow by a whole step so that reloads stay rare
+            step = int(self.lb_slots or 16)
+            free = range(len(self.slots), len(self.slots) + step)
+            self.slots.extend([None]*step)
+
+        slot = random.choice(free)
+        self.slots[slot] = proxy
+        self.slot_of[proxy] = slot
+        # Statistics of the slot's previous proxy do not apply
+        self.lb_poller.forget(self.slot_name(proxy))
+        return slot
+
+    def release_slots(self):
+        """ Free the LB slots held by switched out proxies """
+
+        for proxy, slot in self.slot_of.items():
+            if not self.is_active(proxy) and proxy not in self.draining:
+                self.slots[slot] = None
+                del self.slot_of[proxy]
+
+    @synchronized
+    def start_drain(self, proxy, linode_id, deadline, label=None, new_id=None):
+        """ Journal the drain of a switched out proxy, so that a restart
+        resumes it """
+
+        self.journal.drain_start(proxy, self.draining[proxy], linode_id, deadline, label, new_id)
+        self.journal.sync()
+
+    @synchronized
+    def finish_drain(self, proxy):
+        """ Free the LB slot of a switched out proxy once it has drained """
+
+        self.draining.pop(proxy, None)
+        self.journal.drain_end(proxy)
+        self.release_slots()
+
+    @synchronized
+    def drain_proxy(self, proxy):
+        """ Put the LB slot of a proxy into maintenance at runtime. Returns
+        whether it was taken out. """
+
+        if proxy not in self.slot_of:
+            return False
+        try:
+            self.lb_admin.execute(self.lb_admin.server_state_cmd(self.slot_name(proxy), 'maint'))
+        except HAProxyAdminError, e:
+            print 'Error draining',proxy,'via admin socket',e
+            return False
+        print 'Drained proxy',proxy,'from the LB'
+        self.drained.add(proxy)
+        return True
+
+    @synchronized
+    def get_slot_names(self):
+        """ Return {proxy: HAProxy server name} of the active proxies """
+
+        return dict((proxy, self.slot_name(proxy)) for proxy in self.slot_of if self.is_active(proxy))
+
+    def slot_name(self, proxy):
+        """ Return the HAProxy server name of the proxy's slot """
+
+        return 'squid%d' % (self.slot_of[proxy] + 1)
+
+    def get_proxy_stats(self, proxy):
+        """ Return smoothed LB statistics of a proxy, empty if it has no slot """
+
+        if proxy not in self.slot_of:
+            return {}
+        return self.lb_poller.smoothed(self.slot_name(proxy))
 
     def get_active_regions(self):
         """ Return unique regions for which proxies are active """
 
-        regions = set()
-        for proxy,region,pi,si,so in self.proxy_dict.values():
-            if self.proxy_state[proxy]:
-                regions.add(region)
-
-        return list(regions)
+        return self.index.active_regions()
         
+    @synchronized
     def write(self, disabled=False):
-        """ Write current state to an output file """
+        """ Commit current state to the journal and export the legacy
+        proxies.list file """
 
-        lines = []
-        for proxy, reg, pi, si, so in self.proxy_dict.values():
-            if disabled or self.proxy_state[proxy]:
-                lines.append('%s,%s,%s,%s,%s\n' % (proxy, str(reg), str(pi), str(int(si)), str(int(so))))
+        self.journal.sync()
+        if self.journal.needs_compaction():
+            self.journal.compact(self.index)
 
-        open(self.proxylist,'w').writelines(lines)
+        if (self.state or {}).get('export_csv', True):
+            export_csv(self.index, self.proxylist, disabled=disabled)
 
-    def write_lb_config(self, disabled=False, test=False):
-        """ Write current proxy configuration into the load balancer config """
+    def render_lb_config(self):
+        """ Return the load balancer config for the current slots """
 
-        lines, idx = [], 1
-        # Shuffle
-        items = self.proxy_dict.values()
-        for i in range(10):
-            random.shuffle(items)
-            
-        for proxy, reg, pi, si, so in items:
-            if self.proxy_state[proxy]:
-                lines.append('\tserver  squid%d %s:8321 check inter 10000 rise 2 fall 5' % (idx, proxy))
-                idx += 1
+        lines = []
+        # Proxies are spread over the slots at random, so the roundrobin
+        # order is shuffled. Unused slots are declared disabled so that they
+        # can be brought up at runtime without a reload.
+        for idx, proxy in enumerate(self.slots):
+            if proxy != None and self.is_active(proxy):
+                lines.append('\tserver  squid%d %s:8321 check inter 10000 rise 2 fall 5' % (idx + 1, proxy))
+            else:
+                lines.append('\tserver  squid%d 127.0.0.1:8321 disabled check inter 10000 rise 2 fall 5' % (idx + 1))
 
         squid_config = "\n".join(lines)
-        content = self.proxy_template % locals()
+        return self.proxy_template % locals()
+
+    def write_lb_config(self, disabled=False, test=False, reload=True):
+        """ Write current proxy configuration into the load balancer config """
+
+        content = self.render_lb_config()
         # Write to temp file
         tmpfile = '/tmp/.haproxy.cfg'
         open(tmpfile,'w').write(content)
@@ -252,10 +469,100 @@ class ProxyConfig(object):
             # Run as sudo
             cmd = 'sudo cp %s %s; rm -f %s' % (tmpfile, self.lb_config, tmpfile)
             os.system(cmd)
+            self.deployed_slots = len(self.slots)
 
-        self.reload_lb()
+        if reload:
+            return self.reload_lb()
         return True
 
+    @synchronized
+    def update_lb(self, proxy_in=None, proxy_out=None, test=False, drain=False):
+        """ Apply a switch to the running load balancer. The config on disk is
+        always rewritten for persistence, but HAProxy is only reloaded when the
+        number of server slots changed - otherwise the slots are updated at
+        runtime through the admin socket. With drain, the slot of proxy_out is
+        put into drain instead of maintenance and kept until finish_drain(). """
+
+        resized = (len(self.slots) != self.deployed_slots)
+        with timing.span('lb.write_config'):
+            self.write_lb_config(test=test, reload=False)
+        ret = True
+
+        if test:
+            pass
+        elif resized:
+            print 'LB server slots changed to',len(self.slots),'- reloading LB'
+            ret = self.reload_lb()
+        else:
+            cmds = []
+            if proxy_out in self.slot_of:
+                cmds.append(self.lb_admin.server_state_cmd(self.slot_name(proxy_out), 'drain' if drain else 'maint'))
+            if proxy_in in self.slot_of:
+                cmds.append(self.lb_admin.server_addr_cmd(self.slot_name(proxy_in), proxy_in))
+                cmds.append(self.lb_admin.server_state_cmd(self.slot_name(proxy_in), 'ready'))
+            try:
+                with timing.span('lb.admin_socket'):
+                    self.lb_admin.execute(*cmds)
+                print 'Updated LB at runtime =>',cmds
+                if drain and proxy_out in self.slot_of:
+                    self.draining[proxy_out] = self.slot_name(proxy_out)
+            except HAProxyAdminError, e:
+                print 'Error updating LB via admin socket',e,'- reloading LB'
+                ret = self.reload_lb()
+
+        self.release_slots()
+        return ret
+
+    @synchronized
+    def switch_fleet(self, nodes_in, proxies_out, drain=False):
+        """ Switch the LB from proxies_out to nodes_in, a list of (ip, linode
+        id, region), in one runtime update. Slots for the new nodes are added
+        beforehand if needed, disabled, so that the switch itself does not
+        need a reload. With drain, the slots of proxies_out are drained and
+        kept until finish_drain(). Returns whether the LB was updated. """
+
+        # Room for the new fleet next to the current one
+        step = int(self.lb_slots or 16)
+        free = self.slots.count(None)
+        if free < len(nodes_in):
+            grow = ((len(nodes_in) - free + step - 1) // step) * step
+            self.slots.extend([None]*grow)
+            print 'LB server slots changed to',len(self.slots),'- reloading LB'
+            if not self.write_lb_config():
+                return False
+
+        cmds = []
+        for ip, linode_id, region in nodes_in:
+            # Switched back in, e.g. on a rollback, in the slot it drains in
+            self.draining.pop(ip, None)
+            self.switch_in_proxy(ip, linode_id, region)
+            cmds.append(self.lb_admin.server_addr_cmd(self.slot_name(ip), ip))
+            cmds.append(self.lb_admin.server_state_cmd(self.slot_name(ip), 'ready'))
+        out = [proxy for proxy in proxies_out if self.is_active(proxy)]
+        for proxy in out:
+            self.switch_out_proxy(proxy)
+            if proxy in self.slot_of:
+                cmds.insert(0, self.lb_admin.server_state_cmd(self.slot_name(proxy), 'drain' if drain else 'maint'))
+
+        with timing.span('lb.write_config'):
+            self.write_lb_config(reload=False)
+        ret = True
+        try:
+            with timing.span('lb.admin_socket'):
+                self.lb_admin.execute(*cmds)
+            print 'Switched LB at runtime to',len(nodes_in),'proxies from',len(out)
+            if drain:
+                for proxy in out:
+                    if proxy in self.slot_of:
+                        self.draining[proxy] = self.slot_name(proxy)
+        except HAProxyAdminError, e:
+            print 'Error updating LB via admin socket',e,'- reloading LB'
+            ret = self.reload_lb()
+
+        self.release_slots()
+        return ret
+
+    @timing.timed('lb.reload')
     def reload_lb(self):
         """ Reload the HAProxy load balancer """
 
@@ -264,7 +571,7 @@ class ProxyConfig(object):
     def get_proxy_id(self, proxy):
         """ Given proxy return its id """
 
-        return self.proxy_dict[proxy][2]
+        return self.proxy_dict[proxy].linode_id
 
     def get_email_config(self):
         """ Return email configuration """
@@ -274,9 +581,13 @@ class ProxyConfig(object):
 class ProxyRotator(object):
     """ Proxy rotation, provisioning & re-configuration with linode nodes """
 
-    def __init__(self, cfg='proxy.conf', test_mode=False, rotate=False, region=None):
-        self.config = ProxyConfig(cfg=cfg)        
+    def __init__(self, cfg='proxy.conf', test_mode=False, rotate=False, region=None, config=None):
+        self.config = config or ProxyConfig(cfg=cfg)
+        # Every wait of the daemon goes through the clock
+        self.clock = self.config.clock
         print 'Frequency set to',self.config.frequency,'seconds.'
+        # Phase timings, a no-op unless enabled
+        timing.setup(self.config.timing or {})
         # Test mode ?
         self.test_mode = test_mode
         # Event object
@@ -285,8 +596,48 @@ class ProxyRotator(object):
         self.alarm.clear()
         # Heartbeat file
         self.hbf = '.heartbeat'
-        # Linode creation class
-        self.linode_cmd = LinodeCommand(verbose=True, config=self.config)
+        # Linode creation class, behind a cached inventory of the fleet
+        self.linode_cmd = Inventory.from_config(self.config, make_linode_backend(self.config, verbose=True),
+                                                clock=self.clock)
+        # Multiplexed ssh sessions to the nodes
+        self.ssh = SessionManager.from_config(self.config)
+        # Gates new nodes on boot, ssh, squid and a proxied request
+        self.readiness = ReadinessChecker.from_config(self.config, self.linode_cmd, self.ssh, clock=self.clock)
+        # New host => post process commands still to succeed on it
+        self.setup_pending = {}
+        # Background queue for report emails
+        self.notifier = Notifier.from_config(self.config)
+        # Warm standby pool of spare nodes, if configured
+        self.standby = None
+        if not test_mode:
+            self.standby = StandbyPool.from_config(self, self.config)
+        # Regions picked by rotations still creating their node
+        self.reserved_regions = []
+        # Measured latency and throughput of the regions, if enabled
+        self.region_scorer = RegionScorer.from_config(self.config, clock=self.clock)
+        # Queues and runs the rotations, woken up through the alarm
+        self.scheduler = RotationScheduler.from_config(self.config, self.run_job, clock=self.clock, wakeup=self.alarm)
+        # Drains banned proxies and has them replaced at once, if enabled
+        self.ban_detector = BanDetector.from_config(self.config, self.config.drain_proxy,
+                                                    lambda ip: self.scheduler.request('ban', ip, urgent=True),
+                                                    notify=self.notifier.notify)
+        # Deletes switched out nodes once their LB sessions are done
+        self.drainer = Drainer.from_config(self.config, self.config.lb_admin, self.drained, clock=self.clock)
+        # Finds leaked linodes and drift between the state and the LB
+        self.reconciler = Reconciler.from_config(self.config, self.linode_cmd,
+                                                 replace=lambda ip: self.scheduler.request('reconcile', ip,
+                                                                                           urgent=True),
+                                                 ignore=lambda: (self.scheduler.pending() | self.config.drained |
+                                                                 set(self.config.draining)),
+                                                 standby=self.standby and self.standby.linode_ids,
+                                                 notify=self.notifier.notify)
+        # Grows and shrinks the pool from the LB load, if enabled
+        self.autoscaler = None
+        if not test_mode:
+            self.autoscaler = Autoscaler.from_config(self.config, self.add_nodes, self.remove_node,
+                                                     ignore=lambda: (self.scheduler.pending() | self.config.drained |
+                                                                     set(self.config.draining)),
+                                                     notify=self.notifier.notify)
         # If rotate is set, rotate before going to sleep
         if rotate:
             print 'Rotating a node'
@@ -294,23 +645,32 @@ class ProxyRotator(object):
             
         signal.signal(signal.SIGTERM, self.sighandler)
         signal.signal(signal.SIGUSR1, self.sighandler)      
+        signal.signal(signal.SIGHUP, self.rotate_now)
             
-    def pick_region(self):
-        """ Pick the region for the new node """
+    def pick_region(self, candidates=None):
+        """ Pick the region for the new node, optionally restricted
+        to the given candidate regions """
 
         # Try and pick a region not present in the
-        # current list of nodes
-        regions = self.config.get_active_regions()
+        # current list of nodes, nor taken by a rotation in progress
+        regions = self.config.get_active_regions() + self.reserved_regions
+        candidates = list(candidates or self.config.region_ids)
+        if self.region_scorer:
+            # Fast regions first, weighed against how many proxies each has
+            counts = dict((reg, self.config.index.count_active(reg) + self.reserved_regions.count(reg))
+                          for reg in candidates)
+            return self.region_scorer.pick(candidates, counts)
         # Shuffle current regions
-        random.shuffle(self.config.region_ids)
+        random.shuffle(candidates)
         
-        for reg in self.config.region_ids:
+        for reg in candidates:
             if reg not in regions:
                 return reg
             
         # All regions already present ? Pick a random one.
-        return random.choice(self.config.region_ids)
+        return random.choice(candidates)
 
+    @timing.timed('make_new_linode')
     def make_new_linode(self, region, test=False, verbose=False):
         """ Make a new linode in the given region """
 
@@ -327,104 +687,319 @@ class ProxyRotator(object):
                randpass())
         
         print 'Making new linode in region',region,'...'        
-        data = self.linode_cmd.linode_create(*tup)
+        with timing.span('make_new_linode.create'):
+            node = self.linode_cmd.create_node(*tup)
         
-        # data = os.popen(cmd).read()
         if verbose:
-            print data
-        # The IP is the last line of the command
-        ip = data.strip().split('\n')[-1].strip().split()[-1].strip()
-        # Proxy ID
-        pid = data.strip().split('\n')[-3].strip().split()[-1].strip()
+            print node
+        ip, pid = node.ip, node.id
         print 'I.P address of new linode is',ip
         print 'ID of new linode is',pid
-        # Post process the host
-        print 'Post-processing',ip,'...'
-        self.post_process(ip)       
+        # Post process the host once it is up, and wait for squid to serve
+        print 'Waiting for',ip,'to become ready ...'
+        with timing.span('make_new_linode.readiness'):
+            result = self.readiness.wait(ip, pid, setup=self.post_process)
+        self.setup_pending.pop(ip, None)
+        print result
+        if not result.ok:
+            print 'Removing linode',pid,'which did not become ready'
+            self.linode_cmd.linode_delete(pid)
+            self.ssh.close(ip)
+            raise ReadinessError('%s not ready: %s failed (%s)' % (ip, result.failed, result.error))
         return ip, pid
 
-    def rotate(self, region=None):
-        """ Rotate the configuration to a new node """
+    @timing.timed('rotate')
+    def rotate(self, region=None, proxy_out=None):
+        """ Rotate the configuration to a new node, switching out proxy_out
+        if it is given and still active, else a proxy picked by the policy.
+        Returns whether the LB was updated. """
 
-        proxy_out_label = None
         # Pick the data-center
         if region == None:
             print 'Picking a region ...'
-            region = self.pick_region()
+            # Prefer regions which have a standby node ready
+            with timing.span('rotate.pick_region'):
+                with self.config.lock:
+                    region = self.pick_region(self.standby and self.standby.ready_regions())
+                    self.reserved_regions.append(region)
         else:
             print 'Using supplied region',region,'...'
-            
-        # Switch in the new linode from this region
-        new_proxy, proxy_id = self.make_new_linode(region)
-        # Rotate another node
-        if self.config.policy == Policy.ROTATION_RANDOM:
-            proxy_out = self.config.get_proxy_for_rotation(use_random=True, input_region=region)
-        elif self.config.policy == Policy.ROTATION_NEW_REGION:
-            proxy_out = self.config.get_proxy_for_rotation(region_switch=True, input_region=region)
-        elif self.config.policy == Policy.ROTATION_LRU:
-            proxy_out = self.config.get_proxy_for_rotation(least_used=True, input_region=region)
-        elif self.config.policy == Policy.ROTATION_LRU_NEW_REGION:
-            proxy_out = self.config.get_proxy_for_rotation(least_used=True, region_switch=True,
-                                                           input_region=region)
-            
-        # Switch in the new proxy
-        self.config.switch_in_proxy(new_proxy, proxy_id, region)
-        print 'Switched in new proxy',new_proxy
-        # Write configuration
-        self.config.write()
-        print 'Wrote new configuration.'
-        # Write new HAProxy LB template and reload ha proxy
-        ret1 = self.config.write_lb_config()
-        ret2 = self.config.reload_lb()
-        if ret1 and ret2:
+            with self.config.lock:
+                self.reserved_regions.append(region)
+
+        try:
+            return self.replace_node(region, proxy_out)
+        finally:
+            with self.config.lock:
+                self.reserved_regions.remove(region)
+
+    def replace_node(self, region, proxy_out=None):
+        """ Switch in a node from region in place of proxy_out, or of a proxy
+        picked by the policy """
+
+        proxy_out_label = None
+        # Switch in the new linode from this region, from the
+        # standby pool if possible
+        with timing.span('rotate.standby_pop'):
+            node = self.standby and self.standby.pop(region)
+        if node:
+            new_proxy, proxy_id = node.ip, node.linode_id
+        else:
+            new_proxy, proxy_id = self.make_new_linode(region)
+        # Measure the proxies before taking the state lock, which the
+        # score sources could otherwise hold for minutes
+        metrics = None
+        if proxy_out == None and self.config.policy in (Policy.ROTATION_SCORE, Policy.ROTATION_SCORE_NEW_REGION):
+            with timing.span('rotate.collect_metrics'):
+                metrics = self.config.collect_metrics()
+        # Other rotations may run concurrently - hold the state from the
+        # pick of the proxy to switch out until the LB is updated
+        with self.config.lock:
+            score = None
+            with timing.span('rotate.select'):
+                if proxy_out != None and self.config.claim_proxy(proxy_out):
+                    pass
+                elif self.config.policy == Policy.ROTATION_RANDOM:
+                    proxy_out = self.config.get_proxy_for_rotation(use_random=True, input_region=region)
+                elif self.config.policy == Policy.ROTATION_NEW_REGION:
+                    proxy_out = self.config.get_proxy_for_rotation(region_switch=True, input_region=region)
+                elif self.config.policy == Policy.ROTATION_LRU:
+                    proxy_out = self.config.get_proxy_for_rotation(least_used=True, input_region=region)
+                elif self.config.policy == Policy.ROTATION_LRU_NEW_REGION:
+                    proxy_out = self.config.get_proxy_for_rotation(least_used=True, region_switch=True,
+                                                                   input_region=region)
+                elif self.config.policy == Policy.ROTATION_SCORE:
+                    proxy_out = self.config.get_proxy_for_rotation(scored=True, input_region=region,
+                                                                   metrics=metrics)
+                    score = self.config.last_score
+                elif self.config.policy == Policy.ROTATION_SCORE_NEW_REGION:
+                    proxy_out = self.config.get_proxy_for_rotation(scored=True, region_switch=True,
+                                                                   input_region=region, metrics=metrics)
+                    score = self.config.last_score
+
+            # Switch in the new proxy
+            self.config.switch_in_proxy(new_proxy, proxy_id, region)
+            print 'Switched in new proxy',new_proxy
+            # Write configuration
+            with timing.span('rotate.write_state'):
+                self.config.write()
+            print 'Wrote new configuration.'
+            # Update the HAProxy LB at runtime, reloading only if needed
+            with timing.span('rotate.update_lb'):
+                updated = self.config.update_lb(new_proxy, proxy_out, drain=self.drainer != None)
+        if updated:
             if proxy_out != None:
                 print 'Switched out proxy',proxy_out
                 proxy_out_id = int(self.config.get_proxy_id(proxy_out))
+                if proxy_out_id == 0:
+                    # Not recorded in the state - the inventory may know it
+                    proxy_out_id = self.linode_cmd.get_proxy_id(proxy_out) or 0
                 
                 if proxy_out_id != 0:
                     proxy_out_label = self.linode_cmd.get_label(proxy_out_id)
-                    print 'Removing switched out linode',proxy_out_id
-                    self.linode_cmd.linode_delete(proxy_out_id)
                 else:
-                    'Proxy id is 0, not removing linode',proxy_out
+                    print 'Proxy id is 0, not removing linode',proxy_out
+
+                if proxy_out in self.config.draining:
+                    # Removed, and its label passed on, once its sessions are done
+                    self.drain(proxy_out, proxy_out_id, proxy_out_label, proxy_id)
+                else:
+                    self.retire(proxy_out, proxy_out_id, proxy_out_label, proxy_id)
         else:
             print 'Error - Did not switch out proxy as there was a problem in writing/restarting LB'
 
+        if self.standby:
+            print 'Standby pool stats =>',self.standby.stats()
+        self.send_email(proxy_out, proxy_out_label, new_proxy, region, score)
+        return updated
+
+    def retire(self, proxy, linode_id, label, new_id):
+        """ Delete a switched out node and give its label to the node which
+        replaced it """
+
+        if linode_id != 0:
+            with timing.span('rotate.linode_delete'):
+                print 'Removing switched out linode',linode_id
+                self.linode_cmd.linode_delete(linode_id)
+            self.ssh.close(proxy)
+
+        if label != None:
+            # Labels are unique, so only once the old node is gone
+            print 'Assigning label',label,'to new linode',new_id
+            with timing.span('rotate.linode_update'):
+                try:
+                    retry(self.relabel, (int(new_id), label), attempts=5,
+                          backoff=self.readiness.initial, factor=self.readiness.factor,
+                          label='relabel', clock=self.clock)
+                except Exception, e:
+                    print 'Error assigning label',label,'to linode',new_id,e
+
+    def next_labels(self, count=1):
+        """ Return the first count labels of our prefix no linode has. The
+        CLI backend lists no labels, so those are looked up by id. """
+
+        labels = set()
+        for node in self.linode_cmd.list_nodes():
+            labels.add(node.label if node.label != None else self.linode_cmd.get_label(node.id))
+        free, idx = [], 1
+        while len(free) < count:
+            label = self.config.proxy_prefix + str(idx)
+            if label not in labels:
+                free.append(label)
+            idx += 1
+        return free
 
-        if proxy_out_label != None:
-            # Get its label and assign it to the new linode
-            print 'Assigning label',proxy_out_label,'to new linode',proxy_id
-            time.sleep(5)
-            self.linode_cmd.linode_update(int(proxy_id),
-                                          proxy_out_label,
-                                          self.config.group)
+    def add_node(self, job):
+        """ Create, label and switch in one node of add_nodes, from the
+        standby pool if it has one in the region. Returns whether the LB
+        was updated. """
 
-        # Post process the host
-        print 'Post-processing',new_proxy,'...'
-        self.post_process(new_proxy)
-        self.send_email(proxy_out, proxy_out_label, new_proxy, region)
+        label, region = job
+        try:
+            node = self.standby and self.standby.pop(region)
+            if node:
+                new_proxy, proxy_id = node.ip, node.linode_id
+            else:
+                result = self.provision_node((None, region))
+                if result['error'] != None:
+                    return False
+                new_proxy, proxy_id = result['ip'], result['id']
+            try:
+                retry(self.relabel, (int(proxy_id), label), attempts=5,
+                      backoff=self.readiness.initial, factor=self.readiness.factor,
+                      label='relabel', clock=self.clock)
+            except Exception, e:
+                print 'Error assigning label',label,'to linode',proxy_id,e
+
+            with self.config.lock:
+                self.config.switch_in_proxy(new_proxy, proxy_id, region)
+                print 'Added new proxy',new_proxy,'in region',region
+                self.config.write()
+                return self.config.update_lb(new_proxy)
+        except Exception, e:
+            print 'Error adding a node in region',region,e
+            return False
+        finally:
+            with self.config.lock:
+                self.reserved_regions.remove(region)
+
+    @timing.timed('add_nodes')
+    def add_nodes(self, count=1):
+        """ Grow the pool by count nodes, in regions picked as for rotations.
+        The nodes are created in parallel by the provisioning workers and
+        each is switched in once ready. Returns how many were added. """
+
+        parallel = self.provision_settings()
+        labels = self.next_labels(count)
+        jobs = []
+        with self.config.lock:
+            for label in labels:
+                region = self.pick_region(self.standby and self.standby.ready_regions())
+                self.reserved_regions.append(region)
+                jobs.append((label, region))
+
+        print 'Adding',count,'nodes with',min(parallel, count),'workers ...'
+        pool = ThreadPool(max(1, min(parallel, count)))
+        try:
+            added = pool.map(self.add_node, jobs, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+        return len([ok for ok in added if ok])
+
+    @timing.timed('remove_node')
+    def remove_node(self, proxy):
+        """ Shrink the pool by a proxy, draining it first if draining is
+        enabled. Returns whether it was removed. """
+
+        with self.config.lock:
+            if not self.config.claim_proxy(proxy):
+                return False
+            self.config.write()
+            if not self.config.update_lb(proxy_out=proxy, drain=self.drainer != None):
+                print 'Error - Did not remove proxy as there was a problem in writing/restarting LB'
+                return False
+            server = self.config.draining.get(proxy)
+
+        linode_id = int(self.config.get_proxy_id(proxy)) or self.linode_cmd.get_proxy_id(proxy) or 0
+        print 'Removed proxy',proxy
+        if server != None:
+            self.drain(proxy, linode_id)
+        else:
+            self.retire(proxy, linode_id, None, None)
+        return True
+
+    def drain(self, proxy, linode_id, label=None, new_id=None):
+        """ Watch the draining slot of a switched out proxy, journalled
+        first so that the drain survives a restart """
+
+        deadline = self.clock.time() + self.drainer.deadline
+        self.config.start_drain(proxy, linode_id, deadline, label, new_id)
+        return self.drainer.add(proxy, self.config.draining[proxy], linode_id, (label, new_id), deadline)
+
+    def resume_drains(self):
+        """ Resume the drains journalled by the previous run. A node whose
+        slot is gone, or with draining now disabled, is released at once. """
 
-    def send_email(self, proxy_out, label, proxy_in, region):
-        """ Send email upon switching of a proxy """
+        for proxy, drain in sorted(self.config.journal.drains.items()):
+            server, linode_id, deadline, label, new_id = drain
+            if self.drainer != None and self.config.draining.get(proxy) == server:
+                print 'Resuming drain of',proxy
+                self.drainer.add(proxy, server, linode_id, (label, new_id), deadline)
+            else:
+                print 'Releasing',proxy,'left draining by the previous run'
+                self.config.finish_drain(proxy)
+                self.retire(proxy, linode_id, label, new_id)
+
+    def drained(self, drain):
+        """ Release a switched out node whose LB slot has drained """
+
+        self.config.finish_drain(drain.proxy)
+        label, new_id = drain.context
+        self.retire(drain.proxy, drain.linode_id, label, new_id)
+
+    def run_job(self, job):
+        """ Run a rotation queued by the scheduler """
 
-        print 'Sending email...'
+        print 'Rotating proxy node, job #%d (%s) ...' % (job.id, job.reason)
+        if self.test_mode:
+            return self.test()
+        return self.rotate(proxy_out=job.proxy)
+
+    @timing.timed('send_email')
+    def send_email(self, proxy_out, label, proxy_in, region, score=None):
+        """ Queue the report email upon switching of a proxy """
+
+        print 'Queueing email...'
         region = region_dict[region]
+        score = format_breakdown(score)
         content = email_template % locals()
-        email_config = self.config.get_email_config()
-
-        email_report.email_report(email_config, "%s", content)
+        self.notifier.notify('rotate', content)
                    
+    def relabel(self, linode_id, label):
+        """ Assign label to a linode, raising ValueError until the backend
+        reports the new label """
+
+        self.linode_cmd.linode_update(linode_id, label, self.config.group)
+        if self.linode_cmd.get_label(linode_id, fresh=True) != label:
+            raise ValueError('label of linode %d is not yet %s' % (linode_id, label))
+
+    @timing.timed('post_process')
     def post_process(self, ip):
-        """ Post-process a switched-in host """
-
-        # Sleep a bit before sshing
-        time.sleep(5)
-        cmd = post_process_cmd_template % (self.config.user, ip, iptables_restore_cmd)
-        print 'SSH command 1=>',cmd
-        os.system(cmd)
-        cmd = post_process_cmd_template % (self.config.user, ip, squid_restart_cmd)
-        print 'SSH command 2=>',cmd     
-        os.system(cmd)      
+        """ Post-process a new host. Returns True if every command
+        succeeded. Called again until it does, when only the commands
+        which failed last time are run. """
+
+        commands = self.setup_pending.get(ip, [iptables_restore_cmd, squid_restart_cmd])
+        print 'SSH commands =>',ip,commands
+        with timing.span('post_process.ssh'):
+            results = self.ssh.run(ip, commands)
+        failed = [result.command for result in results if not result.ok]
+        if failed:
+            self.setup_pending[ip] = failed
+            return False
+        self.setup_pending.pop(ip, None)
+        return True
         
     def alive(self):
         """ Return whether I should be alive """
@@ -441,52 +1016,117 @@ class ProxyRotator(object):
         """ Drop all the proxies in current configuration (except the LB) """
 
         print 'Dropping all proxies ...'
-        proxies = rotator.linode_cmd.linode_list_proxies()
-        for item in proxies.split('\n'):
-            if item.strip() == "": continue
-            ip,dc,lid,si,so = item.split(',')
-            print '\tDropping linode',lid,'with IP',ip,'from dc',dc,'...'
-            self.linode_cmd.linode_delete(int(lid))
+        for node in self.linode_cmd.list_nodes(refresh=True):
+            print '\tDropping linode',node.id,'with IP',node.ip,'from dc',node.region,'...'
+            self.linode_cmd.linode_delete(node.id)
 
+        if self.standby:
+            self.standby.clear()
         print 'done.'
 
-    def provision(self, count=8, add=False):
-        """ Provision an entirely fresh set of linodes after dropping current set """
+    def provision_node(self, job):
+        """ Create, post-process and label one linode of a provisioning run,
+        leaving it unlabelled if the label is None. Returns a result
+        dictionary with the per-node timings """
+
+        label, region = job
+        result = {'label': label, 'region': region, 'ip': None, 'id': None,
+                  'attempts': 0, 'wait': 0.0, 'elapsed': 0.0, 'error': None}
+        
+        start = time.time()
+        # Respect the per-region rate limit of create calls
+        self.region_limiters[region].acquire()
+        result['wait'] = time.time() - start
+        timing.observe('provision.rate_wait', result['wait'])
+        try:
+            (ip, lid), result['attempts'] = retry(self.make_new_linode, (region,),
+                                                  attempts=self.provision_retries,
+                                                  backoff=self.provision_backoff,
+                                                  label='create %s' % (label or 'node'))
+            result['ip'], result['id'] = ip, int(lid)
+            if label != None:
+                self.linode_cmd.linode_update(int(lid), label, self.config.group)
+        except Exception, e:
+            print 'Error creating linode',label,e
+            result['error'] = str(e)
+
+        result['elapsed'] = time.time() - start
+        timing.observe('provision.node', result['elapsed'])
+        print 'Provisioned %(label)s in region %(region)d => %(ip)s (%(elapsed).1fs)' % result
+        return result
+
+    def provision_settings(self, parallel=None):
+        """ Set up the retries and region rate limits of provision_node from
+        the "provision" section. Returns the number of parallel workers. """
+
+        settings = self.config.provision or {}
+        self.provision_retries = int(settings.get('retries', 3))
+        self.provision_backoff = float(settings.get('backoff', 10))
+        # Creates per minute allowed in one region
+        region_rate = float(settings.get('region_rate', 4))
+        self.region_limiters = dict((reg, RateLimiter(region_rate, per=60.0, clock=self.clock))
+                                    for reg in self.config.region_ids)
+        return int(parallel or settings.get('parallel', 8))
+
+    @timing.timed('provision')
+    def provision(self, count=8, add=False, parallel=None, bluegreen=False):
+        """ Provision an entirely fresh set of linodes after dropping current set,
+        or with bluegreen, next to the current set which is only removed once
+        the new one has taken over """
+
+        if bluegreen:
+            return BlueGreen.from_config(self, count, parallel).run()
 
         if not add:
             self.drop()
-            
-        num, idx = 0, 0
+
+        parallel = self.provision_settings(parallel)
 
         # If we are adding Linodes without dropping, start from current count
         if add:
-            start = len(self.config.get_active_proxies())
+            start = self.config.count_active()
         else:
             start = 0
-                        
-        for i in range(start, start + count):
-            # region = self.pick_region()
-            # Do a round-robin on regions
-            region = self.config.region_ids[idx % len(self.config.region_ids) ]
-            try:
-                ip, lid = self.make_new_linode(region)
-                self.linode_cmd.linode_update(int(lid),
-                                              self.config.proxy_prefix + str(i+1),
-                                              self.config.group)              
-                num += 1
-            except Exception, e:
-                print 'Error creating linode',e
 
-            idx += 1
+        # Labels and regions are fixed up-front so they stay deterministic
+        # whatever order the workers finish in. Do a round-robin on regions.
+        jobs = []
+        for idx, i in enumerate(range(start, start + count)):
+            region = self.config.region_ids[idx % len(self.config.region_ids)]
+            jobs.append((self.config.proxy_prefix + str(i+1), region))
 
-        print 'Provisioned',num,'linodes.'
-        linodes_list = rotator.linode_cmd.linode_list_proxies().strip().split('\n')
+        print 'Provisioning',count,'linodes with',parallel,'workers ...'
+        begin = time.time()
+        pool = ThreadPool(max(1, min(parallel, count)))
+        try:
+            results = pool.map(self.provision_node, jobs, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+        num = len([r for r in results if r['error'] == None])
+        lines = ['Provisioned %d of %d linodes in %.1f seconds.' % (num, count, time.time() - begin),
+                 '%-12s %6s %-16s %10s %8s %8s %9s' % ('label', 'region', 'ip', 'id', 'attempts', 'wait', 'elapsed')]
+        for r in results:
+            lines.append('%-12s %6d %-16s %10s %8d %8.1f %9.1f %s' % (r['label'], r['region'], r['ip'], r['id'],
+                                                                      r['attempts'], r['wait'], r['elapsed'],
+                                                                      r['error'] or ''))
+        print '\n'.join(lines)
+        # One report for the whole run
+        self.notifier.notify('provision', '\n'.join(lines))
+
+        # Only write the list once every worker has finished
+        with timing.span('provision.list_nodes'):
+            linodes_list = [node.csv() for node in self.linode_cmd.list_nodes()]
         # Randomize it
         for i in range(5):
             random.shuffle(linodes_list)
         
         print >> open('proxies.list', 'w'), '\n'.join(linodes_list)
+        # The fresh list replaces the journalled state on next start
+        self.config.journal.reset()
         print 'Saved current proxy configuration to proxies.list'
+        return results
                   
     def test(self):
         """ Function to be called in loop for testing """
@@ -496,19 +1136,20 @@ class ProxyRotator(object):
         print 'Rotating proxy to new region',region,'...'
         # Make a test IP
         new_proxy, proxy_id = self.make_new_linode(region, test=True)
-        proxy_out = self.config.get_proxy_for_rotation(least_used=True, region_switch=True,
-                                                       input_region=region)     
-
-        if proxy_out != None:
-            print 'Switched out proxy',proxy_out
-            proxy_out_id = int(self.config.get_proxy_id(proxy_out))
-            proxy_out_label = self.linode_cmd.get_label(proxy_out_id)           
-
-        # Switch in the new proxy
-        self.config.switch_in_proxy(new_proxy, proxy_id, region)
-        print 'Switched in new proxy',new_proxy
-        # Write new HAProxy LB template and reload ha proxy
-        self.config.write_lb_config(test=True)       
+        with self.config.lock:
+            proxy_out = self.config.get_proxy_for_rotation(least_used=True, region_switch=True,
+                                                           input_region=region)     
+
+            if proxy_out != None:
+                print 'Switched out proxy',proxy_out
+                proxy_out_id = int(self.config.get_proxy_id(proxy_out))
+                proxy_out_label = self.linode_cmd.get_label(proxy_out_id)           
+
+            # Switch in the new proxy
+            self.config.switch_in_proxy(new_proxy, proxy_id, region)
+            print 'Switched in new proxy',new_proxy
+            # Write new HAProxy LB template
+            self.config.update_lb(new_proxy, proxy_out, test=True)
         self.send_email(proxy_out, proxy_out_label, new_proxy, region)
         
     def stop(self):
@@ -529,6 +1170,11 @@ class ProxyRotator(object):
 
         # This will be called when you want to stop the daemon
         self.stop()
+
+    def rotate_now(self, signum, stack):
+        """ SIGHUP handler - queue an on-demand rotation """
+
+        self.scheduler.request('signal')
                    
     def run(self, daemon=True):
         """ Run as a background process, rotating proxies """
@@ -544,22 +1190,65 @@ class ProxyRotator(object):
             open('rotator.pid','w').write(str(os.getpid()))
 
         print 'Proxy rotate daemon started.'
-        count = 1
+        # Metrics endpoint, if configured
+        timing.serve(self.config.timing or {})
+        # Deliver what the spool kept from the previous run
+        if self.notifier.pending:
+            self.notifier.start()
+        self.resume_drains()
+        # Refill the standby pool in the background
+        if self.standby:
+            self.standby.start()
+        self.config.lb_poller.start()
+        if self.ban_detector:
+            self.ban_detector.start()
+        if self.reconciler:
+            self.reconciler.start()
+        if self.autoscaler:
+            self.autoscaler.start()
+        if self.region_scorer:
+            self.region_scorer.start()
         
         while True:
-            # Wait on event object till woken up
-            self.alarm.wait(self.config.frequency)
             status = self.alive()
             if not status:
                 print 'Daemon signalled to exit. Quitting ...'
+                if self.ban_detector:
+                    self.ban_detector.stop()
+                    print 'Ban detector stats =>',self.ban_detector.stats()
+                if self.reconciler:
+                    self.reconciler.stop()
+                    print 'Reconciler stats =>',self.reconciler.stats()
+                if self.autoscaler:
+                    self.autoscaler.stop()
+                    print 'Autoscaler stats =>',self.autoscaler.stats()
+                if self.region_scorer:
+                    self.region_scorer.stop()
+                    self.region_scorer.save()
+                    print 'Region scorer stats =>',self.region_scorer.stats()
+                # Let rotations in progress complete
+                self.scheduler.close()
+                if self.drainer:
+                    self.drainer.stop()
+                    print 'Drainer stats =>',self.drainer.stats()
+                if self.standby:
+                    self.standby.stop()
+                self.config.lb_poller.stop()
+                print 'Inventory stats =>',self.linode_cmd.stats()
+                self.ssh.close_all()
+                self.notifier.close()
                 break
-                
-            print 'Rotating proxy node, round #%d ...' % count
-            if self.test_mode:
-                self.test()
-            else:
-                self.rotate()
-            count += 1
+
+            # Queue and start whatever rotations are due
+            self.scheduler.step()
+            self.ssh.evict_idle()
+            # Drains not watched by a thread of their own are checked here
+            due = None
+            if self.drainer and self.drainer.inline:
+                self.drainer.check()
+                due = self.drainer.next_check()
+            # Wait on event object till the next trigger or woken up
+            self.scheduler.wait(due)
 
         sys.exit(0)
     
@@ -581,13 +1270,28 @@ if __name__ == "__main__":
                         action='store_true')    
     parser.add_argument('-N','--num',help='Number of new linodes to provision or add (use with -P or -A)',type=int,
                         default=8)    
+    parser.add_argument('-B','--bluegreen',help='Provision the new set next to the current one and switch over (use with -P)',
+                        default=False, action='store_true')
+    parser.add_argument('-j','--parallel',help='Number of linodes to provision in parallel (use with -P or -A)',type=int,
+                        default=None)
     
     parser.add_argument('-w','--writeconfig',help='Load current Linode proxies configuration and write a fresh proxies.list config file', action='store_true')
     parser.add_argument('-W','--writelbconfig',help='Load current Linode proxies configuration and write a fresh HAProxy config to /etc/haproxy/haproxy.cfg', action='store_true')
     parser.add_argument('--restart',help='Restart the daemon',action='store_true')
+    parser.add_argument('--rotate-now',help='Ask the running daemon for an immediate rotation',action='store_true')
 
     args = parser.parse_args()
     # print args
+
+    if args.rotate_now:
+        # Queued by the daemon's scheduler on SIGHUP
+        try:
+            os.kill(int(open('rotator.pid').read().strip()), signal.SIGHUP)
+            print 'Requested a rotation from the daemon.'
+        except (IOError, OSError, ValueError), e:
+            print e
+            print 'Unable to signal, possibly daemon not running.'
+        sys.exit(0)
     
     rotator = ProxyRotator(cfg=args.conf,
                            test_mode = args.test,
@@ -596,16 +1300,21 @@ if __name__ == "__main__":
     if args.test:
         print 'Testing the daemon'
         rotator.test()
+        rotator.notifier.close()
         sys.exit(0)
         
     if args.add != 0:
         print 'Adding new set of',args.num,'linode proxies ...'
-        rotator.provision(count = int(args.num), add=True)
+        rotator.provision(count = int(args.num), add=True, parallel=args.parallel)
+        timing.report()
+        rotator.notifier.close()
         sys.exit(0)
         
     if args.provision != 0:
         print 'Provisioning fresh set of',args.num,'linode proxies ...'
-        rotator.provision(count = int(args.num))
+        rotator.provision(count = int(args.num), parallel=args.parallel, bluegreen=args.bluegreen)
+        timing.report()
+        rotator.notifier.close()
         sys.exit(0)
         
     if args.create:
@@ -620,7 +1329,9 @@ if __name__ == "__main__":
         
     if args.writeconfig:
         # Load current proxies config and write proxies.list file
-        print >> open('proxies.list', 'w'), rotator.linode_cmd.linode_list_proxies().strip()
+        print >> open('proxies.list', 'w'), '\n'.join(node.csv() for node in rotator.linode_cmd.list_nodes())
+        # The fresh list replaces the journalled state on next start
+        rotator.config.journal.reset()
         print 'Saved current proxy configuration to proxies.list'
         sys.exit(0)
 
@@ -0,0 +1,281 @@
+"""
+
+Performance based rotation scoring.
+
+Every active proxy gets a score built from how long it has been in
+service and what its metric sources measure - latency, error/ban rate
+and throughput - each normalized over the candidates and multiplied by
+a weight from the "score" section of proxy.conf. The proxy with the
+highest score is rotated out first, so a throttled or slow node goes
+before a fast, healthy one which merely happens to be older.
+
+Metric sources are pluggable: anything with prepare(records) and
+metrics(ip) returning a dict with any of 'latency' (ms), 'errors'
+(fraction of failed or blocked requests) and 'throughput' (requests per
+second). Sources shipped here read the HAProxy stats poller, the squid
+access log analyzer and the health prober.
+
+Run this module to simulate a fleet and compare its aggregate crawl
+throughput under the score and the LRU + new region policies.
+
+"""
+
+import time
+import random
+import argparse
+
+# Score components, in display order
+components = ('age', 'latency', 'errors', 'throughput')
+
+default_weights = {'age': 1.0, 'latency': 1.0, 'errors': 2.0, 'throughput': 1.0}
+
+class LBStatsSource(object):
+    """ Metrics from the HAProxy stats poller, via ProxyConfig.get_proxy_stats """
+
+    def __init__(self, config):
+        self.config = config
+
+    def prepare(self, records):
+        pass
+
+    def metrics(self, ip):
+        stats = self.config.get_proxy_stats(ip)
+        if not stats:
+            return {}
+
+        metrics = {'latency': stats.get('rtime', 0.0)}
+        rate = stats.get('stot_rate')
+        if rate != None:
+            metrics['throughput'] = rate
+            if rate > 0:
+                failed = sum(stats.get(name, 0.0) for name in ('econ_rate', 'eresp_rate',
+                                                               'hrsp_4xx_rate', 'hrsp_5xx_rate'))
+                metrics['errors'] = min(failed / rate, 1.0)
+        return metrics
+
+class LogSource(object):
+    """ Metrics from the squid access logs of the proxies """
+
+    def __init__(self, analyzer, user=None, path='/var/log/squid3/access.log'):
+        self.analyzer = analyzer
+        # Pull the logs of the candidates over ssh first if a user is given
+        self.user = user
+        self.path = path
+
+    def prepare(self, records):
+        if self.user:
+            for record in records:
+                self.analyzer.pull_remote(record.ip, self.user, self.path)
+
+    def metrics(self, ip):
+        summary = self.analyzer.node_summary(ip)
+        if not summary or not summary['requests']:
+            return {}
+        return {'latency': summary['p50'], 'throughput': summary['rate'],
+                'errors': summary['r403'] + summary['r429'] + summary['r5xx']}
+
+class ProbeSource(object):
+    """ Metrics from probing every candidate through the health prober """
+
+    def __init__(self, prober, port=8321):
+        self.prober = prober
+        self.port = port
+        self.results = {}
+
+    def prepare(self, records):
+        results = self.prober.sweep([('proxy', r.ip, self.port) for r in records])
+        self.results = dict((result.ip, result) for result in results)
+
+    def metrics(self, ip):
+        result = self.results.get(ip)
+        if result == None:
+            return {}
+        if not result.ok:
+            return {'errors': 1.0}
+        return {'latency': result.elapsed * 1000.0, 'errors': 0.0}
+
+def make_sources(config, names):
+    """ Create metric sources by name, as listed in the "score" section """
+
+    sources = []
+    for name in names:
+        if name == 'lb_stats':
+            sources.append(LBStatsSource(config))
+        elif name == 'squid_log':
+            from squid_log import LogAnalyzer
+            settings = config.squid_log or {}
+            sources.append(LogSource(LogAnalyzer.from_config(config), user=config.user,
+                                     path=settings.get('path', '/var/log/squid3/access.log')))
+        elif name == 'probe':
+            from health_probe import HealthProber, probe_defaults
+            settings = dict(probe_defaults)
+            settings.update(config.probe or {})
+            sources.append(ProbeSource(HealthProber(concurrency=int(settings['concurrency']),
+                                                    timeout=float(settings['timeout']),
+                                                    url=settings['url'], auth=settings['auth'])))
+        else:
+            print 'Unknown score source',name
+    return sources
+
+class RotationScorer(object):
+    """ Score active proxies for rotation from weighted, normalized metrics """
+
+    def __init__(self, weights=None, sources=()):
+        self.weights = dict(default_weights)
+        self.weights.update(weights or {})
+        self.sources = list(sources)
+
+    @classmethod
+    def from_config(cls, config):
+        """ Create a scorer from the "score" section of proxy.conf """
+
+        settings = config.score or {}
+        return cls(weights=settings.get('weights'),
+                   sources=make_sources(config, settings.get('sources', ['lb_stats'])))
+
+    def collect(self, records):
+        """ Return {ip: metrics} averaged over the sources reporting them """
+
+        for source in self.sources:
+            source.prepare(records)
+
+        collected = {}
+        for record in records:
+            totals, counts = {}, {}
+            for source in self.sources:
+                for name, value in source.metrics(record.ip).items():
+                    if value != None:
+                        totals[name] = totals.get(name, 0.0) + value
+                        counts[name] = counts.get(name, 0) + 1
+            collected[record.ip] = dict((name, totals[name] / counts[name]) for name in totals)
+        return collected
+
+    def score(self, records, now=None, metrics=None):
+        """ Return [(score, breakdown, record)] for records, highest score first.
+        Metrics missing for a proxy count as neutral (zero). """
+
+        now = now or time.time()
+        if metrics == None:
+            metrics = self.collect(records)
+
+        ages = dict((r.ip, max(now - r.switch_out, 0)) for r in records)
+        max_age = max(ages.values() or [0]) or 1
+        max_latency = max([m.get('latency', 0) for m in metrics.values()] or [0]) or 1
+        max_throughput = max([m.get('throughput', 0) for m in metrics.values()] or [0]) or 1
+
+        scored = []
+        for record in records:
+            m = metrics.get(record.ip, {})
+            parts = {'age': float(ages[record.ip]) / max_age,
+                     'latency': m.get('latency', 0) / max_latency,
+                     'errors': m.get('errors', 0.0),
+                     # Slow nodes should go first
+                     'throughput': 1.0 - m['throughput'] / max_throughput if 'throughput' in m else 0.0}
+            breakdown = dict((name, self.weights.get(name, 0.0) * parts[name]) for name in components)
+            breakdown['score'] = sum(breakdown[name] for name in components)
+            scored.append((breakdown['score'], breakdown, record))
+
+        scored.sort(key=lambda item: (-item[0], item[2].switch_out))
+        return scored
+
+    def select(self, records, exclude_region=None, now=None, metrics=None):
+        """ Return (record, breakdown) of the best proxy to rotate out, not
+        from exclude_region unless every candidate is. (None, None) if
+        there are no records. """
+
+        candidates = records
+        if exclude_region != None:
+            candidates = [r for r in records if r.region != exclude_region] or records
+        if not candidates:
+            return None, None
+
+        score, breakdown, record = self.score(candidates, now, metrics)[0]
+        return record, breakdown
+
+def format_breakdown(breakdown):
+    """ Return a one line description of a score breakdown """
+
+    if not breakdown:
+        return 'n/a'
+    return '%.3f (%s)' % (breakdown['score'], ', '.join('%s %.3f' % (name, breakdown[name])
+                                                        for name in components))
+
+class SimNode(object):
+    """ A synthetic proxy node with a hidden capacity and throttling onset """
+
+    def __init__(self, ip, region, now, mean_onset):
+        self.ip = ip
+        self.region = region
+        self.switch_in = self.switch_out = now
+        self.active = True
+        self.capacity = random.uniform(5.0, 15.0)
+        self.latency = random.uniform(200.0, 1500.0)
+        # Hours of service until target sites start throttling it
+        self.onset = now + random.expovariate(1.0 / mean_onset)
+
+    def throttled(self, now):
+        return now >= self.onset
+
+    def throughput(self, now):
+        return self.capacity * (0.15 if self.throttled(now) else 1.0)
+
+    def observe(self, now):
+        """ Noisy metrics as a source would report them """
+
+        noise = random.uniform(0.9, 1.1)
+        throttled = self.throttled(now)
+        return {'throughput': self.throughput(now) * noise,
+                'latency': self.latency * (3.0 if throttled else 1.0) * noise,
+                'errors': (0.6 if throttled else 0.02) * noise}
+
+def simulate(nodes=40, rotations=2000, interval=1.0, regions=range(2, 11), mean_onset=30.0, seed=1):
+    """ Compare mean aggregate throughput of the LRU + new region policy
+    with the score + new region policy over the same random fleet """
+
+    scorer = RotationScorer()
+    results = {}
+    for policy in ('lru_new_region', 'score_new_region'):
+        random.seed(seed)
+        now = 0.0
+        fleet = [SimNode('n%d' % i, random.choice(regions), now - random.uniform(0, nodes), mean_onset)
+                 for i in range(nodes)]
+        # Rotation stamps switch_out of surviving nodes as in rotate_proxies
+        for node in fleet:
+            node.switch_out = node.switch_in
+        counter, total, throttled = nodes, 0.0, 0
+
+        for i in range(rotations):
+            now += interval
+            region = random.choice(regions)
+            if policy == 'lru_new_region':
+                candidates = [n for n in fleet if n.region != region] or fleet
+                out = min(candidates, key=lambda n: n.switch_out)
+            else:
+                metrics = dict((n.ip, n.observe(now)) for n in fleet)
+                out, breakdown = scorer.select(fleet, exclude_region=region, now=now, metrics=metrics)
+
+            fleet.remove(out)
+            fleet.append(SimNode('n%d' % counter, region, now, mean_onset))
+            counter += 1
+            total += sum(n.throughput(now) for n in fleet)
+            throttled += sum(1 for n in fleet if n.throttled(now))
+
+        results[policy] = (total / rotations, float(throttled) / rotations)
+
+    print 'Fleet of %d nodes, %d rotations, throttling after %.0f rotations on average' % (nodes, rotations,
+                                                                                          mean_onset / interval)
+    for policy in ('lru_new_region', 'score_new_region'):
+        print '  %-18s mean throughput %8.1f req/s   throttled nodes %5.1f' % ((policy,) + results[policy])
+    base, scored = results['lru_new_region'][0], results['score_new_region'][0]
+    print 'Throughput change: %+.1f%%' % ((scored - base) * 100.0 / base)
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog='rotation_score')
+    parser.add_argument('-n','--nodes',help='Size of the simulated fleet', type=int, default=40)
+    parser.add_argument('-r','--rotations',help='Number of simulated rotations', type=int, default=2000)
+    parser.add_argument('-o','--onset',help='Mean rotations until a node is throttled', type=float, default=30.0)
+    parser.add_argument('-s','--seed',help='Random seed', type=int, default=1)
+    args = parser.parse_args()
+
+    simulate(args.nodes, args.rotations, mean_onset=args.onset, seed=args.seed)
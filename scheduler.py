@@ -0,0 +1,538 @@
+"""
+
+Event-driven rotation scheduler.
+
+Rotations are queued by three kinds of triggers - the fixed interval
+(`frequency` in proxy.conf), nodes reaching a maximum age and on-demand
+requests (SIGHUP to the daemon, or request()). Queued rotations run on a
+thread pool, up to `max_concurrent` at once and never so many that less
+than `min_healthy` of the pool stays in service. Starts are spaced at
+least `stagger` seconds apart so that new nodes do not all come up, and
+later age out, together.
+
+Urgent requests, such as the replacement of a banned node, go to the
+head of the queue and are not staggered.
+
+Every decision - queued, coalesced, deferred, started, finished - is
+printed, kept in a bounded history and written with the queue depth to
+a JSON status file.
+
+The scheduler never sleeps by itself but through a clock, so with the
+VirtualClock of clock.py a month of scheduling runs in well under a
+second. Run with --simulate DAYS to do that against a simulated pool.
+
+"""
+
+import sys
+import math
+import json
+import time
+import heapq
+import random
+import argparse
+import itertools
+import threading
+import collections
+
+from multiprocessing.pool import ThreadPool
+
+import timing
+from clock import RealClock, VirtualClock
+from state_journal import atomic_write
+
+# Wake up at least this often, if nothing else is due
+max_sleep = 3600.0
+
+class RotationJob(object):
+    """ One queued or running rotation """
+
+    __slots__ = ('id', 'reason', 'proxy', 'queued', 'started', 'finished', 'ok')
+
+    def __init__(self, id, reason, proxy=None, queued=0.0):
+        self.id = id
+        self.reason = reason
+        # Proxy to switch out, None to leave it to the rotation policy
+        self.proxy = proxy
+        self.queued = queued
+        self.started = None
+        self.finished = None
+        self.ok = None
+
+    def to_dict(self):
+        return {'id': self.id, 'reason': self.reason, 'proxy': self.proxy, 'queued': self.queued,
+                'started': self.started}
+
+    def __repr__(self):
+        return '<RotationJob #%d %s %s>' % (self.id, self.reason, self.proxy or '-')
+
+class RotationScheduler(object):
+    """ Queue rotations from interval, max-age and on-demand triggers and
+    run them concurrently within the health budget of the pool """
+
+    def __init__(self, runner, records, clock=None, wakeup=None, max_concurrent=1, min_healthy=0.75,
+                 interval=None, max_age=None, stagger=0.0, history=200, status_file=None, retry_backoff=600.0,
+                 inline=False):
+        # Called with a RotationJob in a worker thread, returns False on failure
+        self.runner = runner
+        # Returns the active proxy records
+        self.records = records
+        self.clock = clock or RealClock()
+        self.wakeup = wakeup or threading.Event()
+        self.max_concurrent = max(1, max_concurrent)
+        # Share of the pool which must stay in service
+        self.min_healthy = min_healthy
+        self.interval = interval
+        self.max_age = max_age
+        self.stagger = stagger
+        self.status_file = status_file
+        # Seconds before a proxy whose rotation failed is tried again
+        self.retry_backoff = retry_backoff
+        # Proxy => time its rotation may be retried
+        self.backoff = {}
+        self.queue = collections.deque()
+        # Job id => running RotationJob
+        self.running = {}
+        # On-demand requests, taken over into the queue by step(). Appending
+        # to a deque needs no lock, so a signal handler can request.
+        self.requests = collections.deque()
+        # Ids of queued jobs which skip the stagger
+        self.urgent = set()
+        self.decisions = collections.deque(maxlen=history)
+        self.counters = collections.defaultdict(int)
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+        self.next_interval = None
+        self.last_start = None
+        # Why the head of the queue is waiting, to log deferrals once
+        self.blocked = None
+        self.max_queue = 0
+        self.max_running = 0
+        self.pool = None
+        # Run jobs one at a time in the thread calling step(), as needed
+        # when rotations wait on a virtual clock
+        self.inline = inline
+        self.ready = []
+
+    @classmethod
+    def from_config(cls, config, runner, clock=None, wakeup=None):
+        """ Create a scheduler from the "scheduler" section of proxy.conf. The
+        interval is the top-level frequency. """
+
+        settings = config.scheduler or {}
+        max_age = float(settings.get('max_age', 0))*3600.0
+        return cls(runner, config.get_active_proxies, clock=clock, wakeup=wakeup,
+                   max_concurrent=int(settings.get('max_concurrent', 1)),
+                   min_healthy=float(settings.get('min_healthy', 0.75)),
+                   interval=config.frequency,
+                   max_age=max_age or None,
+                   stagger=float(settings.get('stagger', 0)),
+                   history=int(settings.get('history', 200)),
+                   status_file=settings.get('status_file'),
+                   retry_backoff=float(settings.get('retry_backoff', 600)))
+
+    def request(self, reason='manual', proxy=None, urgent=False):
+        """ Ask for a rotation, of the given proxy or one picked by the
+        policy. Urgent rotations jump the queue and are not staggered. Safe
+        to call from signal handlers and other threads. """
+
+        self.requests.append((reason, proxy, urgent))
+        self.wakeup.set()
+
+    def decide(self, now, action, job=None, detail=None):
+        """ Record a scheduling decision. Caller holds lock. """
+
+        decision = {'ts': now, 'action': action, 'job': job and job.id, 'reason': job and job.reason,
+                    'proxy': job and job.proxy, 'queued': len(self.queue), 'running': len(self.running)}
+        if detail:
+            decision['detail'] = detail
+        self.decisions.append(decision)
+        self.counters[action] += 1
+        print 'Scheduler: %s %r%s (queued %d, running %d)' % (action, job, detail and ' - ' + detail or '',
+                                                              len(self.queue), len(self.running))
+
+    def targets(self):
+        """ Return proxies already queued or being rotated out """
+
+        return set(job.proxy for job in itertools.chain(self.queue, self.running.values()) if job.proxy)
+
+    def pending(self):
+        """ Return targets(), for callers not holding the lock """
+
+        with self.lock:
+            return self.targets()
+
+    def enqueue(self, now, reason, proxy=None, urgent=False):
+        """ Queue a rotation, unless it duplicates one. Caller holds lock. """
+
+        if proxy != None and proxy in self.targets():
+            for job in self.queue:
+                if urgent and job.proxy == proxy:
+                    # Already queued - move it up front
+                    self.queue.remove(job)
+                    self.queue.appendleft(job)
+                    self.urgent.add(job.id)
+                    self.decide(now, 'expedited', job)
+                    break
+            return None
+        if proxy == None and reason == 'interval':
+            # A backlog of interval ticks is one rotation, not many
+            for job in self.queue:
+                if job.reason == 'interval':
+                    self.decide(now, 'coalesced', job)
+                    return None
+
+        job = RotationJob(self.ids.next(), reason, proxy, now)
+        if urgent:
+            self.queue.appendleft(job)
+            self.urgent.add(job.id)
+        else:
+            self.queue.append(job)
+        self.max_queue = max(self.max_queue, len(self.queue))
+        self.decide(now, 'queued', job)
+        return job
+
+    def check(self, now):
+        """ Queue rotations for every trigger which fired. Caller holds lock. """
+
+        while self.requests:
+            reason, proxy, urgent = self.requests.popleft()
+            self.enqueue(now, reason, proxy, urgent)
+
+        if self.interval:
+            if self.next_interval == None:
+                self.next_interval = now + self.interval
+            while now >= self.next_interval:
+                self.enqueue(now, 'interval')
+                self.next_interval += self.interval
+
+        if self.max_age:
+            for record in sorted(self.records(), key=lambda r: r.switch_in):
+                if self.age_due(record) <= now:
+                    self.enqueue(now, 'max_age', record.ip)
+
+    def age_due(self, record):
+        """ Return when record is due for a max-age rotation """
+
+        return max(record.switch_in + self.max_age, self.backoff.get(record.ip, 0))
+
+    def capacity(self, pool_size):
+        """ Return how many rotations may run at once with pool_size active
+        proxies. One is always allowed, else a small pool never rotates. """
+
+        spare = pool_size - int(math.ceil(pool_size * self.min_healthy))
+        return max(1, min(self.max_concurrent, spare))
+
+    def dispatch(self, now):
+        """ Start queued rotations as far as the limits allow. Caller holds lock. """
+
+        active = set(record.ip for record in self.records())
+        for proxy in self.backoff.keys():
+            if proxy not in active:
+                del self.backoff[proxy]
+        while self.queue:
+            job = self.queue[0]
+            if job.proxy != None and job.proxy not in active:
+                # Rotated out by something else meanwhile
+                self.queue.popleft()
+                self.decide(now, 'dropped', job, 'no longer active')
+                continue
+
+            limit = self.capacity(len(active))
+            if len(self.running) >= limit:
+                why = 'max_concurrent' if limit == self.max_concurrent else 'min_healthy'
+                blocked = '%s, %d of %d running' % (why, len(self.running), limit)
+            elif self.stagger and self.last_start != None and now - self.last_start < self.stagger and \
+                 job.id not in self.urgent:
+                blocked = 'stagger'
+            else:
+                blocked = None
+
+            if blocked:
+                if blocked != self.blocked:
+                    self.decide(now, 'deferred', job, blocked)
+                self.blocked = blocked
+                return
+            self.blocked = None
+
+            self.queue.popleft()
+            self.urgent.discard(job.id)
+            job.started = now
+            self.running[job.id] = job
+            self.last_start = now
+            self.max_running = max(self.max_running, len(self.running))
+            timing.observe('scheduler.queue_wait', now - job.queued)
+            self.decide(now, 'started', job)
+            self.launch(job)
+
+    def launch(self, job):
+        """ Run the job in the background. Caller holds lock. """
+
+        if self.inline:
+            # Run by step() once the lock is released
+            self.ready.append(job)
+            return
+        if self.pool == None:
+            self.pool = ThreadPool(self.max_concurrent)
+        self.pool.apply_async(self.execute, (job,))
+
+    def execute(self, job):
+        try:
+            ok = self.runner(job) != False
+        except Exception, e:
+            print 'Error in rotation',job,e
+            ok = False
+        self.finish(job, ok)
+
+    def finish(self, job, ok, now=None):
+        """ Mark a running job done and wake the scheduler up """
+
+        with self.lock:
+            now = self.clock.time() if now == None else now
+            self.running.pop(job.id, None)
+            job.finished, job.ok = now, ok
+            if not ok and job.proxy != None:
+                self.backoff[job.proxy] = now + self.retry_backoff
+            elif ok:
+                self.backoff.pop(job.proxy, None)
+            timing.observe('scheduler.rotation', now - job.started)
+            self.decide(now, 'finished' if ok else 'failed', job)
+            self.write_status(now)
+        self.wakeup.set()
+
+    def next_due(self, now):
+        """ Return when a trigger next fires or the queue can next move """
+
+        due = [now + max_sleep]
+        if self.next_interval != None:
+            due.append(self.next_interval)
+        if self.max_age:
+            targets = self.targets()
+            ages = [self.age_due(r) for r in self.records() if r.ip not in targets]
+            if ages:
+                due.append(min(ages))
+        if self.queue and self.blocked == 'stagger':
+            due.append(self.last_start + self.stagger)
+        # Jobs waiting on running ones are woken up by finish()
+        return max(now, min(due))
+
+    def step(self, now=None):
+        """ Check the triggers and start what can be started. Returns the
+        time of the next step. """
+
+        while True:
+            with self.lock:
+                now = self.clock.time() if now == None else now
+                self.check(now)
+                self.dispatch(now)
+                self.write_status(now)
+                due = self.next_due(now)
+                ready, self.ready = self.ready, []
+            if not ready:
+                return due
+            for job in ready:
+                self.execute(job)
+            # Inline jobs took time, look again
+            now = None
+
+    def wait(self, until=None):
+        """ Block on the clock until the next step is due, or until the given
+        time if sooner, or something happens - a request, a finished rotation
+        or a stop. Returns whether woken up early. """
+
+        with self.lock:
+            now = self.clock.time()
+            due = self.next_due(now)
+        if until != None:
+            due = min(due, until)
+        woken = self.clock.wait(self.wakeup, due - now)
+        self.wakeup.clear()
+        return woken
+
+    def status(self, now=None):
+        """ Return the queue, running jobs, counters and recent decisions """
+
+        return {'ts': now or self.clock.time(),
+                'queue': [job.to_dict() for job in self.queue],
+                'running': [job.to_dict() for job in self.running.values()],
+                'next_interval': self.next_interval,
+                'stats': self.stats(),
+                'decisions': list(self.decisions)[-20:]}
+
+    def write_status(self, now):
+        """ Write the status file, if configured. Caller holds lock. """
+
+        if self.status_file:
+            atomic_write(self.status_file, [json.dumps(self.status(now), indent=4)])
+
+    def stats(self):
+        # Counts of each kind of decision, with the current queue depth
+        stats = dict(self.counters)
+        stats.update({'queue_depth': len(self.queue), 'in_flight': len(self.running),
+                      'max_queue': self.max_queue, 'max_running': self.max_running})
+        return stats
+
+    def close(self):
+        """ Wait for the running rotations to complete """
+
+        if self.pool != None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+class SimRecord(object):
+    """ A proxy of the simulated pool """
+
+    __slots__ = ('ip', 'switch_in')
+
+    def __init__(self, ip, switch_in):
+        self.ip = ip
+        self.switch_in = switch_in
+
+class SimulatedScheduler(RotationScheduler):
+    """ Scheduler whose rotations take simulated time, on a virtual clock """
+
+    def __init__(self, duration, failure_rate=0.0, *args, **kwargs):
+        RotationScheduler.__init__(self, None, None, *args, **kwargs)
+        self.records = lambda: self.pool_records.values()
+        # Returns the simulated duration of a rotation
+        self.duration = duration
+        self.failure_rate = failure_rate
+        self.pool_records = {}
+        # Heap of (finish time, job id, job)
+        self.inflight = []
+        self.serial = itertools.count(1)
+        # Seconds each started job spent queued
+        self.waits = []
+        self.min_healthy_seen = 1.0
+        self.max_age_seen = 0.0
+
+    def add_node(self, switch_in):
+        ip = '10.0.%d.%d' % divmod(self.serial.next(), 250)
+        self.pool_records[ip] = SimRecord(ip, switch_in)
+
+    def launch(self, job):
+        self.waits.append(job.started - job.queued)
+        heapq.heappush(self.inflight, (job.started + self.duration(), job.id, job))
+
+    def complete(self, now):
+        """ Finish the rotations due by now, swapping nodes in the pool """
+
+        while self.inflight and self.inflight[0][0] <= now:
+            when, id, job = heapq.heappop(self.inflight)
+            ok = random.random() >= self.failure_rate
+            if ok:
+                proxy = job.proxy
+                if proxy == None or proxy not in self.pool_records:
+                    # The oldest node, like the LRU policies
+                    proxy = min(self.pool_records.values(), key=lambda r: r.switch_in).ip
+                del self.pool_records[proxy]
+                self.add_node(when)
+            self.finish(job, ok, when)
+
+    def observe(self, now):
+        """ Track the worst pool health and node age """
+
+        size = len(self.pool_records)
+        # Every running rotation takes a node out of service
+        self.min_healthy_seen = min(self.min_healthy_seen, float(size - len(self.running)) / size)
+        oldest = min(r.switch_in for r in self.pool_records.values())
+        self.max_age_seen = max(self.max_age_seen, now - oldest)
+
+    def run(self, end, on_demand=()):
+        """ Simulate until end. on_demand is a sorted list of request times. """
+
+        on_demand = collections.deque(on_demand)
+        while True:
+            now = self.clock.time()
+            while on_demand and on_demand[0] <= now:
+                on_demand.popleft()
+                self.request('manual')
+            self.complete(now)
+            due = self.step(now)
+            self.observe(now)
+            if now >= end:
+                break
+            due = [due, end]
+            if self.inflight:
+                due.append(self.inflight[0][0])
+            if on_demand:
+                due.append(on_demand[0])
+            self.clock.advance_to(min(due))
+
+def simulate(days=30, nodes=12, interval=72, max_age=168, max_concurrent=2, min_healthy=0.75, stagger=300,
+             duration=(120, 600), failure_rate=0.02, on_demand=0.5, seed=1):
+    """ Simulate days of scheduling on a virtual clock. interval and max_age
+    are in hours, on_demand is the rate of manual requests per day. """
+
+    random.seed(seed)
+    clock = VirtualClock()
+    sched = SimulatedScheduler(lambda: random.uniform(*duration), failure_rate, clock=clock,
+                               max_concurrent=max_concurrent, min_healthy=min_healthy,
+                               interval=interval*3600.0, max_age=max_age*3600.0, stagger=stagger, history=100000)
+    for i in range(nodes):
+        # Ages spread over the max age, as in a pool which has run for a while
+        sched.add_node(-random.uniform(0, max_age*3600.0))
+
+    end = days*86400.0
+    requests, t = [], 0.0
+    while on_demand:
+        t += random.expovariate(on_demand / 86400.0)
+        if t >= end:
+            break
+        requests.append(t)
+
+    # Quiet the per-decision printing
+    stdout, sys.stdout = sys.stdout, open('/dev/null', 'w')
+    start = time.time()
+    try:
+        sched.run(end, requests)
+    finally:
+        sys.stdout = stdout
+    elapsed = time.time() - start
+
+    waits = sorted(sched.waits)
+    reasons = collections.defaultdict(int)
+    for d in sched.decisions:
+        if d['action'] == 'started':
+            reasons[d['reason']] += 1
+
+    print 'Simulated %d days of a %d node pool in %.3fs wall time' % (days, nodes, elapsed)
+    print 'Interval %dh, max age %dh, max concurrent %d, min healthy %.0f%%, stagger %ds' % (
+        interval, max_age, max_concurrent, min_healthy * 100, stagger)
+    print 'Rotations started: %d (%s), failed: %d, on-demand requests: %d' % (
+        len(waits), ', '.join('%s %d' % kv for kv in sorted(reasons.items())), sched.counters['failed'], len(requests))
+    print 'The single rotation per interval would have done %d' % int(days * 24 / interval)
+    if waits:
+        print 'Queue wait: median %.0fs, p95 %.0fs, max %.0fs' % (waits[len(waits) // 2],
+                                                                  waits[int(len(waits) * 0.95)], waits[-1])
+    print 'Max running at once: %d, max queue depth: %d, deferrals: %d, coalesced: %d' % (
+        sched.max_running, sched.max_queue, sched.counters['deferred'], sched.counters['coalesced'])
+    print 'Lowest healthy share of the pool: %.1f%% (floor %.1f%%)' % (sched.min_healthy_seen * 100,
+                                                                        min_healthy * 100)
+    print 'Oldest node age seen: %.1fh (max age %dh)' % (sched.max_age_seen / 3600.0, max_age)
+    return sched
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog='scheduler')
+    parser.add_argument('--simulate',help='Simulate N days of scheduling on a virtual clock', type=int, default=0)
+    parser.add_argument('-n','--nodes',help='Pool size in the simulation', type=int, default=12)
+    parser.add_argument('-j','--concurrent',help='Max concurrent rotations in the simulation', type=int, default=2)
+    parser.add_argument('--max-age',help='Max node age in hours in the simulation', type=float, default=168)
+    parser.add_argument('--status',help='Print the status file of the running daemon', default=None)
+    args = parser.parse_args()
+
+    if args.simulate:
+        simulate(args.simulate, args.nodes, max_age=args.max_age, max_concurrent=args.concurrent)
+        sys.exit(0)
+
+    if args.status:
+        status = json.load(open(args.status))
+        print 'Scheduler stats =>',status['stats']
+        for job in status['running']:
+            print 'Running:',job
+        for job in status['queue']:
+            print 'Queued:',job
+        for d in status['decisions']:
+            print '%s %-9s #%s %s %s %s' % (time.strftime('%d-%b-%Y %H:%M:%S', time.localtime(d['ts'])),
+                                            d['action'], d['job'], d['reason'], d['proxy'] or '-',
+                                            d.get('detail', ''))
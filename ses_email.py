@@ -8,12 +8,15 @@ def send_ses(fromaddr,
              body,
              recipient,
              attachment=None,
-             filename=''):
+             filename='',
+             conn=None):
     """Send an email via the Amazon SES service.
 
     Example:
       send_ses('me@example.com, 'greetings', "Hi!", 'you@example.com)
 
+    conn is an SES connection to reuse; one is made if not given.
+
     Return:
       If 'ErrorResponse' appears in the return message from SES,
       return the message, otherwise return an empty '' string.
@@ -28,7 +31,7 @@ def send_ses(fromaddr,
         part = MIMEApplication(attachment)
         part.add_header('Content-Disposition', 'attachment', filename=filename)
         msg.attach(part)
-    conn = boto.connect_ses()
+    conn = conn or boto.connect_ses()
     result = conn.send_raw_email(msg.as_string())
     return result if 'ErrorResponse' in result else ''
 
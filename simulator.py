@@ -0,0 +1,440 @@
+"""
+
+Offline fleet simulator and rotation benchmark.
+
+Runs the real ProxyRotator daemon loop - scheduler, rotation policies,
+proxy state, journal and LB slot handling - against in-process fakes of
+the Linode backend (boot latency and create failures), the ssh sessions
+(handshake, command time, failures and hosts still booting), squid probes
+and HAProxy (the admin socket
+state of fake_haproxy and timed reloads), all on a VirtualClock. Months
+of rotations replay in seconds.
+
+For every policy it reports the distribution of rotation latencies, the
+fairness of node lifetimes (Jain's index, 1.0 when every node serves
+equally long), the region spread of the pool and the availability of
+the pool - the time weighted share of the target pool size that was in
+the LB with squid running. Results can be written as JSON so that runs
+can be compared for regressions.
+
+Usage: simulator.py [--days N] [--policy NAME]... [--output FILE]
+
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import collections
+
+from clock import VirtualClock
+from utils import LinodeNode
+from health_probe import ProbeResult
+from ssh_session import CommandResult, timeout_status
+from haproxy_admin import HAProxyAdmin
+from fake_haproxy import FakeHAProxyState
+from fake_linode_api import FakeLinodeState
+from inventory import Inventory
+from rotate_proxies import ProxyConfig, ProxyRotator
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+policies = ('ROTATION_RANDOM', 'ROTATION_LRU', 'ROTATION_NEW_REGION', 'ROTATION_LRU_NEW_REGION',
+            'ROTATION_SCORE', 'ROTATION_SCORE_NEW_REGION')
+
+def percentiles(values):
+    """ Return p50, p95, max and mean of values, rounded """
+
+    values = sorted(values)
+    if not values:
+        return {}
+    return {'p50': round(values[len(values) // 2], 2), 'p95': round(values[int(len(values) * 0.95)], 2),
+            'max': round(values[-1], 2), 'mean': round(sum(values) / len(values), 2)}
+
+def jain_index(values):
+    """ Jain's fairness index - 1.0 when all values are equal, 1/n at worst """
+
+    if not values:
+        return None
+    return sum(values) ** 2 / (len(values) * sum(v * v for v in values))
+
+class Availability(object):
+    """ Time weighted share of the target pool size serving traffic """
+
+    def __init__(self, clock, target):
+        self.clock = clock
+        self.target = target
+        self.start = self.last = clock.time()
+        self.level = 0
+        self.area = 0.0
+
+    def update(self, serving):
+        now = self.clock.time()
+        self.area += self.level * (now - self.last)
+        self.last, self.level = now, serving
+
+    def value(self):
+        self.update(self.level)
+        elapsed = self.last - self.start
+        return min(1.0, self.area / (self.target * elapsed)) if elapsed else 1.0
+
+class SimFleet(object):
+    """ Shared state of the fakes - linodes, squid processes and the LB """
+
+    def __init__(self, clock, target, boot=90.0, api_latency=1.0, create_failure=0.0, ssh_failure=0.0,
+                 handshake=0.5, command_time=0.3, reload_time=2.0):
+        self.clock = clock
+        self.linodes = FakeLinodeState()
+        self.lb = FakeHAProxyState()
+        # IPs whose squid runs
+        self.squid_up = set()
+        # IP => time at which a new node has booted
+        self.booted_at = {}
+        self.boot = boot
+        self.api_latency = api_latency
+        self.create_failure = create_failure
+        self.ssh_failure = ssh_failure
+        self.handshake = handshake
+        self.command_time = command_time
+        self.reload_time = reload_time
+        self.availability = Availability(clock, target)
+        self.counters = collections.defaultdict(int)
+
+    def serving(self):
+        ips = set(self.linodes.ips.values())
+        return len([s for s in self.lb.servers.values()
+                    if s.admin == 'ready' and s.addr in self.squid_up and s.addr in ips])
+
+    def changed(self):
+        self.availability.update(self.serving())
+
+    def load_slots(self, slots):
+        """ Rebuild the LB servers from (slot, proxy or None) pairs, as
+        HAProxy does when it starts """
+
+        self.lb = FakeHAProxyState()
+        for idx, proxy in slots:
+            self.lb.add_server('squid%d' % (idx + 1), proxy or '127.0.0.1', admin='ready' if proxy else 'maint')
+        self.changed()
+
+    def reload(self, slots):
+        """ Restart the LB - nothing is served while it starts """
+
+        self.counters['lb_reloads'] += 1
+        self.availability.update(0)
+        self.clock.sleep(self.reload_time)
+        self.load_slots(slots)
+
+class SimLinode(object):
+    """ In-process stand-in for LinodeCommand / LinodeAPI """
+
+    def __init__(self, fleet, group='ynodes'):
+        self.fleet = fleet
+        self.group = group
+
+    def add(self, label, region):
+        """ Add a running node with squid up, for the initial pool """
+
+        state = self.fleet.linodes
+        linode_id = state.add(label, region, self.group)
+        self.fleet.squid_up.add(state.ips[linode_id])
+        return linode_id, state.ips[linode_id]
+
+    def create_node(self, region, plan_id, os_id, image_id, label, passwd):
+        fleet = self.fleet
+        fleet.counters['creates'] += 1
+        fleet.clock.sleep(fleet.api_latency)
+        if random.random() < fleet.create_failure:
+            fleet.counters['create_failures'] += 1
+            raise ValueError('Simulated create failure in region %d' % region)
+        linode_id = fleet.linodes.add('linode%d' % (fleet.linodes.next_id + 1), region, self.group)
+        ip = fleet.linodes.ips[linode_id]
+        # Boot times vary a lot, with a long tail
+        fleet.booted_at[ip] = fleet.clock.time() + fleet.boot * random.lognormvariate(0, 0.4)
+        return LinodeNode(linode_id, 'linode%d' % linode_id, ip, int(region), None, '')
+
+    def node_status(self, linode_id):
+        fleet = self.fleet
+        fleet.clock.sleep(fleet.api_latency)
+        ip = fleet.linodes.ips.get(int(linode_id))
+        return int(fleet.clock.time() >= fleet.booted_at.get(ip, 0))
+
+    def get_label(self, linode_id):
+        linode = self.fleet.linodes.linodes.get(int(linode_id))
+        return linode and linode['LABEL']
+
+    def linode_update(self, linode_id, label, group):
+        self.fleet.clock.sleep(self.fleet.api_latency)
+        self.fleet.linodes.dispatch('linode.update', {'LinodeID': linode_id, 'Label': label,
+                                                      'lpm_displayGroup': group})
+
+    def linode_delete(self, linode_id):
+        fleet = self.fleet
+        fleet.counters['deletes'] += 1
+        fleet.clock.sleep(fleet.api_latency)
+        ip = fleet.linodes.ips.get(int(linode_id))
+        fleet.linodes.dispatch('linode.delete', {'LinodeID': linode_id})
+        fleet.squid_up.discard(ip)
+        fleet.booted_at.pop(ip, None)
+        fleet.changed()
+
+    def list_nodes(self):
+        state = self.fleet.linodes
+        return [LinodeNode(i, l['LABEL'], state.ips[i], l['DATACENTERID'], l['STATUS'], l['LPM_DISPLAYGROUP'])
+                for i, l in state.linodes.items()]
+
+class SimSessions(object):
+    """ In-process stand-in for ssh_session.SessionManager """
+
+    def __init__(self, fleet):
+        self.fleet = fleet
+        self.sessions = set()
+
+    def run(self, host, commands, timeout=None, stop_on_error=False):
+        fleet = self.fleet
+        if fleet.clock.time() < fleet.booted_at.get(host, 0):
+            # sshd is not up yet
+            fleet.clock.sleep(fleet.handshake)
+            fleet.counters['ssh_refused'] += 1
+            return [CommandResult(host, command, 255, stderr='Connection refused') for command in commands]
+        if host not in self.sessions:
+            fleet.clock.sleep(fleet.handshake)
+            self.sessions.add(host)
+        failed = random.random() < fleet.ssh_failure
+        results = []
+        for command in commands:
+            fleet.counters['ssh_commands'] += 1
+            fleet.clock.sleep(fleet.command_time)
+            if failed:
+                results.append(CommandResult(host, command, timeout_status, stderr='simulated failure'))
+                continue
+            if 'squid' in command:
+                fleet.squid_up.add(host)
+                fleet.changed()
+            results.append(CommandResult(host, command, 0, elapsed=fleet.command_time))
+        if failed:
+            fleet.counters['ssh_failures'] += 1
+        return results
+
+    def close(self, host):
+        self.sessions.discard(host)
+
+    def close_all(self):
+        self.sessions.clear()
+
+    def evict_idle(self, now=None):
+        return []
+
+    def stats(self):
+        return {'sessions': len(self.sessions)}
+
+class SimProber(object):
+    """ Stand-in for health_probe.HealthProber - a node answers once its
+    squid runs """
+
+    def __init__(self, fleet, url=None):
+        self.fleet = fleet
+        self.url = url
+        self.timeout = 5
+
+    def probe(self, server):
+        result = ProbeResult(*server)
+        result.ok = server[1] in self.fleet.squid_up
+        if result.ok:
+            result.status = 200 if self.url else 0
+        else:
+            result.stage, result.error = 'tcp', 'Connection refused'
+        return result
+
+class SimLBAdmin(HAProxyAdmin):
+    """ Admin socket client talking to the fake LB state in process """
+
+    def __init__(self, fleet, backend='rotateproxy'):
+        HAProxyAdmin.__init__(self, 'sim', backend)
+        self.fleet = fleet
+
+    def command(self, *commands):
+        output = ''.join(self.fleet.lb.run(command) for command in commands)
+        if any(command.startswith('set ') for command in commands):
+            self.fleet.counters['lb_commands'] += len(commands)
+            self.fleet.changed()
+        return output
+
+class SimProxyConfig(ProxyConfig):
+    """ Proxy config whose load balancer is the fake one """
+
+    def __init__(self, cfg, fleet, clock):
+        ProxyConfig.__init__(self, cfg, clock=clock)
+        # Not self.fleet, which is the "fleet" section of the config
+        self.sim_fleet = fleet
+        self.lb_admin = SimLBAdmin(fleet, self.lb_backend or 'rotateproxy')
+        self.lb_poller.admin = self.lb_admin
+        # Start out as if the current slots were deployed
+        self.deployed_slots = len(self.slots)
+        fleet.load_slots(self.deployed())
+
+    def deployed(self):
+        return [(idx, proxy if proxy != None and self.is_active(proxy) else None)
+                for idx, proxy in enumerate(self.slots)]
+
+    def write_lb_config(self, disabled=False, test=False, reload=True):
+        self.deployed_slots = len(self.slots)
+        if reload:
+            return self.reload_lb()
+        return True
+
+    def reload_lb(self):
+        self.sim_fleet.reload(self.deployed())
+        return True
+
+class SimRotator(ProxyRotator):
+    """ The rotation daemon, stopping at a given virtual time """
+
+    def __init__(self, cfg, config, until):
+        ProxyRotator.__init__(self, cfg, config=config)
+        self.until = until
+        self.latencies = []
+        # (distinct regions, largest region count) after every rotation
+        self.spread = []
+
+    def alive(self):
+        return self.clock.time() < self.until
+
+    def run_job(self, job):
+        start = self.clock.time()
+        try:
+            return ProxyRotator.run_job(self, job)
+        finally:
+            self.latencies.append(self.clock.time() - start)
+            regions = collections.Counter(r.region for r in self.config.get_active_proxies())
+            self.spread.append((len(regions), max(regions.values() or [0])))
+
+def make_config(workdir, policy, nodes, frequency, max_age, max_concurrent, stagger):
+    """ Write the simulation config, based on proxy.conf, to workdir """
+
+    config = json.load(open(os.path.join(here, 'proxy.conf')))
+    config.update({'policy': policy, 'frequency': frequency,
+                   'proxylist': os.path.join(workdir, 'proxies.list'),
+                   'lb_template': os.path.join(here, config['lb_template']),
+                   'lb_config': os.path.join(workdir, 'haproxy.cfg'),
+                   'linode_backend': 'sim'})
+    config['state'] = {'journal': os.path.join(workdir, 'proxies.journal'),
+                       'snapshot': os.path.join(workdir, 'proxies.snapshot'), 'export_csv': False}
+    config['standby'] = {'size': 0}
+    config['ban'] = {'enabled': False}
+    config['reconcile'] = {'enabled': False}
+    config['region_score'] = {'enabled': False}
+    config['timing'] = {'enabled': False}
+    config['notify'] = {'spool': ''}
+    config['inventory'] = {'state_file': ''}
+    config['email'] = dict(config.get('email', {}), send_email=False)
+    config['scheduler'] = {'max_concurrent': max_concurrent, 'stagger': stagger, 'max_age': max_age}
+    path = os.path.join(workdir, 'sim.conf')
+    json.dump(config, open(path, 'w'), indent=4)
+    return path, config
+
+def simulate(policy='ROTATION_LRU_NEW_REGION', days=90, nodes=12, frequency=72.0, max_age=0, max_concurrent=1,
+             stagger=300, seed=1, verbose=False, **fleet_settings):
+    """ Run the daemon for days of virtual time under policy and return
+    the benchmark results """
+
+    random.seed(seed)
+    workdir = tempfile.mkdtemp(prefix='proxysim')
+    cwd, stdout = os.getcwd(), sys.stdout
+    begin = time.time()
+    try:
+        path, settings = make_config(workdir, policy, nodes, frequency, max_age, max_concurrent, stagger)
+        clock = VirtualClock(1500000000)
+        fleet = SimFleet(clock, nodes, **fleet_settings)
+        linode = SimLinode(fleet, settings['group'])
+
+        # A pool which has been rotating for a while
+        lines = []
+        for i in range(nodes):
+            region = settings['region_ids'][i % len(settings['region_ids'])]
+            linode_id, ip = linode.add('%s%d' % (settings['proxy_prefix'], i + 1), region)
+            switched = int(clock.time() - random.uniform(0, frequency * 3600 * nodes))
+            lines.append('%s,%d,%d,%d,%d' % (ip, region, linode_id, switched, switched))
+        open(settings['proxylist'], 'w').write('\n'.join(lines) + '\n')
+
+        # The daemon writes its heartbeat and pid file to the current directory
+        os.chdir(workdir)
+        if not verbose:
+            sys.stdout = open(os.devnull, 'w')
+        start = clock.time()
+        config = SimProxyConfig(path, fleet, clock)
+        rotator = SimRotator(path, config, start + days * 86400)
+        rotator.linode_cmd = rotator.readiness.linode_cmd = Inventory(linode, settings['group'], clock=clock)
+        rotator.ssh = rotator.readiness.ssh = SimSessions(fleet)
+        rotator.readiness.prober = SimProber(fleet, rotator.readiness.prober.url)
+        rotator.readiness.connector = SimProber(fleet)
+        rotator.scheduler.inline = rotator.drainer.inline = True
+        try:
+            rotator.run(daemon=False)
+        except SystemExit:
+            pass
+    finally:
+        sys.stdout = stdout
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    # Every node retired during the run, the initial pool included. Those
+    # switched in before the start count from their seeded switch in time.
+    lifetimes = [(r.switch_out - r.switch_in) / 3600.0 for r in config.proxy_dict.values()
+                 if not r.active and r.switch_out >= start]
+    stats = rotator.scheduler.stats()
+    return {'policy': policy,
+            'rotations': stats.get('started', 0),
+            'failed': stats.get('failed', 0),
+            'latency_s': percentiles(rotator.latencies),
+            'lifetime_h': percentiles(lifetimes),
+            'lifetime_fairness': round(jain_index(lifetimes), 4) if lifetimes else None,
+            'regions_distinct': percentiles([s[0] for s in rotator.spread]),
+            'region_max_nodes': max([s[1] for s in rotator.spread] or [0]),
+            'availability': round(fleet.availability.value(), 6),
+            'counters': dict(fleet.counters),
+            'wall_s': round(time.time() - begin, 3)}
+
+def report(results):
+    print '%-26s %5s %5s %8s %8s %8s %9s %8s %7s %8s %6s' % ('policy', 'rot', 'fail', 'lat p50', 'lat p95',
+                                                             'life p50', 'fairness', 'regions', 'max/rg',
+                                                             'avail', 'wall')
+    for r in results:
+        print '%-26s %5d %5d %7.0fs %7.0fs %7.1fh %9s %8s %7d %7.3f%% %5.1fs' % (
+            r['policy'], r['rotations'], r['failed'], r['latency_s'].get('p50', 0), r['latency_s'].get('p95', 0),
+            r['lifetime_h'].get('p50', 0), r['lifetime_fairness'], r['regions_distinct'].get('mean', '-'),
+            r['region_max_nodes'], r['availability'] * 100, r['wall_s'])
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog='simulator')
+    parser.add_argument('-d','--days',help='Days of virtual time to simulate', type=int, default=90)
+    parser.add_argument('-n','--nodes',help='Pool size', type=int, default=12)
+    parser.add_argument('-p','--policy',help='Policy to simulate (repeatable), default all', action='append',
+                        choices=policies)
+    parser.add_argument('-f','--frequency',help='Rotation interval in hours', type=float, default=72)
+    parser.add_argument('--max-age',help='Max node age in hours, 0 for none', type=float, default=0)
+    parser.add_argument('--boot',help='Median boot time of a linode in seconds', type=float, default=90)
+    parser.add_argument('--create-failure',help='Share of failing creates', type=float, default=0.02)
+    parser.add_argument('--ssh-failure',help='Share of failing ssh sessions', type=float, default=0.01)
+    parser.add_argument('--reload-time',help='Seconds the LB takes to reload', type=float, default=2.0)
+    parser.add_argument('-s','--seed',help='Random seed', type=int, default=1)
+    parser.add_argument('-o','--output',help='Write the results as JSON to this file', default=None)
+    parser.add_argument('-v','--verbose',help='Show the output of the daemon', action='store_true')
+    args = parser.parse_args()
+
+    params = {'days': args.days, 'nodes': args.nodes, 'frequency': args.frequency, 'max_age': args.max_age,
+              'seed': args.seed, 'boot': args.boot, 'create_failure': args.create_failure,
+              'ssh_failure': args.ssh_failure, 'reload_time': args.reload_time}
+    results = []
+    for policy in args.policy or policies:
+        results.append(simulate(policy, verbose=args.verbose, **params))
+    report(results)
+
+    if args.output:
+        json.dump({'params': params, 'ts': int(time.time()), 'results': results}, open(args.output, 'w'),
+                  indent=4, sort_keys=True)
+        print 'Wrote',args.output
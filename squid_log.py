@@ -0,0 +1,372 @@
+"""
+
+Streaming analyzer for the squid access logs of the proxy nodes.
+
+Parses the custom logformat from squid.conf
+
+    logformat squid [%tl] %6tr %>a %Ss/%03Hs %<st %rm %ru %un %>ha %Sh/%<A %mt
+
+incrementally - remembering byte offsets between runs - either from
+local files or pulled in batches over one ssh session per node, and keeps
+rolling-window aggregates per node and per target domain: request rate,
+p50/p95 response time, bytes and 403/429/5xx ratios. Memory use depends
+only on the window and the number of nodes/domains tracked, never on the
+size of the logs.
+
+Run with --bench to measure parsing throughput.
+
+"""
+
+import os
+import sys
+import json
+import time
+import bisect
+import calendar
+import argparse
+import tempfile
+import subprocess
+
+months = dict((m, i + 1) for i, m in enumerate(('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun',
+                                                 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec')))
+
+# Response time histogram bin upper bounds in ms, growing by 25% a bin
+latency_bins = [1.25 ** i for i in range(0, 62)]
+
+# Pull a batch of a remote log - first line is "inode:size", then the data
+remote_cmd_template = """ssh -o StrictHostKeyChecking=no -o UserKnownHostsFile=/dev/null %s@%s "stat -c %%i:%%s %s && tail -c +%d %s | head -c %d" """
+
+read_size = 1 << 20
+
+class RollingStats(object):
+    """ Request aggregates over a rolling time window, kept in a fixed ring
+    of time buckets """
+
+    __slots__ = ('bucket', 'nslots', 'epochs', 'counts', 'nbytes', 'r403', 'r429', 'r5xx', 'hist', 'last')
+
+    def __init__(self, window=900, bucket=60):
+        self.bucket = bucket
+        self.nslots = max(1, int(window // bucket))
+        # Bucket number each slot currently holds
+        self.epochs = [-1] * self.nslots
+        self.counts = [0] * self.nslots
+        self.nbytes = [0] * self.nslots
+        self.r403 = [0] * self.nslots
+        self.r429 = [0] * self.nslots
+        self.r5xx = [0] * self.nslots
+        self.hist = [None] * self.nslots
+        self.last = 0
+
+    def add(self, ts, elapsed, status, size):
+        """ Account one request """
+
+        epoch = int(ts // self.bucket)
+        slot = epoch % self.nslots
+        if self.epochs[slot] != epoch:
+            if epoch < self.epochs[slot]:
+                # Older than the window
+                return
+            self.epochs[slot] = epoch
+            self.counts[slot] = self.nbytes[slot] = self.r403[slot] = self.r429[slot] = self.r5xx[slot] = 0
+            self.hist[slot] = [0] * (len(latency_bins) + 1)
+
+        self.counts[slot] += 1
+        self.nbytes[slot] += size
+        if status == 403:
+            self.r403[slot] += 1
+        elif status == 429:
+            self.r429[slot] += 1
+        elif status >= 500:
+            self.r5xx[slot] += 1
+        self.hist[slot][bisect.bisect_left(latency_bins, elapsed)] += 1
+        if ts > self.last:
+            self.last = ts
+
+    def summary(self, now=None):
+        """ Return the aggregates of the window ending at now (default: the
+        latest request seen) """
+
+        now = now or self.last
+        newest = int(now // self.bucket)
+        live = [i for i in range(self.nslots) if newest - self.nslots < self.epochs[i] <= newest]
+        count = sum(self.counts[i] for i in live)
+        result = {'requests': count, 'bytes': sum(self.nbytes[i] for i in live),
+                  'rate': float(count) / (self.nslots * self.bucket),
+                  'p50': None, 'p95': None, 'r403': 0.0, 'r429': 0.0, 'r5xx': 0.0}
+        if count == 0:
+            return result
+
+        result['r403'] = float(sum(self.r403[i] for i in live)) / count
+        result['r429'] = float(sum(self.r429[i] for i in live)) / count
+        result['r5xx'] = float(sum(self.r5xx[i] for i in live)) / count
+
+        hist = [sum(col) for col in zip(*[self.hist[i] for i in live])]
+        for key, q in (('p50', 0.5), ('p95', 0.95)):
+            target, seen = q * count, 0
+            for idx, n in enumerate(hist):
+                seen += n
+                if seen >= target:
+                    result[key] = latency_bins[min(idx, len(latency_bins) - 1)]
+                    break
+
+        return result
+
+class LogAnalyzer(object):
+    """ Incremental squid access log analyzer with per node and per domain
+    rolling aggregates """
+
+    def __init__(self, window=900, bucket=60, max_domains=1000, offsets='squid_log.offsets'):
+        self.window = window
+        self.bucket = bucket
+        self.max_domains = max_domains
+        self.offsets_file = offsets
+        self.nodes = {}
+        # Domain => RollingStats
+        self.domains = {}
+        self.offsets = {}
+        self.lines = 0
+        self.errors = 0
+        # Single entry cache of the last parsed minute
+        self.ts_key, self.ts_base = None, 0
+        self.load_offsets()
+
+    @classmethod
+    def from_config(cls, config):
+        """ Create an analyzer from the "squid_log" section of proxy.conf """
+
+        settings = config.squid_log or {}
+        return cls(window=int(settings.get('window', 900)),
+                   bucket=int(settings.get('bucket', 60)),
+                   max_domains=int(settings.get('max_domains', 1000)),
+                   offsets=settings.get('offsets', 'squid_log.offsets'))
+
+    def load_offsets(self):
+        if self.offsets_file and os.path.isfile(self.offsets_file):
+            try:
+                self.offsets = json.load(open(self.offsets_file))
+            except ValueError, e:
+                print 'Ignoring bad offsets file',e
+
+    def save_offsets(self):
+        if self.offsets_file:
+            tmpfile = self.offsets_file + '.tmp'
+            json.dump(self.offsets, open(tmpfile, 'w'))
+            os.rename(tmpfile, self.offsets_file)
+
+    def parse_time(self, stamp, zone):
+        """ Convert '[17/Oct/2026:10:00:01' '+0530]' to epoch seconds """
+
+        key = stamp[:18] + zone
+        if key != self.ts_key:
+            day, month, rest = stamp[1:].split('/')
+            year, hour, minute, second = rest.split(':')
+            offset = int(zone[1:3]) * 3600 + int(zone[3:5]) * 60
+            if zone[0] == '-':
+                offset = -offset
+            self.ts_base = calendar.timegm((int(year), months[month], int(day), int(hour), int(minute),
+                                            0, 0, 0, 0)) - offset
+            self.ts_key = key
+        return self.ts_base + int(stamp[19:21])
+
+    def stats_for(self, node):
+        stats = self.nodes.get(node)
+        if stats == None:
+            stats = self.nodes[node] = RollingStats(self.window, self.bucket)
+        return stats
+
+    def domain_stats(self, domain):
+        stats = self.domains.get(domain)
+        if stats == None:
+            if len(self.domains) >= self.max_domains:
+                # Forget the domain seen least recently
+                oldest = min(self.domains, key=lambda d: self.domains[d].last)
+                del self.domains[oldest]
+            stats = self.domains[domain] = RollingStats(self.window, self.bucket)
+        return stats
+
+    def feed(self, node, lines):
+        """ Parse an iterable of complete log lines for node """
+
+        stats = self.stats_for(node)
+        parse_time = self.parse_time
+        domains = self.domains
+        domain_stats = self.domain_stats
+        for line in lines:
+            fields = line.split(None, 8)
+            try:
+                # [%tl] is two fields, then %tr %>a %Ss/%Hs %<st %rm %ru
+                ts = parse_time(fields[0], fields[1])
+                elapsed = int(fields[2])
+                status = int(fields[4][-3:])
+                size = int(fields[5])
+                url = fields[7]
+            except (IndexError, ValueError, KeyError):
+                self.errors += 1
+                continue
+
+            if fields[6] == 'CONNECT':
+                host = url
+            else:
+                host = url.split('/', 3)[2] if '://' in url else url
+            domain = host.rsplit(':', 1)[0] if ':' in host else host
+
+            stats.add(ts, elapsed, status, size)
+            (domains.get(domain) or domain_stats(domain)).add(ts, elapsed, status, size)
+            self.lines += 1
+
+    def feed_stream(self, node, stream, limit=None):
+        """ Parse complete lines from a file-like object in fixed size chunks.
+        Returns the number of bytes consumed, which always ends on a line
+        boundary. """
+
+        consumed, remainder = 0, ''
+        while limit == None or consumed + len(remainder) < limit:
+            chunk = stream.read(read_size if limit == None else min(read_size, limit - consumed - len(remainder)))
+            if not chunk:
+                break
+            chunk = remainder + chunk
+            end = chunk.rfind('\n') + 1
+            remainder = chunk[end:]
+            if end:
+                self.feed(node, chunk[:end].splitlines())
+                consumed += end
+
+        return consumed
+
+    def tail_file(self, node, path):
+        """ Process whatever has been appended to a local log since the last run """
+
+        key = '%s:%s' % (node, path)
+        st = os.stat(path)
+        saved = self.offsets.get(key, {})
+        offset = saved.get('offset', 0)
+        # Start over if the log was rotated or truncated
+        if saved.get('inode') != st.st_ino or offset > st.st_size:
+            offset = 0
+
+        f = open(path, 'rb')
+        f.seek(offset)
+        offset += self.feed_stream(node, f)
+        f.close()
+
+        self.offsets[key] = {'offset': offset, 'inode': st.st_ino}
+        self.save_offsets()
+        return offset
+
+    def pull_remote(self, node, user, path='/var/log/squid3/access.log', max_bytes=64 << 20):
+        """ Pull the next batch of a node's log over a single ssh session """
+
+        key = '%s:%s' % (node, path)
+        saved = self.offsets.get(key, {})
+        offset = saved.get('offset', 0)
+
+        cmd = remote_cmd_template % (user, node, path, offset + 1, path, max_bytes)
+        proc = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE)
+        header = proc.stdout.readline().strip()
+        try:
+            inode, size = map(int, header.split(':'))
+        except ValueError:
+            proc.wait()
+            print 'Could not read log on',node,repr(header)
+            return None
+
+        # A node seen for the first time is already read from the start
+        if saved.get('inode', inode) != inode or offset > size:
+            # Rotated - read again from the start
+            proc.stdout.close()
+            proc.wait()
+            self.offsets[key] = {'offset': 0, 'inode': inode}
+            return self.pull_remote(node, user, path, max_bytes)
+
+        offset += self.feed_stream(node, proc.stdout)
+        proc.stdout.close()
+        proc.wait()
+
+        self.offsets[key] = {'offset': offset, 'inode': inode}
+        self.save_offsets()
+        return offset
+
+    def node_summary(self, node, now=None):
+        """ Return the rolling aggregates of a node, None if never seen """
+
+        stats = self.nodes.get(node)
+        return stats.summary(now) if stats else None
+
+    def domain_summary(self, domain, now=None):
+        """ Return the rolling aggregates of a target domain """
+
+        stats = self.domains.get(domain)
+        return stats.summary(now) if stats else None
+
+    def summary(self, now=None, top=10):
+        """ Return a compact summary of all nodes and the busiest domains """
+
+        domains = [(d, s.summary(now)) for d, s in self.domains.items()]
+        domains.sort(key=lambda item: -item[1]['requests'])
+        return {'nodes': dict((n, s.summary(now)) for n, s in self.nodes.items()),
+                'domains': dict(domains[:top])}
+
+def make_line(ts, elapsed, status, size, url, method='GET'):
+    """ Format a log line in our squid logformat """
+
+    stamp = time.strftime('[%d/%b/%Y:%H:%M:%S +0000]', time.gmtime(ts))
+    return '%s %6d 10.0.0.1 TCP_MISS/%03d %d %s %s crawler "-" HIER_DIRECT/93.184.216.34 text/html\n' % (
+        stamp, elapsed, status, size, method, url)
+
+def benchmark(count):
+    """ Measure parsing throughput on a generated log file """
+
+    import random
+    import resource
+
+    fd, path = tempfile.mkstemp(prefix='squid-bench')
+    f = os.fdopen(fd, 'w')
+    start = int(time.time()) - count // 100
+    statuses = [200] * 90 + [403] * 4 + [429] * 3 + [503] * 3
+    for i in range(count):
+        f.write(make_line(start + i // 100, random.randrange(20, 3000), random.choice(statuses),
+                          random.randrange(500, 50000), 'http://site%d.example.com/page/%d' % (i % 50, i)))
+    f.close()
+    size = os.path.getsize(path)
+
+    analyzer = LogAnalyzer(offsets=None)
+    t = time.time()
+    analyzer.tail_file('node1', path)
+    elapsed = time.time() - t
+    os.remove(path)
+
+    print 'Parsed %d lines (%.1f MB) in %.2fs: %.0f lines/sec, %.1f MB/s' % (analyzer.lines, size / 1e6, elapsed,
+                                                                        analyzer.lines / elapsed,
+                                                                        size / 1e6 / elapsed)
+    print 'Max RSS: %.1f MB' % (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0)
+    print json.dumps(analyzer.node_summary('node1'), indent=2)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog='squid_log')
+    parser.add_argument('logs', nargs='*', help='Local access logs to analyze')
+    parser.add_argument('-C','--conf',help='Use the given configuration file', default='proxy.conf')
+    parser.add_argument('-n','--node',help='Node name for local logs', default='localhost')
+    parser.add_argument('--pull',help='Pull logs from all proxies in proxies.list over ssh', action='store_true')
+    parser.add_argument('--bench',help='Benchmark parsing N generated lines', type=int, default=0)
+    args = parser.parse_args()
+
+    if args.bench:
+        benchmark(args.bench)
+        sys.exit(0)
+
+    config = json.load(open(args.conf))
+    settings = config.get('squid_log', {})
+    analyzer = LogAnalyzer(window=int(settings.get('window', 900)), bucket=int(settings.get('bucket', 60)),
+                           max_domains=int(settings.get('max_domains', 1000)),
+                           offsets=settings.get('offsets', 'squid_log.offsets'))
+    for path in args.logs:
+        analyzer.tail_file(args.node, path)
+
+    if args.pull:
+        for line in open(config['proxylist']):
+            ip = line.strip().split(',')[0].strip()
+            if ip:
+                analyzer.pull_remote(ip, config['user'], settings.get('path', '/var/log/squid3/access.log'),
+                                     int(settings.get('max_bytes', 64 << 20)))
+
+    print json.dumps(analyzer.summary(), indent=2)
@@ -0,0 +1,351 @@
+"""
+
+Persistent, multiplexed ssh sessions to the proxy nodes.
+
+SessionManager keeps one OpenSSH ControlMaster connection per host and
+runs commands as extra channels over it, so a batch of commands costs
+one handshake instead of one per command. Every command reports its own
+exit status and output and is killed after its timeout. Masters sitting
+idle longer than the idle timeout are closed by evict_idle(), and by
+ssh itself through ControlPersist should the daemon die.
+
+Settings come from the "ssh" section of proxy.conf. Point "command" at
+fake_ssh.py to run against the local stand-in instead of real hosts.
+
+Run with --bench to compare a batch over one session with one ssh per
+command against the stand-in.
+
+"""
+
+import os
+import sys
+import time
+import shlex
+import argparse
+import tempfile
+import threading
+import subprocess
+
+# Status reported for commands which were killed or never ran
+timeout_status = -1
+
+base_options = ['-o', 'StrictHostKeyChecking=no', '-o', 'UserKnownHostsFile=/dev/null',
+                '-o', 'LogLevel=ERROR']
+
+# Never prompt - fail instead of waiting on a password nobody will type
+batch_options = ['-o', 'BatchMode=yes']
+
+class CommandResult(object):
+    """ Outcome of one remote command """
+
+    __slots__ = ('host', 'command', 'status', 'stdout', 'stderr', 'elapsed', 'timed_out')
+
+    def __init__(self, host, command, status, stdout='', stderr='', elapsed=0.0, timed_out=False):
+        self.host = host
+        self.command = command
+        self.status = status
+        self.stdout = stdout
+        self.stderr = stderr
+        self.elapsed = elapsed
+        self.timed_out = timed_out
+
+    @property
+    def ok(self):
+        return self.status == 0
+
+    def __repr__(self):
+        state = 'timed out' if self.timed_out else 'exit %d' % self.status
+        return '<CommandResult %s %r %s %.3fs>' % (self.host, self.command, state, self.elapsed)
+
+def run_process(args, timeout, detach=False, data=None):
+    """ Run args, killing it after timeout seconds. Returns (status, stdout,
+    stderr, timed_out). With detach the output is not piped, as a process
+    forking into the background (ssh -f) would hold the pipes open. data,
+    if given, is fed to the standard input. """
+
+    if detach:
+        errfile = tempfile.TemporaryFile()
+        proc = subprocess.Popen(args, stdin=open(os.devnull), stdout=open(os.devnull, 'w'), stderr=errfile)
+    else:
+        stdin = open(os.devnull) if data == None else subprocess.PIPE
+        proc = subprocess.Popen(args, stdin=stdin, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    killed = []
+
+    def kill():
+        killed.append(True)
+        try:
+            proc.kill()
+        except OSError:
+            pass
+
+    timer = threading.Timer(timeout, kill) if timeout else None
+    if timer:
+        timer.start()
+    try:
+        if detach:
+            proc.wait()
+            errfile.seek(0)
+            stdout, stderr = '', errfile.read()
+            errfile.close()
+        else:
+            stdout, stderr = proc.communicate(data)
+    finally:
+        if timer:
+            timer.cancel()
+
+    if killed:
+        return timeout_status, stdout, stderr, True
+    return proc.returncode, stdout, stderr, False
+
+class SSHSession(object):
+    """ A ControlMaster connection to one host """
+
+    def __init__(self, host, user, control_path, ssh_cmd=('ssh',), connect_timeout=10,
+                 persist=300, options=(), batch_mode=True):
+        self.host = host
+        self.user = user
+        self.control_path = control_path
+        self.ssh_cmd = list(ssh_cmd)
+        self.connect_timeout = connect_timeout
+        # Seconds ssh keeps an idle master around by itself
+        self.persist = persist
+        self.options = list(options)
+        # Without batch mode ssh may prompt on the terminal, e.g. for a password
+        self.batch_mode = batch_mode
+        self.lock = threading.Lock()
+        self.opened = None
+        self.last_used = time.time()
+        self.commands = 0
+
+    def target(self):
+        return '%s@%s' % (self.user, self.host) if self.user else self.host
+
+    def base_args(self):
+        options = base_options + (batch_options if self.batch_mode else [])
+        return self.ssh_cmd + options + self.options + ['-o', 'ConnectTimeout=%d' % self.connect_timeout,
+                                                        '-S', self.control_path]
+
+    def is_open(self):
+        """ Return whether the master connection is alive """
+
+        if not os.path.exists(self.control_path):
+            return False
+        status = run_process(self.base_args() + ['-O', 'check', self.target()], self.connect_timeout)[0]
+        return status == 0
+
+    def open(self):
+        """ Start the master connection, unless one is up. Returns True if
+        the master is usable. """
+
+        with self.lock:
+            if self.opened and os.path.exists(self.control_path):
+                return True
+            args = self.base_args() + ['-M', '-f', '-N', '-o', 'ControlPersist=%d' % self.persist, self.target()]
+            # Give whoever is at the terminal all the time they need to answer a prompt
+            timeout = self.connect_timeout + 5 if self.batch_mode else None
+            status, stdout, stderr, timed_out = run_process(args, timeout, detach=True)
+            if status != 0:
+                print 'Could not open ssh session to',self.host,stderr.strip() or 'timed out'
+                self.opened = None
+                return False
+            self.opened = time.time()
+            return True
+
+    def run(self, command, timeout=60, data=None):
+        """ Run one command over the session, feeding it data on standard
+        input if given, and return a CommandResult """
+
+        self.last_used = time.time()
+        start = time.time()
+        # Without a master, ssh falls back to a connection of its own
+        args = self.base_args() + ['-o', 'ControlMaster=no', self.target(), command]
+        status, stdout, stderr, timed_out = run_process(args, timeout, data=data)
+        self.commands += 1
+        self.last_used = time.time()
+        return CommandResult(self.host, command, status, stdout, stderr, time.time() - start, timed_out)
+
+    def run_batch(self, commands, timeout=60, stop_on_error=False):
+        """ Run commands in order, returning a CommandResult for each. With
+        stop_on_error, commands after a failure are reported as not run. """
+
+        self.open()
+        results = []
+        for command in commands:
+            if stop_on_error and results and not results[-1].ok:
+                results.append(CommandResult(self.host, command, timeout_status))
+                continue
+            results.append(self.run(command, timeout))
+        return results
+
+    def push(self, local_path, remote_path, timeout=60, mode=None):
+        """ Copy a local file to the host over the session, replacing
+        remote_path atomically. Returns a CommandResult. """
+
+        self.open()
+        command = 'cat > %s.tmp && mv %s.tmp %s' % (remote_path, remote_path, remote_path)
+        if mode != None:
+            command = 'cat > %s.tmp && chmod %o %s.tmp && mv %s.tmp %s' % (remote_path, mode, remote_path,
+                                                                         remote_path, remote_path)
+        return self.run(command, timeout, data=open(local_path, 'rb').read())
+
+    def close(self):
+        """ Stop the master connection """
+
+        with self.lock:
+            if os.path.exists(self.control_path):
+                run_process(self.base_args() + ['-O', 'exit', self.target()], self.connect_timeout)
+            self.opened = None
+
+class SessionManager(object):
+    """ One multiplexed ssh session per host, shared by all callers """
+
+    def __init__(self, user=None, ssh_cmd='ssh', control_dir=None, idle_timeout=300,
+                 connect_timeout=10, command_timeout=120, options=(), batch_mode=True):
+        self.user = user
+        self.ssh_cmd = shlex.split(ssh_cmd) if isinstance(ssh_cmd, basestring) else list(ssh_cmd)
+        # Control sockets need a short path - unix socket paths are limited
+        self.control_dir = control_dir or tempfile.mkdtemp(prefix='ssh-mux')
+        self.idle_timeout = idle_timeout
+        self.connect_timeout = connect_timeout
+        self.command_timeout = command_timeout
+        self.options = list(options)
+        self.batch_mode = batch_mode
+        # Host => SSHSession
+        self.sessions = {}
+        self.lock = threading.Lock()
+        self.opened = 0
+        self.evicted = 0
+
+    @classmethod
+    def from_config(cls, config):
+        """ Create a manager from the "ssh" section of proxy.conf """
+
+        return cls.from_settings(config.ssh or {}, config.user)
+
+    @classmethod
+    def from_settings(cls, settings, user=None):
+        return cls(user=settings.get('user', user),
+                   ssh_cmd=settings.get('command', 'ssh'),
+                   control_dir=settings.get('control_dir'),
+                   idle_timeout=float(settings.get('idle_timeout', 300)),
+                   connect_timeout=int(settings.get('connect_timeout', 10)),
+                   command_timeout=float(settings.get('command_timeout', 120)),
+                   options=settings.get('options', []),
+                   batch_mode=settings.get('batch_mode', True))
+
+    def session(self, host):
+        """ Return the session for host, creating it if needed """
+
+        with self.lock:
+            session = self.sessions.get(host)
+            if session == None:
+                if not os.path.isdir(self.control_dir):
+                    os.makedirs(self.control_dir, 0700)
+                path = os.path.join(self.control_dir, '%s.sock' % host)
+                session = SSHSession(host, self.user, path, self.ssh_cmd, self.connect_timeout,
+                                     persist=int(self.idle_timeout), options=self.options,
+                                     batch_mode=self.batch_mode)
+                self.sessions[host] = session
+                self.opened += 1
+            session.last_used = time.time()
+            return session
+
+    def run(self, host, commands, timeout=None, stop_on_error=False):
+        """ Run a batch of commands on host over its session """
+
+        if isinstance(commands, basestring):
+            commands = [commands]
+        results = self.session(host).run_batch(commands, timeout or self.command_timeout, stop_on_error)
+        for result in results:
+            print result
+            if result.stderr.strip():
+                print '  stderr:',result.stderr.strip()
+        return results
+
+    def evict_idle(self, now=None):
+        """ Close sessions idle for longer than the idle timeout. Returns
+        the hosts evicted. """
+
+        now = now or time.time()
+        with self.lock:
+            idle = [(host, s) for host, s in self.sessions.items() if now - s.last_used > self.idle_timeout]
+            for host, session in idle:
+                del self.sessions[host]
+        for host, session in idle:
+            session.close()
+            self.evicted += 1
+        return [host for host, session in idle]
+
+    def close(self, host):
+        """ Close the session to host, e.g. when the node is destroyed """
+
+        with self.lock:
+            session = self.sessions.pop(host, None)
+        if session:
+            session.close()
+
+    def close_all(self):
+        with self.lock:
+            sessions, self.sessions = self.sessions.values(), {}
+        for session in sessions:
+            session.close()
+
+    def stats(self):
+        return {'sessions': len(self.sessions), 'opened': self.opened, 'evicted': self.evicted}
+
+def benchmark(hosts, commands, handshake):
+    """ Compare one ssh per command with one session per host on fake_ssh """
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    os.environ['FAKE_SSH_HANDSHAKE'] = str(handshake)
+    os.environ['FAKE_SSH_DRYRUN'] = '1'
+    fake = [sys.executable, os.path.join(here, 'fake_ssh.py')]
+    batch = ['sudo iptables-restore < /etc/iptables.rules', 'sudo squid3 -f /etc/squid3/squid.conf']
+    batch = (batch * commands)[:commands]
+    ips = ['10.0.0.%d' % (i + 1) for i in range(hosts)]
+
+    start = time.time()
+    for ip in ips:
+        for command in batch:
+            run_process(fake + base_options + batch_options + ['ubuntu@' + ip, command], 30)
+    forked = time.time() - start
+
+    manager = SessionManager(user='ubuntu', ssh_cmd=fake)
+    start = time.time()
+    for ip in ips:
+        results = manager.session(ip).run_batch(batch)
+        assert all(r.ok for r in results), results
+    first = time.time() - start
+    # A second post-process of the same hosts reuses the sessions
+    start = time.time()
+    for ip in ips:
+        manager.session(ip).run_batch(batch)
+    reused = time.time() - start
+    manager.close_all()
+    os.rmdir(manager.control_dir)
+
+    print 'Hosts: %d, commands per host: %d, handshake %.2fs' % (hosts, commands, handshake)
+    print 'One ssh per command:          %7.3fs' % forked
+    print 'Session, opening the master:  %7.3fs' % first
+    print 'Session, reused:              %7.3fs' % reused
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog='ssh_session')
+    parser.add_argument('--bench',help='Benchmark against fake_ssh with N hosts', type=int, default=0)
+    parser.add_argument('-c','--commands',help='Commands per host in the benchmark', type=int, default=2)
+    parser.add_argument('--handshake',help='Simulated handshake time in seconds', type=float, default=0.3)
+    parser.add_argument('-u','--user',help='Remote user', default='ubuntu')
+    parser.add_argument('host', nargs='?', help='Host to run commands on')
+    parser.add_argument('command', nargs='*', help='Commands to run in one session')
+    args = parser.parse_args()
+
+    if args.bench:
+        benchmark(args.bench, args.commands, args.handshake)
+        sys.exit(0)
+
+    if not args.host:
+        parser.error('A host is required')
+    manager = SessionManager(user=args.user)
+    results = manager.run(args.host, args.command)
+    manager.close_all()
+    sys.exit(max([abs(r.status) for r in results] or [0]))
@@ -0,0 +1,264 @@
+"""
+
+Warm standby pool of pre-provisioned proxy linodes.
+
+Spare nodes are created, post-processed and health-checked in the
+background per region so that a rotation only has to pop a ready node
+and swap it into the load balancer.
+
+Spare nodes are billed linodes, so the pool ships disabled. Settings
+come from the "standby" section of proxy.conf: set `size` to the number
+of spares to keep, optionally spread over regions with `regions`
+({region id: count}). Spares older than `max_idle_age` hours are
+replaced, and the pool is topped up every `refill_interval` seconds.
+
+"""
+
+import os
+import time
+import json
+import threading
+import collections
+
+from health_probe import HealthProber
+
+class StandbyNode(object):
+    """ A spare linode waiting in the pool """
+
+    def __init__(self, ip, linode_id, region, created=None):
+        self.ip = ip
+        self.linode_id = int(linode_id)
+        self.region = int(region)
+        self.created = created or int(time.time())
+
+    def age(self, now=None):
+        """ Return seconds since this node was created """
+
+        return (now or time.time()) - self.created
+
+    def to_dict(self):
+        return {'ip': self.ip, 'linode_id': self.linode_id,
+                'region': self.region, 'created': self.created}
+
+    def __repr__(self):
+        return '<StandbyNode %s id=%d region=%d>' % (self.ip, self.linode_id, self.region)
+
+class StandbyPool(object):
+    """ Per-region pool of ready spare linodes, refilled in the background """
+
+    def __init__(self, rotator, size=2, targets=None, max_idle_age=24*3600.0,
+                 refill_interval=600.0, state_file='standby.list', prober=None):
+        self.rotator = rotator
+        self.size = size
+        self.targets = self.make_targets(size, targets, rotator.config.region_ids)
+        self.max_idle_age = max_idle_age
+        self.refill_interval = refill_interval
+        self.state_file = state_file
+        self.prober = prober or HealthProber(concurrency=1, timeout=5)
+        # Region => deque of StandbyNode, oldest first
+        self.nodes = collections.defaultdict(collections.deque)
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.thread = None
+        self.running = False
+        self.hits = 0
+        self.misses = 0
+        self.load()
+
+    @classmethod
+    def from_config(cls, rotator, config):
+        """ Create a pool from the "standby" section of proxy.conf, returns None
+        if the pool is disabled """
+
+        settings = config.standby or {}
+        size = int(settings.get('size', 0))
+        if size <= 0:
+            return None
+
+        targets = dict((int(k), int(v)) for k,v in settings.get('regions', {}).items())
+        return cls(rotator, size=size, targets=targets,
+                   max_idle_age=float(settings.get('max_idle_age', 24))*3600.0,
+                   refill_interval=float(settings.get('refill_interval', 600)),
+                   state_file=settings.get('state_file', 'standby.list'))
+
+    def make_targets(self, size, targets, region_ids):
+        """ Return the region => count targets. Without explicit per-region
+        targets the pool size is spread round-robin over region_ids """
+
+        if targets:
+            return targets
+
+        targets = collections.defaultdict(int)
+        for i in range(size):
+            targets[region_ids[i % len(region_ids)]] += 1
+        return dict(targets)
+
+    def load(self):
+        """ Load pooled nodes persisted by a previous run """
+
+        if not os.path.isfile(self.state_file):
+            return
+
+        try:
+            for item in json.load(open(self.state_file)):
+                node = StandbyNode(item['ip'], item['linode_id'], item['region'], item['created'])
+                self.nodes[node.region].append(node)
+        except (IOError, OSError, ValueError, KeyError), e:
+            print 'Error loading standby pool state',e
+
+        print 'Loaded',self.count(),'standby nodes.'
+
+    def save(self):
+        """ Persist the pooled nodes so they are not leaked across restarts """
+
+        with self.lock:
+            items = [node.to_dict() for nodes in self.nodes.values() for node in nodes]
+
+        tmpfile = self.state_file + '.tmp'
+        json.dump(items, open(tmpfile, 'w'))
+        os.rename(tmpfile, self.state_file)
+
+    def count(self, region=None):
+        """ Return number of ready nodes, in total or in a region """
+
+        with self.lock:
+            if region != None:
+                return len(self.nodes.get(region, ()))
+            return sum(map(len, self.nodes.values()))
+
+    def ready_regions(self):
+        """ Return regions which have at least one ready node """
+
+        with self.lock:
+            return [reg for reg, nodes in self.nodes.items() if len(nodes)]
+
+    def linode_ids(self):
+        """ Return the linode ids of all ready nodes """
+
+        with self.lock:
+            return set(node.linode_id for nodes in self.nodes.values() for node in nodes)
+
+    def healthy(self, node):
+        """ Return whether squid on the node is accepting connections """
+
+        return self.prober.probe(('standby', node.ip, 8321)).ok
+
+    def pop(self, region):
+        """ Pop a ready, healthy node from region. Returns None on a miss """
+
+        while True:
+            with self.lock:
+                nodes = self.nodes.get(region)
+                node = nodes.popleft() if nodes else None
+
+            if node == None:
+                self.misses += 1
+                print 'Standby pool miss for region',region
+                break
+
+            if self.healthy(node):
+                self.hits += 1
+                print 'Standby pool hit for region',region,'=>',node
+                break
+
+            print 'Standby node',node,'failed health check, discarding.'
+            self.destroy(node)
+
+        self.save()
+        # Refill in the background
+        self.wakeup.set()
+        return node
+
+    def destroy(self, node):
+        """ Delete the linode of a discarded pool node """
+
+        try:
+            self.rotator.linode_cmd.linode_delete(node.linode_id)
+        except Exception, e:
+            print 'Error deleting standby linode',node.linode_id,e
+        self.rotator.ssh.close(node.ip)
+
+    def expire(self):
+        """ Delete nodes which have been idle for longer than max_idle_age """
+
+        now, expired = time.time(), []
+        with self.lock:
+            for region, nodes in self.nodes.items():
+                for node in list(nodes):
+                    if node.age(now) > self.max_idle_age:
+                        nodes.remove(node)
+                        expired.append(node)
+
+        for node in expired:
+            print 'Standby node',node,'exceeded max idle age, deleting.'
+            self.destroy(node)
+
+        return len(expired)
+
+    def refill(self):
+        """ Create nodes for every region below its target """
+
+        changed = self.expire()
+        for region, target in self.targets.items():
+            while self.running and self.count(region) < target:
+                try:
+                    ip, linode_id = self.rotator.make_new_linode(region)
+                except Exception, e:
+                    print 'Error creating standby linode in region',region,e
+                    break
+
+                node = StandbyNode(ip, linode_id, region)
+                if not self.healthy(node):
+                    print 'New standby node',node,'failed health check, discarding.'
+                    self.destroy(node)
+                    break
+
+                with self.lock:
+                    self.nodes[region].append(node)
+                print 'Added standby node',node
+                changed += 1
+                self.save()
+
+        if changed:
+            self.save()
+
+    def loop(self):
+        """ Background refill loop """
+
+        while self.running:
+            self.refill()
+            self.wakeup.wait(self.refill_interval)
+            self.wakeup.clear()
+
+    def start(self):
+        """ Start the background refill thread """
+
+        self.running = True
+        self.thread = threading.Thread(target=self.loop, name='standby-refill')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """ Stop the background refill thread """
+
+        self.running = False
+        self.wakeup.set()
+
+    def clear(self):
+        """ Delete every pooled node """
+
+        with self.lock:
+            nodes = [node for nodes in self.nodes.values() for node in nodes]
+            self.nodes.clear()
+
+        for node in nodes:
+            print '\tDropping standby linode',node.linode_id,'with IP',node.ip,'...'
+            self.destroy(node)
+        self.save()
+
+    def stats(self):
+        """ Return pool hit/miss counts and ready nodes per region """
+
+        with self.lock:
+            ready = dict((reg, len(nodes)) for reg, nodes in self.nodes.items())
+        return {'hits': self.hits, 'misses': self.misses, 'ready': ready}
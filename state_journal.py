@@ -0,0 +1,314 @@
+"""
+
+Crash-safe store for the proxy state.
+
+Switch-in and switch-out events, and the start and end of the drain of
+every switched out proxy, are appended to a journal, fsynced in
+batches, and periodically compacted into a snapshot written with an
+atomic rename. At startup the snapshot and the journal are replayed into
+a ProxyIndex. Events are idempotent, so replaying a journal which was
+already compacted (a crash between the rename and the truncate) gives
+the same state. Compaction keeps only the `keep_inactive` most recently
+switched out inactive records, so the snapshot does not grow forever.
+Tools reading the state next to the running daemon open it read-only,
+which never writes or truncates the files. Drains still in progress are
+kept in the snapshot, so that a restarted daemon can resume them. The
+legacy proxies.list CSV can still be exported for fabfile.py consumers.
+
+Run with --bench to time appends, replay and compaction at 100k events.
+
+"""
+
+import os
+import time
+import random
+import argparse
+import tempfile
+
+from proxy_index import ProxyIndex
+
+def atomic_write(path, lines):
+    """ Write lines to path through a fsynced temp file and a rename """
+
+    dirname = os.path.dirname(os.path.abspath(path))
+    fd, tmpfile = tempfile.mkstemp(dir=dirname, prefix='.' + os.path.basename(path))
+    try:
+        f = os.fdopen(fd, 'w')
+        f.writelines(lines)
+        f.flush()
+        os.fsync(f.fileno())
+        f.close()
+        os.rename(tmpfile, path)
+    except:
+        os.unlink(tmpfile)
+        raise
+
+    # Make the rename itself durable
+    dirfd = os.open(dirname, os.O_RDONLY)
+    try:
+        os.fsync(dirfd)
+    finally:
+        os.close(dirfd)
+
+class StateJournal(object):
+    """ Append-only journal of proxy switch events plus a snapshot """
+
+    def __init__(self, path='proxies.journal', snapshot='proxies.snapshot',
+                 sync_every=16, sync_interval=1.0, compact_every=1000, keep_inactive=1000, read_only=False):
+        self.path = path
+        self.snapshot = snapshot
+        self.keep_inactive = keep_inactive
+        self.read_only = read_only
+        # fsync after this many appends or seconds, whichever comes first
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self.compact_every = compact_every
+        self.f = None
+        self.unsynced = 0
+        self.last_sync = time.time()
+        # Events in the journal since the last compaction
+        self.events = 0
+        # Proxy => (server, linode id, deadline, label, new id) of the
+        # drains in progress
+        self.drains = {}
+
+    @classmethod
+    def from_config(cls, config, read_only=False):
+        """ Create a journal from the "state" section of proxy.conf """
+
+        settings = config.state or {}
+        return cls(path=settings.get('journal', 'proxies.journal'),
+                   snapshot=settings.get('snapshot', 'proxies.snapshot'),
+                   sync_every=int(settings.get('sync_every', 16)),
+                   sync_interval=float(settings.get('sync_interval', 1.0)),
+                   compact_every=int(settings.get('compact_every', 1000)),
+                   keep_inactive=int(settings.get('keep_inactive', 1000)),
+                   read_only=read_only)
+
+    def exists(self):
+        """ Return whether there is any saved state """
+
+        return os.path.isfile(self.snapshot) or os.path.isfile(self.path)
+
+    def replay(self, index):
+        """ Load the snapshot and replay the journal into index. Returns the
+        number of records and events read. """
+
+        records = events = 0
+        if os.path.isfile(self.snapshot):
+            for line in open(self.snapshot):
+                fields = line.split(',')
+                if fields[0] == 'D' and len(fields) == 7 and line.endswith('\n'):
+                    self.load_drain(fields[1:])
+                    continue
+                if len(fields) != 6 or not line.endswith('\n'):
+                    print 'Skipping bad snapshot line',repr(line)
+                    continue
+                ip, region, pid, si, so, active = fields
+                index.add(ip, int(region), int(pid), int(si), int(so), active.strip() == '1')
+                records += 1
+
+        if os.path.isfile(self.path):
+            offset = 0
+            for line in open(self.path):
+                # A line without a newline was cut short by a crash - cut
+                # it off so that new records start on a fresh line
+                if not line.endswith('\n'):
+                    # Read-only, it may still be being written by the daemon
+                    if self.read_only:
+                        print 'Ignoring incomplete journal record',repr(line)
+                        break
+                    print 'Dropping truncated journal record',repr(line)
+                    f = open(self.path, 'r+')
+                    f.truncate(offset)
+                    f.close()
+                    break
+                offset += len(line)
+                fields = line.split() or ['']
+                if fields[0] == 'I' and len(fields) == 6:
+                    index.add(fields[1], int(fields[2]), int(fields[3]), int(fields[4]), int(fields[5]))
+                elif fields[0] == 'O' and len(fields) == 3:
+                    record = index.get(fields[1])
+                    if record != None:
+                        index.deactivate(record)
+                        record.switch_out = int(fields[2])
+                elif fields[0] == 'D' and len(fields) == 7:
+                    self.load_drain(fields[1:])
+                elif fields[0] == 'E' and len(fields) == 2:
+                    self.drains.pop(fields[1], None)
+                else:
+                    print 'Skipping bad journal record',repr(line)
+                    continue
+                events += 1
+
+        self.events = events
+        return records, events
+
+    def load_drain(self, fields):
+        ip, server, linode_id, deadline, label, new_id = [field.strip() for field in fields]
+        self.drains[ip] = (server, int(linode_id), int(deadline), None if label == '-' else label,
+                           None if new_id == '-' else int(new_id))
+
+    def format_drain(self, ip, sep=' '):
+        server, linode_id, deadline, label, new_id = self.drains[ip]
+        return sep.join(('D', ip, server, str(linode_id), str(deadline), label or '-',
+                         '-' if new_id == None else str(new_id))) + '\n'
+
+    def check_writable(self):
+        if self.read_only:
+            raise IOError('State journal %s is open read-only' % self.path)
+
+    def append(self, line):
+        self.check_writable()
+        if self.f == None:
+            self.f = open(self.path, 'a')
+        self.f.write(line)
+        self.events += 1
+        self.unsynced += 1
+        if self.unsynced >= self.sync_every or time.time() - self.last_sync >= self.sync_interval:
+            self.sync()
+
+    def switch_in(self, ip, region, proxy_id, switch_in, switch_out):
+        """ Record a proxy being switched in """
+
+        self.append('I %s %d %d %d %d\n' % (ip, region, proxy_id, switch_in, switch_out))
+
+    def switch_out(self, ip, timestamp):
+        """ Record a proxy being switched out """
+
+        self.append('O %s %d\n' % (ip, timestamp))
+
+    def drain_start(self, ip, server, linode_id, deadline, label=None, new_id=None):
+        """ Record a switched out proxy starting to drain. label and new_id
+        are passed on to its replacement once it has drained. """
+
+        self.check_writable()
+        self.drains[ip] = (server, int(linode_id), int(deadline), label, new_id)
+        self.append(self.format_drain(ip))
+
+    def drain_end(self, ip):
+        """ Record the drain of a proxy as done """
+
+        if self.drains.pop(ip, None) != None:
+            self.append('E %s\n' % ip)
+
+    def sync(self):
+        """ Flush and fsync pending journal records """
+
+        if self.f != None and self.unsynced:
+            self.f.flush()
+            os.fsync(self.f.fileno())
+        self.unsynced = 0
+        self.last_sync = time.time()
+
+    def needs_compaction(self):
+        return self.events >= self.compact_every
+
+    def compact(self, index):
+        """ Write a snapshot of index and start a fresh journal, dropping
+        the oldest inactive records beyond keep_inactive """
+
+        self.check_writable()
+        pruned = index.prune(self.keep_inactive)
+        if pruned:
+            print 'Pruned',pruned,'inactive proxy records from the state'
+        self.sync()
+        atomic_write(self.snapshot, ['%s,%d,%d,%d,%d,%d\n' % (r.ip, r.region, r.linode_id, r.switch_in,
+                                                               r.switch_out, r.active)
+                                     for r in index.records.values()] +
+                                    [self.format_drain(ip, ',') for ip in sorted(self.drains)])
+        # The snapshot covers everything journalled so far
+        if self.f != None:
+            self.f.close()
+        self.f = open(self.path, 'w')
+        os.fsync(self.f.fileno())
+        self.events = 0
+
+    def reset(self):
+        """ Drop all saved state, so that the next start imports proxies.list """
+
+        self.check_writable()
+        self.close()
+        for path in (self.path, self.snapshot):
+            if os.path.isfile(path):
+                os.remove(path)
+        self.events = 0
+        self.drains = {}
+
+    def close(self):
+        if self.f != None:
+            self.sync()
+            self.f.close()
+            self.f = None
+
+def export_csv(index, path, disabled=False):
+    """ Atomically write the legacy proxies.list format """
+
+    atomic_write(path, ['%s,%d,%d,%d,%d\n' % (r.ip, r.region, r.linode_id, r.switch_in, r.switch_out)
+                        for r in index.records.values() if disabled or r.active])
+
+def benchmark(events, proxies=1000, sync_every=16):
+    """ Time appends, replay and compaction of a journal of events """
+
+    dirname = tempfile.mkdtemp(prefix='journal-bench')
+    journal = StateJournal(os.path.join(dirname, 'j'), os.path.join(dirname, 's'),
+                           sync_every=sync_every, sync_interval=1.0, compact_every=events + 1,
+                           keep_inactive=events)
+    index = ProxyIndex()
+    now = int(time.time())
+
+    start = time.time()
+    for i in range(proxies):
+        index.add('10.0.%d.%d' % (i // 256, i % 256), random.randrange(2, 11), i, now, now)
+        journal.switch_in('10.0.%d.%d' % (i // 256, i % 256), 3, i, now, now)
+    for i in range(events - proxies):
+        # A rotation is a switch out followed by a switch in
+        if i % 2:
+            record = index.lru()
+            index.deactivate(record)
+            journal.switch_out(record.ip, now + i)
+        else:
+            ip = '10.%d.%d.%d' % (1 + i // 65536, i // 256 % 256, i % 256)
+            index.add(ip, 3, i, now + i, now + i)
+            journal.switch_in(ip, 3, i, now + i, now + i)
+    journal.sync()
+    append = time.time() - start
+
+    start = time.time()
+    replayed = ProxyIndex()
+    records, count = journal.replay(replayed)
+    replay = time.time() - start
+
+    start = time.time()
+    journal.compact(replayed)
+    compact = time.time() - start
+
+    start = time.time()
+    StateJournal(journal.path, journal.snapshot).replay(ProxyIndex())
+    load = time.time() - start
+
+    # The legacy store rewrites the whole file after every switch
+    start = time.time()
+    for i in range(20):
+        export_csv(replayed, os.path.join(dirname, 'proxies.list'), disabled=True)
+    rewrite = (time.time() - start) / 20
+
+    print 'Events: %d, records after replay: %d' % (count, len(replayed))
+    print 'Append (fsync every %d):  %8.3fs  (%.1f us/event)' % (sync_every, append, append * 1e6 / events)
+    print 'Replay journal:            %8.3fs' % replay
+    print 'Compact to snapshot:       %8.3fs' % compact
+    print 'Load snapshot:             %8.3fs' % load
+    print 'Legacy full rewrite:       %8.3fs per switch' % rewrite
+
+    journal.reset()
+    for name in os.listdir(dirname):
+        os.remove(os.path.join(dirname, name))
+    os.rmdir(dirname)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog='state_journal')
+    parser.add_argument('--bench',help='Benchmark with the given number of events', type=int, default=100000)
+    parser.add_argument('--sync-every',help='fsync batch size in the benchmark', type=int, default=16)
+    args = parser.parse_args()
+
+    benchmark(args.bench, sync_every=args.sync_every)
@@ -0,0 +1,65 @@
+""" Tests for watching the new fleet of a blue/green replacement """
+
+import os
+import sys
+import unittest
+
+from bluegreen import BlueGreen
+from clock import VirtualClock
+from health_probe import HealthProber
+
+class Stub(object):
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+class FakePoller(object):
+    """ Returns the given rounds of samples, None for an unreadable LB """
+
+    def __init__(self, rounds):
+        self.rounds = list(rounds)
+        self.polls = 0
+
+    def poll(self, now=None):
+        self.polls += 1
+        return self.rounds.pop(0) if self.rounds else None
+
+def sample(status, stot, ts):
+    return Stub(status=status, stot=stot, ts=ts)
+
+class BlueGreenWatchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+
+    def tearDown(self):
+        sys.stdout.close()
+        sys.stdout = self.stdout
+
+    def bluegreen(self, rounds, watch=30.0, fall=2):
+        clock = VirtualClock(1000)
+        prober = HealthProber(url=None)
+        rotator = Stub(config=Stub(lb_admin=None, probe={}), clock=clock,
+                       readiness=Stub(prober=prober, port=8321))
+        self.poller = FakePoller(rounds)
+        return BlueGreen(rotator, 2, watch=watch, interval=10.0, fall=fall, poller=self.poller, prober=prober)
+
+    def test_unreadable_lb_rolls_back(self):
+        # Used to poll forever, skipping the deadline check
+        bg = self.bluegreen([{}])
+        reason = bg.watch_green({'squid1': '10.0.0.1'}, 100.0)
+        self.assertEqual(reason, 'LB stats unreadable')
+        self.assertEqual(self.poller.polls, 3)
+
+    def test_unreadable_polls_count_toward_fall(self):
+        up = {'squid1': sample('UP', 100, 1000)}
+        bg = self.bluegreen([up, None, up, None, up, {'squid1': sample('UP', 3100, 1030)}], watch=50.0)
+        self.assertEqual(bg.watch_green({'squid1': '10.0.0.1'}, 100.0), None)
+        self.assertEqual(bg.log, [('throughput', '100.0 req/s, baseline 100.0 req/s')])
+
+    def test_unhealthy_fleet_rolls_back(self):
+        down = {'squid1': sample('DOWN', 0, 1000)}
+        bg = self.bluegreen([down, down, down])
+        self.assertEqual(bg.watch_green({'squid1': '10.0.0.1'}, 100.0), 'only 0% of the new fleet healthy')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,117 @@
+""" Tests for draining on a virtual clock and drains surviving a restart """
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import unittest
+
+from clock import VirtualClock
+from drain import Drainer
+from fake_haproxy import FakeHAProxyState
+from haproxy_admin import HAProxyAdmin
+from rotate_proxies import ProxyConfig
+from simulator import make_config
+from state_journal import StateJournal
+from proxy_index import ProxyIndex
+
+class LocalAdmin(HAProxyAdmin):
+    """ Admin socket client running commands on the fake LB in process """
+
+    def __init__(self, state):
+        HAProxyAdmin.__init__(self, 'local', state.backend)
+        self.state = state
+
+    def command(self, *commands):
+        return ''.join(self.state.run(command) for command in commands)
+
+class DrainTest(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix='draintest')
+        self.stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+
+    def tearDown(self):
+        sys.stdout.close()
+        sys.stdout = self.stdout
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def test_drains_on_the_virtual_clock(self):
+        lb = FakeHAProxyState()
+        lb.add_server('squid1', '10.0.0.1', admin='drain').scur = 3
+        lb.add_server('squid2', '10.0.0.2', admin='drain').scur = 2
+        clock = VirtualClock(1000)
+        released = []
+        drainer = Drainer(LocalAdmin(lb), released.append, deadline=300, interval=5, clock=clock)
+        drainer.inline = True
+
+        drainer.add('10.0.0.1', 'squid1', 101)
+        drainer.add('10.0.0.2', 'squid2', 102, deadline=1100)
+        # Inline, no thread is started
+        self.assertEqual(drainer.thread, None)
+        self.assertEqual(drainer.check(), [])
+        self.assertEqual(drainer.next_check(), 1005)
+
+        clock.advance(60)
+        lb.servers['squid1'].scur = 0
+        self.assertEqual([d.proxy for d in drainer.check()], ['10.0.0.1'])
+        clock.advance(40)
+        self.assertEqual([d.proxy for d in drainer.check()], ['10.0.0.2'])
+
+        self.assertEqual([(d.outcome, d.duration(), d.forced) for d in released],
+                         [('drained', 60, 0), ('deadline', 100, 2)])
+        self.assertEqual(lb.servers['squid2'].admin, 'maint')
+        self.assertEqual(drainer.next_check(), None)
+
+    def test_journal_keeps_drains(self):
+        journal = StateJournal(os.path.join(self.workdir, 'j'), os.path.join(self.workdir, 's'))
+        journal.drain_start('10.0.0.1', 'squid3', 101, 1000, 'ynode1', 201)
+        journal.drain_start('10.0.0.2', 'squid4', 102, 1000)
+        journal.drain_start('10.0.0.3', 'squid5', 103, 1000)
+        journal.drain_end('10.0.0.3')
+        journal.sync()
+
+        replayed = StateJournal(journal.path, journal.snapshot, read_only=True)
+        replayed.replay(ProxyIndex())
+        self.assertEqual(replayed.drains, {'10.0.0.1': ('squid3', 101, 1000, 'ynode1', 201),
+                                           '10.0.0.2': ('squid4', 102, 1000, None, None)})
+
+        # Compaction moves the drains in progress to the snapshot
+        journal.compact(ProxyIndex())
+        self.assertEqual(os.path.getsize(journal.path), 0)
+        replayed = StateJournal(journal.path, journal.snapshot, read_only=True)
+        replayed.replay(ProxyIndex())
+        self.assertEqual(sorted(replayed.drains), ['10.0.0.1', '10.0.0.2'])
+        journal.close()
+
+    def test_drain_resumed_after_restart(self):
+        path, settings = make_config(self.workdir, 'ROTATION_LRU', 3, 72.0, 0, 1, 300)
+        now = int(time.time())
+        open(settings['proxylist'], 'w').write(''.join('10.0.0.%d,3,%d,%d,%d\n' % (i, 100 + i, now, now)
+                                                       for i in (1, 2, 3)))
+        config = ProxyConfig(path)
+        proxy = '10.0.0.2'
+        server = config.slot_name(proxy)
+        config.claim_proxy(proxy)
+        config.draining[proxy] = server
+        config.start_drain(proxy, 102, now + 300, 'ynode2', 104)
+        config.journal.close()
+        # The deployed LB config lists the draining slot as disabled
+        open(settings['lb_config'], 'w').write(''.join(
+            '\tserver  squid%d %s:8321 check\n' % (idx + 1, ip) if ip != None and config.is_active(ip) else
+            '\tserver  squid%d 127.0.0.1:8321 disabled check\n' % (idx + 1) for idx, ip in enumerate(config.slots)))
+
+        restarted = ProxyConfig(path)
+        # The drain keeps its slot, which no new proxy can take
+        self.assertEqual(restarted.draining, {proxy: server})
+        self.assertEqual(restarted.slot_name(proxy), server)
+        self.assertEqual(restarted.journal.drains[proxy], (server, 102, now + 300, 'ynode2', 104))
+        restarted.finish_drain(proxy)
+        self.assertNotIn(proxy, restarted.slot_of)
+        restarted.journal.close()
+
+        self.assertEqual(ProxyConfig(path, read_only=True).draining, {})
+
+if __name__ == '__main__':
+    unittest.main()
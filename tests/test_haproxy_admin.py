@@ -0,0 +1,65 @@
+""" Tests for the HAProxy admin socket client, against the fake socket """
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from fake_haproxy import FakeHAProxy
+from haproxy_admin import HAProxyAdmin, HAProxyAdminError
+
+class HAProxyAdminTest(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix='admintest')
+        self.socket_path = os.path.join(self.workdir, 'admin.sock')
+        self.lb = FakeHAProxy(self.socket_path).start()
+        self.lb.state.add_server('squid1', '10.0.0.1')
+        self.lb.state.add_server('squid2', '127.0.0.1', admin='maint')
+        self.admin = HAProxyAdmin(self.socket_path, self.lb.state.backend)
+
+    def tearDown(self):
+        self.lb.stop()
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def test_set_server_addr(self):
+        self.admin.set_server_addr('squid2', '10.0.0.2', 3128)
+        server = self.lb.state.servers['squid2']
+        self.assertEqual((server.addr, server.port), ('10.0.0.2', 3128))
+        # Setting the same address again is not an error
+        self.admin.set_server_addr('squid2', '10.0.0.2', 3128)
+        self.assertEqual(self.lb.state.history[-1], 'set server %s/squid2 addr 10.0.0.2 port 3128'
+                         % self.lb.state.backend)
+
+    def test_state_transitions(self):
+        states = lambda: dict((name, flags) for name, (addr, flags) in self.admin.show_servers_state().items())
+        self.assertEqual(states(), {'squid1': 0, 'squid2': 0x01})
+
+        self.admin.set_server_state('squid1', 'drain')
+        self.assertEqual(states()['squid1'], 0x08)
+        self.admin.set_server_state('squid1', 'maint')
+        self.assertEqual(states()['squid1'], 0x01)
+        self.admin.set_server_state('squid1', 'ready')
+        self.assertEqual(states()['squid1'], 0)
+
+        # Repoint and enable a slot over one connection
+        self.admin.execute(self.admin.server_addr_cmd('squid2', '10.0.0.2'),
+                           self.admin.server_state_cmd('squid2', 'ready'))
+        self.assertEqual(self.admin.show_servers_state(), {'squid1': ('10.0.0.1', 0),
+                                                           'squid2': ('10.0.0.2', 0)})
+
+    def test_errors(self):
+        self.assertRaises(HAProxyAdminError, self.admin.set_server_state, 'squid9', 'ready')
+        self.assertRaises(HAProxyAdminError, self.admin.set_server_addr, 'squid9', '10.0.0.9')
+        # Wrong backend
+        other = HAProxyAdmin(self.socket_path, 'otherbackend')
+        self.assertRaises(HAProxyAdminError, other.set_server_state, 'squid1', 'drain')
+        # A reply that is not one of the known informational messages
+        self.assertRaises(HAProxyAdminError, self.admin.execute, 'set server bogus')
+        self.assertEqual(self.lb.state.servers['squid1'].admin, 'ready')
+        # No socket at all
+        missing = HAProxyAdmin(os.path.join(self.workdir, 'missing.sock'))
+        self.assertRaises(HAProxyAdminError, missing.command, 'show stat')
+
+if __name__ == '__main__':
+    unittest.main()
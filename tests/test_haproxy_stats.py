@@ -0,0 +1,91 @@
+""" Tests for the LB stats poller, replaying recorded `show stat` output """
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import unittest
+
+import haproxy_stats
+from fake_haproxy import FakeHAProxy
+from haproxy_admin import HAProxyAdmin
+from haproxy_stats import StatsPoller
+
+class StatsPollerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix='statstest')
+        self.lb = FakeHAProxy(os.path.join(self.workdir, 'admin.sock')).start()
+        self.admin = HAProxyAdmin(self.lb.socket_path, self.lb.state.backend)
+        self.recording = os.path.join(self.workdir, 'stats.rec')
+        self.stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+
+        # Record five rounds in the --record format, a busy and an idle server
+        busy = self.lb.state.add_server('squid1', '10.0.0.1')
+        idle = self.lb.state.add_server('squid2', '10.0.0.2', admin='drain')
+        idle.stot = 7
+        for scur, stot, rtime in ((4, 100, 20), (8, 200, 40), (2, 250, 0), (6, 250, 10), (0, 300, 30)):
+            busy.scur, busy.stot, busy.rtime = scur, stot, rtime
+            haproxy_stats.record(self.admin, self.recording, 1, 0)
+        # Anything served from now on comes from the recording
+        busy.scur = idle.scur = 99
+        self.lb.state.load_recording(self.recording)
+
+    def tearDown(self):
+        sys.stdout.close()
+        sys.stdout = self.stdout
+        self.lb.stop()
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def test_replay(self):
+        self.assertEqual(len(self.lb.state.recording), 5)
+        poller = StatsPoller(self.admin, history=3, alpha=0.5)
+
+        samples = poller.poll(now=1000)
+        self.assertEqual(sorted(samples), ['squid1', 'squid2'])
+        first = samples['squid1']
+        self.assertEqual((first.ts, first.status, first.scur, first.stot, first.rtime), (1000, 'UP', 4, 100, 20))
+        self.assertEqual((samples['squid2'].status, samples['squid2'].stot), ('DRAIN', 7))
+        # The first sample is taken as is, there is no rate yet
+        self.assertEqual(poller.smoothed('squid1'), {'scur': 4, 'qcur': 0, 'rtime': 20})
+
+        poller.poll(now=1010)
+        smoothed = poller.smoothed('squid1')
+        self.assertEqual((smoothed['scur'], smoothed['rtime'], smoothed['stot_rate']), (6.0, 30.0, 10.0))
+        poller.poll(now=1020)
+        smoothed = poller.smoothed('squid1')
+        self.assertEqual((smoothed['scur'], smoothed['rtime'], smoothed['stot_rate']), (4.0, 15.0, 7.5))
+        # The idle server's unchanged line parses to the same values
+        self.assertEqual(poller.smoothed('squid2')['stot_rate'], 0)
+
+        poller.poll(now=1030)
+        poller.poll(now=1040)
+        self.assertEqual(poller.polls, 5)
+        # The ring buffer keeps the last three rounds
+        self.assertEqual([s.ts for s in poller.samples('squid1')], [1020, 1030, 1040])
+        self.assertEqual([s.stot for s in poller.samples('squid1')], [250, 250, 300])
+        self.assertEqual(poller.current('squid1').scur, 0)
+
+        poller.forget('squid1')
+        self.assertEqual(poller.samples('squid1'), [])
+        self.assertEqual(poller.current('squid1'), None)
+
+    def test_survives_unparsable_output(self):
+        # Garble every other snapshot
+        good = self.lb.state.recording
+        self.lb.state.recording = [good[0], 'garbage\n', good[1], '\n']
+        poller = StatsPoller(self.admin, interval=0.01)
+        poller.start()
+        deadline = time.time() + 10
+        while (poller.polls < 3 or poller.errors < 2) and time.time() < deadline:
+            time.sleep(0.01)
+        poller.stop()
+
+        self.assertGreaterEqual(poller.polls, 3)
+        self.assertGreaterEqual(poller.errors, 2)
+        self.assertEqual(poller.current('squid1').status, 'UP')
+        self.assertIn(poller.current('squid1').scur, (4, 8))
+
+if __name__ == '__main__':
+    unittest.main()
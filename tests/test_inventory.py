@@ -0,0 +1,132 @@
+""" Tests for the linode inventory cache, against the fake API server """
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+from clock import VirtualClock
+from inventory import Inventory
+from linode_api import LinodeAPI
+from fake_linode_api import FakeLinodeServer
+
+class InventoryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix='invtest')
+        self.server = FakeLinodeServer().start()
+        self.state = self.server.state
+        self.ids = [self.state.add('ynode%d' % (i + 1), 3, 'ynodes') for i in range(4)]
+        # Not ours
+        self.state.add('other', 3, 'others')
+        self.backend = LinodeAPI(url=self.server.url)
+        self.backend.group = 'ynodes'
+        self.clock = VirtualClock(1000)
+        self.state_file = os.path.join(self.workdir, 'inventory.json')
+        self.stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+
+    def tearDown(self):
+        sys.stdout.close()
+        sys.stdout = self.stdout
+        self.backend.close()
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def inventory(self, ttl=600.0):
+        return Inventory(self.backend, group='ynodes', ttl=ttl, state_file=self.state_file, clock=self.clock)
+
+    def lookups(self):
+        return self.state.calls.get('linode.list', 0)
+
+    def test_hits_and_misses(self):
+        inventory = self.inventory()
+        self.assertEqual(len(inventory.list_nodes()), 4)
+        self.assertEqual(self.lookups(), 1)
+
+        self.assertEqual(inventory.get_label(self.ids[0]), 'ynode1')
+        self.assertEqual(inventory.get_proxy_id(self.state.ips[self.ids[1]]), self.ids[1])
+        # Answered from the cache
+        self.assertEqual(self.lookups(), 1)
+        self.assertEqual(inventory.counters['hits'], 2)
+
+        self.assertEqual(inventory.get_proxy_id('192.0.2.1'), None)
+        self.assertEqual(inventory.counters['misses'], 1)
+        # A fresh label goes to the API and updates the cache
+        self.state.linodes[self.ids[2]]['LABEL'] = 'renamed'
+        self.assertEqual(inventory.get_label(self.ids[2], fresh=True), 'renamed')
+        self.assertEqual(inventory.counters['misses'], 2)
+        self.assertEqual(self.lookups(), 2)
+        self.assertEqual(inventory.get_label(self.ids[2]), 'renamed')
+        self.assertEqual(self.lookups(), 2)
+
+    def test_refresh_when_stale(self):
+        inventory = self.inventory(ttl=600.0)
+        self.assertTrue(inventory.stale())
+        inventory.list_nodes()
+        self.assertEqual((inventory.counters['stale'], inventory.counters['refreshes']), (1, 1))
+
+        self.clock.advance(599)
+        inventory.list_nodes()
+        self.assertEqual(inventory.counters['refreshes'], 1)
+        self.assertEqual(inventory.age(), 599)
+
+        # Changes made behind our back show up once the TTL is over
+        self.state.add('ynode5', 4, 'ynodes')
+        self.clock.advance(1)
+        self.assertEqual(len(inventory.list_nodes()), 5)
+        self.assertEqual((inventory.counters['stale'], inventory.counters['refreshes']), (2, 2))
+        self.assertEqual(self.lookups(), 2)
+
+    def test_write_through(self):
+        inventory = self.inventory()
+        inventory.list_nodes()
+
+        node = inventory.create_node(3, 1, 140, 1121781, 'proxy_disk', 'secret')
+        self.assertEqual(inventory.get_proxy_id(node.ip), node.id)
+        self.assertEqual(inventory.unassigned(), [node])
+
+        inventory.linode_update(node.id, 'ynode9', 'ynodes')
+        inventory.linode_delete(self.ids[0])
+        self.assertEqual(inventory.counters['writes'], 3)
+        self.assertEqual(inventory.get_label(node.id), 'ynode9')
+        labels = sorted(n.label for n in inventory.list_nodes())
+        self.assertEqual(labels, ['ynode2', 'ynode3', 'ynode4', 'ynode9'])
+        # No lookups beyond the first refresh
+        self.assertEqual(self.lookups(), 1)
+        # The cache agrees with the API
+        self.assertEqual(sorted(n.label for n in self.backend.list_nodes()), labels)
+
+        # The state file is written through as well, and a restart within
+        # the TTL uses it without a refresh
+        restarted = self.inventory()
+        self.assertFalse(restarted.stale())
+        self.assertEqual(sorted(n.label for n in restarted.list_nodes()), labels)
+        self.assertEqual(restarted.counters['refreshes'], 0)
+        self.assertEqual(self.lookups(), 2)
+
+    def test_unassigned_dropped_when_gone(self):
+        inventory = self.inventory()
+        inventory.list_nodes()
+        kept = inventory.create_node(3, 1, 140, 1121781, 'proxy_disk', 'secret')
+        gone = inventory.create_node(3, 1, 140, 1121781, 'proxy_disk', 'secret')
+        # Deleted behind our back
+        self.backend.linode_delete(gone.id)
+
+        self.clock.advance(600)
+        inventory.list_nodes()
+        self.assertEqual(inventory.unassigned(), [kept])
+        self.assertEqual(inventory.get_proxy_id(gone.ip), None)
+        self.assertEqual(inventory.counters['gone'], 1)
+
+        # Kept while the backend cannot tell
+        def broken(linode_id):
+            raise IOError('API down')
+        self.backend.linode_exists = broken
+        self.clock.advance(600)
+        inventory.list_nodes()
+        self.assertEqual(inventory.unassigned(), [kept])
+
+if __name__ == '__main__':
+    unittest.main()
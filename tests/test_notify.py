@@ -0,0 +1,121 @@
+""" Tests for the notification queue, against the fake SMTP server """
+
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import tempfile
+import unittest
+
+from fake_smtp import FakeSMTPServer
+from notify import Notifier, SMTPTransport
+
+def wait_for(condition, timeout=10.0):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.02)
+    return condition()
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+class NotifierTest(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix='notifytest')
+        self.spool = os.path.join(self.workdir, 'notify.spool')
+        self.server = FakeSMTPServer().start()
+        self.stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+
+    def tearDown(self):
+        sys.stdout.close()
+        sys.stdout = self.stdout
+        self.server.stop()
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def notifier(self, port=None, **kwargs):
+        transport = SMTPTransport('127.0.0.1', port or self.server.port)
+        return Notifier(transport, 'proxy@example.com', ['ops@example.com'], spool=self.spool, **kwargs)
+
+    def spooled(self):
+        return [json.loads(line)['body'] for line in open(self.spool)]
+
+    def test_window_coalesces(self):
+        notifier = self.notifier(window=0.5)
+        for i in range(3):
+            notifier.notify('rotate', 'Switched proxy %d' % i)
+        self.assertTrue(wait_for(lambda: not notifier.pending and not self.spooled()))
+        self.assertEqual(len(self.server.messages), 1)
+        data = self.server.messages[0][2]
+        self.assertIn('(3 events)', data)
+        self.assertIn('Digest of 3 events: 3 rotate', data)
+        self.assertEqual(self.spooled(), [])
+
+        # A later event goes out on its own, over the same connection
+        notifier.notify('ban', 'Proxy banned')
+        self.assertTrue(wait_for(lambda: notifier.digests == 2 and not notifier.pending))
+        self.assertNotIn('events)', self.server.messages[1][2])
+        self.assertEqual(notifier.stats(), {'pending': 0, 'sent': 4, 'digests': 2, 'failures': 0})
+        self.assertEqual((notifier.transport.connects, self.server.connections), (1, 1))
+        notifier.close()
+
+    def test_spool_survives_restart(self):
+        notifier = self.notifier(window=60.0)
+        notifier.notify('rotate', 'Switched proxy 1')
+        notifier.notify('rotate', 'Switched proxy 2')
+        # Die without delivering, the worker still waiting on the window
+        with notifier.cond:
+            notifier.running = False
+            notifier.cond.notify_all()
+        notifier.thread.join()
+        # A line cut short by the crash
+        open(self.spool, 'a').write('{"ts": 1')
+        self.assertEqual(self.server.messages, [])
+
+        restarted = self.notifier(window=60.0)
+        self.assertEqual([e['body'] for e in restarted.pending], ['Switched proxy 1', 'Switched proxy 2'])
+        restarted.close()
+        self.assertEqual(len(self.server.messages), 1)
+        self.assertIn('Switched proxy 2', self.server.messages[0][2])
+        self.assertEqual(self.spooled(), [])
+
+    def test_failed_delivery_kept_and_retried(self):
+        # Nothing listens on the port at first
+        notifier = self.notifier(port=free_port(), window=0, retry_backoff=1.0)
+        notifier.notify('rotate', 'Switched proxy 1')
+        self.assertTrue(wait_for(lambda: notifier.failures == 1))
+        failed = time.time()
+        self.assertEqual(self.spooled(), ['Switched proxy 1'])
+        self.assertEqual(len(notifier.pending), 1)
+
+        notifier.transport.port = self.server.port
+        self.assertTrue(wait_for(lambda: not notifier.pending and not self.spooled()))
+        # Retried after the backoff, not before
+        self.assertGreaterEqual(time.time() - failed, 0.9)
+        self.assertEqual((notifier.failures, notifier.digests), (1, 1))
+        self.assertEqual(len(self.server.messages), 1)
+        self.assertEqual(self.spooled(), [])
+        notifier.close()
+
+    def test_reconnect_on_dropped_connection(self):
+        transport = SMTPTransport('127.0.0.1', self.server.port)
+        transport.send('proxy@example.com', ['ops@example.com'], 'first', 'First')
+        # The server restarts, dropping the open connection
+        port = self.server.port
+        self.server.stop()
+        self.server = FakeSMTPServer(port=port).start()
+
+        transport.send('proxy@example.com', ['ops@example.com'], 'second', 'Second')
+        self.assertEqual(transport.connects, 2)
+        self.assertEqual(len(self.server.messages), 1)
+        self.assertIn('Subject: second', self.server.messages[0][2])
+        transport.close()
+
+if __name__ == '__main__':
+    unittest.main()
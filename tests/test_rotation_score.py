@@ -0,0 +1,78 @@
+""" Tests for the score based rotation policies """
+
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+
+import rotation_score
+from rotation_score import RotationScorer
+from rotate_proxies import ProxyConfig
+from simulator import make_config
+
+class FakeSource(object):
+    """ A metric source recording whether the state lock was free while it
+    prepared """
+
+    def __init__(self, config, metrics):
+        self.config = config
+        self.values = metrics
+        self.lock_free = []
+
+    def prepare(self, records):
+        # Try the state lock from another thread, as the ban detector would
+        def attempt():
+            acquired = self.config.lock.acquire(False)
+            if acquired:
+                self.config.lock.release()
+            self.lock_free.append(acquired)
+        t = threading.Thread(target=attempt)
+        t.start()
+        t.join()
+
+    def metrics(self, ip):
+        return self.values.get(ip, {})
+
+class FailingSource(object):
+    def prepare(self, records):
+        raise AssertionError('Metrics collected again under the state lock')
+
+    def metrics(self, ip):
+        raise AssertionError('Metrics collected again under the state lock')
+
+class RotationScoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix='scoretest')
+        path, settings = make_config(self.workdir, 'ROTATION_SCORE', 3, 72.0, 0, 1, 300)
+        now = int(time.time())
+        open(settings['proxylist'], 'w').write(''.join('10.0.0.%d,%d,%d,%d,%d\n' % (i, region, 100 + i, now, now)
+                                                       for i, region in ((1, 3), (2, 4), (3, 6))))
+        self.config = ProxyConfig(path)
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def test_metrics_collected_without_the_state_lock(self):
+        source = FakeSource(self.config, {'10.0.0.2': {'errors': 0.9}})
+        self.config.scorer = RotationScorer(sources=[source])
+        metrics = self.config.collect_metrics()
+        self.assertEqual(source.lock_free, [True])
+        self.assertEqual(metrics['10.0.0.2'], {'errors': 0.9})
+
+    def test_selection_uses_the_collected_metrics(self):
+        self.config.scorer = RotationScorer(sources=[FailingSource()])
+        metrics = {'10.0.0.3': {'errors': 0.8, 'latency': 900.0}, '10.0.0.1': {'latency': 100.0}}
+        proxy = self.config.get_proxy_for_rotation(scored=True, input_region=3, metrics=metrics)
+        self.assertEqual(proxy, '10.0.0.3')
+
+    def test_score_policy_beats_lru_in_simulation(self):
+        results = rotation_score.simulate(nodes=40, rotations=600)
+        lru, scored = results['lru_new_region'], results['score_new_region']
+        # More aggregate throughput from fewer throttled nodes
+        self.assertGreater(scored[0], lru[0] * 1.1)
+        self.assertLess(scored[1], lru[1])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,108 @@
+""" Tests for the multiplexed ssh sessions, against the fake_ssh stand-in """
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import unittest
+
+import ssh_session
+from ssh_session import SessionManager
+
+fake_ssh = os.path.join(os.path.dirname(os.path.abspath(ssh_session.__file__)), 'fake_ssh.py')
+
+class SessionManagerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix='sshtest')
+        self.handshake = os.environ.get('FAKE_SSH_HANDSHAKE')
+        os.environ['FAKE_SSH_HANDSHAKE'] = '0.05'
+        self.manager = SessionManager(user='ubuntu', ssh_cmd=[sys.executable, fake_ssh],
+                                      control_dir=os.path.join(self.workdir, 'mux'), idle_timeout=60)
+        self.stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+
+    def tearDown(self):
+        sys.stdout.close()
+        sys.stdout = self.stdout
+        self.manager.close_all()
+        if self.handshake == None:
+            del os.environ['FAKE_SSH_HANDSHAKE']
+        else:
+            os.environ['FAKE_SSH_HANDSHAKE'] = self.handshake
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def test_master_reused(self):
+        session = self.manager.session('10.0.0.1')
+        # Commands run as children of the master, so share a parent pid
+        first = session.run_batch(['echo $PPID', 'echo $PPID'])
+        second = self.manager.run('10.0.0.1', ['echo $PPID'])
+        parents = set(r.stdout.strip() for r in first + second)
+        self.assertTrue(all(r.ok for r in first + second))
+        self.assertEqual(len(parents), 1)
+        self.assertNotIn(str(os.getpid()), parents)
+        self.assertTrue(session.is_open())
+        self.assertEqual(self.manager.session('10.0.0.1'), session)
+        self.assertEqual((self.manager.opened, session.commands), (1, 3))
+
+    def test_exit_status_and_stop_on_error(self):
+        results = self.manager.run('10.0.0.1', ['true', 'echo oops >&2; exit 3', 'echo after'])
+        self.assertEqual([r.status for r in results], [0, 3, 0])
+        self.assertEqual((results[1].ok, results[1].stderr), (False, 'oops\n'))
+        self.assertEqual(results[2].stdout, 'after\n')
+
+        results = self.manager.run('10.0.0.1', ['true', 'exit 3', 'echo after'], stop_on_error=True)
+        self.assertEqual([r.status for r in results], [0, 3, ssh_session.timeout_status])
+        # The command after the failure never ran
+        self.assertEqual(results[2].stdout, '')
+        self.assertEqual(self.manager.session('10.0.0.1').commands, 5)
+
+    def test_timeout(self):
+        start = time.time()
+        result, after = self.manager.run('10.0.0.1', ['sleep 3', 'echo alive'], timeout=0.5)
+        self.assertTrue(time.time() - start < 2.5)
+        self.assertTrue(result.timed_out)
+        self.assertEqual(result.status, ssh_session.timeout_status)
+        # The session is still usable
+        self.assertEqual((after.ok, after.stdout), (True, 'alive\n'))
+
+    def test_batch_mode(self):
+        self.assertIn('BatchMode=yes', self.manager.session('10.0.0.1').base_args())
+        interactive = SessionManager(ssh_cmd=[sys.executable, fake_ssh], control_dir=self.manager.control_dir,
+                                     batch_mode=False)
+        session = interactive.session('10.0.0.2')
+        self.assertNotIn('BatchMode=yes', session.base_args())
+        self.assertEqual(session.run('echo hello').stdout, 'hello\n')
+        interactive.close_all()
+
+    def test_push(self):
+        local = os.path.join(self.workdir, 'squid.conf')
+        remote = os.path.join(self.workdir, 'pushed.conf')
+        open(local, 'w').write('http_port 8321\n')
+        result = self.manager.session('10.0.0.1').push(local, remote, mode=0600)
+        self.assertTrue(result.ok)
+        self.assertEqual(open(remote).read(), 'http_port 8321\n')
+        self.assertEqual(os.stat(remote).st_mode & 0777, 0600)
+        self.assertFalse(os.path.exists(remote + '.tmp'))
+
+    def test_evict_idle(self):
+        self.manager.run('10.0.0.1', ['true'])
+        self.manager.run('10.0.0.2', ['true'])
+        path = self.manager.session('10.0.0.1').control_path
+        self.assertTrue(os.path.exists(path))
+        self.assertEqual(self.manager.evict_idle(), [])
+
+        self.manager.sessions['10.0.0.2'].last_used = time.time() - 120
+        self.assertEqual(self.manager.evict_idle(), ['10.0.0.2'])
+        self.assertEqual(sorted(self.manager.sessions), ['10.0.0.1'])
+        self.assertEqual(self.manager.stats(), {'sessions': 1, 'opened': 2, 'evicted': 1})
+
+        self.assertEqual(self.manager.evict_idle(time.time() + 120), ['10.0.0.1'])
+        # The master was told to exit and removes its socket
+        deadline = time.time() + 5
+        while os.path.exists(path) and time.time() < deadline:
+            time.sleep(0.05)
+        self.assertFalse(os.path.exists(path))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,271 @@
+"""
+
+Phase timing for the rotation daemon.
+
+Code marks phases with `with timing.span('rotate.update_lb'):` or the
+@timing.timed decorator. Durations are kept in process as cumulative
+histograms, served in the Prometheus text format over HTTP and dumped
+as JSON on SIGUSR2.
+
+Timing is off unless enabled in the "timing" section of proxy.conf. When
+off span() hands back one shared no-op context manager, so an
+instrumented phase costs a function call and a global lookup.
+
+Run with --bench to measure the per-span overhead, enabled and disabled.
+
+"""
+
+import os
+import json
+import time
+import bisect
+import signal
+import argparse
+import threading
+import functools
+import BaseHTTPServer
+
+# Upper bounds of the histogram buckets in seconds - phases range from
+# admin socket commands to linode boots
+buckets = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0)
+
+enabled = False
+# Phase name => Histogram
+registry = {}
+lock = threading.Lock()
+
+class Histogram(object):
+    """ Cumulative duration histogram of one phase """
+
+    __slots__ = ('counts', 'count', 'total', 'max')
+
+    def __init__(self):
+        # The last count is for durations above every bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(buckets, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def quantile(self, q):
+        """ Return the upper bound of the bucket holding quantile q, capped
+        at the largest duration seen """
+
+        target, seen = q * self.count, 0
+        for idx, n in enumerate(self.counts):
+            seen += n
+            if n and seen >= target:
+                return min(buckets[idx], self.max) if idx < len(buckets) else self.max
+        return None
+
+    def to_dict(self):
+        return {'count': self.count, 'sum': round(self.total, 6), 'max': round(self.max, 6),
+                'mean': round(self.total / self.count, 6) if self.count else None,
+                'p50': self.quantile(0.5), 'p95': self.quantile(0.95),
+                'buckets': dict(zip(map(str, buckets) + ['+Inf'], self.counts))}
+
+def observe(name, seconds):
+    """ Record a duration for a phase, unless timing is disabled """
+
+    if not enabled:
+        return
+    with lock:
+        hist = registry.get(name)
+        if hist == None:
+            hist = registry[name] = Histogram()
+        hist.observe(seconds)
+
+class Span(object):
+    """ Time the enclosed block as one phase """
+
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *args):
+        # Failed phases are timed too
+        observe(self.name, time.time() - self.start)
+        return False
+
+class NullSpan(object):
+    """ Stand-in span when timing is disabled """
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+null_span = NullSpan()
+
+def span(name):
+    """ Return a context manager timing a phase, a no-op when disabled """
+
+    if not enabled:
+        return null_span
+    return Span(name)
+
+def timed(name):
+    """ Decorator timing every call of a function as a phase """
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return func(*args, **kwargs)
+            start = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                observe(name, time.time() - start)
+        return wrapper
+    return decorator
+
+def snapshot():
+    """ Return {phase: histogram dict} of everything timed so far """
+
+    with lock:
+        return dict((name, hist.to_dict()) for name, hist in registry.items())
+
+def render_prometheus(prefix='rotator'):
+    """ Render the histograms in the Prometheus text exposition format """
+
+    metric = prefix + '_phase_seconds'
+    lines = ['# HELP %s Duration of rotation daemon phases.' % metric,
+             '# TYPE %s histogram' % metric]
+    with lock:
+        for name in sorted(registry):
+            hist, cumulative = registry[name], 0
+            for bound, n in zip(map(repr, buckets) + ['+Inf'], hist.counts):
+                cumulative += n
+                lines.append('%s_bucket{phase="%s",le="%s"} %d' % (metric, name, bound, cumulative))
+            lines.append('%s_sum{phase="%s"} %.6f' % (metric, name, hist.total))
+            lines.append('%s_count{phase="%s"} %d' % (metric, name, hist.count))
+    return '\n'.join(lines) + '\n'
+
+def dump_json(path):
+    """ Write the histograms as JSON to path """
+
+    data = {'pid': os.getpid(), 'time': int(time.time()), 'phases': snapshot()}
+    f = open(path, 'w')
+    json.dump(data, f, indent=4, sort_keys=True)
+    f.close()
+    print 'Dumped phase timings to',path
+
+def report():
+    """ Print a table of the phases timed so far """
+
+    phases = snapshot()
+    if not phases:
+        return
+    print '%-28s %6s %10s %10s %10s %10s' % ('phase', 'count', 'mean', 'p95', 'max', 'total')
+    for name in sorted(phases):
+        p = phases[name]
+        print '%-28s %6d %10.3f %10.3f %10.3f %10.3f' % (name, p['count'], p['mean'], p['p95'], p['max'], p['sum'])
+
+class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """ Serve /metrics (Prometheus text) and /metrics.json """
+
+    def do_GET(self):
+        if self.path == '/metrics':
+            body, ctype = render_prometheus(), 'text/plain; version=0.0.4'
+        elif self.path == '/metrics.json':
+            body, ctype = json.dumps(snapshot(), sort_keys=True), 'application/json'
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', ctype)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_server(port, host='127.0.0.1'):
+    """ Serve the metrics endpoint from a background thread """
+
+    server = BaseHTTPServer.HTTPServer((host, port), MetricsHandler)
+    t = threading.Thread(target=server.serve_forever, name='metrics')
+    t.daemon = True
+    t.start()
+    print 'Serving phase timings on http://%s:%d/metrics' % (host, server.server_port)
+    return server
+
+def setup(settings):
+    """ Enable timing as configured by the "timing" section of proxy.conf
+    and dump JSON on SIGUSR2. Must be called from the main thread. """
+
+    global enabled
+
+    enabled = bool(settings.get('enabled', False))
+    if enabled:
+        dump_file = settings.get('dump_file', 'timings.json')
+        signal.signal(signal.SIGUSR2, lambda signum, stack: dump_later(dump_file))
+
+def dump_later(path):
+    """ Dump from a thread of its own. A signal handler runs in the main
+    thread, which may be inside observe() holding the registry lock. """
+
+    t = threading.Thread(target=dump_json, args=(path,), name='timing-dump')
+    t.daemon = True
+    t.start()
+
+def serve(settings, port_key='port'):
+    """ Start the metrics endpoint if timing is enabled and the port is
+    configured. Call after daemonizing. Returns the server, if any. """
+
+    if enabled and settings.get(port_key):
+        return start_server(int(settings[port_key]), settings.get('host', '127.0.0.1'))
+    return None
+
+def benchmark(rounds):
+    """ Measure the cost of a span, disabled and enabled """
+
+    global enabled
+
+    def run():
+        start = time.time()
+        for i in xrange(rounds):
+            with span('bench'):
+                pass
+        return (time.time() - start) / rounds
+
+    def bare():
+        start = time.time()
+        for i in xrange(rounds):
+            pass
+        return (time.time() - start) / rounds
+
+    base = bare()
+    enabled = False
+    off = run()
+    enabled = True
+    on = run()
+    enabled = False
+
+    print 'Spans: %d' % rounds
+    print 'Disabled: %6.3f us per span' % ((off - base) * 1e6)
+    print 'Enabled:  %6.3f us per span' % ((on - base) * 1e6)
+    print 'bench =>',registry['bench'].to_dict()['count'],'observations'
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog='timing')
+    parser.add_argument('--bench',help='Benchmark the given number of spans', type=int, default=1000000)
+    args = parser.parse_args()
+
+    benchmark(args.bench)
@@ -4,7 +4,10 @@ import os
 import sys
 import pwd
 import uuid
+import time
 import functools
+import threading
+import collections
 
 def enum(*sequential, **named):
     enums = dict(zip(sequential, range(len(sequential))), **named)
@@ -14,6 +17,68 @@ def randpass():
     """ Return a random password """
     return uuid.uuid4().bytes.encode('base64')[:16]
 
+def retry(func, args=(), attempts=3, backoff=10.0, factor=2.0, label='', clock=None):
+    """ Call func(*args), retrying on any exception with exponential backoff.
+    Returns (result, number of attempts made), re-raises the last error """
+
+    for attempt in range(1, attempts + 1):
+        try:
+            return func(*args), attempt
+        except Exception, e:
+            if attempt == attempts:
+                raise
+            delay = backoff * (factor ** (attempt - 1))
+            print 'Attempt',attempt,'of',label or func.__name__,'failed:',e,'- retrying in',delay,'seconds'
+            (clock or time).sleep(delay)
+
+def synchronized(func):
+    """ Method decorator holding self.lock for the duration of the call """
+
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        with self.lock:
+            return func(self, *args, **kwargs)
+    return wrapper
+
+class RateLimiter(object):
+    """ Thread-safe token bucket allowing `rate` calls per `per` seconds """
+
+    def __init__(self, rate, per=60.0, burst=None, clock=None):
+        self.rate = float(rate)
+        self.per = float(per)
+        self.capacity = float(burst or rate)
+        self.tokens = self.capacity
+        # Anything with time() and sleep(), e.g. a VirtualClock
+        self.clock = clock or time
+        self.stamp = self.clock.time()
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate / self.per)
+        self.stamp = now
+
+    def try_acquire(self):
+        """ Take a token if one is available, return whether it was taken """
+
+        with self.lock:
+            self._refill(self.clock.time())
+            if self.tokens >= 1.0:
+                self.tokens -= 1.0
+                return True
+            return False
+
+    def acquire(self):
+        """ Block until a token is available and take it """
+
+        while True:
+            with self.lock:
+                self._refill(self.clock.time())
+                if self.tokens >= 1.0:
+                    self.tokens -= 1.0
+                    return
+                wait = (1.0 - self.tokens) * self.per / self.rate
+            self.clock.sleep(wait)
+
 class Log(object):
     """A dead-simple, stupid logging class """
 
@@ -94,12 +159,23 @@ def daemonize(pidfile, logfile=None, user='ubuntu', drop=True):
         sys.stdin.close()
         sys.stdout=sys.stderr=log
 
+class LinodeNode(collections.namedtuple('LinodeNode', 'id label ip region status group')):
+    """ Structured view of a linode as returned by the linode backends """
+
+    __slots__ = ()
+
+    def csv(self):
+        """ Return the node as a line of proxies.list """
+
+        return '%s,%d,%d,0,0' % (self.ip, self.region, self.id)
+
 class LinodeCommand(object):
     """ Class encapsulating linode CLI commands """
 
     def __init__(self, binary='linode', verbose=False, config=None):
         self.binary = binary
         self.verbose = verbose
+        self.group = config.group
         self.cmd_template = {'create': 'create -d %d -p %d -o %d -i %d -l %s -r %s',
                              'delete': 'delete -l %d',
                              'list_proxies': 'find -g %s -s %s' % (config.group, config.proxylb),
@@ -136,6 +212,43 @@ class LinodeCommand(object):
         data = self.linode_info(linode_id)
         return data.split('\n')[0].split(':')[-1].strip()
 
+    def node_status(self, linode_id):
+        """ Return 1 if the linode is running, 0 if not, None if the
+        output has no status """
+
+        for line in self.linode_info(linode_id).split('\n'):
+            key, sep, value = line.partition(':')
+            if sep and key.strip().lower() == 'status':
+                return int(value.strip().lower() in ('running', '1'))
+        return None
+
+    def linode_exists(self, linode_id):
+        """ Return whether a linode of the given id exists """
+
+        return 'not found' not in self.linode_info(linode_id).lower()
+
+    def create_node(self, region, plan_id, os_id, image_id, label, passwd):
+        """ Create a linode and return it as a LinodeNode """
+
+        data = self.linode_create(region, plan_id, os_id, image_id, label, passwd)
+        if self.verbose: print data
+        lines = data.strip().split('\n')
+        # The IP is the last line of the command, the id two lines above
+        ip = lines[-1].strip().split()[-1].strip()
+        pid = lines[-3].strip().split()[-1].strip()
+        return LinodeNode(int(pid), label, ip, int(region), None, None)
+
+    def list_nodes(self):
+        """ Return the proxy linodes as a list of LinodeNode """
+
+        nodes = []
+        for item in self.linode_list_proxies().split('\n'):
+            if item.strip() == "": continue
+            ip, dc, lid, si, so = item.split(',')
+            nodes.append(LinodeNode(int(lid), None, ip.strip(), int(dc), None, self.group))
+
+        return nodes
+
 if __name__ == "__main__":
     l = LinodeCommand()
     l.get_label(int(sys.argv[1]))